@@ -0,0 +1,37 @@
+"""
+Benchmark inserting and replacing search entries.
+
+Usage: python benchmarks/search_insert.py [count]
+
+Inserts C{count} (default 20000) exact search entries in a single transaction
+against an in-memory store, then inserts them all again with new search
+values, and reports the throughput of each pass.
+"""
+import sys
+import time
+
+from axiom.store import Store
+
+from fusion_index.search import SearchClasses, SearchEntry
+
+
+
+def _insert(store, count, suffix):
+    for i in xrange(count):
+        SearchEntry.insert(
+            store, SearchClasses.EXACT, u'e', u'i', u'result{:d}'.format(i),
+            u'type', u'value {:d} {}'.format(i, suffix))
+
+
+
+def main(count=20000):
+    store = Store()
+    for label, suffix in [('insert', u'a'), ('update', u'b')]:
+        start = time.time()
+        store.transact(_insert, store, count, suffix)
+        print('{}: {:.0f}/s'.format(label, count / (time.time() - start)))
+
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,67 @@
+"""
+Benchmark upgrading lookup and search entries from their oldest versions.
+
+Usage: python benchmarks/upgrade_entries.py [count]
+
+Creates C{count} (default 5000) version 1 lookup entries and version 1 search
+entries in a temporary store, reopens it, sets every tenth lookup key and
+inserts every tenth search entry again before they are upgraded, then upgrades
+the whole store and reports the throughput.
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+from axiom.item import declareLegacyItem
+from axiom.store import Store
+
+from fusion_index.lookup import LookupEntry
+from fusion_index.search import SearchClasses, SearchEntry
+
+
+
+def _create(store, count):
+    OldLookup = declareLegacyItem(LookupEntry.typeName, 1, {})
+    OldSearch = declareLegacyItem(SearchEntry.typeName, 1, {})
+    for i in xrange(count):
+        OldLookup(
+            store=store, environment=u'e', indexType=u't',
+            key=u'key{:d}'.format(i), value=b'value {:d}'.format(i))
+        OldSearch(
+            store=store, searchClass=u'exact', environment=u'e',
+            indexType=u'i', result=u'result{:d}'.format(i),
+            searchType=u'type', searchValue=u'value {:d}'.format(i))
+
+
+
+def _supersede(store, count):
+    for i in xrange(0, count, 10):
+        LookupEntry.set(
+            store, u'e', u't', u'key{:d}'.format(i), b'new {:d}'.format(i))
+        SearchEntry.insert(
+            store, SearchClasses.EXACT, u'e', u'i', u'result{:d}'.format(i),
+            u'type', u'new {:d}'.format(i))
+
+
+
+def main(count=5000):
+    path = tempfile.mkdtemp()
+    try:
+        store = Store(path + '/index.axiom')
+        store.transact(_create, store, count)
+        store.close()
+
+        store = Store(path + '/index.axiom')
+        store.transact(_supersede, store, count)
+        start = time.time()
+        for _ in store._upgradeManager.upgradeBatch(100):
+            pass
+        print('upgrade: {:.0f}/s'.format(2 * count / (time.time() - start)))
+    finally:
+        shutil.rmtree(path)
+
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -15,6 +15,7 @@ setup(
         'Twisted[tls] >= 15.0.0',
         'txspinneret >= 0.1.2',
         'Axiom >= 0.7.4',
+        'Epsilon',
         'eliot >= 0.8.0',
         'testtools',
         'characteristic',
@@ -0,0 +1,251 @@
+"""
+Admission control for the index service.
+
+L{AdmissionControl} limits the number of requests in flight at once, with
+separate limits for reads and writes. Requests beyond the limits wait in a
+bounded queue, in which reads are admitted before writes, and displace writes
+when it is full; requests that would overflow the queue, or wait for too long
+since they arrived, are rejected with a C{503 Service Unavailable} response,
+so that the service stays responsive to the requests it does admit while it is
+overloaded.
+"""
+from collections import deque
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+from twisted.web import http
+from twisted.web.resource import IResource, getChildForRequest
+from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
+
+from fusion_index.metrics import (
+    METRIC_ADMISSION_IN_FLIGHT, METRIC_ADMISSION_QUEUE_DEPTH,
+    METRIC_ADMISSION_SHED)
+from fusion_index.timing import requestTimings, stage
+
+
+
+_KINDS = [u'read', u'write']
+
+
+
+# The path segments of the POST requests that only read the indexes, with
+# None matching any segment: looking up several lookup entries, and searching
+# several search indexes.
+_READ_POSTS = [
+    [b'lookup', None, None],
+    [b'search']]
+
+
+
+def _isReadPost(postpath):
+    """
+    Determine whether a POST request only reads the indexes.
+    """
+    return any(
+        len(postpath) == len(segments) and
+        all(s is None or s == p for s, p in zip(segments, postpath))
+        for segments in _READ_POSTS)
+
+
+
+@implementer(IResource)
+@attributes(
+    ['resource',
+     Attribute('maxReads', default_value=None),
+     Attribute('maxWrites', default_value=None),
+     Attribute('maxQueued', default_value=256),
+     Attribute('maxQueueTime', default_value=1.0),
+     Attribute('retryAfter', default_value=1),
+     Attribute(
+         'exempt',
+         default_factory=lambda: frozenset(
+             [b'metrics', b'ready', b'changes', b'admin'])),
+     Attribute('clock', default_value=reactor)])
+class AdmissionControl(object):
+    """
+    Admit requests to C{resource}, at most C{maxReads} reads (C{GET} and
+    C{HEAD} requests, and C{POST} requests that look up or search several
+    entries at once), and C{maxWrites} other requests, at once; C{None} means
+    no limit.
+
+    Up to C{maxQueued} requests wait to be admitted, until C{maxQueueTime}
+    seconds after they arrived (or, for requests that do not record their
+    arrival, were queued); other requests are rejected, asking the client to
+    retry after C{retryAfter} seconds. Requests for resources whose
+    first path segment is in C{exempt}, such as metrics and long polls, are
+    always admitted at once, and are not counted.
+    """
+    isLeaf = True
+    _inFlight = None
+    _queues = None
+    _dispatching = False
+
+    def getChildWithDefault(self, name, request):
+        raise NotImplementedError('AdmissionControl is a leaf resource')
+
+
+    def putChild(self, path, child):
+        raise NotImplementedError('AdmissionControl is a leaf resource')
+
+
+    def _limit(self, kind):
+        if kind == u'read':
+            return self.maxReads
+        return self.maxWrites
+
+
+    def _available(self, kind):
+        """
+        Whether another request of a kind can be admitted.
+        """
+        limit = self._limit(kind)
+        return limit is None or self._inFlight[kind] < limit
+
+
+    def render(self, request):
+        if self._inFlight is None:
+            self._inFlight = {kind: 0 for kind in _KINDS}
+            self._queues = {kind: deque() for kind in _KINDS}
+        if request.postpath[:1] and request.postpath[0] in self.exempt:
+            self._render(request)
+            return NOT_DONE_YET
+        kind = u'write'
+        if request.method in (b'GET', b'HEAD') or (
+                request.method == b'POST' and _isReadPost(request.postpath)):
+            kind = u'read'
+        now = self.clock.seconds()
+        age = now - getattr(request, 'received', now)
+        if age >= self.maxQueueTime:
+            return self._reject(request, kind, u'timeout')
+        if self._available(kind) and not self._queues[kind]:
+            self._admit(request, kind)
+            return NOT_DONE_YET
+        if sum(len(queue) for queue in self._queues.values()) >= (
+                self.maxQueued):
+            if kind == u'write' or not self._queues[u'write']:
+                return self._reject(request, kind, u'queue-full')
+            self._shed(self._queues[u'write'].pop(), u'queue-full')
+        entry = [request, kind, now, None]
+        entry[3] = self.clock.callLater(
+            self.maxQueueTime - age, self._expire, entry)
+        self._queues[kind].append(entry)
+        self._publish(kind)
+        request.notifyFinish().addBoth(self._abandon, entry)
+        return NOT_DONE_YET
+
+
+    def _render(self, request):
+        """
+        Locate the resource for a request, and render it.
+        """
+        with requestTimings(request):
+            try:
+                with stage(u'route'):
+                    resource = getChildForRequest(self.resource, request)
+                request.render(resource)
+            except Exception:
+                request.processingFailed(Failure())
+
+
+    def _admit(self, request, kind):
+        """
+        Admit a request, counting it as in flight until it finishes.
+        """
+        self._inFlight[kind] += 1
+        self._publish(kind)
+        request.notifyFinish().addBoth(self._release, kind)
+        self._render(request)
+
+
+    def _release(self, result, kind):
+        """
+        Stop counting a finished request as in flight, and admit waiting
+        requests.
+        """
+        self._inFlight[kind] -= 1
+        self._publish(kind)
+        self._dispatch()
+
+
+    def _dispatch(self):
+        """
+        Admit waiting requests, reads first, while there is room for them.
+        """
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            admitted = True
+            while admitted:
+                admitted = False
+                for kind in _KINDS:
+                    if self._queues[kind] and self._available(kind):
+                        request, _, queued, timeout = (
+                            self._queues[kind].popleft())
+                        timeout.cancel()
+                        self._publish(kind)
+                        timings = getattr(request, 'timings', None)
+                        if timings is not None:
+                            timings.add(
+                                u'queue', self.clock.seconds() - queued)
+                        self._admit(request, kind)
+                        admitted = True
+                        break
+        finally:
+            self._dispatching = False
+
+
+    def _expire(self, entry):
+        """
+        Reject a request that has waited too long to be admitted.
+        """
+        self._queues[entry[1]].remove(entry)
+        self._shed(entry, u'timeout')
+
+
+    def _shed(self, entry, reason):
+        """
+        Reject a request removed from the queue.
+        """
+        request, kind, _, timeout = entry
+        if timeout.active():
+            timeout.cancel()
+        self._publish(kind)
+        request.write(self._reject(request, kind, reason))
+        request.finish()
+
+
+    def _abandon(self, result, entry):
+        """
+        Stop waiting to admit a request whose client has gone away.
+        """
+        request, kind, _, timeout = entry
+        if entry in self._queues[kind]:
+            self._queues[kind].remove(entry)
+            timeout.cancel()
+            self._publish(kind)
+
+
+    def _reject(self, request, kind, reason):
+        """
+        Reject a request because the service is overloaded.
+
+        @return: The response body.
+        """
+        METRIC_ADMISSION_SHED.labels(kind, reason).inc()
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader(b'Retry-After', b'{:d}'.format(self.retryAfter))
+        request.setHeader(b'Content-Type', b'text/plain')
+        return b'Service overloaded, try again later'
+
+
+    def _publish(self, kind):
+        METRIC_ADMISSION_IN_FLIGHT.labels(kind).set(self._inFlight[kind])
+        METRIC_ADMISSION_QUEUE_DEPTH.labels(kind).set(
+            len(self._queues[kind]))
+
+
+
+__all__ = ['AdmissionControl']
@@ -0,0 +1,59 @@
+"""
+Background work done a small batch at a time.
+"""
+from eliot import write_traceback
+from twisted.application.service import Service
+
+
+
+class BatchService(Service):
+    """
+    A service that does some work in the background, a batch at a time, so
+    that a large amount of work never holds up other requests for long.
+
+    Subclasses implement L{_batch}, and have C{interval} and C{clock}
+    attributes. While there is more work to do, batches are done one after the
+    other; otherwise, the next batch is done after C{interval} seconds. A batch
+    that fails is logged, and the next one is done after C{interval} seconds.
+    """
+    _call = None
+
+    def startService(self):
+        Service.startService(self)
+        self._call = self.clock.callLater(0, self._run)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+    def _run(self):
+        """
+        Do a batch of work, and schedule the next batch.
+        """
+        delay = self.interval
+        try:
+            if self._batch():
+                delay = 0
+        except Exception:
+            write_traceback()
+        self._call = None
+        if self.running:
+            self._call = self.clock.callLater(delay, self._run)
+
+
+    def _batch(self):
+        """
+        Do a batch of work.
+
+        @rtype: L{bool}
+        @return: Whether there is more work to do right away.
+        """
+        raise NotImplementedError()
+
+
+
+__all__ = ['BatchService']
@@ -0,0 +1,426 @@
+"""
+Bloom filters for answering lookups of missing keys without a query.
+
+L{LookupFilters} keeps a L{BloomFilter} of the keys in each lookup index. At
+startup the filters are loaded from the file they were last saved to, and
+brought up to date from the change log; if that is not possible, they are
+built by reading the keys of each index a batch at a time, during which the
+filter of an index that is still being built is not used. Keys are added to
+the filters by L{LookupEntry.set}, and the filters are saved periodically, and
+when the service stops.
+
+Lookup keys are matched case-insensitively in ASCII, like the text columns they
+are stored in, so keys are folded to lower case before being added to or
+checked against a filter. Removing an entry leaves its key in the filter, which
+can only cause a false positive; a filter that has had more keys added to it
+than it was sized for, or that has had as many of its keys removed from the
+index as are left, is rebuilt with room for twice as many keys as the index
+has.
+"""
+import marshal
+from hashlib import sha256
+from math import ceil, exp, log
+from string import ascii_lowercase, ascii_uppercase, maketrans
+from struct import unpack
+
+from axiom.attributes import AND
+from characteristic import Attribute, attributes
+from eliot import write_traceback
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from fusion_index.changes import Change, ChangeKinds
+from fusion_index.lookup import LookupEntry
+from fusion_index.metrics import (
+    METRIC_LOOKUP_FILTER_BYTES, METRIC_LOOKUP_FILTER_FALSE_POSITIVE_RATIO,
+    METRIC_LOOKUP_FILTER_FALSE_POSITIVES, METRIC_LOOKUP_FILTER_NEGATIVES)
+from fusion_index.names import IndexName
+
+
+
+_FOLD = maketrans(ascii_uppercase, ascii_lowercase)
+
+
+
+def _fold(value):
+    """
+    Fold a key to lower case in ASCII, as SQLite's C{NOCASE} collation does.
+
+    @type value: L{unicode}
+
+    @rtype: L{bytes}
+    """
+    return value.encode('utf-8').translate(_FOLD)
+
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of byte strings.
+
+    @ivar capacity: The number of items the filter is sized for.
+
+    @ivar count: The number of items added to the filter.
+    """
+    def __init__(self, capacity, errorRate, bits=None, hashes=None, count=0):
+        """
+        @type capacity: L{int}
+        @param capacity: The number of items to size the filter for.
+
+        @type errorRate: L{float}
+        @param errorRate: The false positive rate to size the filter for, when
+            it holds C{capacity} items.
+        """
+        self.capacity = capacity
+        self.errorRate = errorRate
+        if bits is None:
+            size = int(ceil(-capacity * log(errorRate) / log(2) ** 2 / 8))
+            bits = bytearray(max(size, 1))
+        if hashes is None:
+            hashes = max(int(round(len(bits) * 8.0 / capacity * log(2))), 1)
+        self._bits = bits
+        self.hashes = hashes
+        self.count = count
+
+
+    def _positions(self, item):
+        """
+        The positions of the bits for an item.
+        """
+        h1, h2 = unpack('<QQ', sha256(item).digest()[:16])
+        size = len(self._bits) * 8
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % size
+
+
+    def add(self, item):
+        """
+        Add an item to the filter.
+
+        An item the filter already appears to contain is not counted again.
+
+        @type item: L{bytes}
+        """
+        added = False
+        for position in self._positions(item):
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not self._bits[byte] & bit:
+                self._bits[byte] |= bit
+                added = True
+        if added:
+            self.count += 1
+
+
+    def __contains__(self, item):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item))
+
+
+    @property
+    def size(self):
+        """
+        The size of the filter, in bytes.
+        """
+        return len(self._bits)
+
+
+    def falsePositiveRate(self):
+        """
+        Estimate the false positive rate of the filter, for the number of items
+        added to it.
+
+        @rtype: L{float}
+        """
+        return (
+            1 - exp(-float(self.hashes) * self.count / (self.size * 8))
+            ) ** self.hashes
+
+
+    def dump(self):
+        """
+        Serialize the filter.
+
+        @rtype: L{tuple}
+        """
+        return (
+            self.capacity, self.errorRate, bytes(self._bits), self.hashes,
+            self.count)
+
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Deserialize a filter serialized by L{BloomFilter.dump}.
+        """
+        capacity, errorRate, bits, hashes, count = dumped
+        return cls(capacity, errorRate, bytearray(bits), hashes, count)
+
+
+
+@attributes(
+    ['store',
+     Attribute('path', default_value=None),
+     Attribute('errorRate', default_value=0.01),
+     Attribute('minimumCapacity', default_value=1024),
+     Attribute('batchSize', default_value=1000),
+     Attribute('interval', default_value=300.0),
+     Attribute('clock', default_value=reactor)])
+class LookupFilters(Service):
+    """
+    Bloom filters of the keys in each lookup index of C{store}.
+
+    Filters are sized for a false positive rate of C{errorRate}, and at least
+    C{minimumCapacity} keys. They are built C{batchSize} keys at a time, and
+    saved to C{path}, if given, every C{interval} seconds.
+    """
+    _ready = None
+    _building = None
+    _removed = None
+    _build = None
+    _save = None
+
+    def startService(self):
+        Service.startService(self)
+        self._ready = {}
+        self._building = {}
+        self._removed = {}
+        LookupEntry._filters[self.store] = self
+        if not self._load():
+            self._ready = {}
+            self._building = {}
+            self.store.transact(self._discover)
+        self._save = LoopingCall(self.save)
+        self._save.clock = self.clock
+        self._save.start(self.interval, now=False)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        LookupEntry._filters.pop(self.store, None)
+        for call in [self._build, self._save]:
+            if call is not None and call.running:
+                call.stop()
+        self._build = self._save = None
+        self.save()
+
+
+    def _discover(self):
+        """
+        Start building a filter for each lookup index, sized for the number of
+        entries in it.
+        """
+        for environment, indexType, count in self.store.querySQL(
+                'SELECT {environment}, {indexType}, COUNT(*) FROM {table} '
+                'GROUP BY {environment}, {indexType}'.format(
+                    environment=LookupEntry.environmentID.getColumnName(
+                        self.store),
+                    indexType=LookupEntry.indexTypeID.getColumnName(
+                        self.store),
+                    table=self.store.getTableName(LookupEntry))):
+            self._rebuild(
+                IndexName.lookup(self.store, environment),
+                IndexName.lookup(self.store, indexType),
+                count)
+
+
+    def _rebuild(self, environment, indexType, count):
+        """
+        Start building a new filter for a lookup index, with room for twice as
+        many keys as it has.
+        """
+        index = _fold(environment), _fold(indexType)
+        self._removed.pop(index, None)
+        self._building[index] = (
+            environment, indexType, self._filter(count * 2), None)
+        if self._build is None or not self._build.running:
+            self._build = LoopingCall(self._buildStep)
+            self._build.clock = self.clock
+            self._build.start(0, now=False)
+
+
+    def _count(self, environment, indexType):
+        """
+        The number of entries in a lookup index.
+        """
+        return self.store.query(
+            LookupEntry,
+            LookupEntry.inIndex(self.store, environment, indexType)).count()
+
+
+    def _filter(self, capacity):
+        return BloomFilter(max(capacity, self.minimumCapacity), self.errorRate)
+
+
+    def _buildStep(self):
+        """
+        Add the next batch of keys to a filter being built.
+        """
+        if not self._building:
+            self._build.stop()
+            return
+        index = next(iter(self._building))
+        environment, indexType, bloom, after = self._building[index]
+        criteria = [
+            LookupEntry.inIndex(self.store, environment, indexType)]
+        if after is not None:
+            criteria.append(LookupEntry.key > after)
+        keys = list(self.store.query(
+            LookupEntry, AND(*criteria),
+            sort=LookupEntry.key.ascending,
+            limit=self.batchSize).getColumn('key'))
+        for key in keys:
+            bloom.add(_fold(key))
+        if len(keys) < self.batchSize:
+            del self._building[index]
+            self._ready[index] = bloom
+            self._publish(index, bloom)
+        else:
+            self._building[index] = (
+                environment, indexType, bloom, keys[-1])
+
+
+    def add(self, environment, indexType, key):
+        """
+        Add a key to the filter for a lookup index.
+
+        Called by L{LookupEntry.set}; a filter is created for an index that
+        does not have one yet.
+        """
+        index = _fold(environment), _fold(indexType)
+        key = _fold(key)
+        building = self._building.get(index)
+        if building is not None:
+            building[2].add(key)
+        bloom = self._ready.get(index)
+        if bloom is None:
+            if building is not None:
+                return
+            bloom = self._ready[index] = self._filter(0)
+        bloom.add(key)
+        if bloom.count > bloom.capacity and building is None:
+            self._rebuild(
+                environment, indexType, self._count(environment, indexType))
+
+
+    def remove(self, environment, indexType):
+        """
+        Record that an entry has been removed from a lookup index.
+
+        Called by L{LookupEntry} for each entry it removes; the filter for the
+        index is rebuilt once as many of its keys have been removed as are
+        left.
+        """
+        index = _fold(environment), _fold(indexType)
+        bloom = self._ready.get(index)
+        if bloom is None or index in self._building:
+            return
+        removed = self._removed.get(index, 0) + 1
+        if removed * 2 >= bloom.count:
+            self._rebuild(
+                environment, indexType, self._count(environment, indexType))
+        else:
+            self._removed[index] = removed
+
+
+    def mightContain(self, environment, indexType, key):
+        """
+        Determine whether a lookup index might contain a key.
+
+        @rtype: L{bool}
+        @return: C{False} if the index definitely does not contain the key,
+            otherwise C{True}.
+        """
+        if not self.running:
+            return True
+        index = _fold(environment), _fold(indexType)
+        bloom = self._ready.get(index)
+        if bloom is None:
+            result = index in self._building
+        else:
+            result = _fold(key) in bloom
+        if not result:
+            METRIC_LOOKUP_FILTER_NEGATIVES.labels(environment, indexType).inc()
+        return result
+
+
+    def missed(self, environment, indexType):
+        """
+        Record that a lookup the filters could not rule out found nothing.
+        """
+        if (_fold(environment), _fold(indexType)) in self._ready:
+            METRIC_LOOKUP_FILTER_FALSE_POSITIVES.labels(
+                environment, indexType).inc()
+
+
+    def _publish(self, index, bloom):
+        """
+        Publish the size and estimated false positive rate of a filter.
+
+        @param index: The folded C{(environment, indexType)} of the index.
+        """
+        environment, indexType = index
+        labels = environment.decode('utf-8'), indexType.decode('utf-8')
+        METRIC_LOOKUP_FILTER_BYTES.labels(*labels).set(bloom.size)
+        METRIC_LOOKUP_FILTER_FALSE_POSITIVE_RATIO.labels(*labels).set(
+            bloom.falsePositiveRate())
+
+
+    def save(self):
+        """
+        Save the filters, along with the sequence number of the latest change
+        they reflect, unless any are still being built.
+        """
+        if self.path is None or self._ready is None or self._building:
+            return
+        filters = []
+        for index, bloom in self._ready.items():
+            filters.append(index + (bloom.dump(),))
+            self._publish(index, bloom)
+        sequence = self.store.transact(Change.latest, self.store)
+        self.path.setContent(marshal.dumps((sequence, filters)))
+
+
+    def _load(self):
+        """
+        Load the saved filters, if there are any, and add the keys from the
+        changes since they were saved.
+
+        @rtype: L{bool}
+        @return: Whether the filters were loaded.
+        """
+        if self.path is None or not self.path.exists():
+            return False
+        try:
+            sequence, filters = marshal.loads(self.path.getContent())
+            for environment, indexType, dumped in filters:
+                self._ready[environment, indexType] = BloomFilter.load(dumped)
+        except (ValueError, TypeError, EOFError):
+            write_traceback()
+            return False
+        return self.store.transact(self._catchUp, sequence)
+
+
+    def _catchUp(self, sequence):
+        """
+        Add the keys from the changes after a sequence number.
+
+        @rtype: L{bool}
+        @return: C{False} if some of the changes are no longer available.
+        """
+        if not (Change.horizon(self.store) <= sequence <=
+                Change.latest(self.store)):
+            return False
+        while True:
+            changes = Change.since(self.store, sequence, self.batchSize)
+            if not changes:
+                return True
+            for change in changes:
+                if change.kind == ChangeKinds.LOOKUP_SET.value:
+                    self.add(change.environment, change.indexType, change.key)
+            sequence = changes[-1].storeID
+
+
+
+__all__ = ['BloomFilter', 'LookupFilters']
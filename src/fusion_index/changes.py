@@ -0,0 +1,345 @@
+"""
+Change feed of index mutations, for replication.
+
+Every mutation of the lookup and search indexes is recorded as a L{Change} in
+an append-only log, in the same transaction as the mutation itself, so the log
+never disagrees with the indexes. Changes are numbered by their store ID, which
+increases with every change, so a consumer can resume reading the log after the
+last change it has seen. L{ChangeFeed} lets consumers wait for changes after a
+given sequence number to be committed.
+
+The log is kept from growing without bound by compaction, which removes changes
+that have been superseded by a later change to the same entry, and by
+retention, which removes all but the most recent changes, a batch at a time,
+in the background (see L{ChangeRetention}). Compaction never affects the
+outcome of replaying the log from any point, but a consumer that has fallen
+behind the changes removed by retention (the I{horizon}) must start again from
+a copy of the indexes.
+"""
+from axiom.attributes import compoundIndex, integer, text
+from axiom.item import Item
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.constants import ValueConstant, Values
+
+from fusion_index.background import BatchService
+
+
+
+class ChangeKinds(Values):
+    """
+    Kinds of index mutation.
+    """
+    LOOKUP_SET = ValueConstant(u'lookup-set')
+    SEARCH_INSERT = ValueConstant(u'search-insert')
+    SEARCH_REMOVE = ValueConstant(u'search-remove')
+
+
+
+class Change(Item):
+    """
+    A mutation of an index entry.
+
+    Lookup entries are identified by C{(environment, indexType, key)}, and
+    search entries by C{(searchClass, environment, indexType, key,
+    searchType)}, where I{key} is the result of the search entry. The value of
+    a lookup entry is not recorded, since it may be large; consumers read the
+    current value instead.
+    """
+    kind = text(doc="""
+    The kind of mutation; must be a value from L{ChangeKinds}.
+    """, allowNone=False)
+
+    searchClass = text(doc="""
+    The search class of the search entry, or C{None} for a lookup entry.
+    """)
+
+    environment = text(doc="""
+    The environment of the entry.
+    """, allowNone=False)
+
+    indexType = text(doc="""
+    The index type of the entry.
+    """, allowNone=False)
+
+    key = text(doc="""
+    The key of the lookup entry, or the result of the search entry.
+    """, allowNone=False)
+
+    searchType = text(doc="""
+    The search type of the search entry, or C{None} for a lookup entry.
+    """)
+
+    searchValue = text(doc="""
+    The value inserted into the search index, or C{None} for other kinds of
+    mutation.
+    """)
+
+    compoundIndex(environment, indexType, key)
+
+    @classmethod
+    def record(cls, store, kind, environment, indexType, key, searchClass=None,
+               searchType=None, searchValue=None):
+        """
+        Record a mutation.
+
+        This must be called in the transaction making the mutation.
+
+        @type kind: L{ChangeKinds}
+
+        @type searchClass: L{fusion_index.search.SearchClasses} or L{None}
+        """
+        if searchClass is not None:
+            searchClass = searchClass.value
+        store.batchInsert(
+            cls,
+            [cls.kind, cls.searchClass, cls.environment, cls.indexType,
+             cls.key, cls.searchType, cls.searchValue],
+            [(kind.value, searchClass, environment, indexType, key,
+              searchType, searchValue)])
+
+
+    @classmethod
+    def latest(cls, store):
+        """
+        The sequence number of the most recent change.
+
+        @rtype: L{int}
+        @return: The sequence number, or the horizon if there are no changes.
+        """
+        [(latest,)] = store.querySQL(
+            'SELECT MAX(oid) FROM {}'.format(store.getTableName(cls)))
+        if latest is None:
+            return cls.horizon(store)
+        return latest
+
+
+    @classmethod
+    def horizon(cls, store):
+        """
+        The sequence number of the most recent change removed by retention.
+
+        @rtype: L{int}
+        @return: The sequence number, or C{0} if no changes have been removed.
+        """
+        horizon = store.findFirst(ChangeHorizon)
+        if horizon is None:
+            return 0
+        return horizon.sequence
+
+
+    @classmethod
+    def since(cls, store, after, limit=1000):
+        """
+        Get the changes after a sequence number, in order.
+
+        @type after: L{int}
+        @param after: The sequence number of the last change already seen.
+
+        @type limit: L{int}
+        @param limit: The maximum number of changes to get.
+
+        @rtype: L{list} of L{Change}
+        """
+        return list(
+            store.query(cls, cls.storeID > after,
+                        sort=cls.storeID.ascending, limit=limit))
+
+
+    @classmethod
+    def compact(cls, store, after=0, limit=1000):
+        """
+        Remove a batch of changes that have been superseded by a later change
+        to the same entry.
+
+        @type after: L{int}
+        @param after: Only changes with a sequence number greater than this are
+            considered.
+
+        @type limit: L{int}
+        @param limit: The maximum number of changes to consider.
+
+        @rtype: L{int} or L{None}
+        @return: The sequence number of the last change considered, or C{None}
+            if there are no changes left to consider.
+        """
+        table = store.getTableName(cls)
+        columns = dict(
+            environment=cls.environment.getShortColumnName(store),
+            indexType=cls.indexType.getShortColumnName(store),
+            key=cls.key.getShortColumnName(store),
+            searchClass=cls.searchClass.getShortColumnName(store),
+            searchType=cls.searchType.getShortColumnName(store))
+        batch = store.querySQL(
+            'SELECT c.oid, EXISTS (SELECT 1 FROM {table} n '
+            'WHERE n.{environment} = c.{environment} '
+            'AND n.{indexType} = c.{indexType} AND n.{key} = c.{key} '
+            'AND n.{searchClass} IS c.{searchClass} '
+            'AND n.{searchType} IS c.{searchType} AND n.oid > c.oid) '
+            'FROM {table} c WHERE c.oid > ? ORDER BY c.oid LIMIT ?'.format(
+                table=table, **columns),
+            [after, limit])
+        if not batch:
+            return None
+        superseded = [oid for oid, later in batch if later]
+        if superseded:
+            store.query(cls, cls.storeID.oneOf(superseded)).deleteFromStore()
+        return batch[-1][0]
+
+
+    @classmethod
+    def retain(cls, store, count, limit=None):
+        """
+        Remove all but the most recent changes, advancing the horizon.
+
+        @type count: L{int}
+        @param count: The number of changes to keep.
+
+        @type limit: L{int} or L{None}
+        @param limit: The maximum number of changes to remove, oldest first,
+            or C{None} to remove them all at once.
+
+        @rtype: L{int}
+        @return: The number of changes removed.
+        """
+        table = store.getTableName(cls)
+        oldest = store.querySQL(
+            'SELECT oid FROM {} ORDER BY oid DESC LIMIT 1 OFFSET ?'.format(
+                table),
+            [count])
+        if not oldest:
+            return 0
+        [(sequence,)] = oldest
+        if limit is not None:
+            [(sequence,)] = store.querySQL(
+                'SELECT MAX(oid) FROM (SELECT oid FROM {} WHERE oid <= ? '
+                'ORDER BY oid LIMIT ?)'.format(table),
+                [sequence, limit])
+        removed = store.query(cls, cls.storeID <= sequence).count()
+        store.query(cls, cls.storeID <= sequence).deleteFromStore()
+        horizon = store.findOrCreate(ChangeHorizon)
+        horizon.sequence = max(horizon.sequence, sequence)
+        return removed
+
+
+
+class ChangeHorizon(Item):
+    """
+    The sequence number of the most recent change removed by retention.
+    """
+    sequence = integer(allowNone=False, default=0)
+
+
+
+@attributes(
+    ['store',
+     Attribute('count', default_value=1000000),
+     Attribute('batchSize', default_value=1000),
+     Attribute('interval', default_value=60.0),
+     Attribute('clock', default_value=reactor)])
+class ChangeRetention(BatchService):
+    """
+    Keep only the most recent C{count} changes in the change log of C{store},
+    removing older ones in batches of C{batchSize} and checking the log again
+    every C{interval} seconds once it is short enough.
+    """
+    def _batch(self):
+        """
+        Remove a batch of changes.
+        """
+        removed = self.store.transact(
+            Change.retain, self.store, self.count, self.batchSize)
+        return removed >= self.batchSize
+
+
+
+@attributes(['store', Attribute('clock', default_value=reactor)])
+class ChangeFeed(object):
+    """
+    Wait for changes to be committed to a store.
+
+    L{ChangeFeed.install} must be called for waiters and observers to be
+    notified.
+    """
+    _waiters = None
+    _observers = ()
+
+    def install(self):
+        """
+        Notify observers and waiters after each transaction is committed to the
+        store.
+        """
+        store = self.store
+        postCommitHook = store._postCommitHook
+
+        def _postCommitHook():
+            try:
+                return postCommitHook()
+            finally:
+                if self._observers and (
+                        store.transaction or store.executedThisTransaction):
+                    for observer in self._observers:
+                        observer()
+                if self._waiters:
+                    self._notify()
+        store._postCommitHook = _postCommitHook
+
+
+    def observe(self, observer):
+        """
+        Call a function after each transaction that modifies the store is
+        committed, before any waiters are notified.
+
+        @param observer: The function, called with no arguments.
+        """
+        self._observers += (observer,)
+
+
+    def wait(self, after, timeout):
+        """
+        Wait for a change after a sequence number to be committed.
+
+        @type after: L{int}
+        @param after: The sequence number of the last change already seen.
+
+        @type timeout: L{float}
+        @param timeout: The maximum number of seconds to wait.
+
+        @rtype: L{Deferred}
+        @return: Fires with C{True} once there is a change after C{after}, or
+            with C{False} if the timeout expires first. Cancelling it stops
+            waiting.
+        """
+        if self._waiters is None:
+            self._waiters = {}
+        if Change.latest(self.store) > after:
+            return succeed(True)
+
+        def _cancel(d):
+            delayed.cancel()
+            del self._waiters[d]
+        d = Deferred(_cancel)
+
+        def _expired():
+            del self._waiters[d]
+            d.callback(False)
+        delayed = self.clock.callLater(timeout, _expired)
+        self._waiters[d] = after, delayed
+        return d
+
+
+    def _notify(self):
+        """
+        Fire the waiters for which there are new changes.
+        """
+        latest = Change.latest(self.store)
+        for d, (after, delayed) in self._waiters.items():
+            if latest > after:
+                del self._waiters[d]
+                delayed.cancel()
+                d.callback(True)
+
+
+
+__all__ = ['Change', 'ChangeFeed', 'ChangeKinds', 'ChangeRetention']
@@ -0,0 +1,388 @@
+"""
+Twisted client for the index service.
+
+L{IndexClient} reuses connections from a persistent connection pool, limits
+the number of requests in flight at once, caches lookup values and revalidates
+them with their entity tags, and batches lookups made at the same time in the
+same index into a single request.
+"""
+import json
+from base64 import b64decode
+from collections import OrderedDict
+from StringIO import StringIO
+from urllib import quote, urlencode
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.python.failure import Failure
+from twisted.web import http
+from twisted.web.client import (
+    Agent, FileBodyProducer, HTTPConnectionPool, readBody)
+from twisted.web.http_headers import Headers
+
+
+
+class UnexpectedResponse(Exception):
+    """
+    The index service responded with an unexpected status code.
+
+    @ivar code: The status code.
+
+    @ivar body: The response body.
+    """
+    def __init__(self, code, body):
+        Exception.__init__(self, code, body)
+        self.code = code
+        self.body = body
+
+
+
+def _segment(value):
+    """
+    Quote a value as a URL path segment.
+
+    @type value: L{unicode}
+
+    @rtype: L{bytes}
+    """
+    return quote(value.encode('utf-8'), safe=b'')
+
+
+
+@attributes(
+    ['url',
+     Attribute('agent', default_value=None),
+     Attribute('maxInFlight', default_value=10),
+     Attribute('batchSize', default_value=100),
+     Attribute('cacheSize', default_value=1000),
+     Attribute('reactor', default_value=reactor)])
+class IndexClient(object):
+    """
+    A client for the index service at C{url}.
+
+    At most C{maxInFlight} requests are made at once; further requests wait
+    for earlier ones to finish. Unless an C{agent} is given, requests are made
+    with an L{Agent} using a persistent connection pool of the same size.
+
+    Lookups in the same index made before control returns to the reactor are
+    batched into a single request for up to C{batchSize} keys, unless the
+    service does not support it, in which case each is made separately. Up to
+    C{cacheSize} lookup values are cached, and revalidated with the service on
+    each lookup.
+    """
+    _semaphore = None
+    _pending = None
+    _cache = None
+    _batching = True
+
+    def _request(self, method, path, body=None, headers=None):
+        """
+        Make a request to the service, once there are few enough requests in
+        flight.
+
+        @return: A L{Deferred} firing with the response and its body.
+        """
+        if self._semaphore is None:
+            self._semaphore = DeferredSemaphore(self.maxInFlight)
+        if self.agent is None:
+            pool = HTTPConnectionPool(self.reactor)
+            pool.maxPersistentPerHost = self.maxInFlight
+            self.agent = Agent(self.reactor, pool=pool)
+        bodyProducer = None
+        if body is not None:
+            bodyProducer = FileBodyProducer(StringIO(body))
+
+        def _request():
+            d = self.agent.request(
+                method, self.url.rstrip(b'/') + path, headers, bodyProducer)
+            d.addCallback(
+                lambda response: readBody(response).addCallback(
+                    lambda body: (response, body)))
+            return d
+        return self._semaphore.run(_request)
+
+
+    def _expect(self, codes):
+        """
+        Check the status code of a response.
+        """
+        def _check(result):
+            response, body = result
+            if response.code not in codes:
+                raise UnexpectedResponse(response.code, body)
+            return response, body
+        return _check
+
+
+    def _cached(self, cacheKey):
+        """
+        Get a cached lookup value, marking it as recently used.
+
+        @return: The entity tag and value, or C{None} if it is not cached.
+        """
+        if self._cache is None:
+            self._cache = OrderedDict()
+        entry = self._cache.pop(cacheKey, None)
+        if entry is not None:
+            self._cache[cacheKey] = entry
+        return entry
+
+
+    def _store(self, cacheKey, etag, value):
+        """
+        Cache a lookup value, evicting the least recently used value if the
+        cache is full.
+        """
+        self._cached(cacheKey)
+        if etag is None or self.cacheSize <= 0:
+            self._cache.pop(cacheKey, None)
+            return
+        self._cache[cacheKey] = etag, value
+        while len(self._cache) > self.cacheSize:
+            self._cache.popitem(last=False)
+
+
+    def get(self, environment, indexType, key):
+        """
+        Get the value of a lookup index entry.
+
+        @type environment: L{unicode}
+        @type indexType: L{unicode}
+        @type key: L{unicode}
+
+        @return: A L{Deferred} firing with the value, or failing with
+            L{KeyError} if there is no entry.
+        """
+        if self._pending is None:
+            self._pending = {}
+        index = environment, indexType
+        if index not in self._pending:
+            self._pending[index] = {}
+            self.reactor.callLater(0, self._flush, index)
+        d = Deferred()
+        self._pending[index].setdefault(key, []).append(d)
+        return d
+
+
+    def _flush(self, index):
+        """
+        Make the lookups pending for an index.
+        """
+        pending = self._pending.pop(index)
+        keys = pending.keys()
+        if not self._batching or len(keys) == 1:
+            for key in keys:
+                self._chain(self._get(index, key), pending[key])
+            return
+        for i in xrange(0, len(keys), self.batchSize):
+            batch = keys[i:i + self.batchSize]
+            d = self._getMany(index, batch)
+
+            def _results(results, batch=batch):
+                for key in batch:
+                    self._chain(results[key], pending[key])
+
+            def _unsupported(f, batch=batch):
+                f.trap(UnexpectedResponse)
+                if f.value.code not in (http.NOT_FOUND, http.NOT_ALLOWED):
+                    return f
+                self._batching = False
+                for key in batch:
+                    self._chain(self._get(index, key), pending[key])
+
+            def _failed(f, batch=batch):
+                for key in batch:
+                    for waiter in pending[key]:
+                        if not waiter.called:
+                            waiter.errback(f)
+            d.addCallbacks(_results, _unsupported)
+            d.addErrback(_failed)
+
+
+    def _chain(self, result, waiters):
+        """
+        Fire the lookups waiting for the same key with a result.
+
+        @param result: A L{Deferred}, or a value, L{Exception} or L{Failure}.
+        """
+        if isinstance(result, Deferred):
+            result.addBoth(self._chain, waiters)
+            return
+        for waiter in waiters:
+            if isinstance(result, (Exception, Failure)):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+
+    def _get(self, index, key):
+        """
+        Look up a single key, revalidating the cached value, if any.
+
+        @param index: The C{(environment, indexType)} of the index.
+        """
+        environment, indexType = index
+        cacheKey = environment, indexType, key
+        headers = Headers()
+        cached = self._cached(cacheKey)
+        if cached is not None:
+            headers.setRawHeaders(b'If-None-Match', [cached[0]])
+        d = self._request(
+            b'GET',
+            b'/lookup/{}/{}/{}'.format(
+                _segment(environment), _segment(indexType), _segment(key)),
+            headers=headers)
+        d.addCallback(
+            self._expect([http.OK, http.NOT_MODIFIED, http.NOT_FOUND]))
+
+        def _result(result):
+            response, body = result
+            if response.code == http.NOT_MODIFIED:
+                return cached[1]
+            if response.code == http.NOT_FOUND:
+                self._store(cacheKey, None, None)
+                raise KeyError(key)
+            [etag] = response.headers.getRawHeaders(b'ETag', [None])
+            self._store(cacheKey, etag, body)
+            return body
+        return d.addCallback(_result)
+
+
+    def _getMany(self, index, keys):
+        """
+        Look up several keys in one request, revalidating the cached values.
+
+        @param index: The C{(environment, indexType)} of the index.
+
+        @return: A L{Deferred} firing with a L{dict} mapping each key to its
+            value, or to a L{KeyError} if there is no entry.
+        """
+        environment, indexType = index
+        cached = {}
+        for key in keys:
+            entry = self._cached((environment, indexType, key))
+            if entry is not None:
+                cached[key] = entry
+        etags = {
+            key: etag.decode('ascii') for key, (etag, _) in cached.items()}
+        d = self._request(
+            b'POST',
+            b'/lookup/{}/{}'.format(
+                _segment(environment), _segment(indexType)),
+            body=json.dumps({u'keys': keys, u'etags': etags}),
+            headers=Headers({b'Content-Type': [b'application/json']}))
+        d.addCallback(self._expect([http.OK]))
+
+        def _results(result):
+            response, body = result
+            entries = json.loads(body)[u'entries']
+            results = {}
+            for key in keys:
+                cacheKey = environment, indexType, key
+                entry = entries[key]
+                if entry is None:
+                    self._store(cacheKey, None, None)
+                    results[key] = KeyError(key)
+                elif u'value' in entry:
+                    value = b64decode(entry[u'value'])
+                    self._store(
+                        cacheKey, entry[u'etag'].encode('ascii'), value)
+                    results[key] = value
+                else:
+                    results[key] = cached[key][1]
+            return results
+        return d.addCallback(_results)
+
+
+    def set(self, environment, indexType, key, value, ttl=None):
+        """
+        Set the value of a lookup index entry.
+
+        @type value: L{bytes}
+
+        @type ttl: L{float} or L{None}
+        @param ttl: The number of seconds after which the entry expires, or
+            C{None} for the default TTL of the index type, if any.
+
+        @return: A L{Deferred} firing with C{None} once the value is stored.
+        """
+        self._store((environment, indexType, key), None, None)
+        headers = Headers()
+        if ttl is not None:
+            headers.setRawHeaders(b'X-TTL', [repr(float(ttl))])
+        d = self._request(
+            b'PUT',
+            b'/lookup/{}/{}/{}'.format(
+                _segment(environment), _segment(indexType), _segment(key)),
+            body=value, headers=headers)
+        d.addCallback(self._expect([http.NO_CONTENT]))
+        return d.addCallback(lambda _: None)
+
+
+    def search(self, searchClass, environment, indexType, searchValue,
+               searchType=None, count=False):
+        """
+        Search a search index.
+
+        @type searchClass: L{fusion_index.search.SearchClasses}
+
+        @param count: Only count the matching entries.
+
+        @return: A L{Deferred} firing with a L{list} of results, each a
+            L{dict} with C{result} and C{type} keys, or the number of matching
+            entries if C{count} is true.
+        """
+        path = b'/search/{}/{}/{}/results/{}'.format(
+            _segment(searchClass.value), _segment(environment),
+            _segment(indexType), _segment(searchValue))
+        if searchType is not None:
+            path += b'/' + _segment(searchType)
+        if count:
+            path += b'?' + urlencode({b'count': b'true'})
+        d = self._request(b'GET', path)
+        d.addCallback(self._expect([http.OK]))
+        d.addCallback(lambda result: json.loads(result[1]))
+        if count:
+            d.addCallback(lambda result: result[u'count'])
+        return d
+
+
+    def insert(self, searchClass, environment, indexType, result, searchType,
+               searchValue):
+        """
+        Insert an entry into a search index.
+
+        @return: A L{Deferred} firing with C{None} once the entry is stored.
+        """
+        d = self._request(
+            b'PUT', self._entryPath(
+                searchClass, environment, indexType, result, searchType),
+            body=searchValue.encode('utf-8'))
+        d.addCallback(self._expect([http.NO_CONTENT]))
+        return d.addCallback(lambda _: None)
+
+
+    def remove(self, searchClass, environment, indexType, result,
+               searchType):
+        """
+        Remove an entry from a search index.
+
+        @return: A L{Deferred} firing with C{None} once the entry is removed.
+        """
+        d = self._request(
+            b'DELETE', self._entryPath(
+                searchClass, environment, indexType, result, searchType))
+        d.addCallback(self._expect([http.NO_CONTENT]))
+        return d.addCallback(lambda _: None)
+
+
+    def _entryPath(self, searchClass, environment, indexType, result,
+                   searchType):
+        return b'/search/{}/{}/{}/entries/{}/{}'.format(
+            _segment(searchClass.value), _segment(environment),
+            _segment(indexType), _segment(result), _segment(searchType))
+
+
+
+__all__ = ['IndexClient', 'UnexpectedResponse']
@@ -0,0 +1,116 @@
+"""
+Coalescing of identical queries.
+
+The index service runs each query to completion as soon as the request for it
+arrives, so an identical request can never join a query that is still
+running; instead, L{QueryCoalescer} shares the result of a query with the
+identical requests that follow it closely, for as long as nothing in the store
+has changed since. Bursts of requests for the same popular key or search are
+then answered by querying the store once.
+"""
+from collections import OrderedDict
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+
+from fusion_index.metrics import METRIC_COALESCED_REQUESTS
+
+
+
+@attributes(
+    ['changeFeed',
+     Attribute('window', default_value=0.05),
+     Attribute('maxResults', default_value=10000),
+     Attribute('clock', default_value=reactor)])
+class QueryCoalescer(object):
+    """
+    Share the results of queries of the store of C{changeFeed} with identical
+    queries made within C{window} seconds, keeping at most C{maxResults} of
+    them.
+
+    Once installed, results are discarded whenever the change feed observes
+    a transaction that modifies the store being committed, so that a shared
+    result is never older than the most recent change. Lookup entries that
+    expire are only removed from the store later, so one may still be
+    returned for up to C{window} seconds after it expires.
+    """
+    _results = None
+
+    def install(self):
+        """
+        Discard the shared results after each transaction that modifies the
+        store is committed.
+        """
+        self.changeFeed.observe(self._discard)
+
+
+    def _discard(self):
+        """
+        Discard the shared results.
+        """
+        self._results = None
+
+
+    def query(self, route, environment, indexType, key, f, *a, **kw):
+        """
+        Run a query, unless an identical query was run recently enough that its
+        result can be shared.
+
+        A query that raises L{KeyError}, such as a lookup of a missing key, is
+        shared like any other result; other exceptions are not.
+
+        @type route: L{unicode}
+        @param route: The kind of query, such as C{u'lookup'}.
+
+        @type environment: L{unicode}
+        @param environment: The environment queried.
+
+        @type indexType: L{unicode}
+        @param indexType: The index type queried.
+
+        @param key: The rest of the query, normalized so that identical queries
+            have equal keys; it must be hashable.
+
+        @param f: The function running the query, called with the remaining
+            arguments.
+
+        @return: The result of the query.
+        """
+        now = self.clock.seconds()
+        query = (route, environment, indexType, key)
+        if self._results is not None and query in self._results:
+            ranAt, succeeded, result = self._results[query]
+            if now - ranAt <= self.window:
+                METRIC_COALESCED_REQUESTS.labels(
+                    route, environment, indexType).inc()
+                if succeeded:
+                    return result
+                raise result
+            del self._results[query]
+        try:
+            result = f(*a, **kw)
+        except KeyError as e:
+            self._share(now, query, False, e)
+            raise
+        self._share(now, query, True, result)
+        return result
+
+
+    def _share(self, now, query, succeeded, result):
+        """
+        Keep the result of a query to share, discarding the oldest results to
+        make room for it.
+        """
+        if self._results is None:
+            self._results = OrderedDict()
+        results = self._results
+        while results:
+            ranAt, _, _ = next(results.itervalues())
+            if now - ranAt <= self.window and len(results) < self.maxResults:
+                break
+            results.popitem(last=False)
+        results[query] = (now, succeeded, result)
+
+
+
+__all__ = ['QueryCoalescer']
@@ -0,0 +1,42 @@
+"""
+Removal of expired lookup entries.
+
+Expired entries are treated as missing as soon as they expire, but are only
+removed from the store by L{ExpiryReaper}, a small batch at a time, so that
+removing a large number of entries never holds up other requests for long.
+"""
+from characteristic import Attribute, attributes
+from epsilon.extime import Time
+from twisted.internet import reactor
+
+from fusion_index.background import BatchService
+from fusion_index.lookup import LookupEntry
+from fusion_index.metrics import METRIC_LOOKUP_REAPED
+
+
+
+@attributes(
+    ['store',
+     Attribute('batchSize', default_value=100),
+     Attribute('interval', default_value=1.0),
+     Attribute('clock', default_value=reactor)])
+class ExpiryReaper(BatchService):
+    """
+    Remove expired lookup entries from C{store}, up to C{batchSize} in each
+    transaction, checking for more every C{interval} seconds once there are
+    none left.
+    """
+    def _batch(self):
+        """
+        Remove a batch of expired entries.
+        """
+        reaped = self.store.transact(
+            LookupEntry.reap, self.store,
+            Time.fromPOSIXTimestamp(self.clock.seconds()), self.batchSize)
+        for (environment, indexType), count in reaped.items():
+            METRIC_LOOKUP_REAPED.labels(environment, indexType).inc(count)
+        return sum(reaped.values()) >= self.batchSize
+
+
+
+__all__ = ['ExpiryReaper']
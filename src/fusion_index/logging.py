@@ -1,4 +1,4 @@
-from eliot import ActionType, Field, fields
+from eliot import ActionType, Field, MessageType, fields
 
 
 
@@ -11,17 +11,49 @@ _SEARCH_CLASS = Field(
 LOG_LOOKUP_GET = ActionType(
     u'fusion_index:lookup:get',
     fields(environment=unicode, indexType=unicode, key=unicode),
-    [Field.for_types('value', [bytes, None], u'Value in the index, if any')],
+    [Field.for_types(
+        'value', [bytes, None],
+        u'Value in the index, if any and not stored in a file'),
+     Field.for_types(
+         'encoding', [unicode, None], u'Content-coding of the value, if any'),
+     Field.for_types(
+         'size', [int, long, None], u'Length of the value, if any')],
     u'Retrieving a value from the lookup index')
 
 
+LOG_LOOKUP_GET_MANY = ActionType(
+    u'fusion_index:lookup:get_many',
+    fields(environment=unicode, indexType=unicode, keys=list),
+    fields(found=int),
+    u'Retrieving several values from the lookup index')
+
+
 LOG_LOOKUP_PUT = ActionType(
     u'fusion_index:lookup:put',
     fields(environment=unicode, indexType=unicode, key=unicode),
-    fields(value=bytes),
+    [Field.for_types(
+        'value', [bytes, None], u'Value, if not stored in a file'),
+     Field.for_types('size', [int, long], u'Length of the value')],
     u'Storing a value in the lookup index')
 
 
+LOG_LOOKUP_LIST = ActionType(
+    u'fusion_index:lookup:list',
+    fields(
+        Field.for_types(
+            'after', [unicode, None], u'The last key already seen'),
+        environment=unicode, indexType=unicode, prefix=unicode, limit=int),
+    fields(count=int),
+    u'Listing the keys in the lookup index')
+
+
+LOG_LOOKUP_DELETE_PREFIX = ActionType(
+    u'fusion_index:lookup:delete_prefix',
+    fields(environment=unicode, indexType=unicode, prefix=unicode, limit=int),
+    fields(deleted=int),
+    u'Deleting entries with keys starting with a prefix from the lookup index')
+
+
 _SEARCH_TYPE = Field.for_types(
     'searchType', [unicode, None], u'The search type')
 LOG_SEARCH_GET = ActionType(
@@ -33,6 +65,23 @@ LOG_SEARCH_GET = ActionType(
     u'Searching the search index')
 
 
+LOG_SEARCH_COUNT = ActionType(
+    u'fusion_index:search:count',
+    fields(
+        _SEARCH_CLASS, _SEARCH_TYPE,
+        Field.for_types('cap', [int, long, None], u'The maximum count'),
+        environment=unicode, indexType=unicode, searchValue=unicode),
+    fields(count=int),
+    u'Counting matches in the search index')
+
+
+LOG_SEARCH_MANY = ActionType(
+    u'fusion_index:search:many',
+    fields(searchValue=unicode, targets=list),
+    fields(results=list),
+    u'Searching several indexes in the search index')
+
+
 LOG_SEARCH_PUT = ActionType(
     u'fusion_index:search:put',
     fields(
@@ -51,6 +100,35 @@ LOG_SEARCH_DELETE = ActionType(
     u'Deleting an entry from the search index')
 
 
+LOG_CHANGES_GET = ActionType(
+    u'fusion_index:changes:get',
+    fields(after=int, limit=int),
+    fields(count=int),
+    u'Reading the change log')
+
+
+LOG_MAINTENANCE_STEP = ActionType(
+    u'fusion_index:maintenance:step',
+    fields(step=unicode),
+    [],
+    u'Running a database maintenance step')
+
+
+LOG_SLOW_QUERY = MessageType(
+    u'fusion_index:slow_query',
+    [Field.for_types('sql', [bytes, unicode], u'The SQL statement'),
+     Field.for_types(
+         'args', [list], u'The bound parameters, unless redacted'),
+     Field.for_types(
+         'plan', [list], u'The EXPLAIN QUERY PLAN details of the statement'),
+     Field.for_types('rows', [int, long], u'The number of rows returned'),
+     Field.for_types('duration', [float], u'The query duration in seconds')],
+    u'A database query took longer than the slow query threshold')
+
+
 __all__ = [
-    'LOG_LOOKUP_GET', 'LOG_LOOKUP_PUT', 'LOG_SEARCH_GET', 'LOG_SEARCH_PUT',
-    'LOG_SEARCH_DELETE']
+    'LOG_LOOKUP_GET', 'LOG_LOOKUP_GET_MANY', 'LOG_LOOKUP_PUT',
+    'LOG_LOOKUP_LIST', 'LOG_LOOKUP_DELETE_PREFIX', 'LOG_SEARCH_GET',
+    'LOG_SEARCH_COUNT', 'LOG_SEARCH_MANY', 'LOG_SEARCH_PUT',
+    'LOG_SEARCH_DELETE', 'LOG_CHANGES_GET', 'LOG_MAINTENANCE_STEP',
+    'LOG_SLOW_QUERY']
@@ -1,11 +1,536 @@
 """
 Simple Axiom-based lookup index implementation.
 """
-from axiom.attributes import AND, bytes, compoundIndex, text
-from axiom.item import Item
+import errno
+import mmap
+import os
+import zlib
+from hashlib import sha256
+from tempfile import mkstemp
+from weakref import WeakKeyDictionary
 
+from axiom.attributes import (
+    AND, OR, bytes, compoundIndex, inmemory, integer, path, reference, text,
+    timestamp)
+from axiom.item import Item, declareLegacyItem
+from axiom.upgrade import registerAttributeCopyingUpgrader, registerUpgrader
+from characteristic import Attribute, attributes
+from epsilon.extime import Time
+from twisted.python.constants import ValueConstant, Values
+from twisted.python.filepath import FilePath
+
+from fusion_index.changes import Change, ChangeKinds
 from fusion_index.metrics import (
+    METRIC_LOOKUP_COMPRESSION_RATIO, METRIC_LOOKUP_DEDUPLICATION_RATIO,
     METRIC_LOOKUP_INSERT_LATENCY, METRIC_LOOKUP_QUERY_LATENCY)
+from fusion_index.names import IndexName
+
+
+
+class Encodings(Values):
+    """
+    Encodings of stored lookup values.
+
+    The values of these constants are the corresponding HTTP content-codings.
+    """
+    IDENTITY = ValueConstant(u'identity')
+    DEFLATE = ValueConstant(u'deflate')
+
+
+
+@attributes(['threshold', Attribute('level', default_value=6)])
+class Compression(object):
+    """
+    Compression policy for the values in a lookup index.
+
+    @ivar threshold: Values at least this many bytes long are compressed.
+
+    @ivar level: The zlib compression level.
+    """
+    @property
+    def spec(self):
+        """
+        A description of this policy, recorded with the values encoded
+        according to it.
+
+        @rtype: L{unicode}
+        """
+        return u'{}:{:d}:{:d}'.format(
+            Encodings.DEFLATE.value, self.threshold, self.level)
+
+
+    def encode(self, value):
+        """
+        Encode a value according to this policy.
+
+        Values that do not get any smaller are stored uncompressed.
+
+        @type value: L{bytes}
+        @param value: The raw value.
+
+        @rtype: L{tuple} of L{Encodings} and L{bytes}
+        @return: The encoding and encoded value.
+        """
+        if len(value) >= self.threshold:
+            compressed = zlib.compress(value, self.level)
+            if len(compressed) < len(value):
+                return Encodings.DEFLATE, compressed
+        return Encodings.IDENTITY, value
+
+
+
+# The longest TTL an entry can be set with, in seconds: about a century.
+MAX_TTL = 100 * 365 * 24 * 60 * 60
+
+
+
+def parseCompression(spec):
+    """
+    Parse a compression policy specification.
+
+    @type spec: L{str}
+    @param spec: A specification of the form C{indexType[:threshold]}.
+
+    @rtype: L{tuple} of L{unicode} and L{Compression}
+    @return: The index type and compression policy.
+
+    @raises ValueError: if the specification is invalid.
+    """
+    indexType, _, threshold = spec.partition(':')
+    if not indexType:
+        raise ValueError('Invalid compression policy: {!r}'.format(spec))
+    return (indexType.decode('utf-8'),
+            Compression(threshold=int(threshold or 1024)))
+
+
+
+def parseTTL(ttl):
+    """
+    Parse a TTL.
+
+    @type ttl: L{str}
+    @param ttl: A positive number of seconds, of at most C{MAX_TTL}.
+
+    @rtype: L{float}
+
+    @raises ValueError: if the TTL is invalid.
+    """
+    ttl = float(ttl)
+    if not 0 < ttl <= MAX_TTL:
+        raise ValueError(
+            'TTL must be a positive number of seconds, at most {:d}'.format(
+                MAX_TTL))
+    return ttl
+
+
+
+def decode(encoding, value):
+    """
+    Decode a stored value.
+
+    @type encoding: L{Encodings}
+    @param encoding: The encoding of the stored value.
+
+    @type value: L{bytes}
+    @param value: The stored value.
+
+    @rtype: L{bytes}
+    @return: The raw value.
+    """
+    if encoding == Encodings.DEFLATE:
+        return zlib.decompress(value)
+    return value
+
+
+
+@attributes(['path', 'digest', 'size'])
+class Blob(object):
+    """
+    A value that has been written to a temporary file in the store's file
+    area, but not yet stored in the lookup index.
+
+    @ivar path: The L{FilePath} of the temporary file.
+
+    @ivar digest: The hex-encoded SHA-256 digest of the value.
+
+    @ivar size: The length of the value.
+    """
+    @classmethod
+    def fromFile(cls, store, f, chunkSize=65536):
+        """
+        Copy the contents of a file into a new blob, a chunk at a time.
+
+        @type store: L{axiom.store.Store}
+        @param store: The store whose file area the blob should be written to.
+
+        @param f: The file to read from.
+
+        @rtype: L{Blob}
+        """
+        tempDir = store.newFilePath('blobs', 'temp')
+        _makeDirs(tempDir)
+        fd, name = mkstemp(dir=tempDir.path)
+        digest = sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = f.read(chunkSize)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        return cls(
+            path=FilePath(name),
+            digest=digest.hexdigest().decode('ascii'),
+            size=size)
+
+
+    def discard(self):
+        """
+        Remove the temporary file.
+        """
+        self.path.remove()
+
+
+
+def _removeFile(path):
+    """
+    Remove a file, if it exists.
+
+    @type path: L{FilePath}
+    """
+    try:
+        path.remove()
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+
+def _makeDirs(path):
+    """
+    Create a directory and its parents, if they do not already exist.
+
+    @type path: L{FilePath}
+    """
+    try:
+        path.makedirs()
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+
+class LookupValue(Item):
+    """
+    A distinct value stored in a lookup index.
+
+    Values are addressed by the digest of their raw content, so entries in the
+    same index with identical values share a single L{LookupValue}, which is
+    deleted once no entries refer to it any longer.
+
+    Large values are stored in files in the store's file area (see L{Blob})
+    rather than in the database.
+    """
+    schemaVersion = 3
+
+    environment = text(doc="""
+    The environment of the index this value belongs to.
+    """, allowNone=False)
+
+    indexType = text(doc="""
+    The index type of the index this value belongs to.
+    """, allowNone=False)
+
+    digest = text(doc="""
+    The hex-encoded SHA-256 digest of the raw value.
+    """, allowNone=False)
+
+    data = bytes(doc="""
+    The value, encoded according to I{encoding}.
+    """, allowNone=False, default=b'')
+
+    encoding = text(doc="""
+    The encoding of I{data}; must be a value from L{Encodings}.
+    """, allowNone=False, default=Encodings.IDENTITY.value)
+
+    size = integer(doc="""
+    The length of the value, before encoding.
+    """, allowNone=False, default=0)
+
+    refCount = integer(doc="""
+    The number of L{LookupEntry} items referring to this value.
+    """, allowNone=False, default=0)
+
+    blob = path(doc="""
+    The file containing the value, or C{None} if the value is stored in
+    I{data}.
+    """)
+
+    policy = text(doc="""
+    The L{Compression.spec} of the policy I{data} was last encoded according
+    to, or C{None} if it was stored without one.
+    """)
+
+    compoundIndex(environment, indexType, digest)
+
+    _newBlob = inmemory(doc="""
+    The file a blob was moved to by the current transaction, which must be
+    removed if the transaction is reverted.
+    """)
+
+    def activate(self):
+        self._newBlob = None
+
+
+    @classmethod
+    def acquire(cls, store, environment, indexType, value, compression=None):
+        """
+        Get the stored value for some raw value, storing it if necessary, and
+        add a reference to it.
+
+        @type value: L{bytes} or L{Blob}
+        @param value: The raw value. A L{Blob} is either moved into place, or
+            discarded if the value is already stored.
+
+        @type compression: L{Compression} or L{None}
+        @param compression: The compression policy for this index, if any.
+            Blobs are never compressed.
+
+        @rtype: L{LookupValue}
+        """
+        if isinstance(value, Blob):
+            digest = value.digest
+        else:
+            digest = sha256(value).hexdigest().decode('ascii')
+        content = store.findUnique(
+            cls,
+            AND(cls.environment == environment,
+                cls.indexType == indexType,
+                cls.digest == digest),
+            None)
+        if content is None:
+            content = cls(
+                store=store,
+                environment=environment,
+                indexType=indexType,
+                digest=digest)
+            if isinstance(value, Blob):
+                content._storeBlob(value)
+            else:
+                content._store(value, compression)
+        elif isinstance(value, Blob):
+            value.discard()
+        content.refCount += 1
+        return content
+
+
+    def release(self):
+        """
+        Remove a reference to this value, deleting it if there are none left.
+        """
+        self.refCount -= 1
+        if self.refCount <= 0:
+            self.deleteFromStore()
+
+
+    def _store(self, value, compression):
+        """
+        Store the raw value, encoding it if necessary.
+        """
+        self.size = len(value)
+        encoding = Encodings.IDENTITY
+        self.policy = None
+        if compression is not None:
+            encoding, value = compression.encode(value)
+            self.policy = compression.spec
+        self.encoding = encoding.value
+        self.data = value
+
+
+    def _storeBlob(self, blob):
+        """
+        Move a blob into place as the file containing this value.
+        """
+        destination = self.store.newFilePath(
+            'blobs', '{:02x}'.format(self.storeID % 256), str(self.storeID))
+        _makeDirs(destination.parent())
+        blob.path.moveTo(destination)
+        self._newBlob = destination
+        self.size = blob.size
+        self.encoding = Encodings.IDENTITY.value
+        self.blob = destination
+
+
+    def open(self, useMmap=False):
+        """
+        Open the file containing this value.
+
+        @type useMmap: L{bool}
+        @param useMmap: Map the file into memory rather than reading it. Empty
+            files cannot be mapped, and are always read.
+
+        @return: A file-like object.
+        """
+        f = self.blob.open('rb')
+        if not useMmap or os.fstat(f.fileno()).st_size == 0:
+            return f
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+
+    def encoded(self):
+        """
+        Get the encoded value, reading it from its file if necessary.
+
+        @rtype: L{tuple} of L{Encodings} and L{bytes}
+        @return: The encoding and encoded value.
+        """
+        if self.blob is not None:
+            return Encodings.IDENTITY, self.blob.getContent()
+        return Encodings.lookupByValue(self.encoding), self.data
+
+
+    def committed(self):
+        Item.committed(self)
+        self._newBlob = None
+
+
+    def revert(self):
+        """
+        Remove the file a blob was moved to, if the transaction that stored it
+        is reverted.
+        """
+        newBlob, self._newBlob = self._newBlob, None
+        Item.revert(self)
+        if newBlob is not None:
+            _removeFile(newBlob)
+
+
+    def deleted(self):
+        """
+        Remove the file containing this value, if any, once its deletion has
+        been committed.
+        """
+        if self.blob is not None:
+            _removeFile(self.blob)
+
+
+    @classmethod
+    def recompress(cls, store, compression, after=0, limit=100):
+        """
+        Re-encode a batch of existing values according to the current
+        compression policies.
+
+        Values in indexes without a compression policy are stored
+        uncompressed. Values stored in files, and values already encoded
+        according to the current policy, are left alone.
+
+        @param compression: A mapping from index types to L{Compression}
+            policies.
+
+        @type after: L{int}
+        @param after: Only values with a store ID greater than this are
+            processed.
+
+        @type limit: L{int}
+        @param limit: The maximum number of values to process.
+
+        @rtype: L{int} or L{None}
+        @return: The store ID of the last value processed, or C{None} if there
+            are no values left to process.
+        """
+        last = None
+        for item in store.query(cls, cls.storeID > after,
+                                sort=cls.storeID.ascending, limit=limit):
+            last = item.storeID
+            if item.blob is not None:
+                continue
+            policy = compression.get(item.indexType)
+            if item.policy == (None if policy is None else policy.spec):
+                continue
+            encoding = Encodings.lookupByValue(item.encoding)
+            if encoding == Encodings.IDENTITY and policy is None:
+                item.policy = None
+                continue
+            item._store(decode(encoding, item.data), policy)
+        return last
+
+
+    def _absorb(self, other):
+        """
+        Merge another stored copy of the same value into this one, moving its
+        references here and deleting it.
+
+        @type other: L{LookupValue}
+        """
+        for entry in self.store.query(
+                LookupEntry, LookupEntry.content == other):
+            entry.content = self
+        self.refCount += other.refCount
+        other.deleteFromStore()
+
+
+    @classmethod
+    def storageStats(cls, store):
+        """
+        Compute the storage used by every lookup index, and publish the
+        compression and deduplication ratios as the C{lookup_compression_ratio}
+        and C{lookup_deduplication_ratio} metrics.
+
+        This scans every stored value, and should only be done occasionally.
+
+        @rtype: L{dict} mapping L{tuple} of C{(environment, indexType)} to
+            L{dict}
+        @return: For each index, the total size of the values of all entries
+            (C{logical}), the total size of the distinct values (C{unique}),
+            and the total size of the distinct values after encoding
+            (C{stored}), all in bytes.
+        """
+        stats = {}
+        rows = store.querySQL(
+            'SELECT {environment}, {indexType}, SUM({size} * {refCount}), '
+            'SUM({size}), '
+            'SUM(CASE WHEN {blob} IS NULL THEN LENGTH({data}) ELSE {size} END) '
+            'FROM {table} GROUP BY {environment}, {indexType}'.format(
+                table=store.getTableName(cls),
+                environment=cls.environment.getColumnName(store),
+                indexType=cls.indexType.getColumnName(store),
+                size=cls.size.getColumnName(store),
+                refCount=cls.refCount.getColumnName(store),
+                data=cls.data.getColumnName(store),
+                blob=cls.blob.getColumnName(store)))
+        for environment, indexType, logical, unique, stored in rows:
+            stats[environment, indexType] = dict(
+                logical=logical, unique=unique, stored=stored)
+        cls.publishRatios(stats)
+        return stats
+
+
+    @classmethod
+    def publishRatios(cls, stats):
+        """
+        Publish the compression and deduplication ratios of each lookup index
+        as the C{lookup_compression_ratio} and C{lookup_deduplication_ratio}
+        metrics.
+
+        @param stats: The storage used by each index, as returned by
+            L{storageStats}.
+        """
+        for (environment, indexType), size in stats.items():
+            METRIC_LOOKUP_COMPRESSION_RATIO.labels(
+                environment, indexType).set(
+                    float(size['stored']) / size['unique']
+                    if size['unique'] else 1.0)
+            METRIC_LOOKUP_DEDUPLICATION_RATIO.labels(
+                environment, indexType).set(
+                    float(size['unique']) / size['logical']
+                    if size['logical'] else 1.0)
 
 
 
@@ -15,31 +540,84 @@ class LookupEntry(Item):
 
     Each combination of C{(environment, indexType, key)} identifies a unique
     item in the index.
+
+    An entry with an expiry time is treated as missing once that time has
+    passed, and eventually removed by L{LookupEntry.reap}.
+
+    The environment and index type are stored as L{IndexName}s.
     """
-    environment = text(doc="""
-    The environment in which this entry exists.
+    schemaVersion = 5
 
-    Usually something like C{u'prod'}.
+    environmentID = integer(doc="""
+    The store ID of the L{IndexName} of the environment in which this entry
+    exists.
     """, allowNone=False)
 
-    indexType = text(doc="""
-    The index type for this index entry.
-
-    Usually something like C{u'idNumber'}.
+    indexTypeID = integer(doc="""
+    The store ID of the L{IndexName} of the index type for this index entry.
     """, allowNone=False)
 
     key = text(doc="""
     The key for this index entry.
     """, allowNone=False)
 
-    value = bytes(doc="""
+    content = reference(doc="""
     The value for this index entry.
-    """, allowNone=False, default=b'')
+    """, reftype=LookupValue, allowNone=False)
+
+    expires = timestamp(doc="""
+    The time after which this entry is treated as missing, or C{None} if it
+    never expires.
+    """, indexed=True)
+
+    compoundIndex(environmentID, indexTypeID, key)
+
+    _filters = WeakKeyDictionary()
+
+    @property
+    def environment(self):
+        """
+        The environment in which this entry exists.
+
+        Usually something like C{u'prod'}.
+        """
+        return IndexName.lookup(self.store, self.environmentID)
+
+
+    @property
+    def indexType(self):
+        """
+        The index type for this index entry.
+
+        Usually something like C{u'idNumber'}.
+        """
+        return IndexName.lookup(self.store, self.indexTypeID)
 
-    compoundIndex(environment, indexType, key)
 
     @classmethod
-    def get(cls, store, environment, indexType, key):
+    def inIndex(cls, store, environment, indexType):
+        """
+        The comparison matching the entries in an index.
+        """
+        return AND(cls.environmentID == IndexName.find(store, environment),
+                   cls.indexTypeID == IndexName.find(store, indexType))
+
+
+    @classmethod
+    def _live(cls, now):
+        """
+        The comparison matching entries that have not expired.
+
+        @type now: L{Time} or L{None}
+        @param now: The current time, or C{None} for the system time.
+        """
+        if now is None:
+            now = Time()
+        return OR(cls.expires == None, cls.expires > now)
+
+
+    @classmethod
+    def get(cls, store, environment, indexType, key, now=None):
         """
         Get the value of an index entry.
 
@@ -55,18 +633,69 @@ class LookupEntry(Item):
         @type key: L{unicode}
         @param key: The key.
 
-        @raises KeyError: if the entry does not exist.
+        @type now: L{Time} or L{None}
+        @param now: The time at which expired entries are treated as missing;
+            by default, the current time.
+
+        @raises KeyError: if the entry does not exist, or has expired.
+        """
+        return decode(
+            *cls.getEncoded(store, environment, indexType, key, now))
+
+
+    @classmethod
+    def getEncoded(cls, store, environment, indexType, key, now=None):
+        """
+        Get the stored value of an index entry, without decoding it.
+
+        @see: L{LookupEntry.get}
+
+        @rtype: L{tuple} of L{Encodings} and L{bytes}
+        @return: The encoding and encoded value.
+        """
+        return cls.getContent(
+            store, environment, indexType, key, now).encoded()
+
+
+    @classmethod
+    def getContent(cls, store, environment, indexType, key, now=None):
+        """
+        Get the stored value of an index entry.
+
+        @see: L{LookupEntry.get}
+
+        @rtype: L{LookupValue}
         """
         with METRIC_LOOKUP_QUERY_LATENCY.labels(environment, indexType).time():
             return store.findUnique(
-                cls,
-                AND(cls.environment == environment,
-                    cls.indexType == indexType,
-                    cls.key == key)).value
+                LookupValue,
+                AND(cls.inIndex(store, environment, indexType),
+                    cls.key == key,
+                    cls._live(now),
+                    cls.content == LookupValue.storeID))
+
+
+    @classmethod
+    def find(cls, store, environment, indexType, key, now=None):
+        """
+        Find an index entry.
+
+        @see: L{LookupEntry.get}
+
+        @rtype: L{LookupEntry} or L{None}
+        @return: The entry, or C{None} if it does not exist, or has expired.
+        """
+        return store.findUnique(
+            cls,
+            AND(cls.inIndex(store, environment, indexType),
+                cls.key == key,
+                cls._live(now)),
+            None)
 
 
     @classmethod
-    def set(cls, store, environment, indexType, key, value):
+    def set(cls, store, environment, indexType, key, value, compression=None,
+            expires=None):
         """
         Set the value of an index entry.
 
@@ -85,13 +714,377 @@ class LookupEntry(Item):
         @type key: L{unicode}
         @param key: The key.
 
-        @type value: L{bytes}
+        @type value: L{bytes} or L{Blob}
         @param value: The value to set.
+
+        @type compression: L{Compression} or L{None}
+        @param compression: The compression policy for this index, if any.
+
+        @type expires: L{Time} or L{None}
+        @param expires: The time after which the entry is treated as missing,
+            or C{None} if it never expires.
         """
         with METRIC_LOOKUP_INSERT_LATENCY.labels(environment, indexType).time():
-            item = store.findOrCreate(
+            entry = store.findUnique(
                 cls,
-                environment=environment,
-                indexType=indexType,
-                key=key)
-            item.value = value
+                AND(cls.inIndex(store, environment, indexType),
+                    cls.key == key),
+                None)
+            content = LookupValue.acquire(
+                store, environment, indexType, value, compression)
+            if entry is None:
+                cls(store=store,
+                    environmentID=IndexName.intern(store, environment),
+                    indexTypeID=IndexName.intern(store, indexType),
+                    key=key,
+                    content=content,
+                    expires=expires)
+            else:
+                entry.content.release()
+                entry.content = content
+                entry.expires = expires
+            Change.record(
+                store, ChangeKinds.LOOKUP_SET, environment, indexType, key)
+            filters = cls._filters.get(store)
+            if filters is not None:
+                filters.add(environment, indexType, key)
+
+
+    @classmethod
+    def reap(cls, store, now=None, limit=100):
+        """
+        Remove a batch of expired entries, recording the removals in the change
+        log.
+
+        @type now: L{Time} or L{None}
+        @param now: The time before which entries have expired; by default,
+            the current time.
+
+        @type limit: L{int}
+        @param limit: The maximum number of entries to remove.
+
+        @rtype: L{dict} mapping L{tuple} of C{(environment, indexType)} to
+            L{int}
+        @return: The number of entries removed from each index.
+        """
+        if now is None:
+            now = Time()
+        reaped = {}
+        for entry in list(store.query(
+                cls, cls.expires <= now, sort=cls.expires.ascending,
+                limit=limit)):
+            index = entry.environment, entry.indexType
+            reaped[index] = reaped.get(index, 0) + 1
+            entry._remove()
+        return reaped
+
+
+    @classmethod
+    def _keyRange(cls, prefix, after):
+        """
+        Build the comparisons matching keys that start with a prefix and sort
+        after a key.
+
+        Unlike C{cls.key.startswith}, SQLite can use the index on
+        C{(environment, indexType, key)} for these.
+        """
+        criteria = []
+        if prefix:
+            criteria.extend([cls.key >= prefix,
+                             cls.key < prefix + u'\U0010ffff'])
+        if after is not None:
+            criteria.append(cls.key > after)
+        return criteria
+
+
+    @classmethod
+    def listEntries(cls, store, environment, indexType, prefix=u'',
+                    after=None, limit=100, now=None):
+        """
+        List a page of the entries in an index, in order of their keys.
+
+        Pages are found by their last key, rather than an offset, so each one
+        is a range scan of the index on C{(environment, indexType, key)},
+        however far into the index it is.
+
+        @type prefix: L{unicode}
+        @param prefix: Only list entries with keys starting with this, ignoring
+            ASCII case like lookups do.
+
+        @type after: L{unicode} or L{None}
+        @param after: Only list entries with keys after this, usually the last
+            key of the previous page; or C{None} for the first page.
+
+        @type limit: L{int}
+        @param limit: The maximum number of entries to list.
+
+        @param now: See L{LookupEntry.get}.
+
+        @rtype: L{list} of L{LookupEntry}
+        """
+        return list(store.query(
+            cls,
+            AND(cls.inIndex(store, environment, indexType),
+                cls._live(now),
+                *cls._keyRange(prefix, after)),
+            sort=cls.key.ascending,
+            limit=limit))
+
+
+    @classmethod
+    def deletePrefix(cls, store, environment, indexType, prefix, limit=1000):
+        """
+        Remove a batch of the entries in an index with keys starting with a
+        prefix, recording the removals in the change log.
+
+        @type prefix: L{unicode}
+        @param prefix: The prefix, matched ignoring ASCII case like lookups
+            do; every entry in the index starts with an empty prefix.
+
+        @type limit: L{int}
+        @param limit: The maximum number of entries to remove.
+
+        @rtype: L{int}
+        @return: The number of entries removed; if it is less than C{limit},
+            there are no matching entries left.
+        """
+        entries = list(store.query(
+            cls,
+            AND(cls.inIndex(store, environment, indexType),
+                *cls._keyRange(prefix, None)),
+            sort=cls.key.ascending,
+            limit=limit))
+        for entry in entries:
+            entry._remove()
+        return len(entries)
+
+
+    def _remove(self):
+        """
+        Delete this entry, recording the removal in the change log.
+        """
+        Change.record(
+            self.store, ChangeKinds.LOOKUP_SET, self.environment,
+            self.indexType, self.key)
+        filters = self._filters.get(self.store)
+        if filters is not None:
+            filters.remove(self.environment, self.indexType)
+        self.deleteFromStore()
+
+
+    def deleteFromStore(self, deleteObject=True):
+        """
+        Delete this entry, releasing its value.
+        """
+        if deleteObject:
+            self.content.release()
+        Item.deleteFromStore(self, deleteObject)
+
+
+
+declareLegacyItem(
+    LookupValue.typeName, 1,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         digest=text(allowNone=False),
+         data=bytes(allowNone=False, default=b''),
+         encoding=text(allowNone=False, default=Encodings.IDENTITY.value),
+         size=integer(allowNone=False, default=0),
+         refCount=integer(allowNone=False, default=0)))
+
+registerAttributeCopyingUpgrader(LookupValue, 1, 2)
+
+
+
+declareLegacyItem(
+    LookupValue.typeName, 2,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         digest=text(allowNone=False),
+         data=bytes(allowNone=False, default=b''),
+         encoding=text(allowNone=False, default=Encodings.IDENTITY.value),
+         size=integer(allowNone=False, default=0),
+         refCount=integer(allowNone=False, default=0),
+         blob=path()))
+
+
+
+def upgradeLookupValue2to3(old):
+    """
+    Upgrade L{LookupValue} from version 2 to 3, leaving the compression policy
+    of existing values unknown, so that they are re-encoded once by
+    L{LookupValue.recompress}.
+
+    If the same value was stored again before this one was upgraded, the copy
+    is merged into it.
+    """
+    store = old.store
+    new = old.upgradeVersion(
+        LookupValue.typeName, 2, 3,
+        environment=old.environment,
+        indexType=old.indexType,
+        digest=old.digest,
+        data=old.data,
+        encoding=old.encoding,
+        size=old.size,
+        refCount=old.refCount,
+        blob=old.blob,
+        policy=None)
+    for other in list(store.query(
+            LookupValue,
+            AND(LookupValue.environment == new.environment,
+                LookupValue.indexType == new.indexType,
+                LookupValue.digest == new.digest,
+                LookupValue.storeID != new.storeID))):
+        new._absorb(other)
+    return new
+
+registerUpgrader(upgradeLookupValue2to3, LookupValue.typeName, 2, 3)
+
+
+
+def _superseded(old):
+    """
+    Find the entry that replaced an entry being upgraded, if the same key was
+    set after the store was opened but before the entry was upgraded; entries
+    are only upgraded when they are loaded, or by the background upgrade.
+
+    If there is one, the old entry is deleted, releasing its value, if it is
+    in the value store.
+
+    @return: The current entry, or C{None}.
+    """
+    store = old.store
+    existing = store.findUnique(
+        LookupEntry,
+        AND(LookupEntry.inIndex(store, old.environment, old.indexType),
+            LookupEntry.key == old.key),
+        None)
+    if existing is not None:
+        content = getattr(old, 'content', None)
+        old.deleteFromStore()
+        if content is not None:
+            content.release()
+    return existing
+
+
+
+declareLegacyItem(
+    LookupEntry.typeName, 1,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         key=text(allowNone=False),
+         value=bytes(allowNone=False, default=b'')))
+
+
+
+declareLegacyItem(
+    LookupEntry.typeName, 2,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         key=text(allowNone=False),
+         value=bytes(allowNone=False, default=b''),
+         encoding=text(allowNone=False, default=Encodings.IDENTITY.value),
+         size=integer(allowNone=False, default=0)))
+
+
+
+def upgradeLookupEntry1to2(old):
+    """
+    Record the encoding and size of existing values, which are always
+    uncompressed.
+    """
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    return old.upgradeVersion(
+        LookupEntry.typeName, 1, 2,
+        environment=old.environment,
+        indexType=old.indexType,
+        key=old.key,
+        value=old.value,
+        encoding=Encodings.IDENTITY.value,
+        size=len(old.value))
+
+registerUpgrader(upgradeLookupEntry1to2, LookupEntry.typeName, 1, 2)
+
+
+
+def upgradeLookupEntry2to3(old):
+    """
+    Move existing values into the deduplicated value store.
+
+    Values are stored uncompressed; they will be compressed again by
+    L{LookupValue.recompress}.
+    """
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    content = LookupValue.acquire(
+        old.store, old.environment, old.indexType,
+        decode(Encodings.lookupByValue(old.encoding), old.value))
+    return old.upgradeVersion(
+        LookupEntry.typeName, 2, 3,
+        environment=old.environment,
+        indexType=old.indexType,
+        key=old.key,
+        content=content)
+
+registerUpgrader(upgradeLookupEntry2to3, LookupEntry.typeName, 2, 3)
+
+
+
+declareLegacyItem(
+    LookupEntry.typeName, 3,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         key=text(allowNone=False),
+         content=reference(allowNone=False)))
+
+
+
+def upgradeLookupEntry3to4(old):
+    """
+    Leave existing entries without an expiry time.
+    """
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    return old.upgradeVersion(
+        LookupEntry.typeName, 3, 4,
+        environment=old.environment,
+        indexType=old.indexType,
+        key=old.key,
+        content=old.content)
+
+registerUpgrader(upgradeLookupEntry3to4, LookupEntry.typeName, 3, 4)
+
+
+
+declareLegacyItem(
+    LookupEntry.typeName, 4,
+    dict(environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         key=text(allowNone=False),
+         content=reference(allowNone=False),
+         expires=timestamp()))
+
+
+
+def upgradeLookupEntry4to5(old):
+    """
+    Replace the environment and index type of existing entries with
+    L{IndexName}s.
+    """
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    return old.upgradeVersion(
+        LookupEntry.typeName, 4, 5,
+        environmentID=IndexName.intern(old.store, old.environment),
+        indexTypeID=IndexName.intern(old.store, old.indexType),
+        key=old.key,
+        content=old.content,
+        expires=old.expires)
+
+registerUpgrader(upgradeLookupEntry4to5, LookupEntry.typeName, 4, 5)
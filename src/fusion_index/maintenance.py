@@ -0,0 +1,242 @@
+"""
+Background database maintenance.
+
+Maintenance work is split into small steps which are run one at a time, with
+control returned to the reactor between steps, so that request handling is
+never blocked for long. Steps are only run inside configured maintenance
+windows, which should be chosen to coincide with periods of low traffic.
+"""
+import time
+
+from characteristic import Attribute, attributes
+from eliot import write_traceback
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from fusion_index.changes import Change
+from fusion_index.logging import LOG_MAINTENANCE_STEP
+from fusion_index.lookup import LookupValue
+from fusion_index.metrics import METRIC_MAINTENANCE_STEP_LATENCY
+from fusion_index.search import SearchPrefixStatistic, SearchSuffix
+
+
+
+def parseWindow(window):
+    """
+    Parse a maintenance window specification.
+
+    @type window: L{str}
+    @param window: A window of the form C{HH:MM-HH:MM}, in UTC. The end of the
+        window may be earlier than the start, in which case the window wraps
+        around midnight.
+
+    @rtype: L{tuple} of two L{int}s
+    @return: The start and end of the window, in minutes past midnight.
+
+    @raises ValueError: if the window specification is invalid.
+    """
+    def _minutes(s):
+        hours, minutes = s.split(':')
+        hours, minutes = int(hours), int(minutes)
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError('Invalid time: {!r}'.format(s))
+        return hours * 60 + minutes
+    try:
+        start, end = window.split('-')
+        return _minutes(start), _minutes(end)
+    except ValueError:
+        raise ValueError('Invalid maintenance window: {!r}'.format(window))
+
+
+
+def inWindow(windows, when):
+    """
+    Determine whether a point in time falls inside any maintenance window.
+
+    @param windows: Windows as returned by L{parseWindow}.
+
+    @type when: L{float}
+    @param when: A POSIX timestamp.
+
+    @rtype: L{bool}
+    """
+    t = time.gmtime(when)
+    minute = t.tm_hour * 60 + t.tm_min
+    for start, end in windows:
+        if start <= end:
+            if start <= minute < end:
+                return True
+        elif minute >= start or minute < end:
+            return True
+    return False
+
+
+
+@attributes(
+    ['store',
+     'windows',
+     Attribute('compression', default_factory=dict),
+     Attribute('interval', default_value=1.0),
+     Attribute('vacuumPages', default_value=256),
+     Attribute('analysisLimit', default_value=1000),
+     Attribute('clock', default_value=reactor)])
+class MaintenanceService(Service):
+    """
+    Run database maintenance in small steps during maintenance windows.
+
+    Each time a maintenance window opens, existing lookup values are first
+    re-encoded according to the C{compression} policies (if there are any), a
+    batch of values per step, and the resulting compression and deduplication
+    ratios are published, along with the storage amplification of the substring
+    search indexes, and the prefix search statistics are recalculated (one
+    prefix length of one index per step). The change log is then compacted, a
+    batch of changes per step. Next, the query planner statistics are
+    refreshed with C{ANALYZE} (one table per step, sampling at most
+    C{analysisLimit} rows per index) followed by C{PRAGMA optimize}, and then
+    free pages are returned to the filesystem with C{PRAGMA
+    incremental_vacuum} (C{vacuumPages} pages per step) until there are none
+    left or the window closes. One step is run every C{interval} seconds.
+
+    Incremental vacuuming requires the database to be in
+    C{auto_vacuum=INCREMENTAL} mode, which only takes effect on an existing
+    database after a full C{VACUUM}; a database in any other mode is converted
+    with a single full C{VACUUM} step first, which blocks for as long as it
+    takes to rewrite the database, but only happens once.
+
+    A step that fails is logged and skipped, along with any remaining steps of
+    the same batched operation, and maintenance carries on with the next one.
+    """
+    _steps = None
+    _succeeded = None
+    _call = None
+
+    def startService(self):
+        Service.startService(self)
+        self._call = LoopingCall(self._tick)
+        self._call.clock = self.clock
+        self._call.start(self.interval, now=True)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.running:
+            self._call.stop()
+        self._call = None
+
+
+    def _tick(self):
+        """
+        Run the next maintenance step, if a maintenance window is open.
+        """
+        if not inWindow(self.windows, self.clock.seconds()):
+            self._steps = None
+            return
+        if self._steps is None:
+            self._steps = self._maintenanceSteps()
+            self._succeeded = None
+        try:
+            name, step = self._steps.send(self._succeeded)
+        except StopIteration:
+            return
+        except Exception:
+            write_traceback()
+            self._steps = iter(())
+            return
+        self._succeeded = self._runStep(name, step)
+
+
+    def _runStep(self, name, step):
+        """
+        Run a single maintenance step, logging it and recording its duration.
+
+        @rtype: L{bool}
+        @return: Whether the step succeeded; a failure is logged, rather than
+            raised, so that it does not stop the maintenance loop.
+        """
+        try:
+            with LOG_MAINTENANCE_STEP(step=name):
+                with METRIC_MAINTENANCE_STEP_LATENCY.labels(name).time():
+                    step()
+        except Exception:
+            return False
+        return True
+
+
+    def _maintenanceSteps(self):
+        """
+        Generate the steps to run during a maintenance window.
+
+        @return: A generator of C{(name, callable)} pairs, which is sent
+            whether each step succeeded; batched operations are abandoned when
+            one of their steps fails.
+        """
+        if self.compression:
+            position = [0]
+
+            def _recompress():
+                position[0] = self.store.transact(
+                    LookupValue.recompress, self.store, self.compression,
+                    position[0])
+            while position[0] is not None:
+                if not (yield u'recompress', _recompress):
+                    break
+        yield u'storage_stats', lambda: LookupValue.storageStats(self.store)
+        yield u'search_stats', lambda: SearchSuffix.storageStats(self.store)
+        for length in xrange(1, SearchPrefixStatistic.length + 1):
+            index = [None]
+
+            def _recalculate(length=length):
+                index[0] = self.store.transact(
+                    SearchPrefixStatistic.recalculate, self.store, length,
+                    index[0])
+            while (yield u'prefix_stats', _recalculate):
+                if index[0] is None:
+                    break
+        changes = [0]
+
+        def _compact():
+            changes[0] = self.store.transact(
+                Change.compact, self.store, changes[0])
+        while changes[0] is not None:
+            if not (yield u'compact_changes', _compact):
+                break
+        self.store.querySQL(
+            'PRAGMA analysis_limit={:d}'.format(self.analysisLimit))
+        tables = [
+            name for (name,) in self.store.querySQL(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND name LIKE 'item\\_%' ESCAPE '\\'")]
+        for table in tables:
+            yield u'analyze', lambda table=table: self.store.querySQL(
+                'ANALYZE [{}]'.format(table))
+        yield u'optimize', lambda: self.store.querySQL('PRAGMA optimize')
+        [(autoVacuum,)] = self.store.querySQL('PRAGMA auto_vacuum')
+        if autoVacuum != 2:
+            if not (yield u'vacuum', self._convertVacuum):
+                return
+        vacuum = 'PRAGMA incremental_vacuum({:d})'.format(self.vacuumPages)
+        while self._freePages() > 0:
+            if not (yield u'incremental_vacuum',
+                    lambda: self.store.querySQL(vacuum)):
+                break
+
+
+    def _convertVacuum(self):
+        """
+        Switch the database to incremental vacuum mode, rewriting it.
+        """
+        self.store.querySQL('PRAGMA auto_vacuum=INCREMENTAL')
+        self.store.querySQL('VACUUM')
+
+
+    def _freePages(self):
+        """
+        The number of unused pages in the database file.
+        """
+        [(count,)] = self.store.querySQL('PRAGMA freelist_count')
+        return count
+
+
+
+__all__ = ['MaintenanceService', 'parseWindow']
@@ -1,4 +1,4 @@
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 
 
@@ -12,11 +12,41 @@ METRIC_LOOKUP_INSERT_LATENCY = Histogram(
     'Lookup insertion latency in seconds',
     ['environment', 'indexType'])
 
+METRIC_LOOKUP_COMPRESSION_RATIO = Gauge(
+    'lookup_compression_ratio',
+    'Ratio of stored to raw lookup value size',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_DEDUPLICATION_RATIO = Gauge(
+    'lookup_deduplication_ratio',
+    'Ratio of distinct to total lookup value size',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_ENTRIES = Gauge(
+    'lookup_entries',
+    'Number of entries in the lookup index',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_VALUE_BYTES = Gauge(
+    'lookup_value_bytes',
+    'Stored size of the distinct lookup values in bytes',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_REAPED = Counter(
+    'lookup_reaped_total',
+    'Number of expired lookup entries removed',
+    ['environment', 'indexType'])
+
 METRIC_SEARCH_QUERY_LATENCY = Histogram(
     'search_query_latency_seconds',
     'Search query latency in seconds',
     ['searchClass', 'environment', 'indexType'])
 
+METRIC_SEARCH_COUNT_LATENCY = Histogram(
+    'search_count_latency_seconds',
+    'Search count latency in seconds',
+    ['searchClass', 'environment', 'indexType'])
+
 METRIC_SEARCH_INSERT_LATENCY = Histogram(
     'search_insert_latency_seconds',
     'Search insertion latency in seconds',
@@ -31,3 +61,90 @@ METRIC_SEARCH_REJECTED = Counter(
     'search_rejected_count',
     'Searches rejected due to being too general',
     ['searchClass', 'environment', 'indexType'])
+
+METRIC_SEARCH_ENTRIES = Gauge(
+    'search_entries',
+    'Number of entries in the search index',
+    ['searchClass', 'environment', 'indexType'])
+
+METRIC_SEARCH_SUBSTRING_AMPLIFICATION = Gauge(
+    'search_substring_amplification_ratio',
+    'Ratio of substring index size to search value size',
+    ['environment', 'indexType'])
+
+METRIC_DATABASE_FILE_BYTES = Gauge(
+    'database_file_bytes',
+    'Size of the database files in bytes',
+    ['file'])
+
+METRIC_DATABASE_FREE_PAGES = Gauge(
+    'database_free_pages',
+    'Number of unused pages in the database')
+
+METRIC_WARMUP_PROGRESS = Gauge(
+    'warmup_progress_ratio',
+    'Fraction of the hot key manifest replayed since startup')
+
+METRIC_REQUEST_STAGE_LATENCY = Histogram(
+    'request_stage_latency_seconds',
+    'Time spent in each stage of handling a request, in seconds',
+    ['route', 'stage'])
+
+METRIC_SLOW_QUERIES = Counter(
+    'slow_query_count',
+    'Database queries slower than the slow query threshold',
+    ['table', 'plan', 'environment', 'indexType'])
+
+METRIC_MAINTENANCE_STEP_LATENCY = Histogram(
+    'maintenance_step_latency_seconds',
+    'Database maintenance step duration in seconds',
+    ['step'])
+
+METRIC_REPLICATION_LAG_CHANGES = Gauge(
+    'replication_lag_changes',
+    'Number of changes at the primary not yet applied by this replica')
+
+METRIC_REPLICATION_LAG_SECONDS = Gauge(
+    'replication_lag_seconds',
+    'Time since this replica had applied every change at the primary, in '
+    'seconds')
+
+METRIC_ADMISSION_IN_FLIGHT = Gauge(
+    'admission_in_flight_requests',
+    'Number of requests admitted and not yet finished',
+    ['kind'])
+
+METRIC_ADMISSION_QUEUE_DEPTH = Gauge(
+    'admission_queued_requests',
+    'Number of requests waiting to be admitted',
+    ['kind'])
+
+METRIC_ADMISSION_SHED = Counter(
+    'admission_shed_requests_total',
+    'Number of requests rejected because the service was overloaded',
+    ['kind', 'reason'])
+
+METRIC_LOOKUP_FILTER_BYTES = Gauge(
+    'lookup_filter_bytes',
+    'Size of the Bloom filter of lookup keys in bytes',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_FILTER_FALSE_POSITIVE_RATIO = Gauge(
+    'lookup_filter_false_positive_ratio',
+    'Estimated false positive rate of the Bloom filter of lookup keys',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_FILTER_NEGATIVES = Counter(
+    'lookup_filter_negatives_total',
+    'Lookups of missing keys answered by the Bloom filter of lookup keys',
+    ['environment', 'indexType'])
+
+METRIC_LOOKUP_FILTER_FALSE_POSITIVES = Counter(
+    'lookup_filter_false_positives_total',
+    'Lookups of missing keys not ruled out by the Bloom filter of lookup keys',
+    ['environment', 'indexType'])
+
+METRIC_COALESCED_REQUESTS = Counter(
+    'coalesced_requests_total',
+    'Number of requests answered with the result of an identical query',
+    ['route', 'environment', 'indexType'])
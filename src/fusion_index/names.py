@@ -0,0 +1,138 @@
+"""
+Interned index names.
+
+Every lookup and search entry belongs to an index named by its environment and
+index type (and, for search entries, its search class); rather than repeating
+these names in every row, and in the indexes on those rows, entries refer to
+them by the store ID of an L{IndexName}. Names are resolved through an
+in-memory map, so this costs no more queries than storing the names directly.
+"""
+from weakref import WeakKeyDictionary
+
+from axiom.attributes import text
+from axiom.item import Item
+
+
+
+_ASCII_LOWER = {c: c + 32 for c in xrange(ord(u'A'), ord(u'Z') + 1)}
+
+
+
+def _fold(name):
+    """
+    Fold the ASCII case of a name, the way SQLite's C{NOCASE} collation does.
+    """
+    return name.translate(_ASCII_LOWER)
+
+
+
+class IndexName(Item):
+    """
+    An environment, index type or search class name.
+
+    Like the text columns they replace, names are matched ignoring ASCII case;
+    a name is stored as it was first given.
+    """
+    name = text(doc="""
+    The name.
+    """, allowNone=False, indexed=True)
+
+    _maps = WeakKeyDictionary()
+
+    @classmethod
+    def _map(cls, store):
+        """
+        Get the in-memory map of a store's names.
+
+        @return: A L{tuple} of a L{dict} mapping folded names to store IDs,
+            and a L{dict} mapping store IDs to names.
+        """
+        names = cls._maps.get(store)
+        if names is None:
+            names = cls._maps[store] = {}, {}
+        return names
+
+
+    def _remember(self):
+        """
+        Add this name to the in-memory map.
+        """
+        ids, names = self._map(self.store)
+        ids[_fold(self.name)] = self.storeID
+        names[self.storeID] = self.name
+
+
+    def _load(self):
+        """
+        Add this name to the in-memory map, unless it was created by the
+        current transaction, which may yet be reverted; it is added once the
+        transaction is committed.
+        """
+        transaction = self.store.transaction
+        if transaction is None or self not in transaction:
+            self._remember()
+
+
+    def committed(self):
+        Item.committed(self)
+        if self.store is not None:
+            self._remember()
+
+
+    @classmethod
+    def find(cls, store, name):
+        """
+        Find the store ID of a name.
+
+        @type name: L{unicode}
+
+        @rtype: L{int} or L{None}
+        @return: The store ID, or C{None} if the name has never been interned;
+            comparing an attribute with C{None} matches nothing, so the result
+            can be used in queries either way.
+        """
+        ids, _ = cls._map(store)
+        nameID = ids.get(_fold(name))
+        if nameID is None:
+            item = store.findFirst(cls, cls.name == name)
+            if item is not None:
+                item._load()
+                nameID = item.storeID
+        return nameID
+
+
+    @classmethod
+    def intern(cls, store, name):
+        """
+        Find the store ID of a name, storing it if necessary.
+
+        @type name: L{unicode}
+
+        @rtype: L{int}
+        """
+        nameID = cls.find(store, name)
+        if nameID is None:
+            nameID = cls(store=store, name=name).storeID
+        return nameID
+
+
+    @classmethod
+    def lookup(cls, store, nameID):
+        """
+        Get the name with a store ID.
+
+        @type nameID: L{int}
+
+        @rtype: L{unicode}
+        """
+        _, names = cls._map(store)
+        name = names.get(nameID)
+        if name is None:
+            item = store.getItemByID(nameID)
+            item._load()
+            name = item.name
+        return name
+
+
+
+__all__ = ['IndexName']
@@ -0,0 +1,215 @@
+"""
+On-demand profiling of request handling.
+
+A L{Profiler} is switched on for a number of requests or a period of time, and
+profiles the rendering of each request with C{cProfile}, aggregating the
+results per route. When it is not switched on, requests are handled exactly as
+they would be without it.
+"""
+import marshal
+from cProfile import Profile
+from pstats import Stats
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+from twisted.python.compat import nativeString
+from twisted.web.error import UnsupportedMethod
+from txspinneret.interfaces import ISpinneretResource
+from zope.interface import implementer
+
+
+
+def _label(func):
+    """
+    Format a function in a C{pstats} key as a stack frame label.
+    """
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '{}:{}:{}'.format(filename, line, name)
+
+
+
+def collapsedStacks(stats):
+    """
+    Convert profiling statistics to collapsed stacks, as used by flame graph
+    tools.
+
+    C{cProfile} only records callers one level deep, so the time spent in each
+    function is divided between the stacks leading to it in proportion to the
+    time spent in it on behalf of each caller.
+
+    @type stats: L{pstats.Stats}
+
+    @rtype: L{bytes}
+    @return: One line per stack, of the form C{caller;callee microseconds}.
+    """
+    callees = {}
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        for caller, (_, _, _, callerCumulative) in callers.items():
+            if cumulative > 0:
+                callees.setdefault(caller, []).append(
+                    (func, callerCumulative / cumulative))
+    lines = {}
+
+    def _walk(func, stack, fraction):
+        stack = stack + [func]
+        selfTime = stats.stats[func][2] * fraction
+        if selfTime > 0:
+            key = ';'.join(_label(f) for f in stack)
+            lines[key] = lines.get(key, 0) + selfTime
+        for callee, share in callees.get(func, []):
+            if callee not in stack:
+                _walk(callee, stack, fraction * share)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            _walk(func, [], 1.0)
+    return b''.join(
+        '{} {:d}\n'.format(key, int(round(seconds * 1e6)))
+        for key, seconds in sorted(lines.items()))
+
+
+
+@attributes([Attribute('clock', default_value=reactor)])
+class Profiler(object):
+    """
+    Profile request rendering, per route, for a limited number of requests or
+    time.
+    """
+    _remaining = None
+    _deadline = None
+    _profiles = None
+
+    def start(self, requests=None, seconds=None):
+        """
+        Start profiling, discarding the results of any previous profiling.
+
+        @type requests: L{int} or L{None}
+        @param requests: The number of requests to profile, or C{None} for no
+            limit.
+
+        @type seconds: L{float} or L{None}
+        @param seconds: The number of seconds to profile for, or C{None} for
+            no limit.
+
+        @raise ValueError: If neither limit is given.
+        """
+        if requests is None and seconds is None:
+            raise ValueError('A request or time limit is required')
+        self._remaining = requests
+        self._deadline = None
+        if seconds is not None:
+            self._deadline = self.clock.seconds() + seconds
+        self._profiles = {}
+
+
+    def stop(self):
+        """
+        Stop profiling, keeping the results.
+        """
+        self._remaining = self._deadline = None
+
+
+    @property
+    def active(self):
+        """
+        Whether requests are currently being profiled.
+        """
+        if self._remaining is None and self._deadline is None:
+            return False
+        if self._remaining is not None and self._remaining <= 0:
+            return False
+        if (self._deadline is not None and
+                self.clock.seconds() >= self._deadline):
+            return False
+        return True
+
+
+    def wrap(self, route, resource):
+        """
+        Wrap a resource so that rendering it is profiled, if profiling is
+        active.
+
+        @type route: L{unicode}
+        @param route: The route template the resource was found by.
+
+        @param resource: An L{ISpinneretResource}.
+
+        @return: C{resource} if profiling is not active, otherwise a wrapper
+            around it.
+        """
+        if not self.active:
+            return resource
+        if self._remaining is not None:
+            self._remaining -= 1
+        profile, counter = self._profiles.setdefault(route, (Profile(), [0]))
+        return _ProfiledResource(
+            resource=resource, profile=profile, counter=counter)
+
+
+    def routes(self):
+        """
+        The number of requests profiled for each route.
+
+        @rtype: L{dict} mapping L{unicode} to L{int}
+        """
+        return {
+            route: counter[0]
+            for route, (_, counter) in (self._profiles or {}).items()}
+
+
+    def stats(self, route=None):
+        """
+        Get the profiling statistics.
+
+        @type route: L{unicode} or L{None}
+        @param route: The route to get statistics for, or C{None} for all
+            routes combined.
+
+        @rtype: L{pstats.Stats} or L{None}
+        @return: The statistics, or C{None} if nothing has been profiled.
+        """
+        profiles = [
+            profile for r, (profile, counter) in (self._profiles or {}).items()
+            if counter[0] > 0 and (route is None or r == route)]
+        if not profiles:
+            return None
+        stats = Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+
+@implementer(ISpinneretResource)
+@attributes(['resource', 'profile', 'counter'])
+class _ProfiledResource(object):
+    """
+    Profile rendering a resource.
+    """
+    def render(self, request):
+        method = getattr(
+            self.resource, 'render_' + nativeString(request.method), None)
+        if method is None:
+            raise UnsupportedMethod([
+                name[len('render_'):] for name in dir(self.resource)
+                if name.startswith('render_')])
+        self.counter[0] += 1
+        return self.profile.runcall(method, request)
+
+
+
+def dumpStats(stats):
+    """
+    Serialize profiling statistics in the format written by
+    L{pstats.Stats.dump_stats}.
+
+    @type stats: L{pstats.Stats}
+
+    @rtype: L{bytes}
+    """
+    return marshal.dumps(stats.stats)
+
+
+
+__all__ = ['Profiler', 'collapsedStacks', 'dumpStats']
@@ -0,0 +1,370 @@
+"""
+Read-only replicas of the index service.
+
+A replica copies the indexes of a primary with L{Follower}, which first copies
+a snapshot of the primary's entries, a page at a time, and then tails the
+primary's change log, applying each batch of changes in a single transaction.
+The position reached is stored in the same transaction, so a replica that is
+restarted carries on where it left off.
+"""
+import json
+import os
+from base64 import b64decode
+from StringIO import StringIO
+from tempfile import TemporaryFile
+from urllib import quote
+
+from axiom.attributes import AND, integer, text
+from axiom.item import Item
+from characteristic import Attribute, attributes
+from eliot import write_failure
+from epsilon.extime import Time
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.protocol import Protocol
+from twisted.web import http
+from twisted.web.client import ResponseDone, readBody
+
+from fusion_index.changes import ChangeKinds
+from fusion_index.lookup import Blob, LookupEntry
+from fusion_index.metrics import (
+    METRIC_REPLICATION_LAG_CHANGES, METRIC_REPLICATION_LAG_SECONDS)
+from fusion_index.search import SearchClasses, SearchEntry
+
+
+
+class ReplicaTooFarBehind(Exception):
+    """
+    Changes the replica has not applied yet have been removed from the
+    primary's change log by retention.
+    """
+
+
+
+class ReplicationState(Item):
+    """
+    How much of the primary's indexes a replica has copied.
+    """
+    snapshot = text(doc="""
+    The indexes currently being copied from a snapshot (C{u'lookup'} or
+    C{u'search'}), or C{None} once the snapshot has been copied.
+    """, default=u'lookup')
+
+    snapshotAfter = integer(doc="""
+    The position reached in the snapshot of the indexes being copied.
+    """, allowNone=False, default=0)
+
+    sequence = integer(doc="""
+    The sequence number of the last change applied, or C{None} if the first
+    page of the snapshot has not been copied yet.
+    """)
+
+
+
+class _BodyWriter(Protocol):
+    """
+    Write a response body to a file.
+    """
+    def __init__(self, f, finished):
+        self.f = f
+        self.finished = finished
+
+
+    def dataReceived(self, data):
+        self.f.write(data)
+
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone):
+            self.finished.callback(self.f)
+        else:
+            self.f.close()
+            self.finished.errback(reason)
+
+
+
+def _value(store, change, blobThreshold):
+    """
+    Get the value of a lookup change, as a L{Blob} if it is at least
+    C{blobThreshold} bytes long and the store has a file area.
+    """
+    if change.get(u'blob'):
+        content = change[u'content']
+    else:
+        content = StringIO(b64decode(change[u'value']))
+    try:
+        content.seek(0, os.SEEK_END)
+        size = content.tell()
+        content.seek(0)
+        if (blobThreshold is not None and store.filesdir is not None and
+                size >= blobThreshold):
+            return Blob.fromFile(store, content)
+        return content.read()
+    finally:
+        content.close()
+
+
+
+def applyChange(store, change, compression=None, blobThreshold=None):
+    """
+    Apply a change, as returned by the change log and snapshot resources of
+    the primary.
+
+    @type change: L{dict}
+    @param change: The change; the value of a lookup change that refers to a
+        value stored in a file at the primary (C{blob}) must have been fetched
+        into the file C{content}.
+
+    @param compression: A mapping from index types to L{Compression} policies.
+
+    @type blobThreshold: L{int} or L{None}
+    @param blobThreshold: Lookup values at least this many bytes long are
+        stored in files, if the store has a file area.
+    """
+    kind = ChangeKinds.lookupByValue(change[u'kind'])
+    environment = change[u'environment']
+    indexType = change[u'indexType']
+    key = change[u'key']
+    if kind == ChangeKinds.LOOKUP_SET:
+        if change.get(u'value') is None and not change.get(u'blob'):
+            entry = store.findUnique(
+                LookupEntry,
+                AND(LookupEntry.inIndex(store, environment, indexType),
+                    LookupEntry.key == key),
+                None)
+            if entry is not None:
+                entry._remove()
+        else:
+            expires = change.get(u'expires')
+            if expires is not None:
+                expires = Time.fromPOSIXTimestamp(expires)
+            LookupEntry.set(
+                store, environment, indexType, key,
+                _value(store, change, blobThreshold),
+                (compression or {}).get(indexType), expires)
+        return
+    searchClass = SearchClasses.lookupByValue(change[u'searchClass'])
+    if kind == ChangeKinds.SEARCH_INSERT:
+        SearchEntry.insert(
+            store, searchClass, environment, indexType, key,
+            change[u'searchType'], change[u'searchValue'])
+    else:
+        SearchEntry.remove(
+            store, searchClass, environment, indexType, key,
+            change[u'searchType'])
+
+
+
+@attributes(
+    ['store',
+     'agent',
+     'primary',
+     Attribute('compression', default_factory=dict),
+     Attribute('blobThreshold', default_value=None),
+     Attribute('batchSize', default_value=1000),
+     Attribute('wait', default_value=30.0),
+     Attribute('retryInterval', default_value=5.0),
+     Attribute('clock', default_value=reactor)])
+class Follower(Service):
+    """
+    Copy the indexes of the primary at the URL C{primary} into C{store}, and
+    keep them up to date.
+
+    Snapshot pages and batches of changes are requested with C{agent}, up to
+    C{batchSize} at a time; requests for changes wait up to C{wait} seconds for
+    new changes. Values the primary stores in files are fetched one at a time,
+    into temporary files, before the page or batch that refers to them is
+    applied; values at least C{blobThreshold} bytes long are stored in files
+    here too. After a failed request, the next one is made after
+    C{retryInterval} seconds. If the replica falls so far behind that changes
+    it needs have been removed from the primary's change log, it stops
+    following the primary, and must be started again from an empty store.
+
+    @ivar failed: Whether the replica has stopped following the primary
+        because it fell too far behind.
+    """
+    failed = False
+    _call = None
+    _request = None
+    _caughtUp = None
+
+    @property
+    def ready(self):
+        """
+        Whether the snapshot has been copied, and the replica is still
+        following the primary.
+        """
+        state = self.store.findFirst(ReplicationState)
+        return (
+            not self.failed and state is not None and state.snapshot is None)
+
+
+    def startService(self):
+        Service.startService(self)
+        self._caughtUp = self.clock.seconds()
+        self._poll()
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._request is not None:
+            self._request.cancel()
+
+
+    def _poll(self):
+        """
+        Copy the next snapshot page or batch of changes, and schedule the next
+        poll.
+        """
+        self._call = None
+
+        def _failed(f):
+            if f.check(CancelledError):
+                return None
+            write_failure(f)
+            if f.check(ReplicaTooFarBehind):
+                self.failed = True
+                return None
+            return self.retryInterval
+        d = self._request = self._next()
+        d.addCallbacks(lambda _: 0, _failed)
+        d.addCallback(self._schedule)
+
+
+    def _schedule(self, delay):
+        self._request = None
+        if delay is not None and self.running:
+            self._call = self.clock.callLater(delay, self._poll)
+
+
+    def _next(self):
+        """
+        Copy the next snapshot page or batch of changes.
+        """
+        state = self.store.transact(
+            self.store.findOrCreate, ReplicationState)
+        if state.snapshot is not None:
+            d = self._get(
+                b'/snapshot/{}?after={:d}&limit={:d}'.format(
+                    state.snapshot.encode('ascii'), state.snapshotAfter,
+                    self.batchSize))
+            d.addCallback(
+                lambda page: self._fetchBlobs(page[u'entries']).addCallback(
+                    lambda _: self.store.transact(
+                        self._applySnapshot, state, page)))
+        else:
+            d = self._get(
+                b'/changes?after={:d}&limit={:d}&wait={:f}'.format(
+                    state.sequence, self.batchSize, self.wait))
+            d.addCallback(
+                lambda changes: self._fetchBlobs(
+                    changes[u'changes']).addCallback(
+                        lambda _: self.store.transact(
+                            self._applyChanges, state, changes)))
+        return d
+
+
+    def _get(self, path):
+        """
+        Make a request to the primary.
+
+        @return: A L{Deferred} firing with the decoded JSON response.
+        """
+        def _response(response):
+            if response.code == http.GONE:
+                raise ReplicaTooFarBehind(
+                    'Changes after {} are no longer available at {}'.format(
+                        path, self.primary))
+            if response.code != http.OK:
+                raise ValueError(
+                    'Unexpected response {} from {}'.format(
+                        response.code, self.primary))
+            return readBody(response).addCallback(json.loads)
+        d = self.agent.request(b'GET', self.primary.rstrip(b'/') + path)
+        d.addCallback(_response)
+        return d
+
+
+    def _fetchBlobs(self, changes):
+        """
+        Fetch the values of lookup changes that refer to values stored in
+        files at the primary, one at a time, into temporary files.
+
+        A change to an entry that no longer exists at the primary becomes a
+        deletion; the primary's change log will have a later change deleting
+        it.
+        """
+        d = succeed(None)
+        for change in changes:
+            if change.get(u'blob'):
+                d.addCallback(lambda _, change=change: self._fetchBlob(change))
+        return d
+
+
+    def _fetchBlob(self, change):
+        """
+        Fetch the value of a lookup change into a temporary file.
+        """
+        def _response(response):
+            if response.code == http.NOT_FOUND:
+                change[u'blob'] = False
+                change[u'value'] = None
+                return None
+            if response.code != http.OK:
+                raise ValueError(
+                    'Unexpected response {} from {}'.format(
+                        response.code, self.primary))
+            finished = Deferred()
+            response.deliverBody(_BodyWriter(TemporaryFile(), finished))
+            finished.addCallback(
+                lambda content: change.__setitem__(u'content', content))
+            return finished
+        path = b'/'.join(
+            [b'', b'lookup'] +
+            [quote(change[name].encode('utf-8'), safe=b'')
+             for name in [u'environment', u'indexType', u'key']])
+        d = self.agent.request(b'GET', self.primary.rstrip(b'/') + path)
+        d.addCallback(_response)
+        return d
+
+
+    def _applySnapshot(self, state, page):
+        """
+        Apply a page of the snapshot.
+        """
+        if state.sequence is None:
+            state.sequence = page[u'sequence']
+        for entry in page[u'entries']:
+            applyChange(
+                self.store, entry, self.compression, self.blobThreshold)
+        if page[u'next'] is not None:
+            state.snapshotAfter = page[u'next']
+        elif state.snapshot == u'lookup':
+            state.snapshot = u'search'
+            state.snapshotAfter = 0
+        else:
+            state.snapshot = None
+
+
+    def _applyChanges(self, state, changes):
+        """
+        Apply a batch of changes, and publish the replication lag.
+        """
+        for change in changes[u'changes']:
+            applyChange(
+                self.store, change, self.compression, self.blobThreshold)
+        state.sequence = changes[u'next']
+        now = self.clock.seconds()
+        if changes[u'next'] >= changes[u'latest']:
+            self._caughtUp = now
+        METRIC_REPLICATION_LAG_CHANGES.set(
+            max(changes[u'latest'] - changes[u'next'], 0))
+        METRIC_REPLICATION_LAG_SECONDS.set(now - self._caughtUp)
+
+
+
+__all__ = ['Follower', 'ReplicaTooFarBehind', 'applyChange']
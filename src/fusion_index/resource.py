@@ -1,132 +1,1194 @@
 import json
+import os
+from base64 import b64encode
+from datetime import timedelta
+from hmac import compare_digest
 
-from characteristic import attributes
+from characteristic import Attribute, attributes
+from epsilon.extime import Time
 from prometheus_client.twisted import MetricsResource
 from toolz.dicttoolz import merge
+from toolz.itertoolz import concat
+from twisted.internet.defer import CancelledError
+from twisted.protocols.basic import FileSender
+from twisted.python.compat import intToBytes
 from twisted.web import http
+from twisted.web.resource import ErrorPage, ForbiddenResource
+from twisted.web.server import NOT_DONE_YET
 from txspinneret.interfaces import ISpinneretResource
 from txspinneret.resource import NotFound
 from txspinneret.route import Router, Text, routedResource
 from zope.interface import implementer
 
+from fusion_index.changes import Change, ChangeKinds
 from fusion_index.logging import (
-    LOG_LOOKUP_GET, LOG_LOOKUP_PUT, LOG_SEARCH_DELETE, LOG_SEARCH_GET,
-    LOG_SEARCH_PUT)
-from fusion_index.lookup import LookupEntry
-from fusion_index.search import SearchClasses, SearchEntry
+    LOG_CHANGES_GET, LOG_LOOKUP_DELETE_PREFIX, LOG_LOOKUP_GET,
+    LOG_LOOKUP_GET_MANY, LOG_LOOKUP_LIST, LOG_LOOKUP_PUT, LOG_SEARCH_COUNT,
+    LOG_SEARCH_DELETE, LOG_SEARCH_GET, LOG_SEARCH_MANY, LOG_SEARCH_PUT)
+from fusion_index.lookup import (
+    Blob, Encodings, LookupEntry, decode, parseTTL)
+from fusion_index.profiling import Profiler, collapsedStacks, dumpStats
+from fusion_index.search import SearchClasses, SearchEntry, SearchTooBroad
+from fusion_index.stats import IndexStatistics
+from fusion_index.timing import (
+    setIndex, setRoute, stage, timedContext, timedRoute)
 
 
 
-@attributes(['store'])
+def _acceptsEncoding(request, encoding):
+    """
+    Determine whether the client accepts a response with the given
+    content-coding.
+
+    @type encoding: L{bytes}
+    @param encoding: The content-coding.
+
+    @rtype: L{bool}
+    """
+    for header in request.requestHeaders.getRawHeaders(b'Accept-Encoding', []):
+        for coding in header.split(b','):
+            params = coding.split(b';')
+            if params[0].strip().lower() != encoding:
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition(b'=')
+                if name.strip() == b'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+
+def _etag(content):
+    """
+    The entity tag of a lookup value.
+
+    The tag is weak, since the representation of the value depends on the
+    content-coding negotiated.
+
+    @type content: L{LookupValue}
+
+    @rtype: L{bytes}
+    """
+    return b'W/"{}"'.format(content.digest.encode('ascii'))
+
+
+
+def _etagMatches(request, etag):
+    """
+    Determine whether a request's C{If-None-Match} header matches an entity
+    tag, using the weak comparison function.
+
+    @type etag: L{bytes}
+
+    @rtype: L{bool}
+    """
+    def _opaque(tag):
+        tag = tag.strip()
+        if tag.startswith(b'W/'):
+            tag = tag[2:]
+        return tag
+    for header in request.requestHeaders.getRawHeaders(b'If-None-Match', []):
+        for tag in header.split(b','):
+            if tag.strip() == b'*' or _opaque(tag) == _opaque(etag):
+                return True
+    return False
+
+
+
+def _routed(profiler, route, resource, params=None):
+    """
+    Record the route template a resource was found by, for request timing and
+    profiling, and the index it is for, if C{params} has one.
+    """
+    setRoute(route)
+    if params is not None and 'indexType' in params:
+        setIndex(params['environment'], params['indexType'])
+    return profiler.wrap(route, resource)
+
+
+
+def _logged(action):
+    """
+    Time an Eliot action's start and end messages as logging.
+    """
+    return timedContext(u'log', action)
+
+
+
+def _json(request, value):
+    """
+    Encode a JSON response.
+    """
+    request.setHeader('Content-Type', 'application/json')
+    with stage(u'serialize'):
+        return json.dumps(value)
+
+
+
+def _readOnly(primary):
+    """
+    Reject a request to modify the indexes of a read-only replica.
+    """
+    return ErrorPage(
+        http.FORBIDDEN, 'Read-only replica',
+        'Changes must be made at the primary, {}'.format(primary))
+
+
+
+def _addValue(result, content):
+    """
+    Add the value of a lookup entry to its description in a response with
+    several entries: base64-encoded as C{value} or, if the value is stored in
+    a file, as just a true C{blob}, so that such values never make the
+    response too large; the client can get them from the entry's own
+    resource, which streams them.
+
+    @type result: L{dict}
+
+    @type content: L{fusion_index.lookup.LookupValue}
+    """
+    if content.blob is None:
+        result[u'value'] = b64encode(decode(*content.encoded()))
+    else:
+        result[u'blob'] = True
+
+
+
+def _lookupChange(environment, indexType, key, entry):
+    """
+    Format the value of a lookup entry as a change.
+
+    Values stored in files are left out, as with L{_addValue}.
+
+    @type entry: L{LookupEntry} or L{None}
+    @param entry: The entry, or C{None} if there is no entry.
+    """
+    result = {
+        u'kind': ChangeKinds.LOOKUP_SET.value,
+        u'environment': environment,
+        u'indexType': indexType,
+        u'key': key,
+        u'expires': None}
+    if entry is None:
+        result[u'value'] = None
+    else:
+        _addValue(result, entry.content)
+        if entry.expires is not None:
+            result[u'expires'] = entry.expires.asPOSIXTimestamp()
+    return result
+
+
+
+@attributes(
+    ['store',
+     Attribute('compression', default_factory=dict),
+     Attribute('ttl', default_factory=dict),
+     Attribute('blobThreshold', default_value=None),
+     Attribute('blobMmap', default_value=False),
+     Attribute('substring', default_factory=frozenset),
+     Attribute('prefixLimit', default_value=None),
+     Attribute('adminToken', default_value=None),
+     Attribute('profiler', default_factory=Profiler),
+     Attribute('statistics', default_value=None),
+     Attribute('hotKeys', default_value=None),
+     Attribute('warmup', default_value=None),
+     Attribute('changeFeed', default_value=None),
+     Attribute('primary', default_value=None),
+     Attribute('follower', default_value=None),
+     Attribute('filters', default_value=None),
+     Attribute('coalescer', default_value=None)])
 class IndexRouter(object):
+    """
+    The index service.
+
+    Lookup entries set without a TTL expire after the default TTL for their
+    index type in C{ttl}, if any.
+
+    Administrative resources under C{admin} are only available if
+    C{adminToken} is set, to requests that include it as a bearer token in
+    their C{Authorization} header.
+
+    Index statistics are served from C{statistics}, if given, or else
+    computed on demand and cached for a minute.
+
+    Lookup and search requests are recorded in C{hotKeys}, if given; the
+    service is ready once the store has been fully upgraded, and C{warmup},
+    if given, is.
+
+    Requests for the change log can only wait for changes if C{changeFeed} is
+    given.
+
+    If this is a read-only replica of the service at the URL C{primary},
+    requests to modify the indexes are rejected; the replica is ready once its
+    C{follower} has copied the primary's indexes.
+
+    Lookups of keys that C{filters}, if given, rule out are answered without
+    querying the store; identical lookups and searches share their results
+    through C{coalescer}, if given.
+    """
     router = Router()
+    _upgraded = None
+
+    def _storeUpgraded(self):
+        """
+        Whether every item in the store has been upgraded to its current
+        schema version.
+
+        Items are only upgraded when they are loaded, or in the background, so
+        until then lookups and searches miss entries that have not been
+        upgraded yet.
+        """
+        if self._upgraded is None:
+            self._upgraded = False
+            def upgraded(_):
+                self._upgraded = True
+            self.store.whenFullyUpgraded().addCallback(upgraded)
+        return self._upgraded
+
+
+    def _indexStatistics(self):
+        """
+        The L{IndexStatistics} of the store.
+        """
+        if self.statistics is None:
+            self.statistics = IndexStatistics(store=self.store)
+        return self.statistics
+
 
     @router.route(
         b'lookup', Text('environment'), Text('indexType'), Text('key'))
+    @timedRoute
     def lookup(self, request, params):
-        return LookupResource(store=self.store, **params)
+        if self.primary is not None and request.method != b'GET':
+            return _readOnly(self.primary)
+        if self.hotKeys is not None and request.method == b'GET':
+            self.hotKeys.lookup(
+                params['environment'], params['indexType'], params['key'])
+        blobThreshold = self.blobThreshold
+        if self.store.filesdir is None:
+            blobThreshold = None
+        return _routed(self.profiler, u'lookup', LookupResource(
+            store=self.store,
+            compression=self.compression.get(params['indexType']),
+            ttl=self.ttl.get(params['indexType']),
+            blobThreshold=blobThreshold,
+            blobMmap=self.blobMmap,
+            filters=self.filters,
+            coalescer=self.coalescer,
+            **params), params)
+
+
+    @router.route(b'lookup', Text('environment'), Text('indexType'))
+    @timedRoute
+    def lookupMany(self, request, params):
+        if self.primary is not None and request.method == b'DELETE':
+            return _readOnly(self.primary)
+        return _routed(self.profiler, u'lookup/many', LookupManyResource(
+            store=self.store, hotKeys=self.hotKeys, filters=self.filters,
+            **params), params)
 
 
     @router.subroute(
         b'search', Text('searchClass'), Text('environment'), Text('indexType'))
+    @timedRoute
     def search(self, request, params):
         try:
             params['searchClass'] = SearchClasses.lookupByValue(
                 params['searchClass'])
         except ValueError:
             return NotFound()
-        return SearchResource(store=self.store, params=params)
+        if (params['searchClass'] == SearchClasses.SUBSTRING and
+                params['indexType'] not in self.substring):
+            return NotFound()
+        return SearchResource(
+            store=self.store,
+            params=params,
+            maxMatches=self.prefixLimit,
+            profiler=self.profiler,
+            hotKeys=self.hotKeys,
+            primary=self.primary,
+            coalescer=self.coalescer)
+
+
+    @router.route(b'search')
+    @timedRoute
+    def searchMany(self, request, params):
+        return _routed(self.profiler, u'search', MultiSearchResource(
+            store=self.store,
+            substring=self.substring,
+            maxMatches=self.prefixLimit))
+
+
+    @router.route(b'changes')
+    @timedRoute
+    def changes(self, request, params):
+        return _routed(self.profiler, u'changes', ChangesResource(
+            store=self.store, changeFeed=self.changeFeed))
+
+
+    @router.route(b'snapshot', Text('index'))
+    @timedRoute
+    def snapshot(self, request, params):
+        if params['index'] not in SnapshotResource.indexes:
+            return NotFound()
+        return _routed(self.profiler, u'snapshot', SnapshotResource(
+            store=self.store, index=params['index']))
 
 
     @router.route(b'metrics')
+    @timedRoute
     def metrics(self, request, params):
+        setRoute(u'metrics')
+        self._indexStatistics().get()
         return MetricsResource()
 
 
+    @router.route(b'stats')
+    @timedRoute
+    def stats(self, request, params):
+        setRoute(u'stats')
+        return StatisticsResource(statistics=self._indexStatistics())
+
+
+    @router.route(b'ready')
+    @timedRoute
+    def ready(self, request, params):
+        setRoute(u'ready')
+        return ReadinessResource(
+            warmup=self.warmup,
+            follower=self.follower,
+            upgraded=self._storeUpgraded())
+
+
+    @router.subroute(b'admin')
+    @timedRoute
+    def admin(self, request, params):
+        setRoute(u'admin')
+        if self.adminToken is None:
+            return NotFound()
+        [authorization] = request.requestHeaders.getRawHeaders(
+            b'Authorization', [b''])[:1]
+        scheme, _, token = authorization.partition(b' ')
+        if not (scheme.lower() == b'bearer' and
+                compare_digest(token.strip(), self.adminToken)):
+            return ForbiddenResource()
+        return AdminResource(profiler=self.profiler)
+
+
 
 @implementer(ISpinneretResource)
-@attributes(['store', 'environment', 'indexType', 'key'])
+@attributes(
+    ['store', 'environment', 'indexType', 'key', 'compression',
+     'blobThreshold', 'blobMmap', Attribute('ttl', default_value=None),
+     Attribute('filters', default_value=None),
+     Attribute('coalescer', default_value=None)])
 class LookupResource(object):
+    """
+    A lookup index entry.
+
+    An entry can be set with a TTL in seconds, given by the C{X-TTL} request
+    header or otherwise by C{ttl}, after which it is treated as missing.
+
+    Lookups share their results with identical lookups through C{coalescer},
+    if given.
+    """
     def render_GET(self, request):
         action = LOG_LOOKUP_GET(
             environment=self.environment,
             indexType=self.indexType,
             key=self.key)
-        with action as a:
+        with _logged(action) as a:
             try:
-                result = self.store.transact(
-                    LookupEntry.get,
-                    store=self.store,
-                    environment=self.environment,
-                    indexType=self.indexType,
-                    key=self.key)
+                content = self._getContent()
             except KeyError:
-                a.add_success_fields(value=None)
+                a.add_success_fields(value=None, encoding=None, size=None)
                 return NotFound()
             else:
+                etag = _etag(content)
+                request.setHeader(b'ETag', etag)
+                if _etagMatches(request, etag):
+                    a.add_success_fields(
+                        value=None, encoding=None, size=content.size)
+                    request.setResponseCode(http.NOT_MODIFIED)
+                    return b''
                 request.setHeader(b'Content-Type', b'application/octet-stream')
-                a.add_success_fields(value=result)
+                if content.blob is not None:
+                    a.add_success_fields(
+                        value=None, encoding=None, size=content.size)
+                    return self._sendBlob(request, content)
+                encoding, result = content.encoded()
+                if encoding == Encodings.IDENTITY:
+                    a.add_success_fields(
+                        value=result, encoding=None, size=content.size)
+                    return result
+                request.setHeader(b'Vary', b'Accept-Encoding')
+                if _acceptsEncoding(request, encoding.value.encode('ascii')):
+                    request.setHeader(
+                        b'Content-Encoding', encoding.value.encode('ascii'))
+                    a.add_success_fields(
+                        value=result, encoding=encoding.value,
+                        size=content.size)
+                else:
+                    result = decode(encoding, result)
+                    a.add_success_fields(
+                        value=result, encoding=None, size=content.size)
                 return result
 
 
+    def _getContent(self):
+        """
+        Get the stored value, unless the filters rule out the key.
+
+        @raises KeyError: if the entry does not exist.
+        """
+        if self.filters is None:
+            return self._query()
+        if not self.filters.mightContain(
+                self.environment, self.indexType, self.key):
+            raise KeyError(self.key)
+        try:
+            return self._query()
+        except KeyError:
+            self.filters.missed(self.environment, self.indexType)
+            raise
+
+
+    def _query(self):
+        """
+        Query the store for the stored value, or share the result of an
+        identical query.
+        """
+        args = (LookupEntry.getContent,
+                self.store, self.environment, self.indexType, self.key)
+        if self.coalescer is None:
+            return self.store.transact(*args)
+        return self.coalescer.query(
+            u'lookup', self.environment, self.indexType, self.key,
+            self.store.transact, *args)
+
+
+    def _sendBlob(self, request, content):
+        """
+        Stream a value stored in a file to the client.
+        """
+        f = content.open(useMmap=self.blobMmap)
+        request.setHeader(b'Content-Length', intToBytes(content.size))
+
+        def _close(result):
+            f.close()
+            return result
+        d = FileSender().beginFileTransfer(f, request)
+        d.addBoth(_close)
+        d.addCallback(lambda ignored: b'')
+        return d
+
+
     def render_PUT(self, request):
         action = LOG_LOOKUP_PUT(
             environment=self.environment,
             indexType=self.indexType,
             key=self.key)
-        with action as a:
-            value = request.content.read()
-            a.add_success_fields(value=value)
-            self.store.transact(
-                LookupEntry.set,
-                store=self.store,
-                environment=self.environment,
-                indexType=self.indexType,
-                key=self.key,
-                value=value)
+        with _logged(action) as a:
+            try:
+                expires = self._expires(request)
+            except ValueError as e:
+                request.setResponseCode(http.BAD_REQUEST)
+                return 'Invalid TTL: {}'.format(e)
+            value = self._readValue(request)
+            if isinstance(value, Blob):
+                a.add_success_fields(value=None, size=value.size)
+            else:
+                a.add_success_fields(value=value, size=len(value))
+            try:
+                self.store.transact(
+                    LookupEntry.set,
+                    store=self.store,
+                    environment=self.environment,
+                    indexType=self.indexType,
+                    key=self.key,
+                    value=value,
+                    compression=self.compression,
+                    expires=expires)
+            except:
+                if isinstance(value, Blob) and value.path.exists():
+                    value.discard()
+                raise
             request.setResponseCode(http.NO_CONTENT)
             return ''
 
 
+    def _expires(self, request):
+        """
+        Determine when an entry being set expires.
+
+        @rtype: L{Time} or L{None}
+        """
+        [ttl] = request.requestHeaders.getRawHeaders(
+            b'X-TTL', [self.ttl])[:1]
+        if ttl is None:
+            return None
+        try:
+            return Time() + timedelta(seconds=parseTTL(ttl))
+        except OverflowError:
+            raise ValueError('TTL is too far in the future')
+
+
+    def _readValue(self, request):
+        """
+        Read the request body, into a L{Blob} if it is at least
+        C{blobThreshold} bytes long.
+        """
+        content = request.content
+        if self.blobThreshold is not None:
+            content.seek(0, os.SEEK_END)
+            size = content.tell()
+            content.seek(0)
+            if size >= self.blobThreshold:
+                return Blob.fromFile(self.store, content)
+        return content.read()
+
+
+
+@implementer(ISpinneretResource)
+@attributes(
+    ['store',
+     'environment',
+     'indexType',
+     Attribute('hotKeys', default_value=None),
+     Attribute('filters', default_value=None),
+     Attribute('maxKeys', default_value=1000)])
+class LookupManyResource(object):
+    """
+    Several values from a lookup index.
+
+    The request body is a JSON object with the keys to look up (at most
+    C{maxKeys}) as C{keys}, and optionally an object mapping keys to the entity
+    tags of values the client already has as C{etags}. The response is an
+    object with C{entries}, mapping each key to C{null} if there is no entry,
+    or otherwise an object with the entity tag of the value as C{etag} and,
+    unless it matches the one given in the request, the value, base64-encoded,
+    as C{value}. Values stored in files are not included; C{blob} is true
+    instead, and they must be fetched from the entry's own resource.
+
+    C{GET} lists the keys in the index, in order, as C{keys}: those starting
+    with the C{prefix} query parameter, after the C{after} query parameter, up
+    to the C{limit} query parameter (default 100, at most C{maxKeys}). The key
+    to pass as C{after} to get the next page is C{next}, or C{null} if there
+    are no more. If the C{values} query parameter is C{true}, C{entries} maps
+    each key to an object with the entity tag and value, as above.
+
+    C{DELETE} removes up to the C{limit} query parameter (default and at most
+    C{maxKeys}) entries with keys starting with the C{prefix} query parameter,
+    which is required. The response is an object with the number of entries
+    removed as C{deleted}, and whether there may be more as C{more}.
+    """
+    def _listing(self, request, defaultLimit):
+        """
+        Parse the query parameters of a listing.
+
+        @return: A L{tuple} of the prefix, the key to list after or C{None},
+            and the limit.
+        """
+        prefix = request.args.get(b'prefix', [b''])[0].decode('utf-8')
+        after = request.args.get(b'after')
+        if after is not None:
+            after = after[0].decode('utf-8')
+        limit = int(request.args.get(b'limit', [defaultLimit])[0])
+        if not 0 < limit <= self.maxKeys:
+            raise ValueError(
+                'limit must be between 1 and {:d}'.format(self.maxKeys))
+        return prefix, after, limit
+
+
+    def render_GET(self, request):
+        try:
+            prefix, after, limit = self._listing(request, 100)
+            values = request.args.get(b'values', [b'false'])[0]
+            if values not in (b'true', b'false'):
+                raise ValueError('values must be true or false')
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid listing: {}'.format(e)
+        with _logged(LOG_LOOKUP_LIST(
+                environment=self.environment,
+                indexType=self.indexType,
+                prefix=prefix,
+                after=after,
+                limit=limit)) as action:
+            result = self.store.transact(
+                self._list, prefix, after, limit, values == b'true')
+            action.add_success_fields(count=len(result[u'keys']))
+            return _json(request, result)
+
+
+    def _list(self, prefix, after, limit, values):
+        """
+        List a page of the keys in the index, and optionally their values.
+        """
+        entries = LookupEntry.listEntries(
+            self.store, self.environment, self.indexType, prefix, after,
+            limit)
+        keys = [entry.key for entry in entries]
+        result = {
+            u'keys': keys,
+            u'next': keys[-1] if len(keys) == limit else None}
+        if values:
+            result[u'entries'] = {}
+            for entry in entries:
+                result[u'entries'][entry.key] = {
+                    u'etag': _etag(entry.content).decode('ascii')}
+                _addValue(result[u'entries'][entry.key], entry.content)
+        return result
+
+
+    def render_DELETE(self, request):
+        try:
+            if b'prefix' not in request.args:
+                raise ValueError('prefix is required')
+            prefix, _, limit = self._listing(request, self.maxKeys)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid delete: {}'.format(e)
+        with _logged(LOG_LOOKUP_DELETE_PREFIX(
+                environment=self.environment,
+                indexType=self.indexType,
+                prefix=prefix,
+                limit=limit)) as action:
+            deleted = self.store.transact(
+                LookupEntry.deletePrefix, self.store, self.environment,
+                self.indexType, prefix, limit)
+            action.add_success_fields(deleted=deleted)
+            return _json(
+                request, {u'deleted': deleted, u'more': deleted == limit})
+
+
+    def render_POST(self, request):
+        try:
+            body = json.loads(request.content.read())
+            keys = body[u'keys']
+            etags = body.get(u'etags', {})
+            if not (isinstance(keys, list) and
+                    all(isinstance(key, unicode) for key in keys)):
+                raise ValueError('keys must be a list of strings')
+            if len(keys) > self.maxKeys:
+                raise ValueError(
+                    'At most {:d} keys are allowed'.format(self.maxKeys))
+            if not isinstance(etags, dict):
+                raise ValueError('etags must be an object')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid lookup: {}'.format(e)
+        if self.hotKeys is not None:
+            for key in keys:
+                self.hotKeys.lookup(self.environment, self.indexType, key)
+        with _logged(LOG_LOOKUP_GET_MANY(
+                environment=self.environment,
+                indexType=self.indexType,
+                keys=keys)) as action:
+            entries = self.store.transact(self._entries, keys, etags)
+            action.add_success_fields(
+                found=sum(1 for entry in entries.values() if entry))
+            return _json(request, {u'entries': entries})
+
+
+    def _entries(self, keys, etags):
+        """
+        Look up the values of some keys.
+        """
+        entries = {}
+        for key in keys:
+            if not (self.filters is None or self.filters.mightContain(
+                    self.environment, self.indexType, key)):
+                entries[key] = None
+                continue
+            try:
+                content = LookupEntry.getContent(
+                    self.store, self.environment, self.indexType, key)
+            except KeyError:
+                if self.filters is not None:
+                    self.filters.missed(self.environment, self.indexType)
+                entries[key] = None
+                continue
+            etag = _etag(content)
+            entries[key] = {u'etag': etag.decode('ascii')}
+            if etags.get(key) != entries[key][u'etag']:
+                _addValue(entries[key], content)
+        return entries
+
+
+
+@implementer(ISpinneretResource)
+@attributes(
+    ['store',
+     'changeFeed',
+     Attribute('maxLimit', default_value=10000),
+     Attribute('maxBytes', default_value=16 * 1024 * 1024),
+     Attribute('maxWait', default_value=60.0)])
+class ChangesResource(object):
+    """
+    The change log.
+
+    Returns the changes after the sequence number given by the C{after} query
+    parameter (default 0), in order, up to the C{limit} query parameter
+    (default 1000, at most C{maxLimit}), stopping early once the values of
+    the changes add up to C{maxBytes}. If there are none, and the C{wait}
+    query parameter is given, waits up to that many seconds (at most
+    C{maxWait}) for one to be committed.
+
+    The response is an object with the changes as C{changes}, the sequence
+    number to pass as C{after} to get the next changes as C{next}, and the
+    sequence number of the most recent change as C{latest}. Each change
+    has its C{sequence} number, C{kind} (a value from L{ChangeKinds}),
+    C{environment}, C{indexType} and C{key}; lookup changes have the current
+    value of the entry, base64-encoded, as C{value} (C{null} if there is no
+    entry) or, if it is stored in a file, a true C{blob} instead, in which case
+    it must be fetched from the entry's own resource; and search changes have
+    C{searchClass}, C{searchType} and C{searchValue}. If changes after C{after}
+    have been removed by retention, the response is 410 instead.
+    """
+    def render_GET(self, request):
+        try:
+            after = int(request.args.get(b'after', [0])[0])
+            limit = int(request.args.get(b'limit', [1000])[0])
+            wait = float(request.args.get(b'wait', [0])[0])
+            if after < 0 or not 0 < limit <= self.maxLimit or wait < 0:
+                raise ValueError('Parameter out of range')
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid change request: {}'.format(e)
+        horizon = self.store.transact(Change.horizon, self.store)
+        if after < horizon:
+            request.setResponseCode(http.GONE)
+            return 'Changes after {:d} are no longer available'.format(after)
+        if wait > 0 and self.changeFeed is not None:
+            d = self.changeFeed.wait(after, min(wait, self.maxWait))
+            request.notifyFinish().addErrback(lambda _: d.cancel())
+            d.addCallback(lambda _: self._render(request, after, limit))
+            d.addErrback(self._disconnected)
+            return d
+        return self._render(request, after, limit)
+
+
+    def _disconnected(self, reason):
+        """
+        Stop waiting for changes once the client has gone away.
+        """
+        reason.trap(CancelledError)
+        return NOT_DONE_YET
+
+
+    def _render(self, request, after, limit):
+        """
+        Render the changes after a sequence number.
+        """
+        with _logged(LOG_CHANGES_GET(after=after, limit=limit)) as action:
+            changes, latest = self.store.transact(self._changes, after, limit)
+            action.add_success_fields(count=len(changes))
+            if changes:
+                after = changes[-1][u'sequence']
+            return _json(
+                request,
+                {u'changes': changes, u'next': after, u'latest': latest})
+
+
+    def _changes(self, after, limit):
+        """
+        Get the changes after a sequence number, and the sequence number of the
+        most recent change.
+        """
+        changes = []
+        size = 0
+        for change in Change.since(self.store, after, limit):
+            if change.kind == ChangeKinds.LOOKUP_SET.value:
+                result = _lookupChange(
+                    change.environment, change.indexType, change.key,
+                    LookupEntry.find(
+                        self.store, change.environment, change.indexType,
+                        change.key))
+            else:
+                result = {
+                    u'kind': change.kind,
+                    u'environment': change.environment,
+                    u'indexType': change.indexType,
+                    u'key': change.key,
+                    u'searchClass': change.searchClass,
+                    u'searchType': change.searchType,
+                    u'searchValue': change.searchValue}
+            result[u'sequence'] = change.storeID
+            changes.append(result)
+            size += len(result.get(u'value') or b'')
+            if size >= self.maxBytes:
+                break
+        return changes, Change.latest(self.store)
+
+
+
+@implementer(ISpinneretResource)
+@attributes(
+    ['store',
+     'index',
+     Attribute('maxLimit', default_value=10000),
+     Attribute('maxBytes', default_value=16 * 1024 * 1024)])
+class SnapshotResource(object):
+    """
+    A page of the entries in the lookup or search indexes, for copying them to
+    a replica.
+
+    Returns the entries in the C{index} indexes (C{lookup} or C{search}) after
+    the position given by the C{after} query parameter (default 0), up to the
+    C{limit} query parameter (default 1000, at most C{maxLimit}), stopping
+    early once the values of the entries add up to C{maxBytes}.
+
+    The response is an object with the entries, in the same form as the
+    changes returned by L{ChangesResource} that would create them, as
+    C{entries}; the position to pass as C{after} to get the next page as
+    C{next}, or C{null} if there are no more entries; and the sequence number
+    of the most recent change as C{sequence}. Taking a copy of the entries,
+    starting from an empty index, and then applying the changes after the
+    C{sequence} of the first page results in a copy of the indexes.
+    """
+    indexes = {
+        u'lookup': LookupEntry,
+        u'search': SearchEntry}
+
+    def render_GET(self, request):
+        try:
+            after = int(request.args.get(b'after', [0])[0])
+            limit = int(request.args.get(b'limit', [1000])[0])
+            if after < 0 or not 0 < limit <= self.maxLimit:
+                raise ValueError('Parameter out of range')
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid snapshot request: {}'.format(e)
+        return _json(
+            request, self.store.transact(self._snapshot, after, limit))
+
+
+    def _snapshot(self, after, limit):
+        """
+        Get a page of entries.
+        """
+        item = self.indexes[self.index]
+        entries = list(
+            self.store.query(item, item.storeID > after,
+                             sort=item.storeID.ascending, limit=limit))
+        result = []
+        size = 0
+        for entry in entries:
+            if item is LookupEntry:
+                result.append(_lookupChange(
+                    entry.environment, entry.indexType, entry.key, entry))
+            else:
+                result.append({
+                    u'kind': ChangeKinds.SEARCH_INSERT.value,
+                    u'environment': entry.environment,
+                    u'indexType': entry.indexType,
+                    u'key': entry.result,
+                    u'searchClass': entry.searchClass,
+                    u'searchType': entry.searchType,
+                    u'searchValue': entry.searchValue})
+            size += len(result[-1].get(u'value') or b'')
+            if size >= self.maxBytes:
+                break
+        following = None
+        if len(result) < len(entries) or len(entries) == limit:
+            following = entries[len(result) - 1].storeID
+        return {
+            u'entries': result,
+            u'next': following,
+            u'sequence': Change.latest(self.store)}
+
+
+
+@implementer(ISpinneretResource)
+@attributes(['statistics'])
+class StatisticsResource(object):
+    """
+    Index size and storage statistics, as returned by L{IndexStatistics.get}.
+
+    Responds with 503 if the statistics are being computed in the background
+    and have not been computed yet.
+
+    The page cache hit rate is not included, since the C{sqlite3} module does
+    not expose the connection status counters it would be computed from.
+    """
+    def render_GET(self, request):
+        statistics = self.statistics.get()
+        if statistics is None:
+            return ErrorPage(
+                http.SERVICE_UNAVAILABLE, 'Statistics unavailable',
+                'The index statistics have not been computed yet')
+        return _json(request, statistics)
+
+
+
+@implementer(ISpinneretResource)
+@attributes(
+    ['warmup',
+     Attribute('follower', default_value=None),
+     Attribute('upgraded', default_value=True)])
+class ReadinessResource(object):
+    """
+    Whether the service is ready to take traffic.
+
+    Responds with 503 until the store has been C{upgraded}, the caches have
+    been warmed up and, for a replica, the primary's indexes have been copied,
+    and 200 after, with the warm-up progress as an object with C{ready},
+    C{warmed} and C{total} properties.
+    """
+    def render_GET(self, request):
+        if self.warmup is None:
+            progress = {u'ready': True, u'warmed': 0, u'total': 0}
+        else:
+            progress = {
+                u'ready': self.warmup.ready,
+                u'warmed': self.warmup.warmed,
+                u'total': len(self.warmup.manifest)}
+        if self.follower is not None and not self.follower.ready:
+            progress[u'ready'] = False
+        if not self.upgraded:
+            progress[u'ready'] = False
+        if not progress[u'ready']:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        return _json(request, progress)
+
+
 
 @routedResource
 @implementer(ISpinneretResource)
-@attributes(['store', 'params'])
+@attributes(
+    ['store',
+     'params',
+     Attribute('maxMatches', default_value=None),
+     Attribute('profiler', default_factory=Profiler),
+     Attribute('hotKeys', default_value=None),
+     Attribute('primary', default_value=None),
+     Attribute('coalescer', default_value=None)])
 class SearchResource(object):
     router = Router()
 
+    def _record(self, request, params):
+        """
+        Record a search request in the hot keys, if they are being tracked.
+        """
+        if self.hotKeys is not None and request.method == b'GET':
+            self.hotKeys.search(
+                self.params['searchClass'], self.params['environment'],
+                self.params['indexType'], params['searchValue'],
+                params.get('searchType'))
+
+
 
     @router.route(b'results', Text('searchValue'))
+    @timedRoute
     def searchNoType(self, request, params):
-        return SearchResultResource(
+        self._record(request, params)
+        resource = SearchResultResource(
             store=self.store,
-            params=merge(self.params, params, {'searchType': None}))
+            params=merge(self.params, params, {'searchType': None}),
+            maxMatches=self.maxMatches,
+            coalescer=self.coalescer)
+        return _routed(self.profiler, u'search/results', resource, self.params)
 
 
     @router.route(b'results', Text('searchValue'), Text('searchType'))
+    @timedRoute
     def searchWithType(self, request, params):
-        return SearchResultResource(
-            store=self.store, params=merge(self.params, params))
+        self._record(request, params)
+        resource = SearchResultResource(
+            store=self.store,
+            params=merge(self.params, params),
+            maxMatches=self.maxMatches,
+            coalescer=self.coalescer)
+        return _routed(self.profiler, u'search/results', resource, self.params)
 
 
     @router.route(b'entries', Text('result'), Text('searchType'))
+    @timedRoute
     def searchEntry(self, request, params):
-        return SearchEntryResource(
+        if self.primary is not None:
+            return _readOnly(self.primary)
+        resource = SearchEntryResource(
             store=self.store, params=merge(self.params, params))
+        return _routed(self.profiler, u'search/entries', resource, self.params)
 
 
 
 @implementer(ISpinneretResource)
-@attributes(['store', 'params'])
+@attributes(
+    ['store', 'params', Attribute('maxMatches', default_value=None),
+     Attribute('coalescer', default_value=None)])
 class SearchResultResource(object):
+    """
+    Search results.
+
+    If the C{count} query parameter is true, only the number of matching
+    entries is returned, as an object with a C{count} property; counting stops
+    at the value of the C{cap} query parameter, if given.
+
+    Prefix searches estimated to match more than C{maxMatches} entries are
+    rejected with a 400 response.
+
+    Searches share their results with identical searches through
+    C{coalescer}, if given.
+    """
     def render_GET(self, request):
-        with LOG_SEARCH_GET(**self.params) as action:
-            results = self.store.transact(
-                lambda: list(
-                    SearchEntry.search(store=self.store, **self.params)))
+        if request.args.get(b'count', [b'false'])[0] in (b'true', b'1'):
+            return self._renderCount(request)
+        with _logged(LOG_SEARCH_GET(**self.params)) as action:
+            try:
+                results = self._search()
+            except SearchTooBroad as e:
+                action.add_success_fields(results=[])
+                request.setResponseCode(http.BAD_REQUEST)
+                return (
+                    'Search too broad: about {:d} entries match, '
+                    'at most {:d} allowed'.format(e.estimate, self.maxMatches))
             action.add_success_fields(results=results)
-            request.setHeader('Content-Type', 'application/json')
-            return json.dumps(results)
+            return _json(request, results)
+
+
+    def _search(self):
+        """
+        Query the store for the search results, or share the results of an
+        identical search.
+        """
+        def _search():
+            return list(
+                SearchEntry.search(
+                    store=self.store,
+                    maxMatches=self.maxMatches,
+                    **self.params))
+        if self.coalescer is None:
+            return self.store.transact(_search)
+        searchClass = self.params['searchClass']
+        return self.coalescer.query(
+            u'search',
+            self.params['environment'],
+            self.params['indexType'],
+            (searchClass,
+             SearchEntry.normalized(searchClass, self.params['searchValue']),
+             self.params['searchType']),
+            self.store.transact, _search)
+
+
+    def _renderCount(self, request):
+        try:
+            cap = request.args.get(b'cap')
+            if cap is not None:
+                cap = int(cap[0])
+                if cap < 0:
+                    raise ValueError('cap must not be negative')
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid cap: {}'.format(e)
+        with _logged(LOG_SEARCH_COUNT(cap=cap, **self.params)) as action:
+            count = self.store.transact(
+                SearchEntry.count, store=self.store, cap=cap, **self.params)
+            action.add_success_fields(count=count)
+            return _json(request, {u'count': count})
+
+
+
+@implementer(ISpinneretResource)
+@attributes(
+    ['store',
+     'substring',
+     Attribute('maxMatches', default_value=None),
+     Attribute('maxLimit', default_value=1000),
+     Attribute('maxTargets', default_value=100)])
+class MultiSearchResource(object):
+    """
+    Search several indexes for the same value in one request.
+
+    The request body is a JSON object with the search value as C{searchValue},
+    the indexes to search as C{targets} (a list of at most C{maxTargets}
+    objects with C{searchClass}, C{environment}, C{indexType}, and optionally
+    C{searchType}), and optionally the maximum number of results per target as
+    C{limit} (default 200, at most C{maxLimit}). The response is a list of the
+    targets, each with its C{results} added; or, if C{merge} is true in the
+    request, a single list of the distinct results of all the targets, in
+    order. Prefix searches estimated to match more than C{maxMatches} entries
+    are skipped, and the target is marked as C{rejected}.
+    """
+    def _parseTargets(self, targets):
+        """
+        Parse and validate the search targets.
+
+        @raise ValueError: If any of the targets are invalid.
+        """
+        if not isinstance(targets, list):
+            raise ValueError('targets must be a list')
+        if len(targets) > self.maxTargets:
+            raise ValueError(
+                'At most {:d} targets are allowed'.format(self.maxTargets))
+        for target in targets:
+            searchClass = SearchClasses.lookupByValue(target[u'searchClass'])
+            environment = target[u'environment']
+            indexType = target[u'indexType']
+            searchType = target.get(u'searchType')
+            if not all(isinstance(v, unicode)
+                       for v in [environment, indexType, searchType or u'']):
+                raise ValueError('Invalid target: {!r}'.format(target))
+            if (searchClass == SearchClasses.SUBSTRING and
+                    indexType not in self.substring):
+                raise ValueError(
+                    'Substring search is not enabled for {!r}'.format(
+                        indexType))
+            yield searchClass, environment, indexType, searchType
+
+
+    def render_POST(self, request):
+        try:
+            body = json.loads(request.content.read())
+            searchValue = body[u'searchValue']
+            if not isinstance(searchValue, unicode):
+                raise ValueError('searchValue must be a string')
+            targets = list(self._parseTargets(body[u'targets']))
+            limit = int(body.get(u'limit', 200))
+            if not 0 < limit <= self.maxLimit:
+                raise ValueError(
+                    'limit must be between 1 and {:d}'.format(self.maxLimit))
+            merge = bool(body.get(u'merge', False))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid search: {}'.format(e)
+        with _logged(LOG_SEARCH_MANY(
+                searchValue=searchValue,
+                targets=[
+                    [searchClass.value, environment, indexType, searchType]
+                    for searchClass, environment, indexType, searchType
+                    in targets])) as action:
+            results = self.store.transact(
+                SearchEntry.searchMany, self.store, targets, searchValue,
+                limit, self.maxMatches)
+            if merge:
+                seen = set()
+                response = []
+                for result in concat(r for r in results if r is not None):
+                    key = result[u'result'], result[u'type']
+                    if key not in seen:
+                        seen.add(key)
+                        response.append(result)
+            else:
+                response = []
+                for (searchClass, environment, indexType, searchType), \
+                        targetResults in zip(targets, results):
+                    target = {
+                        u'searchClass': searchClass.value,
+                        u'environment': environment,
+                        u'indexType': indexType,
+                        u'searchType': searchType,
+                        u'results': targetResults or []}
+                    if targetResults is None:
+                        target[u'rejected'] = True
+                    response.append(target)
+            action.add_success_fields(results=response)
+            return _json(request, response)
 
 
 
@@ -134,7 +1196,7 @@ class SearchResultResource(object):
 @attributes(['store', 'params'])
 class SearchEntryResource(object):
     def render_PUT(self, request):
-        with LOG_SEARCH_PUT(**self.params) as action:
+        with _logged(LOG_SEARCH_PUT(**self.params)) as action:
             searchValue = request.content.read().decode('utf-8')
             action.add_success_fields(searchValue=searchValue)
             self.store.transact(
@@ -145,8 +1207,96 @@ class SearchEntryResource(object):
 
 
     def render_DELETE(self, request):
-        with LOG_SEARCH_DELETE(**self.params):
+        with _logged(LOG_SEARCH_DELETE(**self.params)):
             self.store.transact(
                 SearchEntry.remove, store=self.store, **self.params)
             request.setResponseCode(http.NO_CONTENT)
             return ''
+
+
+
+@routedResource
+@implementer(ISpinneretResource)
+@attributes(['profiler'])
+class AdminResource(object):
+    router = Router()
+
+
+    @router.route(b'profile')
+    @timedRoute
+    def profile(self, request, params):
+        return ProfileResource(profiler=self.profiler)
+
+
+    @router.route(b'profile', b'dump')
+    @timedRoute
+    def profileDump(self, request, params):
+        return ProfileDumpResource(profiler=self.profiler)
+
+
+
+@implementer(ISpinneretResource)
+@attributes(['profiler'])
+class ProfileResource(object):
+    """
+    Control request profiling.
+
+    A POST request starts profiling the next C{requests} requests, or the
+    requests in the next C{seconds} seconds, given as query parameters; a
+    DELETE request stops it. A GET request returns whether profiling is active,
+    and the number of requests profiled for each route.
+    """
+    def render_GET(self, request):
+        return _json(
+            request,
+            {u'active': self.profiler.active,
+             u'routes': self.profiler.routes()})
+
+
+    def render_POST(self, request):
+        try:
+            requests = request.args.get(b'requests')
+            if requests is not None:
+                requests = int(requests[0])
+            seconds = request.args.get(b'seconds')
+            if seconds is not None:
+                seconds = float(seconds[0])
+            if any(limit is not None and limit <= 0
+                   for limit in [requests, seconds]):
+                raise ValueError('Limits must be positive')
+            self.profiler.start(requests=requests, seconds=seconds)
+        except ValueError as e:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid profiling request: {}'.format(e)
+        return self.render_GET(request)
+
+
+    def render_DELETE(self, request):
+        self.profiler.stop()
+        return self.render_GET(request)
+
+
+
+@implementer(ISpinneretResource)
+@attributes(['profiler'])
+class ProfileDumpResource(object):
+    """
+    Profiling results.
+
+    The results for the route given by the C{route} query parameter (or all
+    routes) are returned in the C{pstats} format by default, or as collapsed
+    stacks for flame graph tools if the C{format} query parameter is
+    C{collapsed}.
+    """
+    def render_GET(self, request):
+        route = request.args.get(b'route')
+        if route is not None:
+            route = route[0].decode('utf-8')
+        stats = self.profiler.stats(route)
+        if stats is None:
+            return NotFound()
+        if request.args.get(b'format', [b'pstats'])[0] == b'collapsed':
+            request.setHeader('Content-Type', 'text/plain')
+            return collapsedStacks(stats)
+        request.setHeader('Content-Type', 'application/octet-stream')
+        return dumpStats(stats)
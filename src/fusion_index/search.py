@@ -6,23 +6,46 @@ being 1:1; a particular search key can map to multiple values. In addition,
 this implementation has both exact matching and prefix matching (in different
 indexes).
 """
+from hashlib import sha256
 from re import UNICODE, compile
 from unicodedata import normalize
+from weakref import WeakKeyDictionary
 
-from axiom.attributes import AND, compoundIndex, text
-from axiom.item import Item
+from axiom.attributes import AND, compoundIndex, integer, text
+from axiom.iaxiom import IComparison
+from axiom.item import Item, declareLegacyItem
+from axiom.upgrade import registerUpgrader
 from py2casefold import casefold
 from twisted.python.constants import ValueConstant, Values
+from zope.interface import implementer
 
+from fusion_index.changes import Change, ChangeKinds
 from fusion_index.metrics import (
-    METRIC_SEARCH_DELETE_LATENCY, METRIC_SEARCH_INSERT_LATENCY,
-    METRIC_SEARCH_QUERY_LATENCY, METRIC_SEARCH_REJECTED)
+    METRIC_SEARCH_COUNT_LATENCY, METRIC_SEARCH_DELETE_LATENCY,
+    METRIC_SEARCH_INSERT_LATENCY, METRIC_SEARCH_QUERY_LATENCY,
+    METRIC_SEARCH_REJECTED, METRIC_SEARCH_SUBSTRING_AMPLIFICATION)
+from fusion_index.names import IndexName
 
 
 
 class SearchClasses(Values):
     EXACT = ValueConstant(u'exact')
     PREFIX = ValueConstant(u'prefix')
+    TRIGRAM = ValueConstant(u'trigram')
+    SUBSTRING = ValueConstant(u'substring')
+    TOKEN = ValueConstant(u'token')
+
+
+
+class SearchTooBroad(Exception):
+    """
+    A search was rejected because it would match too many entries.
+
+    @ivar estimate: The estimated number of matching entries.
+    """
+    def __init__(self, estimate):
+        Exception.__init__(self, estimate)
+        self.estimate = estimate
 
 
 
@@ -34,29 +57,40 @@ class SearchEntry(Item):
     index. The primary querying operation supported is matching on the
     C{(searchClass, environment, indexType, searchValue)} portion, with exact
     or prefix matching on the I{searchValue} component depending on the
-    I{searchClass} component.
+    I{searchClass} component. Entries in the L{SearchClasses.TRIGRAM} class are
+    additionally indexed by L{SearchNGram}, for fuzzy matching, and entries in
+    the L{SearchClasses.SUBSTRING} class by L{SearchSuffix}, for substring
+    matching. Entries in the L{SearchClasses.TOKEN} class are indexed by
+    L{SearchTokens}, for matching on individual words.
 
     "Separate" indexes are keyed by C{(searchClass, environment, indexType)}.
     I{environment} and I{indexType} are separated as a convenience to clients
     as separating them allows for easily differentiating between application
     environments at a global configuration level, as well as between different
     indexes within the application.
-    """
-    searchClass = text(doc="""
-    The search "class" that this entry belongs to; must be a value from
-    L{SearchClasses}.
-    """, allowNone=False)
 
-    environment = text(doc="""
-    The environment in which this entry exists.
+    There is at most one entry for each combination of C{(searchClass,
+    environment, indexType, result, searchType)}; this is enforced by a unique
+    index, which is created by L{_ensureUniqueIndex} since Axiom has no way to
+    declare one.
 
-    Usually something like C{u'prod'}.
+    The search class, environment and index type are stored as
+    L{IndexName}s.
+    """
+    schemaVersion = 3
+
+    searchClassID = integer(doc="""
+    The store ID of the L{IndexName} of the search "class" that this entry
+    belongs to, which must be a value from L{SearchClasses}.
     """, allowNone=False)
 
-    indexType = text(doc="""
-    The index type for this index entry.
+    environmentID = integer(doc="""
+    The store ID of the L{IndexName} of the environment in which this entry
+    exists.
+    """, allowNone=False)
 
-    Usually something like C{u'idNumber'}.
+    indexTypeID = integer(doc="""
+    The store ID of the L{IndexName} of the index type for this index entry.
     """, allowNone=False)
 
     searchValue = text(doc="""
@@ -72,9 +106,75 @@ class SearchEntry(Item):
     """, allowNone=False)
 
     compoundIndex(
-        searchClass, environment, indexType, searchValue, searchType, result)
-    compoundIndex(
-        searchClass, environment, indexType, result, searchType)
+        searchClassID, environmentID, indexTypeID, searchValue, searchType,
+        result)
+
+    _uniqueIndexes = WeakKeyDictionary()
+
+    @property
+    def searchClass(self):
+        """
+        The search "class" that this entry belongs to; a value from
+        L{SearchClasses}.
+        """
+        return IndexName.lookup(self.store, self.searchClassID)
+
+
+    @property
+    def environment(self):
+        """
+        The environment in which this entry exists.
+
+        Usually something like C{u'prod'}.
+        """
+        return IndexName.lookup(self.store, self.environmentID)
+
+
+    @property
+    def indexType(self):
+        """
+        The index type for this index entry.
+
+        Usually something like C{u'idNumber'}.
+        """
+        return IndexName.lookup(self.store, self.indexTypeID)
+
+
+    @classmethod
+    def inIndex(cls, store, searchClass, environment, indexType):
+        """
+        The comparison matching the entries in an index.
+
+        @type searchClass: L{SearchClasses}
+        """
+        return AND(
+            cls.searchClassID == IndexName.find(store, searchClass.value),
+            cls.environmentID == IndexName.find(store, environment),
+            cls.indexTypeID == IndexName.find(store, indexType))
+
+
+    @classmethod
+    def _ensureUniqueIndex(cls, store):
+        """
+        Create the unique index on C{(searchClass, environment, indexType,
+        result, searchType)}, if it has not already been created.
+
+        @return: The name of the table for this item type.
+        """
+        tableName = store.getTableName(cls)
+        if cls._uniqueIndexes.get(store) != tableName:
+            columns = [
+                attr.getShortColumnName(store) for attr in [
+                    cls.searchClassID, cls.environmentID, cls.indexTypeID,
+                    cls.result, cls.searchType]]
+            database, table = tableName.split('.', 1)
+            store.createSQL(
+                'CREATE UNIQUE INDEX IF NOT EXISTS {}.{}_unique '
+                'ON {}({})'.format(
+                    database, table.replace('item_', 'axiomidx_', 1), table,
+                    ', '.join(columns)))
+            cls._uniqueIndexes[store] = tableName
+        return tableName
 
 
     _searchNoise = compile(u'[^\w,]', UNICODE)
@@ -93,37 +193,209 @@ class SearchEntry(Item):
         return cls._searchNoise.sub(u'', casefold(normalize('NFC', value)))
 
 
+    _searchToken = compile(u'\w+\*?', UNICODE)
+
+    @classmethod
+    def _normalizeTokens(cls, value):
+        """
+        Normalize a search value for the L{SearchClasses.TOKEN} search class.
+
+        Unlike L{_normalize}, this keeps the words of the value separate, and
+        keeps any C{*} at the end of a word (marking a prefix search).
+
+        @type value: L{unicode}
+        @param value: The value to normalize.
+
+        @rtype: L{unicode}
+        @return: The normalized value, with words separated by spaces.
+        """
+        return u' '.join(
+            cls._searchToken.findall(casefold(normalize('NFC', value))))
+
+
+    @classmethod
+    def _normalizerFor(cls, searchClass):
+        """
+        Get the normalization function for a particular search class.
+        """
+        if searchClass == SearchClasses.TOKEN:
+            return cls._normalizeTokens
+        return cls._normalize
+
+
+    @classmethod
+    def normalized(cls, searchClass, value):
+        """
+        Normalize a search value the way searches of a particular search class
+        do, so that searches for values with the same normalization can be
+        recognized as identical.
+
+        @rtype: L{unicode}
+        """
+        return cls._normalizerFor(searchClass)(value)
+
+
     @classmethod
     def search(cls, store, searchClass, environment, indexType, searchValue,
-               searchType=None, limit=200):
+               searchType=None, limit=200, maxMatches=None):
         """
         Return entries matching the given search.
 
+        @type maxMatches: L{int} or L{None}
+        @param maxMatches: If not C{None}, reject prefix searches that
+            L{SearchPrefixStatistic} estimates would match more than this many
+            entries.
+
+        @raise SearchTooBroad: If the search was rejected.
+
         @see: L{SearchEntry}
         """
-        with METRIC_SEARCH_QUERY_LATENCY.labels(
+        return cls._search(
+            store, searchClass, environment, indexType,
+            cls._normalizerFor(searchClass)(searchValue), searchType, limit,
+            maxMatches)
+
+
+    @classmethod
+    def searchMany(cls, store, targets, searchValue, limit=200,
+                   maxMatches=None):
+        """
+        Search several indexes for the same value.
+
+        The value is only normalized once for each kind of normalization
+        needed.
+
+        @param targets: The indexes to search, as C{(searchClass, environment,
+            indexType, searchType)} tuples, where C{searchType} may be C{None}
+            (as for L{search}).
+
+        @type limit: L{int}
+        @param limit: The maximum number of results for each target.
+
+        @param maxMatches: See L{search}.
+
+        @rtype: L{list}
+        @return: The results for each target, in the same order as the
+            targets, or C{None} for targets whose search was rejected for being
+            too broad.
+        """
+        normalized = {}
+        results = []
+        for searchClass, environment, indexType, searchType in targets:
+            normalizer = cls._normalizerFor(searchClass)
+            if normalizer not in normalized:
+                normalized[normalizer] = normalizer(searchValue)
+            try:
+                results.append(cls._search(
+                    store, searchClass, environment, indexType,
+                    normalized[normalizer], searchType, limit, maxMatches))
+            except SearchTooBroad:
+                results.append(None)
+        return results
+
+
+    @classmethod
+    def count(cls, store, searchClass, environment, indexType, searchValue,
+              searchType=None, cap=None):
+        """
+        Count the entries matching the given search, without loading them.
+
+        @type cap: L{int} or L{None}
+        @param cap: If not C{None}, stop counting at this many entries.
+
+        @rtype: L{int}
+
+        @see: L{search}
+        """
+        searchValue = cls._normalizerFor(searchClass)(searchValue)
+        with METRIC_SEARCH_COUNT_LATENCY.labels(
                 searchClass.value, environment, indexType).time():
-            criteria = []
-            searchValue = cls._normalize(searchValue)
-            if searchClass == SearchClasses.EXACT:
-                criteria.append(SearchEntry.searchValue == searchValue)
-            elif searchClass == SearchClasses.PREFIX:
-                criteria.append(SearchEntry.searchValue.startswith(searchValue))
-            else:
-                raise RuntimeError(
-                    'Invalid search class: {!r}'.format(searchClass))
-            if searchValue == u'':
+            if not cls._accept(
+                    store, searchClass, environment, indexType, searchValue):
+                return 0
+            if searchClass in _postings:
+                return _postings[searchClass].count(
+                    store, environment, indexType, searchValue, searchType,
+                    cap)
+            return _count(
+                store,
+                cls._criteria(
+                    store, searchClass, environment, indexType, searchValue,
+                    searchType),
+                cap)
+
+
+    @classmethod
+    def _accept(cls, store, searchClass, environment, indexType, searchValue,
+                maxMatches=None):
+        """
+        Check whether a search should be run.
+
+        @raise RuntimeError: If the search class is invalid.
+
+        @raise SearchTooBroad: If the search is a prefix search estimated to
+            match more than C{maxMatches} entries.
+
+        @rtype: L{bool}
+        @return: C{False} if the search was rejected for being empty.
+        """
+        if (searchClass not in _postings and
+                searchClass not in (SearchClasses.EXACT, SearchClasses.PREFIX)):
+            raise RuntimeError(
+                'Invalid search class: {!r}'.format(searchClass))
+        if searchValue == u'':
+            METRIC_SEARCH_REJECTED.labels(
+                searchClass.value, environment, indexType).inc()
+            return False
+        if searchClass == SearchClasses.PREFIX and maxMatches is not None:
+            estimate = SearchPrefixStatistic.estimate(
+                store, environment, indexType, searchValue)
+            if estimate > maxMatches:
                 METRIC_SEARCH_REJECTED.labels(
                     searchClass.value, environment, indexType).inc()
+                raise SearchTooBroad(estimate)
+        return True
+
+
+    @classmethod
+    def _criteria(cls, store, searchClass, environment, indexType,
+                  searchValue, searchType):
+        """
+        Build the query for an exact or prefix search.
+        """
+        if searchClass == SearchClasses.EXACT:
+            criteria = [SearchEntry.searchValue == searchValue]
+        else:
+            criteria = [_startswith(SearchEntry.searchValue, searchValue)]
+        criteria.append(
+            cls.inIndex(store, searchClass, environment, indexType))
+        if searchType is not None:
+            criteria.append(SearchEntry.searchType == searchType)
+        return AND(*criteria)
+
+
+    @classmethod
+    def _search(cls, store, searchClass, environment, indexType, searchValue,
+                searchType, limit, maxMatches):
+        """
+        Return entries matching an already-normalized search value.
+        """
+        with METRIC_SEARCH_QUERY_LATENCY.labels(
+                searchClass.value, environment, indexType).time():
+            if not cls._accept(
+                    store, searchClass, environment, indexType, searchValue,
+                    maxMatches):
                 return []
-            criteria.extend([
-                SearchEntry.searchClass == searchClass.value,
-                SearchEntry.environment == environment,
-                SearchEntry.indexType == indexType,
-                ])
-            if searchType is not None:
-                criteria.append(SearchEntry.searchType == searchType)
-            query = store.query(SearchEntry, AND(*criteria), limit=limit)
+            if searchClass in _postings:
+                return _postings[searchClass].search(
+                    store, environment, indexType, searchValue, searchType,
+                    limit)
+            query = store.query(
+                SearchEntry,
+                cls._criteria(
+                    store, searchClass, environment, indexType, searchValue,
+                    searchType),
+                limit=limit)
             return [{u'result': item.result,
                      u'type': item.searchType} for item in query]
 
@@ -138,30 +410,76 @@ class SearchEntry(Item):
         """
         with METRIC_SEARCH_INSERT_LATENCY.labels(
                 searchClass.value, environment, indexType).time():
-            searchValue = cls._normalize(searchValue)
-            entry = store.findUnique(
-                SearchEntry,
-                AND(SearchEntry.searchClass == searchClass.value,
-                    SearchEntry.environment == environment,
-                    SearchEntry.indexType == indexType,
-                    SearchEntry.result == result,
-                    SearchEntry.searchType == searchType),
-                None)
-            if entry is None:
-                if searchValue != u'':
-                    SearchEntry(
-                        store=store,
-                        searchClass=searchClass.value,
-                        environment=environment,
-                        indexType=indexType,
-                        result=result,
-                        searchType=searchType,
-                        searchValue=searchValue)
+            searchValue = cls._normalizerFor(searchClass)(searchValue)
+            if searchValue == u'':
+                cls.remove(
+                    store, searchClass, environment, indexType, result,
+                    searchType)
+                return
+            index = [IndexName.intern(store, name) for name in [
+                searchClass.value, environment, indexType]]
+            # Axiom needs an object row for each item, so a new entry can't be
+            # created by an INSERT ... ON CONFLICT on its own; update any
+            # existing entry in a single statement instead, and only insert
+            # if there was nothing to update.
+            updated = cls._update(
+                store, index + [result, searchType], searchValue)
+            if not updated:
+                store.batchInsert(
+                    cls,
+                    [cls.searchClassID, cls.environmentID, cls.indexTypeID,
+                     cls.result, cls.searchType, cls.searchValue],
+                    [tuple(index) + (result, searchType, searchValue)])
+                updated = store.querySQL('SELECT last_insert_rowid()')
+            [(storeID,)] = updated
+            try:
+                item = store.objectCache.get(storeID)
+            except KeyError:
+                pass
             else:
-                if searchValue == u'':
-                    entry.deleteFromStore()
-                else:
-                    entry.searchValue = searchValue
+                # The UPDATE bypassed the item, so bring it up to date.
+                cls.searchValue.loaded(item, searchValue)
+            if searchClass in _postings:
+                _postings[searchClass].index(
+                    store, storeID, environment, indexType, searchValue)
+            Change.record(
+                store, ChangeKinds.SEARCH_INSERT, environment, indexType,
+                result, searchClass=searchClass, searchType=searchType,
+                searchValue=searchValue)
+
+
+    @classmethod
+    def _update(cls, store, unique, searchValue):
+        """
+        Update the search value of an existing entry.
+
+        SQLite only supports C{UPDATE ... RETURNING} from version 3.35; older
+        versions find the entry with a separate C{SELECT}.
+
+        @param unique: The values of the columns in the unique index.
+
+        @rtype: L{list}
+        @return: A row with the store ID of the entry, or no rows if there is
+            no such entry.
+        """
+        tableName = cls._ensureUniqueIndex(store)
+        where = ' AND '.join(
+            '{} = ?'.format(attr.getShortColumnName(store)) for attr in [
+                cls.searchClassID, cls.environmentID, cls.indexTypeID,
+                cls.result, cls.searchType])
+        column = cls.searchValue.getShortColumnName(store)
+        if _supportsReturning(store):
+            return store.querySQL(
+                'UPDATE {} SET {} = ? WHERE {} RETURNING oid'.format(
+                    tableName, column, where),
+                [searchValue] + unique)
+        updated = store.querySQL(
+            'SELECT oid FROM {} WHERE {}'.format(tableName, where), unique)
+        if updated:
+            store.querySQL(
+                'UPDATE {} SET {} = ? WHERE oid = ?'.format(tableName, column),
+                [searchValue, updated[0][0]])
+        return updated
 
 
     @classmethod
@@ -174,10 +492,809 @@ class SearchEntry(Item):
         """
         with METRIC_SEARCH_DELETE_LATENCY.labels(
                 searchClass.value, environment, indexType).time():
-            store.query(
+            cls._ensureUniqueIndex(store)
+            entries = store.query(
                 SearchEntry,
-                AND(SearchEntry.searchClass == searchClass.value,
-                    SearchEntry.environment == environment,
-                    SearchEntry.indexType == indexType,
+                AND(SearchEntry.inIndex(
+                        store, searchClass, environment, indexType),
                     SearchEntry.result == result,
-                    SearchEntry.searchType == searchType)).deleteFromStore()
+                    SearchEntry.searchType == searchType))
+            if searchClass in _postings:
+                _postings[searchClass].unindex(
+                    store, entries.getColumn('storeID'))
+            entries.deleteFromStore()
+            Change.record(
+                store, ChangeKinds.SEARCH_REMOVE, environment, indexType,
+                result, searchClass=searchClass, searchType=searchType)
+
+
+
+_returning = WeakKeyDictionary()
+
+
+
+def _supportsReturning(store):
+    """
+    Determine whether a store's version of SQLite supports C{RETURNING}
+    clauses.
+
+    @rtype: L{bool}
+    """
+    supported = _returning.get(store)
+    if supported is None:
+        [(version,)] = store.querySQL('SELECT sqlite_version()')
+        supported = _returning[store] = (
+            tuple(int(part) for part in version.split('.')) >= (3, 35))
+    return supported
+
+
+
+def _startswith(attribute, prefix):
+    """
+    Match values of a text attribute that start with a prefix.
+
+    Unlike C{attribute.startswith}, SQLite can use an index for this; it can
+    only use one for a C{LIKE} if the pattern is known when the statement is
+    prepared, rather than bound as a parameter.
+    """
+    return AND(attribute >= prefix, attribute < prefix + u'\U0010ffff')
+
+
+
+@implementer(IComparison)
+class _Contains(object):
+    """
+    Match values of a text attribute that contain a substring, ignoring ASCII
+    case like C{LIKE} does.
+
+    Axiom's C{like} has no C{ESCAPE} clause, so any C{%} or C{_} in the
+    substring would be treated as wildcards.
+    """
+    def __init__(self, attribute, substring):
+        self.attribute = attribute
+        self.substring = substring
+
+
+    def getInvolvedTables(self):
+        return [self.attribute.type]
+
+
+    def getQuery(self, store):
+        return "({} LIKE ? ESCAPE '\\')".format(
+            self.attribute.getColumnName(store))
+
+
+    def getArgs(self, store):
+        escaped = self.substring
+        for c in u'\\%_':
+            escaped = escaped.replace(c, u'\\' + c)
+        return [u'%' + escaped + u'%']
+
+
+
+def _count(store, comparison, cap, column=None):
+    """
+    Count the rows matching a query, stopping at C{cap}.
+
+    @param comparison: The query.
+
+    @param cap: The maximum count, or C{None}.
+
+    @param column: If not C{None}, count the distinct values of this attribute.
+
+    @rtype: L{int}
+    """
+    [(count,)] = store.querySQL(
+        'SELECT COUNT(*) FROM (SELECT {} FROM {} WHERE {} LIMIT ?)'.format(
+            '1' if column is None
+            else 'DISTINCT {}'.format(column.getColumnName(store)),
+            ', '.join(
+                store.getTableName(table)
+                for table in comparison.getInvolvedTables()),
+            comparison.getQuery(store)),
+        comparison.getArgs(store) + [-1 if cap is None else cap])
+    return count
+
+
+
+def trigrams(value):
+    """
+    Split a normalized search value into trigrams.
+
+    The value is padded at the start, so that matches at the start of a value
+    score more highly, but not at the end, so that a query for the start of a
+    value matches as well as a query for all of it.
+
+    @type value: L{unicode}
+
+    @rtype: L{set} of L{unicode}
+    """
+    value = u'  ' + value
+    return {value[i:i + 3] for i in xrange(len(value) - 2)}
+
+
+
+class SearchNGram(Item):
+    """
+    A posting in the trigram index for L{SearchClasses.TRIGRAM} entries.
+
+    There is one posting for each distinct trigram (see L{trigrams}) of the
+    entry's search value. A search gathers candidate entries from the postings
+    for the trigrams of the query, and ranks them by how many trigrams they
+    share with it.
+    """
+    environment = text(doc="""
+    The environment of the entry.
+    """, allowNone=False)
+
+    indexType = text(doc="""
+    The index type of the entry.
+    """, allowNone=False)
+
+    ngram = text(doc="""
+    A trigram of the entry's search value.
+    """, allowNone=False)
+
+    entry = integer(doc="""
+    The store ID of the entry.
+
+    This is not a L{reference} so that postings can be inserted and removed in
+    bulk without loading the entries.
+    """, allowNone=False, indexed=True)
+
+    compoundIndex(environment, indexType, ngram)
+
+    threshold = 0.3
+    candidates = 10
+
+    @classmethod
+    def index(cls, store, storeID, environment, indexType, searchValue):
+        """
+        Replace the postings for an entry.
+
+        @param storeID: The store ID of the L{SearchEntry}.
+        """
+        cls.unindex(store, [storeID])
+        store.batchInsert(
+            cls,
+            [cls.environment, cls.indexType, cls.ngram, cls.entry],
+            [(environment, indexType, ngram, storeID)
+             for ngram in trigrams(searchValue)])
+
+
+    @classmethod
+    def unindex(cls, store, storeIDs):
+        """
+        Remove the postings for some entries.
+
+        @param storeIDs: The store IDs of the L{SearchEntry} items, or a query
+            for them.
+        """
+        store.query(cls, cls.entry.oneOf(storeIDs)).deleteFromStore()
+
+
+    @classmethod
+    def search(cls, store, environment, indexType, searchValue, searchType,
+               limit):
+        """
+        Find the entries most similar to a normalized search value.
+
+        Entries must share at least C{threshold} of the trigrams of the search
+        value. At most C{candidates} times C{limit} entries are considered,
+        those sharing the most trigrams with the search value; these are ranked
+        by their similarity (the proportion of all the trigrams of both values
+        that are shared), and then by the number of shared trigrams.
+
+        @see: L{SearchEntry.search}
+        """
+        ngrams = trigrams(searchValue)
+        sql, args = cls._candidates(
+            store, environment, indexType, ngrams, searchType,
+            [SearchEntry.result, SearchEntry.searchType,
+             SearchEntry.searchValue])
+        rows = store.querySQL(
+            sql + ' ORDER BY COUNT(*) DESC LIMIT ?',
+            args + [limit * cls.candidates])
+
+        def _rank(row):
+            result, searchType, value, shared = row
+            total = len(ngrams) + len(trigrams(value)) - shared
+            return -float(shared) / total, -shared, result
+        return [{u'result': result,
+                 u'type': searchType}
+                for result, searchType, value, shared
+                in sorted(rows, key=_rank)[:limit]]
+
+
+    @classmethod
+    def count(cls, store, environment, indexType, searchValue, searchType,
+              cap):
+        """
+        Count the entries sharing at least C{threshold} of the trigrams of a
+        normalized search value.
+
+        @see: L{SearchEntry.count}
+        """
+        sql, args = cls._candidates(
+            store, environment, indexType, trigrams(searchValue), searchType,
+            [])
+        [(count,)] = store.querySQL(
+            'SELECT COUNT(*) FROM (' + sql + ' LIMIT ?)',
+            args + [-1 if cap is None else cap])
+        return count
+
+
+    @classmethod
+    def _candidates(cls, store, environment, indexType, ngrams, searchType,
+                    columns):
+        """
+        Build a query for the entries sharing at least C{threshold} of some
+        trigrams.
+
+        @param columns: The attributes of L{SearchEntry} to select, in addition
+            to the number of shared trigrams.
+
+        @return: The SQL and arguments for the query.
+        """
+        criteria = []
+        args = [environment, indexType] + list(ngrams)
+        if searchType is not None:
+            criteria.append(
+                'AND {} = ?'.format(SearchEntry.searchType.getColumnName(store)))
+            args.append(searchType)
+        args.append(max(1, int(len(ngrams) * cls.threshold)))
+        sql = (
+            'SELECT {columns} COUNT(*) '
+            'FROM {ngrams} JOIN {entries} ON {entry} = {entries}.oid '
+            'WHERE {environment} = ? AND {indexType} = ? '
+            'AND {ngram} IN ({placeholders}) {criteria} '
+            'GROUP BY {entry} HAVING COUNT(*) >= ?'.format(
+                columns=''.join(
+                    attr.getColumnName(store) + ', ' for attr in columns),
+                ngrams=store.getTableName(cls),
+                entries=store.getTableName(SearchEntry),
+                entry=cls.entry.getColumnName(store),
+                environment=cls.environment.getColumnName(store),
+                indexType=cls.indexType.getColumnName(store),
+                ngram=cls.ngram.getColumnName(store),
+                placeholders=', '.join('?' * len(ngrams)),
+                criteria=' '.join(criteria)))
+        return sql, args
+
+
+
+class SearchSuffix(Item):
+    """
+    A posting in the suffix index for L{SearchClasses.SUBSTRING} entries.
+
+    There is one posting for each suffix of the entry's search value, truncated
+    to C{length} characters, so that a substring search becomes a prefix
+    search on the postings. This multiplies the storage needed for each entry
+    by up to C{length / 2}; see L{storageStats}.
+    """
+    environment = text(doc="""
+    The environment of the entry.
+    """, allowNone=False)
+
+    indexType = text(doc="""
+    The index type of the entry.
+    """, allowNone=False)
+
+    suffix = text(doc="""
+    A suffix of the entry's search value, truncated to C{length} characters.
+    """, allowNone=False)
+
+    entry = integer(doc="""
+    The store ID of the entry.
+    """, allowNone=False, indexed=True)
+
+    compoundIndex(environment, indexType, suffix)
+
+    length = 32
+
+    @classmethod
+    def index(cls, store, storeID, environment, indexType, searchValue):
+        """
+        Replace the postings for an entry.
+
+        @param storeID: The store ID of the L{SearchEntry}.
+        """
+        cls.unindex(store, [storeID])
+        store.batchInsert(
+            cls,
+            [cls.environment, cls.indexType, cls.suffix, cls.entry],
+            {(environment, indexType, searchValue[i:i + cls.length], storeID)
+             for i in xrange(len(searchValue))})
+
+
+    @classmethod
+    def unindex(cls, store, storeIDs):
+        """
+        Remove the postings for some entries.
+
+        @param storeIDs: The store IDs of the L{SearchEntry} items, or a query
+            for them.
+        """
+        store.query(cls, cls.entry.oneOf(storeIDs)).deleteFromStore()
+
+
+    @classmethod
+    def search(cls, store, environment, indexType, searchValue, searchType,
+               limit):
+        """
+        Find the entries with values containing a normalized search value.
+
+        @see: L{SearchEntry.search}
+        """
+        query = store.query(
+            SearchEntry,
+            cls._criteria(environment, indexType, searchValue, searchType),
+            limit=limit).distinct()
+        return [{u'result': item.result,
+                 u'type': item.searchType} for item in query]
+
+
+    @classmethod
+    def count(cls, store, environment, indexType, searchValue, searchType,
+              cap):
+        """
+        Count the entries with values containing a normalized search value.
+
+        @see: L{SearchEntry.count}
+        """
+        return _count(
+            store,
+            cls._criteria(environment, indexType, searchValue, searchType),
+            cap,
+            column=cls.entry)
+
+
+    @classmethod
+    def _criteria(cls, environment, indexType, searchValue, searchType):
+        """
+        Build the query for a substring search.
+        """
+        criteria = [
+            cls.entry == SearchEntry.storeID,
+            cls.environment == environment,
+            cls.indexType == indexType,
+            _startswith(cls.suffix, searchValue[:cls.length]),
+            ]
+        if len(searchValue) > cls.length:
+            criteria.append(_Contains(SearchEntry.searchValue, searchValue))
+        if searchType is not None:
+            criteria.append(SearchEntry.searchType == searchType)
+        return AND(*criteria)
+
+
+    @classmethod
+    def storageStats(cls, store):
+        """
+        Calculate the storage amplification of each substring index, and update
+        the corresponding metrics.
+
+        @rtype: L{dict} mapping C{(environment, indexType)} to L{float}
+        @return: The ratio of the total length of the postings to the total
+            length of the search values in each index.
+        """
+        values = dict(
+            ((IndexName.lookup(store, environment),
+              IndexName.lookup(store, indexType)), length)
+            for environment, indexType, length in store.querySQL(
+                'SELECT {environment}, {indexType}, SUM(LENGTH({value})) '
+                'FROM {entries} WHERE {searchClass} = ? '
+                'GROUP BY {environment}, {indexType}'.format(
+                    environment=SearchEntry.environmentID.getColumnName(store),
+                    indexType=SearchEntry.indexTypeID.getColumnName(store),
+                    value=SearchEntry.searchValue.getColumnName(store),
+                    entries=store.getTableName(SearchEntry),
+                    searchClass=SearchEntry.searchClassID.getColumnName(
+                        store)),
+                [IndexName.find(store, SearchClasses.SUBSTRING.value)]))
+        stats = {}
+        for environment, indexType, length in store.querySQL(
+                'SELECT {environment}, {indexType}, SUM(LENGTH({suffix})) '
+                'FROM {suffixes} GROUP BY {environment}, {indexType}'.format(
+                    environment=cls.environment.getColumnName(store),
+                    indexType=cls.indexType.getColumnName(store),
+                    suffix=cls.suffix.getColumnName(store),
+                    suffixes=store.getTableName(cls))):
+            key = environment, indexType
+            if values.get(key):
+                stats[key] = float(length) / values[key]
+                METRIC_SEARCH_SUBSTRING_AMPLIFICATION.labels(
+                    environment, indexType).set(stats[key])
+        return stats
+
+
+
+class SearchTokens(object):
+    """
+    The full-text index for L{SearchClasses.TOKEN} entries.
+
+    This is an FTS5 table, which Axiom cannot declare, so it is created on
+    first use (see L{_ensureTable}). The rowid of each row is the store ID of
+    the entry, and the row holds the words of the entry's search value, along
+    with a token identifying the entry's C{(environment, indexType)} so that
+    searches only match within one index.
+    """
+    tableName = 'fusion_index_search_tokens'
+
+    _tables = WeakKeyDictionary()
+
+    @classmethod
+    def _ensureTable(cls, store):
+        """
+        Create the FTS5 table, if it has not already been created.
+
+        @return: The fully-qualified name of the table.
+        """
+        tableName = '{}.{}'.format(store.databaseName, cls.tableName)
+        if cls._tables.get(store) != tableName:
+            store.createSQL(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5('
+                'scope, words, '
+                "tokenize='unicode61 remove_diacritics 0')".format(tableName))
+            cls._tables[store] = tableName
+        return tableName
+
+
+    @staticmethod
+    def _scope(environment, indexType):
+        """
+        Compute the token identifying an index.
+
+        Like the columns of L{SearchEntry}, this ignores ASCII case.
+        """
+        return u'x' + sha256(
+            environment.encode('utf-8').lower() + b'\0' +
+            indexType.encode('utf-8').lower()).hexdigest()[:32].decode('ascii')
+
+
+    @classmethod
+    def index(cls, store, storeID, environment, indexType, searchValue):
+        """
+        Replace the indexed words for an entry.
+
+        @param storeID: The store ID of the L{SearchEntry}.
+        """
+        store.executeSQL(
+            'INSERT OR REPLACE INTO {} (rowid, scope, words) '
+            'VALUES (?, ?, ?)'.format(cls._ensureTable(store)),
+            [storeID, cls._scope(environment, indexType), searchValue])
+
+
+    @classmethod
+    def unindex(cls, store, storeIDs):
+        """
+        Remove the indexed words for some entries.
+
+        @param storeIDs: The store IDs of the L{SearchEntry} items, or a query
+            for them.
+        """
+        tableName = cls._ensureTable(store)
+        for storeID in list(storeIDs):
+            store.executeSQL(
+                'DELETE FROM {} WHERE rowid = ?'.format(tableName), [storeID])
+
+
+    @classmethod
+    def search(cls, store, environment, indexType, searchValue, searchType,
+               limit):
+        """
+        Find the entries containing all of the words of a normalized search
+        value, ranked by BM25. Words ending in C{*} match any word starting
+        with them.
+
+        @see: L{SearchEntry.search}
+        """
+        sql, args = cls._matches(
+            store, environment, indexType, searchValue, searchType,
+            [SearchEntry.result, SearchEntry.searchType])
+        rows = store.querySQL(
+            sql + ' ORDER BY bm25({}, 0.0, 1.0) LIMIT ?'.format(cls.tableName),
+            args + [limit])
+        return [{u'result': result,
+                 u'type': searchType}
+                for result, searchType in rows]
+
+
+    @classmethod
+    def count(cls, store, environment, indexType, searchValue, searchType,
+              cap):
+        """
+        Count the entries containing all of the words of a normalized search
+        value.
+
+        @see: L{SearchEntry.count}
+        """
+        sql, args = cls._matches(
+            store, environment, indexType, searchValue, searchType,
+            [SearchEntry.storeID])
+        [(count,)] = store.querySQL(
+            'SELECT COUNT(*) FROM (' + sql + ' LIMIT ?)',
+            args + [-1 if cap is None else cap])
+        return count
+
+
+    @classmethod
+    def _matches(cls, store, environment, indexType, searchValue, searchType,
+                 columns):
+        """
+        Build a query for the entries containing all of the words of a
+        normalized search value.
+
+        @param columns: The attributes of L{SearchEntry} to select.
+
+        @return: The SQL and arguments for the query.
+        """
+        terms = [
+            u'"{}"*'.format(token[:-1]) if token.endswith(u'*')
+            else u'"{}"'.format(token)
+            for token in searchValue.split(u' ')]
+        criteria = []
+        args = [
+            u'scope:{} AND words:({})'.format(
+                cls._scope(environment, indexType), u' AND '.join(terms)),
+            IndexName.find(store, environment),
+            IndexName.find(store, indexType),
+            IndexName.find(store, SearchClasses.TOKEN.value)]
+        if searchType is not None:
+            criteria.append(
+                'AND {} = ?'.format(SearchEntry.searchType.getColumnName(store)))
+            args.append(searchType)
+        sql = (
+            'SELECT {columns} '
+            'FROM {tokens} JOIN {entries} ON {entries}.oid = {tokens}.rowid '
+            'WHERE {table} MATCH ? AND {environment} = ? AND {indexType} = ? '
+            'AND {searchClass} = ? {criteria}'.format(
+                columns=', '.join(attr.getColumnName(store) for attr in columns),
+                tokens=cls._ensureTable(store),
+                table=cls.tableName,
+                entries=store.getTableName(SearchEntry),
+                environment=SearchEntry.environmentID.getColumnName(store),
+                indexType=SearchEntry.indexTypeID.getColumnName(store),
+                searchClass=SearchEntry.searchClassID.getColumnName(store),
+                criteria=' '.join(criteria)))
+        return sql, args
+
+
+
+class SearchPrefixStatistic(Item):
+    """
+    The number of L{SearchClasses.PREFIX} entries in an index whose search
+    values start with a short prefix.
+
+    These are only kept for prefixes up to C{length} characters long that are
+    shared by more than C{minimum} entries; they are recalculated periodically
+    by L{recalculate}, one index at a time, rather than as entries are
+    inserted and removed.
+    """
+    environment = text(doc="""
+    The environment of the entries.
+    """, allowNone=False)
+
+    indexType = text(doc="""
+    The index type of the entries.
+    """, allowNone=False)
+
+    prefix = text(doc="""
+    The prefix of the search values of the entries.
+    """, allowNone=False)
+
+    count = integer(doc="""
+    The number of entries.
+    """, allowNone=False)
+
+    compoundIndex(environment, indexType, prefix)
+
+    length = 3
+    minimum = 100
+
+    @classmethod
+    def estimate(cls, store, environment, indexType, prefix):
+        """
+        Estimate the number of entries matching a normalized prefix search.
+
+        @rtype: L{int}
+        @return: The estimate; C{0} if it is unknown, or no more than
+            C{minimum}.
+        """
+        if len(prefix) > cls.length:
+            return 0
+        statistic = store.findFirst(
+            cls,
+            AND(cls.environment == environment,
+                cls.indexType == indexType,
+                cls.prefix == prefix))
+        if statistic is None:
+            return 0
+        return statistic.count
+
+
+    @classmethod
+    def recalculate(cls, store, length, after=None):
+        """
+        Recalculate the statistics for prefixes of one length in the next
+        index with any L{SearchClasses.PREFIX} entries.
+
+        @type length: L{int}
+        @param length: The length of the prefixes.
+
+        @type after: L{tuple} or L{None}
+        @param after: The C{(environment, indexType)} store IDs of the index
+            recalculated by the previous call, or C{None} to start with the
+            first index.
+
+        @rtype: L{tuple} or L{None}
+        @return: The index recalculated, to pass as C{after} to the next call,
+            or C{None} if there are no indexes left, in which case the
+            statistics of indexes without any entries left are removed
+            instead.
+        """
+        searchClass = IndexName.find(store, SearchClasses.PREFIX.value)
+        columns = dict(
+            environment=SearchEntry.environmentID.getColumnName(store),
+            indexType=SearchEntry.indexTypeID.getColumnName(store),
+            searchValue=SearchEntry.searchValue.getColumnName(store),
+            entries=store.getTableName(SearchEntry),
+            searchClass=SearchEntry.searchClassID.getColumnName(store))
+        environmentID, indexTypeID = after or (0, 0)
+        indexes = store.querySQL(
+            'SELECT {environment}, {indexType} FROM {entries} '
+            'WHERE {searchClass} = ? AND ({environment} > ? '
+            'OR ({environment} = ? AND {indexType} > ?)) '
+            'ORDER BY {environment}, {indexType} LIMIT 1'.format(**columns),
+            [searchClass, environmentID, environmentID, indexTypeID])
+        if not indexes:
+            cls._removeEmpty(store, length)
+            return None
+        [(environmentID, indexTypeID)] = indexes
+        environment = IndexName.lookup(store, environmentID)
+        indexType = IndexName.lookup(store, indexTypeID)
+        store.query(
+            cls,
+            AND(cls.environment == environment,
+                cls.indexType == indexType,
+                cls.prefix.like(u'_' * length))).deleteFromStore()
+        store.batchInsert(
+            cls,
+            [cls.environment, cls.indexType, cls.prefix, cls.count],
+            [(environment, indexType, prefix, count)
+             for prefix, count in store.querySQL(
+                'SELECT SUBSTR({searchValue}, 1, ?) AS prefix, COUNT(*) '
+                'FROM {entries} WHERE {searchClass} = ? '
+                'AND {environment} = ? AND {indexType} = ? '
+                'AND LENGTH({searchValue}) >= ? '
+                'GROUP BY prefix HAVING COUNT(*) > ?'.format(**columns),
+                [length, searchClass, environmentID, indexTypeID, length,
+                 cls.minimum])])
+        return environmentID, indexTypeID
+
+
+    @classmethod
+    def _removeEmpty(cls, store, length):
+        """
+        Remove the statistics for prefixes of one length in indexes that no
+        longer have any L{SearchClasses.PREFIX} entries.
+        """
+        statistics = store.query(cls, cls.prefix.like(u'_' * length))
+        indexes = set(zip(statistics.getColumn('environment'),
+                          statistics.getColumn('indexType')))
+        for environment, indexType in indexes:
+            entry = store.findFirst(
+                SearchEntry,
+                SearchEntry.inIndex(
+                    store, SearchClasses.PREFIX, environment, indexType))
+            if entry is None:
+                store.query(
+                    cls,
+                    AND(cls.environment == environment,
+                        cls.indexType == indexType,
+                        cls.prefix.like(u'_' * length))).deleteFromStore()
+
+
+
+_postings = {
+    SearchClasses.TRIGRAM: SearchNGram,
+    SearchClasses.SUBSTRING: SearchSuffix,
+    SearchClasses.TOKEN: SearchTokens,
+    }
+
+
+
+declareLegacyItem(
+    SearchEntry.typeName, 1,
+    dict(searchClass=text(allowNone=False),
+         environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         searchValue=text(allowNone=False),
+         searchType=text(allowNone=False),
+         result=text(allowNone=False)))
+
+
+
+def _superseded(old):
+    """
+    Find the current entry for the same
+    C{(searchClass, environment, indexType, result, searchType)} as an entry
+    being upgraded, deleting the old entry if there is one.
+
+    @return: The current entry, or C{None}.
+    """
+    store = old.store
+    existing = store.findUnique(
+        SearchEntry,
+        AND(SearchEntry.searchClassID == IndexName.find(
+                store, old.searchClass),
+            SearchEntry.environmentID == IndexName.find(
+                store, old.environment),
+            SearchEntry.indexTypeID == IndexName.find(store, old.indexType),
+            SearchEntry.result == old.result,
+            SearchEntry.searchType == old.searchType),
+        None)
+    if existing is not None:
+        old.deleteFromStore()
+    return existing
+
+
+
+def upgradeSearchEntry1to2(old):
+    """
+    Upgrade L{SearchEntry} from version 1 to 2, discarding duplicate entries.
+
+    Version 1 entries were not guaranteed to be unique; if an entry for the
+    same C{(searchClass, environment, indexType, result, searchType)} has
+    already been upgraded, the old entry is deleted instead.
+    """
+    SearchEntry._ensureUniqueIndex(old.store)
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    return old.upgradeVersion(
+        SearchEntry.typeName, 1, 2,
+        searchClass=old.searchClass,
+        environment=old.environment,
+        indexType=old.indexType,
+        searchValue=old.searchValue,
+        searchType=old.searchType,
+        result=old.result)
+
+registerUpgrader(upgradeSearchEntry1to2, SearchEntry.typeName, 1, 2)
+
+
+
+declareLegacyItem(
+    SearchEntry.typeName, 2,
+    dict(searchClass=text(allowNone=False),
+         environment=text(allowNone=False),
+         indexType=text(allowNone=False),
+         searchValue=text(allowNone=False),
+         searchType=text(allowNone=False),
+         result=text(allowNone=False)))
+
+
+
+def upgradeSearchEntry2to3(old):
+    """
+    Upgrade L{SearchEntry} from version 2 to 3, replacing the search class,
+    environment and index type with L{IndexName}s.
+
+    Entries for the same search may have been inserted after the store was
+    opened but before this entry was upgraded; the old entry is deleted
+    instead.
+    """
+    existing = _superseded(old)
+    if existing is not None:
+        return existing
+    store = old.store
+    return old.upgradeVersion(
+        SearchEntry.typeName, 2, 3,
+        searchClassID=IndexName.intern(store, old.searchClass),
+        environmentID=IndexName.intern(store, old.environment),
+        indexTypeID=IndexName.intern(store, old.indexType),
+        searchValue=old.searchValue,
+        searchType=old.searchType,
+        result=old.result)
+
+registerUpgrader(upgradeSearchEntry2to3, SearchEntry.typeName, 2, 3)
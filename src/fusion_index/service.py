@@ -8,17 +8,149 @@ from twisted.application.service import (
 from twisted.internet import reactor
 from twisted.plugin import IPlugin
 from twisted.python import usage
-from twisted.web.server import Site
+from twisted.python.filepath import FilePath
+from twisted.web.client import Agent, HTTPConnectionPool
 from zope.interface import implementer
 
+from fusion_index.admission import AdmissionControl
+from fusion_index.bloom import LookupFilters
+from fusion_index.changes import ChangeFeed, ChangeRetention
+from fusion_index.coalesce import QueryCoalescer
+from fusion_index.expiry import ExpiryReaper
+from fusion_index.lookup import parseCompression, parseTTL
+from fusion_index.maintenance import MaintenanceService, parseWindow
+from fusion_index.replication import Follower
 from fusion_index.resource import IndexRouter
+from fusion_index.slowquery import SlowQueryLog
+from fusion_index.stats import IndexStatistics
+from fusion_index.timing import TimingSite, timeStore
+from fusion_index.warmup import (
+    HotKeys, ManifestService, WarmupService, loadManifest)
 
 
 
 class Options(usage.Options):
     optParameters = [
         ['port', 'p', 'tcp:80', 'Port to listen on'],
-        ['db', 'd', 'fusion-index.axiom', 'Path to database']]
+        ['db', 'd', 'fusion-index.axiom', 'Path to database'],
+        ['blob-threshold', None, 1024 * 1024,
+         'Store lookup values at least this many bytes long in files', int],
+        ['prefix-limit', None, None,
+         'Reject prefix searches estimated to match more than this many '
+         'entries', int],
+        ['slow-query-threshold', None, None,
+         'Log database queries taking longer than this many seconds', float],
+        ['hot-keys', None, 0,
+         'Track this many of the most requested lookup keys and searches, '
+         'and replay them at startup to warm up the caches', int],
+        ['hot-keys-interval', None, 300.0,
+         'Save the most requested keys this often, in seconds', float],
+        ['change-retention', None, 1000000,
+         'Keep at most this many of the most recent changes in the change '
+         'log, removing older ones in the background', int],
+        ['lookup-filter-error-rate', None, None,
+         'Answer lookups of missing keys from Bloom filters of the lookup '
+         'keys, sized for this false positive rate', float],
+        ['lookup-filter-interval', None, 300.0,
+         'Save the lookup key filters this often, in seconds', float],
+        ['coalesce-window', None, None,
+         'Answer identical lookups and searches made within this many seconds '
+         'of each other, with no change to the indexes in between, with the '
+         'result of the first', float],
+        ['max-reads', None, None,
+         'Handle at most this many GET requests at once, queueing others',
+         int],
+        ['max-writes', None, None,
+         'Handle at most this many other requests at once, queueing others',
+         int],
+        ['max-queued', None, 256,
+         'Reject requests with 503 Service Unavailable when this many are '
+         'already queued', int],
+        ['max-queue-time', None, 1.0,
+         'Reject requests with 503 Service Unavailable once they have been '
+         'queued for this many seconds', float],
+        ['stats-max-age', None, None,
+         'Compute index statistics in the background, this often, in '
+         'seconds, instead of on demand', float],
+        ['follow', None, None,
+         'Run as a read-only replica of the fusion-index service at this '
+         'URL'],
+        ['admin-token-file', None, None,
+         'Enable the admin resources for requests bearing the token in this '
+         'file']]
+
+    optFlags = [
+        ['blob-mmap', None, 'Memory-map files when serving lookup values'],
+        ['slow-query-redact', None,
+         'Leave query parameters out of the slow query log'],
+        ['server-timing', None,
+         'Send a Server-Timing header with the duration of each stage of '
+         'handling the request']]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['maintenance-windows'] = []
+        self['compression'] = {}
+        self['ttl'] = {}
+        self['substring'] = set()
+
+
+    def opt_maintenance_window(self, window):
+        """
+        Run database maintenance during the given UTC time window, of the form
+        HH:MM-HH:MM (may be given multiple times)
+        """
+        try:
+            self['maintenance-windows'].append(parseWindow(window))
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+
+
+    def opt_compress(self, spec):
+        """
+        Compress values in the given lookup index type that are at least the
+        given number of bytes long (default 1024), of the form
+        indexType[:threshold] (may be given multiple times)
+        """
+        try:
+            indexType, compression = parseCompression(spec)
+        except ValueError as e:
+            raise usage.UsageError(str(e))
+        self['compression'][indexType] = compression
+
+
+    def opt_ttl(self, spec):
+        """
+        Expire entries set without a TTL in the given lookup index type after
+        the given number of seconds, of the form indexType:seconds (may be
+        given multiple times)
+        """
+        indexType, _, ttl = spec.partition(':')
+        try:
+            ttl = parseTTL(ttl)
+        except ValueError:
+            raise usage.UsageError(
+                'Invalid TTL {!r}: must be of the form indexType:seconds'
+                .format(spec))
+        self['ttl'][indexType.decode('utf-8')] = ttl
+
+
+    def opt_substring(self, indexType):
+        """
+        Enable the substring search class for the given search index type (may
+        be given multiple times)
+        """
+        self['substring'].add(indexType.decode('utf-8'))
+
+
+    def postOptions(self):
+        if self['change-retention'] < 1:
+            raise usage.UsageError('--change-retention must be positive')
+        if (self['prefix-limit'] is not None and
+                not self['maintenance-windows']):
+            raise usage.UsageError(
+                '--prefix-limit requires a --maintenance-window, during which '
+                'the prefix statistics it relies on are calculated')
 
 
 
@@ -31,12 +163,120 @@ class FusionIndexServiceMaker(object):
     def makeService(self, options):
         service = MultiService()
 
+        created = not FilePath(options['db']).exists()
         store = Store(options['db'])
         store.querySQL('PRAGMA journal_mode=WAL;')
         store.querySQL('PRAGMA synchronous=NORMAL;')
+        if created:
+            # The vacuum mode of a database can only be changed by a full
+            # VACUUM once it has tables, which Store has already created;
+            # existing databases are converted during a maintenance window.
+            store.querySQL('PRAGMA auto_vacuum=INCREMENTAL;')
+            store.querySQL('VACUUM;')
         IService(store).setServiceParent(service)
 
-        site = Site(IndexRouter(store=store).router.resource())
+        if options['slow-query-threshold'] is not None:
+            SlowQueryLog(
+                threshold=options['slow-query-threshold'],
+                redact=options['slow-query-redact'],
+                ).install(store)
+
+        if options['maintenance-windows']:
+            MaintenanceService(
+                store=store,
+                windows=options['maintenance-windows'],
+                compression=options['compression'],
+                ).setServiceParent(service)
+
+        hotKeys = warmup = None
+        if options['hot-keys'] > 0:
+            manifest = store.dbdir.child('hot-keys.json')
+            hotKeys = HotKeys(size=options['hot-keys'])
+            ManifestService(
+                hotKeys=hotKeys,
+                path=manifest,
+                interval=options['hot-keys-interval'],
+                ).setServiceParent(service)
+            warmup = WarmupService(
+                store=store, manifest=loadManifest(manifest))
+            warmup.setServiceParent(service)
+
+        adminToken = None
+        if options['admin-token-file'] is not None:
+            with open(options['admin-token-file'], 'rb') as f:
+                adminToken = f.read().strip()
+            if not adminToken:
+                raise usage.UsageError(
+                    'The admin token file {!r} is empty'.format(
+                        options['admin-token-file']))
+
+        changeFeed = ChangeFeed(store=store)
+        changeFeed.install()
+        ChangeRetention(
+            store=store, count=options['change-retention'],
+            ).setServiceParent(service)
+
+        ExpiryReaper(store=store).setServiceParent(service)
+
+        filters = None
+        if options['lookup-filter-error-rate'] is not None:
+            filters = LookupFilters(
+                store=store,
+                path=store.dbdir.child('lookup-filters'),
+                errorRate=options['lookup-filter-error-rate'],
+                interval=options['lookup-filter-interval'])
+            filters.setServiceParent(service)
+
+        coalescer = None
+        if options['coalesce-window'] is not None:
+            coalescer = QueryCoalescer(
+                changeFeed=changeFeed, window=options['coalesce-window'])
+            coalescer.install()
+
+        follower = None
+        if options['follow'] is not None:
+            follower = Follower(
+                store=store,
+                agent=Agent(reactor, pool=HTTPConnectionPool(reactor)),
+                primary=options['follow'],
+                compression=options['compression'],
+                blobThreshold=options['blob-threshold'])
+            follower.setServiceParent(service)
+
+        statistics = None
+        if options['stats-max-age'] is not None:
+            statistics = IndexStatistics(
+                store=store, maxAge=options['stats-max-age'])
+            statistics.setServiceParent(service)
+
+        router = IndexRouter(
+            store=store,
+            compression=options['compression'],
+            ttl=options['ttl'],
+            blobThreshold=options['blob-threshold'],
+            blobMmap=options['blob-mmap'],
+            substring=options['substring'],
+            prefixLimit=options['prefix-limit'],
+            adminToken=adminToken,
+            statistics=statistics,
+            hotKeys=hotKeys,
+            warmup=warmup,
+            changeFeed=changeFeed,
+            primary=options['follow'],
+            follower=follower,
+            filters=filters,
+            coalescer=coalescer)
+        timeStore(store)
+        resource = router.router.resource()
+        if options['max-reads'] is not None or (
+                options['max-writes'] is not None):
+            resource = AdmissionControl(
+                resource=resource,
+                maxReads=options['max-reads'],
+                maxWrites=options['max-writes'],
+                maxQueued=options['max-queued'],
+                maxQueueTime=options['max-queue-time'])
+        site = TimingSite(resource, serverTiming=options['server-timing'])
         webService = strports.service(options['port'], site, reactor=reactor)
         webService.setServiceParent(service)
         return service
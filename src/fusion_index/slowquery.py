@@ -0,0 +1,135 @@
+"""
+Logging of slow database queries.
+
+Every statement Axiom runs against a store passes through the store's
+C{_queryandfetch}; L{SlowQueryLog.install} wraps it so that statements taking
+longer than a threshold are logged along with their query plan, which is
+captured once per distinct statement. This makes it possible to find queries
+that scan a table instead of using one of its indexes.
+
+Slow statements are counted per table and per index; the index is that of the
+request being handled when the statement ran, as recorded by
+L{fusion_index.timing.setIndex}.
+"""
+from re import IGNORECASE, compile
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+
+from fusion_index.logging import LOG_SLOW_QUERY
+from fusion_index.metrics import METRIC_SLOW_QUERIES
+from fusion_index.timing import currentIndex
+
+
+
+_TABLE = compile(
+    r'\b(?:FROM|INTO|UPDATE)\s+(?:\w+\.)?\[?(?:item_)?(\w+?)(?:_v\d+)?\b',
+    IGNORECASE)
+_EXPLAINABLE = compile(
+    r'\s*(?:SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', IGNORECASE)
+
+
+
+def tableName(sql):
+    """
+    Determine the main table a statement operates on.
+
+    @type sql: L{bytes}
+    @param sql: The statement.
+
+    @rtype: L{unicode}
+    @return: The table name, without Axiom's type prefix and version suffix,
+        or C{u''} if there is none.
+    """
+    match = _TABLE.search(sql)
+    if match is None:
+        return u''
+    return match.group(1).decode('ascii')
+
+
+
+@attributes(
+    ['threshold',
+     Attribute('redact', default_value=False),
+     Attribute('maxPlans', default_value=1000),
+     Attribute('clock', default_value=reactor)])
+class SlowQueryLog(object):
+    """
+    Log database statements that take longer than C{threshold} seconds.
+
+    Bound parameters are replaced with C{None} in the log if C{redact} is
+    true. Query plans are cached for up to C{maxPlans} distinct statements.
+    """
+    _plans = None
+
+    def install(self, store):
+        """
+        Start logging slow statements run against a store.
+
+        @type store: L{axiom.store.Store}
+        """
+        queryandfetch = store._queryandfetch
+
+        def _queryandfetch(sql, args):
+            start = self.clock.seconds()
+            result = queryandfetch(sql, args)
+            duration = self.clock.seconds() - start
+            if duration >= self.threshold:
+                self._logQuery(store, sql, args, result, duration)
+            return result
+        store._queryandfetch = _queryandfetch
+
+
+    def _logQuery(self, store, sql, args, result, duration):
+        """
+        Log a slow statement and count it.
+        """
+        plan = self._plan(store, sql, args)
+        scan = any(
+            detail.startswith(u'SCAN ') and detail != u'SCAN CONSTANT ROW'
+            for detail in plan)
+        environment, indexType = currentIndex()
+        METRIC_SLOW_QUERIES.labels(
+            tableName(sql), u'scan' if scan else u'search', environment,
+            indexType).inc()
+        if self.redact:
+            args = [None] * len(args)
+        LOG_SLOW_QUERY(
+            sql=sql,
+            args=list(args),
+            plan=plan,
+            rows=len(result),
+            duration=float(duration)).write()
+
+
+    def _plan(self, store, sql, args):
+        """
+        Get the query plan of a statement.
+
+        @rtype: L{list} of L{unicode}
+        @return: The details of each step of the plan, or an empty list if the
+            statement has no plan.
+        """
+        if self._plans is None:
+            self._plans = {}
+        plan = self._plans.get(sql)
+        if plan is not None:
+            return plan
+        plan = []
+        if _EXPLAINABLE.match(sql):
+            # Use a separate cursor so that the store's cursor state, such as
+            # the last inserted row ID, is left alone.
+            cursor = store.connection.cursor()
+            try:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, args)
+                plan = [unicode(row[-1]) for row in cursor]
+            finally:
+                cursor.close()
+        if len(self._plans) >= self.maxPlans:
+            self._plans.clear()
+        self._plans[sql] = plan
+        return plan
+
+
+
+__all__ = ['SlowQueryLog']
@@ -0,0 +1,256 @@
+"""
+Index size and storage statistics.
+"""
+import os
+
+from characteristic import Attribute, attributes
+from twisted.internet import reactor
+
+from fusion_index.background import BatchService
+from fusion_index.lookup import LookupEntry, LookupValue
+from fusion_index.metrics import (
+    METRIC_DATABASE_FILE_BYTES, METRIC_DATABASE_FREE_PAGES,
+    METRIC_LOOKUP_ENTRIES, METRIC_LOOKUP_VALUE_BYTES, METRIC_SEARCH_ENTRIES)
+from fusion_index.names import IndexName
+from fusion_index.search import SearchEntry
+
+
+
+_SOURCES = [
+    (LookupEntry, ['environmentID', 'indexTypeID'], ['COUNT(*)']),
+    (SearchEntry, ['searchClassID', 'environmentID', 'indexTypeID'],
+     ['COUNT(*)']),
+    (LookupValue, ['environment', 'indexType'],
+     ['SUM({size} * {refCount})', 'SUM({size})',
+      'SUM(CASE WHEN {blob} IS NULL THEN LENGTH({data}) ELSE {size} END)']),
+    ]
+
+
+
+def _batchTotals(store, item, groupBy, aggregates, after, limit):
+    """
+    Total a batch of the items in a store, grouped by some of their
+    attributes.
+
+    @param groupBy: The names of the attributes to group by.
+
+    @param aggregates: SQL aggregate expressions, in which C{{name}} stands
+        for the column of the attribute C{name}.
+
+    @type after: L{int}
+    @param after: Only items with a store ID greater than this are totalled.
+
+    @type limit: L{int}
+    @param limit: The maximum number of items to total.
+
+    @rtype: L{tuple}
+    @return: The totals of the batch, as a L{dict} mapping the values of the
+        C{groupBy} attributes to the values of the C{aggregates}, and the
+        store ID of the last item totalled, or C{None} if there are no items
+        left.
+    """
+    columns = dict(
+        (name, attr.getShortColumnName(store))
+        for name, attr in item.getSchema())
+    groups = ', '.join(columns[name] for name in groupBy)
+    rows = store.querySQL(
+        'SELECT {groups}, {aggregates}, MAX(oid) FROM ('
+        'SELECT oid, * FROM {table} WHERE oid > ? ORDER BY oid LIMIT ?) '
+        'GROUP BY {groups}'.format(
+            groups=groups,
+            aggregates=', '.join(
+                aggregate.format(**columns) for aggregate in aggregates),
+            table=store.getTableName(item)),
+        [after, limit])
+    if not rows:
+        return {}, None
+    return (
+        dict((tuple(row[:len(groupBy)]), row[len(groupBy):-1])
+             for row in rows),
+        max(row[-1] for row in rows))
+
+
+
+def _fileSize(path):
+    """
+    The size of a file, or 0 if it does not exist.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+
+@attributes(
+    ['store',
+     Attribute('maxAge', default_value=60.0),
+     Attribute('batchSize', default_value=10000),
+     Attribute('clock', default_value=reactor)])
+class IndexStatistics(BatchService):
+    """
+    Statistics about the size of each index and the database.
+
+    Computing the statistics scans every index, so while the service is
+    running they are computed in the background, totalling up to
+    C{batchSize} items in each transaction, and computed again C{maxAge}
+    seconds after they were last computed; the last ones computed are served
+    in between. Otherwise they are computed on demand, and cached for
+    C{maxAge} seconds. Each time they are computed, they are also published
+    as metrics; the metrics of indexes that no longer have any entries are
+    removed.
+    """
+    _statistics = None
+    _published = {}
+    _progress = None
+
+    @property
+    def interval(self):
+        """
+        How long to wait after computing the statistics before computing them
+        again, in the background.
+        """
+        return self.maxAge
+
+
+    def get(self):
+        """
+        Get the statistics, computing them if the service is not running and
+        there are none yet or the cached ones are too old.
+
+        The page cache hit rate is not included, since the C{sqlite3} module
+        does not expose the connection status counters it would be computed
+        from; the size of the page cache is included instead.
+
+        @rtype: L{dict} or L{None}
+        @return: The number of entries and the total size of their values for
+            each lookup index (C{lookup}), the number of entries in each
+            search index (C{search}), and the size of the database, its
+            write-ahead log and its page cache and the number of free pages in
+            it (C{database}); or C{None} if the service is running and has not
+            finished computing them yet.
+        """
+        if not self.running and (
+                self._statistics is None or
+                self.clock.seconds() - self._statistics[u'computed'] >=
+                self.maxAge):
+            self._progress = None
+            while self._batch():
+                pass
+        return self._statistics
+
+
+    def _batch(self):
+        """
+        Total a batch of items towards the next statistics, and compute the
+        statistics once every item has been totalled.
+        """
+        if self._progress is None:
+            self._progress = 0, 0, [{} for _ in _SOURCES]
+        source, after, totals = self._progress
+        item, groupBy, aggregates = _SOURCES[source]
+        batch, last = self.store.transact(
+            _batchTotals, self.store, item, groupBy, aggregates, after,
+            self.batchSize)
+        for key, values in batch.items():
+            previous = totals[source].get(key, (0,) * len(values))
+            totals[source][key] = tuple(
+                total + (value or 0) for total, value in zip(previous, values))
+        if last is not None:
+            self._progress = source, last, totals
+        elif source + 1 < len(_SOURCES):
+            self._progress = source + 1, 0, totals
+        else:
+            self._progress = None
+            self._statistics = self._compute(*totals)
+            return False
+        return True
+
+
+    def _publish(self, published, gauge, values):
+        """
+        Set a gauge to a value for each of its label sets, and remove the
+        label sets it was set for last time but not this time.
+
+        @param published: The label sets published so far this time, by
+            gauge, to be updated.
+
+        @type values: L{dict} mapping L{tuple}s to numbers
+        @param values: The value for each label set.
+        """
+        for labels, value in values.items():
+            gauge.labels(*labels).set(value)
+        for labels in self._published.get(gauge, set()) - set(values):
+            gauge.remove(*labels)
+        published[gauge] = set(values)
+
+
+    def _compute(self, lookupTotals, searchTotals, valueTotals):
+        """
+        Compute the statistics from the totals of every item, and publish
+        them.
+        """
+        values = dict(
+            (index, dict(logical=logical, unique=unique, stored=stored))
+            for index, (logical, unique, stored) in valueTotals.items())
+        LookupValue.publishRatios(values)
+        lookup = []
+        entries = {}
+        valueBytes = {}
+        for (environmentID, indexTypeID), (count,) in lookupTotals.items():
+            environment = IndexName.lookup(self.store, environmentID)
+            indexType = IndexName.lookup(self.store, indexTypeID)
+            size = values.get((environment, indexType), {})
+            lookup.append(
+                {u'environment': environment,
+                 u'indexType': indexType,
+                 u'entries': count,
+                 u'logicalBytes': size.get('logical', 0),
+                 u'storedBytes': size.get('stored', 0)})
+            entries[environment, indexType] = count
+            valueBytes[environment, indexType] = size.get('stored', 0)
+
+        search = []
+        searchEntries = {}
+        for nameIDs, (count,) in searchTotals.items():
+            searchClass, environment, indexType = [
+                IndexName.lookup(self.store, nameID) for nameID in nameIDs]
+            search.append(
+                {u'searchClass': searchClass,
+                 u'environment': environment,
+                 u'indexType': indexType,
+                 u'entries': count})
+            searchEntries[searchClass, environment, indexType] = count
+
+        published = {}
+        self._publish(published, METRIC_LOOKUP_ENTRIES, entries)
+        self._publish(published, METRIC_LOOKUP_VALUE_BYTES, valueBytes)
+        self._publish(published, METRIC_SEARCH_ENTRIES, searchEntries)
+        self._published = published
+
+        [(pageSize,)] = self.store.querySQL('PRAGMA page_size')
+        [(pageCount,)] = self.store.querySQL('PRAGMA page_count')
+        [(freePages,)] = self.store.querySQL('PRAGMA freelist_count')
+        [(cacheSize,)] = self.store.querySQL('PRAGMA cache_size')
+        walSize = 0
+        if self.store.dbdir is not None:
+            walSize = _fileSize(
+                self.store.dbdir.child('db.sqlite-wal').path)
+        database = {
+            u'size': pageSize * pageCount,
+            u'walSize': walSize,
+            u'pageSize': pageSize,
+            u'freePages': freePages,
+            # A negative cache size is a limit in KiB, rather than in pages.
+            u'cacheSize':
+                -cacheSize * 1024 if cacheSize < 0 else cacheSize * pageSize}
+        METRIC_DATABASE_FILE_BYTES.labels(u'db').set(database[u'size'])
+        METRIC_DATABASE_FILE_BYTES.labels(u'wal').set(walSize)
+        METRIC_DATABASE_FREE_PAGES.set(freePages)
+
+        return {u'lookup': lookup, u'search': search, u'database': database,
+                u'computed': self.clock.seconds()}
+
+
+
+__all__ = ['IndexStatistics']
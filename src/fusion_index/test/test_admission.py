@@ -0,0 +1,211 @@
+"""
+Tests for L{fusion_index.admission}.
+"""
+from prometheus_client import REGISTRY
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web import http
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from fusion_index.admission import AdmissionControl
+from fusion_index.test.util import MemoryRequest
+
+
+
+class _HeldResource(Resource):
+    """
+    A resource that responds at once to requests for C{fast}, fails requests
+    for C{error}, and otherwise holds requests until they are finished by the
+    test.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+
+    def render(self, request):
+        if request.postpath == [b'fast']:
+            return b'fast'
+        if request.postpath == [b'error']:
+            raise RuntimeError('rendering failed')
+        self.requests.append(request)
+        return NOT_DONE_YET
+
+
+
+class AdmissionControlTests(SynchronousTestCase):
+    """
+    Tests for L{AdmissionControl}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.resource = _HeldResource()
+        self.admission = AdmissionControl(
+            resource=self.resource, maxReads=1, maxWrites=1, maxQueued=2,
+            maxQueueTime=5, retryAfter=3, clock=self.clock)
+
+
+    def _request(self, method, path, received=None):
+        request = MemoryRequest(method, b'http://index' + path, Headers())
+        if received is not None:
+            request.received = received
+        request.render(self.admission)
+        return request
+
+
+    def _finish(self, request):
+        request.write(b'done')
+        request.finish()
+
+
+    def assertRejected(self, request):
+        self.assertEqual(request.code, http.SERVICE_UNAVAILABLE)
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b'Retry-After'), [b'3'])
+        self.assertEqual(request.finished, 1)
+
+
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+
+    def test_admit(self):
+        """
+        Requests within the limits are rendered at once.
+        """
+        request = self._request(b'GET', b'/fast')
+        self.assertEqual(request.written, [b'fast'])
+        request = self._request(b'GET', b'/slow')
+        self.assertEqual(self.resource.requests, [request])
+        self.assertEqual(
+            self._sample('admission_in_flight_requests', kind=u'read'), 1)
+        self._finish(request)
+        self.assertEqual(
+            self._sample('admission_in_flight_requests', kind=u'read'), 0)
+
+
+    def test_queue(self):
+        """
+        Requests beyond the limits wait until earlier requests of the same kind
+        finish; reads and writes are limited separately.
+        """
+        first = self._request(b'GET', b'/slow')
+        write = self._request(b'PUT', b'/slow')
+        second = self._request(b'GET', b'/slow')
+        self.assertEqual(self.resource.requests, [first, write])
+        self.assertEqual(
+            self._sample('admission_queued_requests', kind=u'read'), 1)
+        self._finish(first)
+        self.assertEqual(self.resource.requests, [first, write, second])
+        self.assertEqual(
+            self._sample('admission_queued_requests', kind=u'read'), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_queueFull(self):
+        """
+        Requests that would overflow the queue are rejected, except reads,
+        which displace the most recently queued write.
+        """
+        shed = self._sample(
+            'admission_shed_requests_total', kind=u'write',
+            reason=u'queue-full')
+        self._request(b'GET', b'/slow')
+        self._request(b'PUT', b'/slow')
+        write = self._request(b'PUT', b'/slow')
+        read = self._request(b'GET', b'/slow')
+        self.assertRejected(self._request(b'PUT', b'/slow'))
+        self.assertEqual(write.finished, 0)
+        self._request(b'GET', b'/slow')
+        self.assertRejected(write)
+        self.assertRejected(self._request(b'GET', b'/slow'))
+        self.assertEqual(read.finished, 0)
+        self.assertEqual(
+            self._sample(
+                'admission_shed_requests_total', kind=u'write',
+                reason=u'queue-full'),
+            shed + 2)
+
+
+    def test_timeout(self):
+        """
+        Requests that wait too long to be admitted are rejected.
+        """
+        self._request(b'GET', b'/slow')
+        queued = self._request(b'GET', b'/slow')
+        self.clock.advance(5)
+        self.assertRejected(queued)
+        self.assertEqual(len(self.resource.requests), 1)
+
+
+    def test_readPosts(self):
+        """
+        POST requests that look up or search several entries at once are
+        counted as reads.
+        """
+        first = self._request(b'POST', b'/lookup/e/t')
+        write = self._request(b'POST', b'/lookup/e/t/k')
+        search = self._request(b'POST', b'/search')
+        self.assertEqual(self.resource.requests, [first, write])
+        self.assertEqual(
+            self._sample('admission_queued_requests', kind=u'read'), 1)
+        self._finish(first)
+        self.assertEqual(self.resource.requests, [first, write, search])
+
+
+    def test_arrival(self):
+        """
+        Requests are rejected once they have waited too long since they
+        arrived, including before they are queued.
+        """
+        self.clock.advance(10)
+        self.assertRejected(self._request(b'GET', b'/fast', received=5))
+        self._request(b'GET', b'/slow', received=10)
+        queued = self._request(b'GET', b'/slow', received=7)
+        self.clock.advance(1)
+        self.assertEqual(queued.finished, 0)
+        self.clock.advance(1)
+        self.assertRejected(queued)
+
+
+    def test_abandon(self):
+        """
+        Requests whose client goes away while they wait are not admitted.
+        """
+        first = self._request(b'GET', b'/slow')
+        queued = self._request(b'GET', b'/slow')
+        queued.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self._finish(first)
+        self.assertEqual(self.resource.requests, [first])
+
+
+    def test_error(self):
+        """
+        Requests that fail to render stop being counted as in flight.
+        """
+        failed = []
+        request = MemoryRequest(b'GET', b'http://index/error', Headers())
+        request.notifyFinish().addErrback(failed.append)
+        request.render(self.admission)
+        [f] = failed
+        f.trap(RuntimeError)
+        self._request(b'GET', b'/slow')
+        self.assertEqual(len(self.resource.requests), 1)
+
+
+    def test_exempt(self):
+        """
+        Requests for exempt resources are always admitted, and not counted.
+        """
+        self._request(b'GET', b'/slow')
+        self._request(b'GET', b'/metrics')
+        self.assertEqual(len(self.resource.requests), 2)
+        self.assertEqual(
+            self._sample('admission_in_flight_requests', kind=u'read'), 1)
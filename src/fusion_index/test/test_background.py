@@ -0,0 +1,67 @@
+"""
+Tests for L{fusion_index.background}.
+"""
+from characteristic import Attribute, attributes
+from eliot.testing import capture_logging
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.background import BatchService
+
+
+
+@attributes(
+    ['batches',
+     Attribute('interval', default_value=10),
+     Attribute('clock', default_factory=Clock)])
+class _Batches(BatchService):
+    """
+    Do the batches in C{batches}, each of which is whether there is more work
+    to do after it, or an exception to raise.
+    """
+    done = 0
+
+    def _batch(self):
+        self.done += 1
+        result = self.batches.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+
+class BatchServiceTests(SynchronousTestCase):
+    """
+    Tests for L{BatchService}.
+    """
+    def test_batches(self):
+        """
+        Batches are done one after the other while there is more work to do,
+        and then after C{interval} seconds.
+        """
+        service = _Batches(batches=[True, True, False, False])
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEqual(service.done, 0)
+        service.clock.advance(0)
+        self.assertEqual(service.done, 3)
+        service.clock.advance(9)
+        self.assertEqual(service.done, 3)
+        service.clock.advance(1)
+        self.assertEqual(service.done, 4)
+
+
+    @capture_logging(None)
+    def test_error(self, logger):
+        """
+        A batch that fails is logged, and the next batch is done after
+        C{interval} seconds.
+        """
+        service = _Batches(batches=[RuntimeError('batch failed'), False])
+        service.startService()
+        service.clock.advance(0)
+        self.assertEqual(len(logger.flush_tracebacks(RuntimeError)), 1)
+        [call] = service.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), 10)
+        service.stopService()
+        self.assertEqual(service.clock.getDelayedCalls(), [])
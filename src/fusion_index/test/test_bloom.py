@@ -0,0 +1,240 @@
+"""
+Tests for L{fusion_index.bloom}.
+"""
+from axiom.store import Store
+from eliot.testing import capture_logging
+from prometheus_client import REGISTRY
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.bloom import BloomFilter, LookupFilters
+from fusion_index.changes import Change
+from fusion_index.lookup import LookupEntry
+
+
+
+class BloomFilterTests(SynchronousTestCase):
+    """
+    Tests for L{BloomFilter}.
+    """
+    def test_contains(self):
+        """
+        A filter contains every item added to it, and few others.
+        """
+        bloom = BloomFilter(1000, 0.01)
+        for i in xrange(1000):
+            bloom.add(b'key-%d' % (i,))
+        for i in xrange(1000):
+            self.assertIn(b'key-%d' % (i,), bloom)
+        falsePositives = sum(
+            1 for i in xrange(10000) if b'other-%d' % (i,) in bloom)
+        self.assertTrue(falsePositives < 300, falsePositives)
+        self.assertTrue(abs(bloom.falsePositiveRate() - 0.01) < 0.002)
+        self.assertEqual(bloom.size, 1199)
+
+
+    def test_count(self):
+        """
+        Adding an item the filter already contains does not count it again.
+        """
+        bloom = BloomFilter(10, 0.01)
+        self.assertEqual(bloom.falsePositiveRate(), 0.0)
+        bloom.add(b'a')
+        bloom.add(b'a')
+        bloom.add(b'b')
+        self.assertEqual(bloom.count, 2)
+
+
+    def test_dump(self):
+        """
+        A filter can be serialized and deserialized.
+        """
+        bloom = BloomFilter(100, 0.05)
+        bloom.add(b'a')
+        loaded = BloomFilter.load(bloom.dump())
+        self.assertIn(b'a', loaded)
+        self.assertNotIn(b'b', loaded)
+        self.assertEqual(
+            (loaded.capacity, loaded.errorRate, loaded.hashes, loaded.count),
+            (100, 0.05, bloom.hashes, 1))
+        self.assertEqual(loaded.dump(), bloom.dump())
+
+
+
+class LookupFiltersTests(SynchronousTestCase):
+    """
+    Tests for L{LookupFilters}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.path = FilePath(self.mktemp())
+
+
+    def filters(self, **kw):
+        filters = LookupFilters(
+            store=self.store, path=self.path, batchSize=2, clock=self.clock,
+            **kw)
+        filters.startService()
+        self.addCleanup(
+            lambda: filters.running and filters.stopService())
+        return filters
+
+
+    def test_build(self):
+        """
+        At startup, a filter is built for each lookup index, a batch of keys at
+        a time; until it is built, no key is ruled out. Keys are matched
+        case-insensitively.
+        """
+        for key in [u'a', u'b', u'c']:
+            LookupEntry.set(self.store, u'e', u't', key, b'value')
+        LookupEntry.set(self.store, u'e', u'u', u'a', b'value')
+        filters = self.filters()
+        self.assertTrue(filters.mightContain(u'e', u't', u'missing'))
+        self.assertFalse(filters.mightContain(u'e', u'v', u'a'))
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(self.clock.getDelayedCalls()[1:], [])
+        for key in [u'a', u'b', u'C']:
+            self.assertTrue(filters.mightContain(u'E', u't', key))
+        self.assertFalse(filters.mightContain(u'e', u't', u'missing'))
+        self.assertFalse(filters.mightContain(u'e', u'u', u'b'))
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_filter_bytes',
+                {'environment': u'e', 'indexType': u't'}),
+            1227)
+
+
+    def test_set(self):
+        """
+        Keys set while the filters are built, or afterwards, are added to them,
+        creating filters for new lookup indexes.
+        """
+        LookupEntry.set(self.store, u'e', u't', u'a', b'value')
+        filters = self.filters()
+        LookupEntry.set(self.store, u'e', u't', u'b', b'value')
+        self.clock.advance(0)
+        LookupEntry.set(self.store, u'e', u't', u'c', b'value')
+        LookupEntry.set(self.store, u'e', u'u', u'd', b'value')
+        for indexType, key in [(u't', u'a'), (u't', u'b'), (u't', u'c'),
+                               (u'u', u'd')]:
+            self.assertTrue(filters.mightContain(u'e', indexType, key))
+        self.assertFalse(filters.mightContain(u'e', u'u', u'a'))
+        filters.stopService()
+        self.assertTrue(filters.mightContain(u'e', u'u', u'a'))
+        self.assertNotIn(self.store, LookupEntry._filters)
+
+
+    def test_saturated(self):
+        """
+        A filter with more keys than it was sized for is rebuilt with room for
+        twice as many, and used until the new one is built.
+        """
+        filters = self.filters(minimumCapacity=4)
+        for i in xrange(5):
+            LookupEntry.set(self.store, u'e', u't', u'%d' % (i,), b'value')
+        self.assertEqual(filters._ready[b'e', b't'].capacity, 4)
+        self.assertIn((b'e', b't'), filters._building)
+        for _ in xrange(3):
+            self.clock.advance(0)
+        self.assertEqual(filters._ready[b'e', b't'].capacity, 10)
+        self.assertTrue(filters.mightContain(u'e', u't', u'4'))
+        self.assertFalse(filters.mightContain(u'e', u't', u'missing'))
+
+
+    def test_saturatedAfterRemovals(self):
+        """
+        A saturated filter is rebuilt with room for twice as many keys as the
+        index has, not as many as were added to the filter.
+        """
+        filters = self.filters(minimumCapacity=4)
+        for i in xrange(4):
+            LookupEntry.set(self.store, u'e', u't', u'%d' % (i,), b'value')
+        LookupEntry.deletePrefix(self.store, u'e', u't', u'0')
+        self.assertNotIn((b'e', b't'), filters._building)
+        LookupEntry.set(self.store, u'e', u't', u'4', b'value')
+        for _ in xrange(3):
+            self.clock.advance(0)
+        self.assertEqual(filters._ready[b'e', b't'].capacity, 8)
+
+
+    def test_removed(self):
+        """
+        Once as many keys have been removed from an index as are left, its
+        filter is rebuilt without them.
+        """
+        filters = self.filters()
+        for i in xrange(4):
+            LookupEntry.set(self.store, u'e', u't', u'%d' % (i,), b'value')
+        self.clock.advance(0)
+        LookupEntry.deletePrefix(self.store, u'e', u't', u'', limit=1)
+        self.assertEqual(filters._building, {})
+        LookupEntry.deletePrefix(self.store, u'e', u't', u'1')
+        self.assertIn((b'e', b't'), filters._building)
+        self.assertTrue(filters.mightContain(u'e', u't', u'0'))
+        for _ in xrange(2):
+            self.clock.advance(0)
+        self.assertEqual(filters._building, {})
+        self.assertFalse(filters.mightContain(u'e', u't', u'0'))
+        self.assertFalse(filters.mightContain(u'e', u't', u'1'))
+        self.assertTrue(filters.mightContain(u'e', u't', u'2'))
+        self.assertTrue(filters.mightContain(u'e', u't', u'3'))
+
+
+    def test_load(self):
+        """
+        The filters are saved periodically and when the service stops, and
+        loaded when it starts again, along with the keys set since then.
+        """
+        LookupEntry.set(self.store, u'e', u't', u'a', b'value')
+        filters = self.filters(interval=10)
+        self.clock.advance(10)
+        self.assertTrue(self.path.exists())
+        filters.stopService()
+        LookupEntry.set(self.store, u'e', u't', u'b', b'value')
+        LookupEntry.set(self.store, u'e', u'u', u'c', b'value')
+        filters = self.filters()
+        self.assertEqual(filters._building, {})
+        self.assertTrue(filters.mightContain(u'e', u't', u'a'))
+        self.assertTrue(filters.mightContain(u'e', u't', u'b'))
+        self.assertTrue(filters.mightContain(u'e', u'u', u'c'))
+        self.assertFalse(filters.mightContain(u'e', u't', u'c'))
+
+
+    def test_loadBehindHorizon(self):
+        """
+        If changes since the filters were saved have been removed from the
+        change log, the filters are built again.
+        """
+        filters = self.filters()
+        filters.stopService()
+        LookupEntry.set(self.store, u'e', u't', u'a', b'value')
+        LookupEntry.set(self.store, u'e', u't', u'b', b'value')
+        Change.retain(self.store, 1)
+        filters = self.filters()
+        self.assertEqual(filters._ready, {})
+        self.assertTrue(filters.mightContain(u'e', u't', u'missing'))
+        self.clock.advance(0)
+        self.assertTrue(filters.mightContain(u'e', u't', u'a'))
+        self.assertFalse(filters.mightContain(u'e', u't', u'missing'))
+
+
+    @capture_logging(None)
+    def test_loadInvalid(self, logger):
+        """
+        If the saved filters are invalid, they are built again.
+        """
+        LookupEntry.set(self.store, u'e', u't', u'a', b'value')
+        for content in [b'garbage', b'\xe9\x00']:
+            self.path.setContent(content)
+            filters = self.filters()
+            self.assertEqual(filters._ready, {})
+            self.assertIn((b'e', b't'), filters._building)
+            filters.stopService()
+        self.assertEqual(
+            len(logger.flush_tracebacks(ValueError)) +
+            len(logger.flush_tracebacks(EOFError)), 2)
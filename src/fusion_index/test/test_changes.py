@@ -0,0 +1,222 @@
+"""
+Tests for L{fusion_index.changes}.
+"""
+from axiom.store import Store
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.changes import (
+    Change, ChangeFeed, ChangeKinds, ChangeRetention)
+from fusion_index.lookup import LookupEntry
+from fusion_index.search import SearchClasses, SearchEntry
+
+
+
+class ChangeTests(SynchronousTestCase):
+    """
+    Tests for L{Change}.
+    """
+    def _changes(self, store, after=0):
+        return [
+            (change.kind, change.searchClass, change.key, change.searchValue)
+            for change in Change.since(store, after)]
+
+
+    def test_record(self):
+        """
+        Every mutation of the lookup and search indexes is recorded, in order.
+        """
+        store = Store()
+        self.assertEqual(Change.latest(store), 0)
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        SearchEntry.insert(
+            store, SearchClasses.EXACT, u'e', u'i', u'r', u'type', u'Value')
+        SearchEntry.remove(
+            store, SearchClasses.EXACT, u'e', u'i', u'r', u'type')
+        self.assertEqual(
+            self._changes(store),
+            [(ChangeKinds.LOOKUP_SET.value, None, u'k', None),
+             (ChangeKinds.SEARCH_INSERT.value, u'exact', u'r', u'value'),
+             (ChangeKinds.SEARCH_REMOVE.value, u'exact', u'r', None)])
+        [first, second, third] = Change.since(store, 0)
+        self.assertTrue(first.storeID < second.storeID < third.storeID)
+        self.assertEqual(Change.latest(store), third.storeID)
+        self.assertEqual(
+            self._changes(store, first.storeID), self._changes(store)[1:])
+
+
+    def test_rollback(self):
+        """
+        Changes are not recorded for mutations that are rolled back.
+        """
+        store = Store()
+
+        def _fail():
+            LookupEntry.set(store, u'e', u't', u'k', b'value')
+            raise ValueError()
+        self.assertRaises(ValueError, store.transact, _fail)
+        self.assertEqual(Change.since(store, 0), [])
+
+
+    def test_compact(self):
+        """
+        Compaction removes changes superseded by a later change to the same
+        entry, a batch at a time.
+        """
+        store = Store()
+        for value in [u'a', u'b', u'c']:
+            LookupEntry.set(store, u'e', u't', u'k', value.encode('ascii'))
+            SearchEntry.insert(
+                store, SearchClasses.EXACT, u'e', u't', u'k', u'type', value)
+        SearchEntry.insert(
+            store, SearchClasses.PREFIX, u'e', u't', u'k', u'type', u'a')
+        SearchEntry.remove(
+            store, SearchClasses.EXACT, u'e', u't', u'k', u'type')
+        position = Change.compact(store, 0, limit=4)
+        self.assertEqual(len(Change.since(store, 0)), 4)
+        while position is not None:
+            position = Change.compact(store, position, limit=4)
+        self.assertEqual(
+            self._changes(store),
+            [(ChangeKinds.LOOKUP_SET.value, None, u'k', None),
+             (ChangeKinds.SEARCH_INSERT.value, u'prefix', u'k', u'a'),
+             (ChangeKinds.SEARCH_REMOVE.value, u'exact', u'k', None)])
+
+
+    def test_retain(self):
+        """
+        Retention removes all but the most recent changes, and advances the
+        horizon to the most recent change removed.
+        """
+        store = Store()
+        for i in xrange(5):
+            LookupEntry.set(store, u'e', u't', unicode(i), b'value')
+        Change.retain(store, 10)
+        self.assertEqual(Change.horizon(store), 0)
+        changes = Change.since(store, 0)
+        self.assertEqual(Change.retain(store, 2), 3)
+        self.assertEqual(Change.horizon(store), changes[2].storeID)
+        self.assertEqual(Change.since(store, 0), changes[3:])
+
+
+    def test_retainLimit(self):
+        """
+        Retention can remove a limited number of changes at a time, oldest
+        first.
+        """
+        store = Store()
+        for i in xrange(5):
+            LookupEntry.set(store, u'e', u't', unicode(i), b'value')
+        changes = Change.since(store, 0)
+        self.assertEqual(Change.retain(store, 1, limit=3), 3)
+        self.assertEqual(Change.horizon(store), changes[2].storeID)
+        self.assertEqual(Change.retain(store, 1, limit=3), 1)
+        self.assertEqual(Change.since(store, 0), changes[4:])
+        self.assertEqual(Change.retain(store, 1, limit=3), 0)
+
+
+
+class ChangeRetentionTests(SynchronousTestCase):
+    """
+    Tests for L{ChangeRetention}.
+    """
+    def test_retain(self):
+        """
+        All but the most recent changes are removed, a batch at a time, one
+        batch after the other while there are more, and then again after the
+        interval.
+        """
+        store = Store()
+        for i in xrange(5):
+            LookupEntry.set(store, u'e', u't', unicode(i), b'value')
+        clock = Clock()
+        service = ChangeRetention(
+            store=store, count=1, batchSize=2, interval=10, clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        clock.advance(0)
+        self.assertEqual(
+            [change.key for change in Change.since(store, 0)], [u'4'])
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        clock.advance(9)
+        self.assertEqual(len(Change.since(store, 0)), 2)
+        clock.advance(1)
+        self.assertEqual(
+            [change.key for change in Change.since(store, 0)], [u'k'])
+
+
+
+class ChangeFeedTests(SynchronousTestCase):
+    """
+    Tests for L{ChangeFeed}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.feed = ChangeFeed(store=self.store, clock=self.clock)
+        self.feed.install()
+
+
+    def test_existing(self):
+        """
+        If there are already changes after the sequence number, waiting
+        finishes immediately.
+        """
+        self.store.transact(
+            LookupEntry.set, self.store, u'e', u't', u'k', b'value')
+        self.assertTrue(self.successResultOf(self.feed.wait(0, 10)))
+
+
+    def test_observe(self):
+        """
+        Observers are called after each transaction that modifies the store is
+        committed, but not after other transactions.
+        """
+        observed = []
+        self.feed.observe(lambda: observed.append(Change.latest(self.store)))
+        self.store.transact(
+            LookupEntry.set, self.store, u'e', u't', u'k', b'value')
+        self.assertEqual(observed, [Change.latest(self.store)])
+        self.store.transact(
+            LookupEntry.find, self.store, u'e', u't', u'k')
+        self.assertEqual(len(observed), 1)
+        self.store.transact(
+            LookupEntry.set, self.store, u'e', u't', u'k', b'other')
+        self.assertEqual(observed[1:], [Change.latest(self.store)])
+
+
+    def test_committed(self):
+        """
+        Waiting finishes once a change is committed.
+        """
+        latest = Change.latest(self.store)
+        d = self.feed.wait(latest, 10)
+        self.store.transact(lambda: self.assertNoResult(d))
+        self.assertNoResult(d)
+        self.store.transact(
+            LookupEntry.set, self.store, u'e', u't', u'k', b'value')
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_timeout(self):
+        """
+        Waiting finishes when the timeout expires, if there are no changes.
+        """
+        d = self.feed.wait(0, 10)
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertFalse(self.successResultOf(d))
+
+
+    def test_cancel(self):
+        """
+        Cancelling stops waiting.
+        """
+        d = self.feed.wait(0, 10)
+        d.cancel()
+        self.failureResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.store.transact(
+            LookupEntry.set, self.store, u'e', u't', u'k', b'value')
@@ -0,0 +1,219 @@
+"""
+Tests for L{fusion_index.client}.
+"""
+from axiom.store import Store
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.client import IndexClient, UnexpectedResponse
+from fusion_index.lookup import LookupEntry
+from fusion_index.resource import IndexRouter
+from fusion_index.search import SearchClasses
+from fusion_index.test.util import ResourceTraversalAgent
+
+
+
+class _RecordingAgent(object):
+    """
+    Record the requests made through another agent.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.requests = []
+
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers))
+        return self.agent.request(method, uri, headers, bodyProducer)
+
+
+
+class _BlockingAgent(object):
+    """
+    An agent whose requests do not complete until released.
+    """
+    def __init__(self):
+        self.requests = []
+
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = Deferred()
+        self.requests.append(d)
+        return d
+
+
+
+class _NoBatchingAgent(_RecordingAgent):
+    """
+    Make requests to a service without the multi-key lookup resource.
+    """
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if method == b'POST':
+            uri = b'http://index/nowhere'
+        return _RecordingAgent.request(
+            self, method, uri, headers, bodyProducer)
+
+
+
+class IndexClientTests(SynchronousTestCase):
+    """
+    Tests for L{IndexClient}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.agent = _RecordingAgent(
+            ResourceTraversalAgent(
+                IndexRouter(store=self.store).router.resource()))
+        self.client = IndexClient(
+            url=b'http://index/', agent=self.agent, reactor=self.clock)
+
+
+    def _get(self, *keys):
+        """
+        Look up some keys at the same time.
+        """
+        ds = [self.client.get(u'e', u't', key) for key in keys]
+        self.clock.advance(0)
+        return ds
+
+
+    def test_lookup(self):
+        """
+        Values are stored and retrieved; looking up a missing key fails with
+        L{KeyError}.
+        """
+        self.successResultOf(self.client.set(u'e', u't', u'k/1', b'value'))
+        [d] = self._get(u'k/1')
+        self.assertEqual(self.successResultOf(d), b'value')
+        [d] = self._get(u'missing')
+        self.failureResultOf(d, KeyError)
+        [(_, uri, _)] = self.agent.requests[-1:]
+        self.assertEqual(uri, b'http://index/lookup/e/t/missing')
+
+
+    def test_ttl(self):
+        """
+        Values can be stored with a TTL.
+        """
+        self.successResultOf(
+            self.client.set(u'e', u't', u'k', b'value', ttl=60))
+        _, _, headers = self.agent.requests[-1]
+        self.assertEqual(headers.getRawHeaders(b'X-TTL'), [b'60.0'])
+        self.assertNotIdentical(
+            LookupEntry.find(self.store, u'e', u't', u'k').expires, None)
+
+
+    def test_revalidate(self):
+        """
+        Cached values are revalidated with their entity tag, and only
+        transferred again if they have changed.
+        """
+        self.successResultOf(self.client.set(u'e', u't', u'k', b'value'))
+        [d] = self._get(u'k')
+        self.assertEqual(self.successResultOf(d), b'value')
+        [d] = self._get(u'k')
+        self.assertEqual(self.successResultOf(d), b'value')
+        _, _, headers = self.agent.requests[-1]
+        [etag] = headers.getRawHeaders(b'If-None-Match')
+        self.assertTrue(etag.startswith(b'W/"'))
+
+        IndexClient(url=b'http://index/', agent=self.agent).set(
+            u'e', u't', u'k', b'changed')
+        [d] = self._get(u'k')
+        self.assertEqual(self.successResultOf(d), b'changed')
+
+
+    def test_batch(self):
+        """
+        Lookups in the same index made at the same time are batched into a
+        single request, which also revalidates cached values.
+        """
+        for key in [u'a', u'b', u'c']:
+            self.successResultOf(
+                self.client.set(u'e', u't', key, key.encode('ascii') * 2))
+        del self.agent.requests[:]
+        ds = self._get(u'a', u'b', u'a', u'missing')
+        self.assertEqual(
+            [(method, uri) for method, uri, _ in self.agent.requests],
+            [(b'POST', b'http://index/lookup/e/t')])
+        self.assertEqual(
+            [self.successResultOf(d) for d in ds[:3]], [b'aa', b'bb', b'aa'])
+        self.failureResultOf(ds[3], KeyError)
+
+        self.client.batchSize = 2
+        ds = self._get(u'a', u'b', u'c')
+        self.assertEqual(
+            sorted(self.successResultOf(d) for d in ds), [b'aa', b'bb', b'cc'])
+        self.assertEqual(len(self.agent.requests), 3)
+
+
+    def test_noBatching(self):
+        """
+        If the service does not support batched lookups, each lookup is made
+        separately.
+        """
+        agent = _NoBatchingAgent(self.agent)
+        client = IndexClient(
+            url=b'http://index/', agent=agent, reactor=self.clock)
+        for key in [u'a', u'b']:
+            self.successResultOf(
+                self.client.set(u'e', u't', key, key.encode('ascii')))
+        ds = [client.get(u'e', u't', key) for key in [u'a', u'b']]
+        self.clock.advance(0)
+        self.assertEqual([self.successResultOf(d) for d in ds], [b'a', b'b'])
+        self.assertEqual(
+            [method for method, _, _ in agent.requests],
+            [b'POST', b'GET', b'GET'])
+        ds = [client.get(u'e', u't', key) for key in [u'a', u'b']]
+        self.clock.advance(0)
+        self.assertEqual([self.successResultOf(d) for d in ds], [b'a', b'b'])
+        self.assertEqual(
+            [method for method, _, _ in agent.requests[3:]], [b'GET', b'GET'])
+
+
+    def test_inFlight(self):
+        """
+        At most C{maxInFlight} requests are made at once.
+        """
+        agent = _BlockingAgent()
+        client = IndexClient(
+            url=b'http://index/', agent=agent, maxInFlight=2,
+            reactor=self.clock)
+        ds = [client.set(u'e', u't', unicode(i), b'value') for i in xrange(3)]
+        self.assertEqual(len(agent.requests), 2)
+        agent.requests[0].errback(ValueError())
+        self.failureResultOf(ds[0], ValueError)
+        self.assertEqual(len(agent.requests), 3)
+
+
+    def test_search(self):
+        """
+        Entries are inserted into and removed from search indexes, and
+        searched for.
+        """
+        self.successResultOf(
+            self.client.insert(
+                SearchClasses.PREFIX, u'e', u'i', u'r', u'type', u'Value'))
+        self.assertEqual(
+            self.successResultOf(
+                self.client.search(SearchClasses.PREFIX, u'e', u'i', u'val')),
+            [{u'result': u'r', u'type': u'type'}])
+        self.assertEqual(
+            self.successResultOf(
+                self.client.search(
+                    SearchClasses.PREFIX, u'e', u'i', u'val', u'other',
+                    count=True)),
+            0)
+        self.successResultOf(
+            self.client.remove(
+                SearchClasses.PREFIX, u'e', u'i', u'r', u'type'))
+        self.assertEqual(
+            self.successResultOf(
+                self.client.search(SearchClasses.PREFIX, u'e', u'i', u'val')),
+            [])
+        f = self.failureResultOf(
+            self.client.search(SearchClasses.SUBSTRING, u'e', u'i', u'val'),
+            UnexpectedResponse)
+        self.assertEqual(f.value.code, 404)
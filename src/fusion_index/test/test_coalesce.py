@@ -0,0 +1,98 @@
+"""
+Tests for L{fusion_index.coalesce}.
+"""
+from axiom.store import Store
+from prometheus_client import REGISTRY
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.changes import ChangeFeed
+from fusion_index.coalesce import QueryCoalescer
+from fusion_index.lookup import LookupEntry
+
+
+
+class QueryCoalescerTests(SynchronousTestCase):
+    """
+    Tests for L{QueryCoalescer}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        changeFeed = ChangeFeed(store=self.store)
+        changeFeed.install()
+        self.coalescer = QueryCoalescer(
+            changeFeed=changeFeed, window=1, maxResults=2, clock=self.clock)
+        self.coalescer.install()
+        self.queries = []
+
+
+    def _query(self, result):
+        self.queries.append(result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def query(self, key, result):
+        return self.coalescer.query(
+            u'lookup', u'coalesce', u't', key, self._query, result)
+
+
+    def test_share(self):
+        """
+        Identical queries within the window share the result of the first, and
+        are counted.
+        """
+        labels = {'route': u'lookup', 'environment': u'coalesce',
+                  'indexType': u't'}
+        coalesced = REGISTRY.get_sample_value(
+            'coalesced_requests_total', labels) or 0
+        self.assertEqual(self.query(u'a', 1), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.query(u'a', 2), 1)
+        self.assertEqual(self.query(u'b', 3), 3)
+        self.clock.advance(0.5)
+        self.assertEqual(self.query(u'a', 4), 4)
+        self.assertEqual(self.queries, [1, 3, 4])
+        self.assertEqual(
+            REGISTRY.get_sample_value('coalesced_requests_total', labels),
+            coalesced + 1)
+
+
+    def test_errors(self):
+        """
+        A L{KeyError} is shared like a result; other exceptions are not.
+        """
+        self.assertRaises(KeyError, self.query, u'a', KeyError(u'a'))
+        self.assertRaises(KeyError, self.query, u'a', 1)
+        self.assertRaises(ValueError, self.query, u'b', ValueError())
+        self.assertEqual(self.query(u'b', 2), 2)
+        self.assertEqual(len(self.queries), 3)
+
+
+    def test_maxResults(self):
+        """
+        Only the most recent C{maxResults} results are kept.
+        """
+        self.query(u'a', 1)
+        self.query(u'b', 2)
+        self.query(u'c', 3)
+        self.assertEqual(self.query(u'c', 4), 3)
+        self.assertEqual(self.query(u'b', 5), 2)
+        self.assertEqual(self.query(u'a', 6), 6)
+
+
+    def test_invalidate(self):
+        """
+        The results are discarded when a transaction that modifies the store is
+        committed, but not otherwise.
+        """
+        LookupEntry.set(self.store, u'coalesce', u't', u'a', b'value')
+        self.query(u'a', 1)
+        self.store.transact(
+            LookupEntry.find, self.store, u'coalesce', u't', u'a')
+        self.assertEqual(self.query(u'a', 2), 1)
+        self.store.transact(
+            LookupEntry.set, self.store, u'coalesce', u't', u'a', b'value')
+        self.assertEqual(self.query(u'a', 3), 3)
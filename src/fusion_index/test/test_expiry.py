@@ -0,0 +1,69 @@
+"""
+Tests for L{fusion_index.expiry}.
+"""
+from axiom.store import Store
+from eliot.testing import capture_logging
+from epsilon.extime import Time
+from prometheus_client import REGISTRY
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.expiry import ExpiryReaper
+from fusion_index.lookup import LookupEntry
+
+
+
+class ExpiryReaperTests(SynchronousTestCase):
+    """
+    Tests for L{ExpiryReaper}.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.reaper = ExpiryReaper(
+            store=self.store, batchSize=2, interval=10, clock=self.clock)
+
+
+    def test_reap(self):
+        """
+        Expired entries are removed a batch at a time, one batch after the
+        other while there are more, and otherwise every C{interval} seconds.
+        The number of entries removed is published.
+        """
+        for i in xrange(5):
+            LookupEntry.set(
+                self.store, u'reaper', u't', u'k%d' % (i,), b'abc',
+                expires=Time.fromPOSIXTimestamp(i))
+        self.clock.advance(3.5)
+        self.reaper.startService()
+        self.addCleanup(self.reaper.stopService)
+        self.assertEqual(self.store.query(LookupEntry).count(), 5)
+        self.clock.advance(0)
+        self.assertEqual(self.store.query(LookupEntry).count(), 1)
+        [call] = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), 13.5)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_reaped_total',
+                {'environment': u'reaper', 'indexType': u't'}),
+            4)
+        self.clock.advance(10)
+        self.assertEqual(self.store.query(LookupEntry).count(), 0)
+
+
+    @capture_logging(None)
+    def test_error(self, logger):
+        """
+        Errors are logged, and the next batch is removed after C{interval}
+        seconds.
+        """
+        def _reap(cls, *a, **kw):
+            raise RuntimeError('reaping failed')
+        self.patch(LookupEntry, 'reap', classmethod(_reap))
+        self.reaper.startService()
+        self.clock.advance(0)
+        self.assertEqual(len(logger.flush_tracebacks(RuntimeError)), 1)
+        [call] = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), 10)
+        self.reaper.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -1,12 +1,22 @@
+import os
 import string
+import zlib
+from hashlib import sha256
+from StringIO import StringIO
 
+from axiom.item import declareLegacyItem
 from axiom.store import Store
+from epsilon.extime import Time
 from hypothesis import given, settings
 from hypothesis.strategies import binary, characters, lists, text, tuples
+from fixtures import TempDir
 from testtools import TestCase
-from testtools.matchers import Equals
+from testtools.matchers import Equals, Not
 
-from fusion_index.lookup import LookupEntry
+from fusion_index.changes import Change
+from fusion_index.lookup import (
+    Blob, Compression, Encodings, LookupEntry, LookupValue, parseCompression)
+from fusion_index.names import IndexName
 
 
 
@@ -48,3 +58,508 @@ class LookupTests(TestCase):
             for (e, t, k), v in d.iteritems():
                 self.assertThat(LookupEntry.get(s, e, t, k), Equals(v))
         s.transact(_tx)
+
+
+    @settings(deadline=500)
+    @given(lists(tuples(axiom_text(), axiom_text(), binary(max_size=300)),
+                 max_size=10))
+    def test_compressedInserts(self, values):
+        """
+        Test inserting and retrieving arbitrary entries with compression.
+        """
+        s = Store()
+        compression = Compression(threshold=100)
+
+        def _tx():
+            for e, k, v in values:
+                LookupEntry.set(s, e, u't', k, v, compression)
+                self.assertThat(LookupEntry.get(s, e, u't', k), Equals(v))
+        s.transact(_tx)
+
+
+    def test_compression(self):
+        """
+        Values at least as long as the threshold are stored compressed, unless
+        that would not make them any smaller.
+        """
+        s = Store()
+        compression = Compression(threshold=100)
+        LookupEntry.set(s, u'e', u't', u'short', b'a' * 99, compression)
+        LookupEntry.set(s, u'e', u't', u'long', b'a' * 100, compression)
+        LookupEntry.set(s, u'e', u't', u'random', os.urandom(1000), compression)
+        self.assertThat(
+            LookupEntry.getEncoded(s, u'e', u't', u'short'),
+            Equals((Encodings.IDENTITY, b'a' * 99)))
+        self.assertThat(
+            LookupEntry.getEncoded(s, u'e', u't', u'long'),
+            Equals((Encodings.DEFLATE, zlib.compress(b'a' * 100, 6))))
+        self.assertThat(
+            LookupEntry.getEncoded(s, u'e', u't', u'random')[0],
+            Equals(Encodings.IDENTITY))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'long'), Equals(b'a' * 100))
+
+
+    def test_parseCompression(self):
+        """
+        Compression policies are parsed from C{indexType[:threshold]}.
+        """
+        self.assertThat(
+            parseCompression('foo'), Equals((u'foo', Compression(threshold=1024))))
+        self.assertThat(
+            parseCompression('foo:10'), Equals((u'foo', Compression(threshold=10))))
+        self.assertRaises(ValueError, parseCompression, '')
+        self.assertRaises(ValueError, parseCompression, 'foo:bar')
+
+
+    def test_deduplication(self):
+        """
+        Entries in the same index with identical values share a single stored
+        value, which is deleted when no entries refer to it any longer.
+        """
+        s = Store()
+        LookupEntry.set(s, u'e', u't', u'k1', b'a')
+        LookupEntry.set(s, u'e', u't', u'k2', b'a')
+        LookupEntry.set(s, u'e', u't2', u'k1', b'a')
+        LookupEntry.set(s, u'e', u't', u'k3', b'b')
+        self.assertThat(
+            sorted((v.indexType, v.data, v.refCount)
+                   for v in s.query(LookupValue)),
+            Equals([(u't', b'a', 2), (u't', b'b', 1), (u't2', b'a', 1)]))
+
+        LookupEntry.set(s, u'e', u't', u'k1', b'b')
+        LookupEntry.set(s, u'e', u't', u'k3', b'b')
+        self.assertThat(
+            sorted((v.indexType, v.data, v.refCount)
+                   for v in s.query(LookupValue)),
+            Equals([(u't', b'a', 1), (u't', b'b', 2), (u't2', b'a', 1)]))
+
+        LookupEntry.set(s, u'e', u't', u'k2', b'c')
+        self.assertThat(
+            sorted((v.indexType, v.data, v.refCount)
+                   for v in s.query(LookupValue)),
+            Equals([(u't', b'b', 2), (u't', b'c', 1), (u't2', b'a', 1)]))
+
+        s.query(
+            LookupEntry, LookupEntry.indexTypeID == IndexName.find(s, u't'),
+            ).deleteFromStore()
+        self.assertThat(
+            sorted((v.indexType, v.data, v.refCount)
+                   for v in s.query(LookupValue)),
+            Equals([(u't2', b'a', 1)]))
+        self.assertThat(LookupEntry.get(s, u'e', u't2', u'k1'), Equals(b'a'))
+
+
+    def test_recompress(self):
+        """
+        L{LookupValue.recompress} re-encodes existing values in batches
+        according to the current compression policies.
+        """
+        s = Store()
+        for i in xrange(5):
+            LookupEntry.set(s, u'e', u'a', unicode(i), bytes(i) * 1000)
+            LookupEntry.set(
+                s, u'e', u'b', unicode(i), bytes(i) * 1000,
+                Compression(threshold=10))
+        compression = {u'a': Compression(threshold=10)}
+        after = 0
+        batches = 0
+        while after is not None:
+            after = LookupValue.recompress(s, compression, after, limit=3)
+            batches += 1
+        self.assertThat(batches, Equals(5))
+        for i in xrange(5):
+            self.assertThat(
+                LookupEntry.getEncoded(s, u'e', u'a', unicode(i)),
+                Equals((Encodings.DEFLATE, zlib.compress(bytes(i) * 1000, 6))))
+            self.assertThat(
+                LookupEntry.getEncoded(s, u'e', u'b', unicode(i)),
+                Equals((Encodings.IDENTITY, bytes(i) * 1000)))
+
+        def _store(*a, **kw):
+            self.fail('Value re-encoded')
+        self.patch(LookupValue, '_store', _store)
+        self.assertThat(
+            LookupValue.recompress(s, compression, limit=10),
+            Equals(s.query(LookupValue).getColumn('storeID').max()))
+
+
+    def test_storageStats(self):
+        """
+        L{LookupValue.storageStats} computes the total, distinct, and stored
+        value size for each index.
+        """
+        s = Store()
+        LookupEntry.set(
+            s, u'e', u'a', u'k1', b'a' * 1000, Compression(threshold=10))
+        LookupEntry.set(s, u'e', u'a', u'k2', b'a' * 1000)
+        LookupEntry.set(s, u'e', u'a', u'k3', b'b' * 1000)
+        LookupEntry.set(s, u'e', u'b', u'k1', b'b' * 1000)
+        stats = LookupValue.storageStats(s)
+        self.assertThat(
+            stats[u'e', u'a'],
+            Equals(dict(
+                logical=3000,
+                unique=2000,
+                stored=len(zlib.compress(b'a' * 1000, 6)) + 1000)))
+        self.assertThat(
+            stats[u'e', u'b'],
+            Equals(dict(logical=1000, unique=1000, stored=1000)))
+
+
+    def test_upgradeValue2to3(self):
+        """
+        Upgrading a version 2 value leaves its compression policy unknown, and
+        merges any copy of it stored before the upgrade.
+        """
+        s = Store()
+        old = declareLegacyItem(LookupValue.typeName, 2, {})(
+            store=s, environment=u'e', indexType=u't',
+            digest=sha256(b'abc').hexdigest().decode('ascii'), data=b'abc',
+            size=3, refCount=1)
+        entry = LookupEntry(
+            store=s, environmentID=IndexName.intern(s, u'e'),
+            indexTypeID=IndexName.intern(s, u't'), key=u'k1',
+            content=old)
+        LookupEntry.set(s, u'e', u't', u'k2', b'abc')
+        copy = LookupEntry.find(s, u'e', u't', u'k2').content
+        self.assertThat(copy.storeID, Not(Equals(old.storeID)))
+
+        value = s.getItemByID(old.storeID)
+        self.assertThat(value.policy, Equals(None))
+        self.assertThat(value.refCount, Equals(2))
+        self.assertThat(
+            [e.content for e in s.query(LookupEntry)], Equals([value, value]))
+        self.assertThat(s.query(LookupValue).count(), Equals(1))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'k2'), Equals(b'abc'))
+        self.assertThat(entry.content, Equals(value))
+
+
+    def test_upgrade1to3(self):
+        """
+        Upgrading a version 1 entry moves its value into the value store.
+        """
+        s = Store()
+        old = declareLegacyItem(LookupEntry.typeName, 1, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k', value=b'abc')
+        entry = s.getItemByID(old.storeID)
+        self.assertThat(entry.content.data, Equals(b'abc'))
+        self.assertThat(
+            entry.content.encoding, Equals(Encodings.IDENTITY.value))
+        self.assertThat(entry.content.size, Equals(3))
+        self.assertThat(entry.content.refCount, Equals(1))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'k'), Equals(b'abc'))
+
+
+    def test_upgrade2to3(self):
+        """
+        Upgrading version 2 entries moves their values into the value store,
+        deduplicating them.
+        """
+        s = Store()
+        Old = declareLegacyItem(LookupEntry.typeName, 2, {})
+        old = [
+            Old(store=s, environment=u'e', indexType=u't', key=u'k1',
+                value=zlib.compress(b'abc'), encoding=u'deflate', size=3),
+            Old(store=s, environment=u'e', indexType=u't', key=u'k2',
+                value=b'abc', encoding=u'identity', size=3)]
+        entries = [s.getItemByID(o.storeID) for o in old]
+        self.assertThat(entries[0].content, Equals(entries[1].content))
+        self.assertThat(entries[0].content.refCount, Equals(2))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'k1'), Equals(b'abc'))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'k2'), Equals(b'abc'))
+
+
+    def test_upgrade3to4(self):
+        """
+        Upgrading a version 3 entry leaves it without an expiry time.
+        """
+        s = Store()
+        content = LookupValue.acquire(s, u'e', u't', b'abc')
+        old = declareLegacyItem(LookupEntry.typeName, 3, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k',
+            content=content)
+        entry = s.getItemByID(old.storeID)
+        self.assertThat(entry.expires, Equals(None))
+        self.assertThat(
+            LookupEntry.get(s, u'e', u't', u'k'), Equals(b'abc'))
+
+
+    def test_upgrade4to5(self):
+        """
+        Upgrading version 4 entries replaces their environment and index type
+        with interned names.
+        """
+        s = Store()
+        content = LookupValue.acquire(s, u'e', u't', b'abc')
+        Old = declareLegacyItem(LookupEntry.typeName, 4, {})
+        expires = Time.fromPOSIXTimestamp(2 ** 35)
+        old = [
+            Old(store=s, environment=u'e', indexType=u't', key=key,
+                content=content, expires=expires)
+            for key in [u'k1', u'k2']]
+        entries = [s.getItemByID(o.storeID) for o in old]
+        self.assertThat(
+            [(e.environmentID, e.indexTypeID) for e in entries],
+            Equals([(IndexName.find(s, u'e'), IndexName.find(s, u't'))] * 2))
+        self.assertThat(entries[0].environment, Equals(u'e'))
+        self.assertThat(entries[0].indexType, Equals(u't'))
+        self.assertThat(entries[0].expires, Equals(expires))
+        self.assertThat(s.query(IndexName).count(), Equals(2))
+        self.assertThat(
+            LookupEntry.get(s, u'E', u'T', u'k2'), Equals(b'abc'))
+
+
+    def test_upgradeSuperseded(self):
+        """
+        Upgrading an entry whose key has been set since the store was opened
+        deletes the old entry, and its value, instead.
+        """
+        s = Store()
+        content = LookupValue.acquire(s, u'e', u't', b'old')
+        old = [
+            declareLegacyItem(LookupEntry.typeName, 1, {})(
+                store=s, environment=u'e', indexType=u't', key=u'k1',
+                value=b'old'),
+            declareLegacyItem(LookupEntry.typeName, 2, {})(
+                store=s, environment=u'e', indexType=u't', key=u'k2',
+                value=b'old', encoding=u'identity', size=3),
+            declareLegacyItem(LookupEntry.typeName, 3, {})(
+                store=s, environment=u'e', indexType=u't', key=u'k3',
+                content=content),
+            declareLegacyItem(LookupEntry.typeName, 4, {})(
+                store=s, environment=u'e', indexType=u't', key=u'k4',
+                content=content)]
+        content.refCount = 2
+        keys = [u'k1', u'k2', u'k3', u'k4']
+        for key in keys:
+            LookupEntry.set(s, u'e', u't', key, b'new')
+        entries = [s.getItemByID(o.storeID) for o in old]
+        self.assertThat(
+            [e.key for e in entries],
+            Equals(keys))
+        self.assertThat(s.query(LookupEntry).count(), Equals(4))
+        self.assertThat(
+            list(s.query(LookupValue).getColumn('refCount')), Equals([4]))
+        for key in keys:
+            self.assertThat(
+                LookupEntry.get(s, u'e', u't', key), Equals(b'new'))
+
+
+    def test_migrate(self):
+        """
+        Opening a store with entries from every earlier version upgrades them
+        all, merging them with any entries set before they were upgraded.
+        """
+        path = self.useFixture(TempDir()).join(u'index.axiom')
+        s = Store(path)
+        content = LookupValue.acquire(s, u'e', u't', b'v3')
+        declareLegacyItem(LookupEntry.typeName, 1, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k1',
+            value=b'v1')
+        declareLegacyItem(LookupEntry.typeName, 2, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k2',
+            value=zlib.compress(b'v2'), encoding=u'deflate', size=2)
+        declareLegacyItem(LookupEntry.typeName, 3, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k3',
+            content=content)
+        declareLegacyItem(LookupEntry.typeName, 4, {})(
+            store=s, environment=u'e', indexType=u't', key=u'k4',
+            content=content, expires=Time.fromPOSIXTimestamp(2 ** 35))
+        content.refCount = 2
+        s.close()
+
+        s = Store(path)
+        self.assertThat(s.whenFullyUpgraded().called, Equals(False))
+        LookupEntry.set(s, u'e', u't', u'k4', b'new')
+        for _ in s._upgradeManager.upgradeEverything():
+            pass
+        self.assertThat(
+            [LookupEntry.get(s, u'e', u't', key)
+             for key in [u'k1', u'k2', u'k3', u'k4']],
+            Equals([b'v1', b'v2', b'v3', b'new']))
+        self.assertThat(s.query(LookupEntry).count(), Equals(4))
+        self.assertThat(
+            sorted(s.query(LookupValue).getColumn('refCount')),
+            Equals([1, 1, 1, 1]))
+
+
+    def test_expiry(self):
+        """
+        An entry with an expiry time is treated as missing once it has
+        expired; setting it again replaces the expiry time.
+        """
+        s = Store()
+        expires = Time.fromPOSIXTimestamp(100)
+        LookupEntry.set(s, u'e', u't', u'k', b'abc', expires=expires)
+        self.assertThat(
+            LookupEntry.get(
+                s, u'e', u't', u'k', Time.fromPOSIXTimestamp(99)),
+            Equals(b'abc'))
+        self.assertRaises(
+            KeyError, LookupEntry.get,
+            s, u'e', u't', u'k', Time.fromPOSIXTimestamp(100))
+        self.assertRaises(KeyError, LookupEntry.get, s, u'e', u't', u'k')
+        self.assertThat(LookupEntry.find(s, u'e', u't', u'k'), Equals(None))
+        LookupEntry.set(s, u'e', u't', u'k', b'def')
+        self.assertThat(LookupEntry.get(s, u'e', u't', u'k'), Equals(b'def'))
+        self.assertThat(
+            LookupEntry.find(s, u'e', u't', u'k').expires, Equals(None))
+
+
+    def test_reap(self):
+        """
+        Expired entries are removed, a batch at a time, and their removal is
+        recorded in the change log.
+        """
+        s = Store()
+        for i in xrange(3):
+            LookupEntry.set(
+                s, u'e', u't', u'k%d' % (i,), b'abc',
+                expires=Time.fromPOSIXTimestamp(i))
+        LookupEntry.set(s, u'e', u'u', u'k', b'abc')
+        latest = Change.latest(s)
+        now = Time.fromPOSIXTimestamp(1.5)
+        self.assertThat(
+            LookupEntry.reap(s, now, limit=1), Equals({(u'e', u't'): 1}))
+        self.assertThat(
+            LookupEntry.reap(s, now, limit=5), Equals({(u'e', u't'): 1}))
+        self.assertThat(LookupEntry.reap(s, now), Equals({}))
+        self.assertThat(
+            sorted(s.query(LookupEntry).getColumn('key')),
+            Equals([u'k', u'k2']))
+        self.assertThat(
+            [change.key for change in Change.since(s, latest)],
+            Equals([u'k0', u'k1']))
+        self.assertThat(s.query(LookupValue).count(), Equals(2))
+
+
+    def test_listEntries(self):
+        """
+        The live entries in an index can be listed in order of their keys, a
+        page at a time, optionally only those with keys starting with a
+        prefix.
+        """
+        s = Store()
+        for key in [u'b', u'a2', u'A1', u'c', u'ab']:
+            LookupEntry.set(s, u'e', u't', key, b'abc')
+        LookupEntry.set(s, u'e', u'u', u'a0', b'abc')
+        LookupEntry.set(
+            s, u'e', u't', u'a3', b'abc', expires=Time.fromPOSIXTimestamp(0))
+
+        def _keys(**kw):
+            return [entry.key
+                    for entry in LookupEntry.listEntries(s, u'e', u't', **kw)]
+        self.assertThat(_keys(), Equals([u'A1', u'a2', u'ab', u'b', u'c']))
+        self.assertThat(_keys(limit=2), Equals([u'A1', u'a2']))
+        self.assertThat(_keys(after=u'a2'), Equals([u'ab', u'b', u'c']))
+        self.assertThat(
+            _keys(prefix=u'A', after=u'a1'), Equals([u'a2', u'ab']))
+        self.assertThat(_keys(prefix=u'd'), Equals([]))
+        self.assertThat(
+            LookupEntry.listEntries(s, u'f', u't'), Equals([]))
+
+
+    def test_deletePrefix(self):
+        """
+        Entries with keys starting with a prefix are removed, a batch at a
+        time, and their removal is recorded in the change log.
+        """
+        s = Store()
+        for key in [u'a1', u'A2', u'a3', u'b']:
+            LookupEntry.set(s, u'e', u't', key, b'abc')
+        LookupEntry.set(s, u'e', u'u', u'a1', b'abc')
+        latest = Change.latest(s)
+        self.assertThat(
+            LookupEntry.deletePrefix(s, u'e', u't', u'a', limit=2),
+            Equals(2))
+        self.assertThat(
+            LookupEntry.deletePrefix(s, u'e', u't', u'a', limit=2),
+            Equals(1))
+        self.assertThat(
+            LookupEntry.deletePrefix(s, u'e', u't', u'a'), Equals(0))
+        self.assertThat(
+            sorted(s.query(LookupEntry).getColumn('key')),
+            Equals([u'a1', u'b']))
+        self.assertThat(
+            [change.key for change in Change.since(s, latest)],
+            Equals([u'a1', u'A2', u'a3']))
+
+
+    def test_blobs(self):
+        """
+        Values can be stored in files in the store's file area, and are
+        deduplicated like any other value. The file is removed when the value
+        is deleted.
+        """
+        s = Store(filesdir=self.useFixture(TempDir()).path)
+        blob = Blob.fromFile(s, StringIO(b'abc' * 1000), chunkSize=7)
+        self.assertThat(blob.size, Equals(3000))
+        self.assertThat(blob.path.getContent(), Equals(b'abc' * 1000))
+        blob.discard()
+
+        def _set(key):
+            LookupEntry.set(
+                s, u'e', u't', key,
+                Blob.fromFile(s, StringIO(b'abc' * 1000)),
+                Compression(threshold=10))
+        s.transact(_set, u'k1')
+        s.transact(_set, u'k2')
+        [content] = s.query(LookupValue)
+        self.assertThat(content.refCount, Equals(2))
+        self.assertThat(content.data, Equals(b''))
+        self.assertThat(content.blob.getContent(), Equals(b'abc' * 1000))
+        self.assertThat(
+            s.newFilePath('blobs', 'temp').listdir(), Equals([]))
+        self.assertThat(
+            LookupEntry.getEncoded(s, u'e', u't', u'k1'),
+            Equals((Encodings.IDENTITY, b'abc' * 1000)))
+        for useMmap in [False, True]:
+            f = content.open(useMmap)
+            self.assertThat(f.read(3000), Equals(b'abc' * 1000))
+            f.close()
+
+        path = content.blob
+        s.transact(LookupEntry.set, s, u'e', u't', u'k1', b'def')
+        s.transact(LookupEntry.set, s, u'e', u't', u'k2', b'def')
+        self.assertThat(path.exists(), Equals(False))
+        self.assertThat(
+            s.query(LookupValue).getColumn('data').distinct().count(),
+            Equals(1))
+
+
+    def test_blobReverted(self):
+        """
+        If the transaction storing a blob is reverted, the file it was moved
+        to is removed.
+        """
+        s = Store(filesdir=self.useFixture(TempDir()).path)
+
+        def _set():
+            LookupEntry.set(
+                s, u'e', u't', u'k', Blob.fromFile(s, StringIO(b'abc')))
+            raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, s.transact, _set)
+        self.assertThat(s.query(LookupValue).count(), Equals(0))
+        self.assertThat(
+            [child.basename()
+             for child in s.newFilePath('blobs').walk() if child.isfile()],
+            Equals([]))
+
+
+    def test_emptyBlob(self):
+        """
+        An empty file is read rather than mapped into memory, which would fail.
+        """
+        s = Store(filesdir=self.useFixture(TempDir()).path)
+        s.transact(
+            LookupEntry.set, s, u'e', u't', u'k',
+            Blob.fromFile(s, StringIO(b'')))
+        content = LookupEntry.find(s, u'e', u't', u'k').content
+        f = content.open(useMmap=True)
+        self.assertThat(f.read(), Equals(b''))
+        f.close()
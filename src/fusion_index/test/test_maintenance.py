@@ -0,0 +1,277 @@
+"""
+Tests for L{fusion_index.maintenance}.
+"""
+from axiom.store import Store
+from eliot.testing import LoggedAction, capture_logging
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.changes import Change
+from fusion_index.logging import LOG_MAINTENANCE_STEP
+from fusion_index.lookup import (
+    Compression, Encodings, LookupEntry, LookupValue)
+from fusion_index.maintenance import MaintenanceService, inWindow, parseWindow
+from fusion_index.search import (
+    SearchClasses, SearchEntry, SearchPrefixStatistic)
+
+
+
+class WindowTests(SynchronousTestCase):
+    """
+    Tests for L{parseWindow} and L{inWindow}.
+    """
+    def test_parse(self):
+        """
+        Windows are parsed into minutes past midnight.
+        """
+        self.assertEqual(parseWindow('01:00-03:30'), (60, 210))
+        self.assertEqual(parseWindow('23:00-00:30'), (1380, 30))
+
+
+    def test_parseInvalid(self):
+        """
+        Invalid windows are rejected with C{ValueError}.
+        """
+        for window in ['', '01:00', '01:00-25:00', '1-2', 'a:b-c:d']:
+            self.assertRaises(ValueError, parseWindow, window)
+
+
+    def test_inWindow(self):
+        """
+        Times are checked against each window, including windows that wrap
+        around midnight.
+        """
+        windows = [(60, 210), (1380, 30)]
+        self.assertFalse(inWindow(windows, 0.5 * 3600))
+        self.assertTrue(inWindow(windows, 1 * 3600))
+        self.assertTrue(inWindow(windows, 3.25 * 3600))
+        self.assertFalse(inWindow(windows, 3.5 * 3600))
+        self.assertTrue(inWindow(windows, 23.5 * 3600))
+        self.assertTrue(inWindow(windows, 24.25 * 3600))
+        self.assertFalse(inWindow([], 0))
+
+
+
+class MaintenanceServiceTests(SynchronousTestCase):
+    """
+    Tests for L{MaintenanceService}.
+    """
+    def _store(self):
+        """
+        Create a store in incremental vacuum mode with some free pages.
+        """
+        s = Store()
+        s.querySQL('PRAGMA auto_vacuum=INCREMENTAL')
+        s.querySQL('VACUUM')
+
+        def _tx():
+            for i in xrange(500):
+                LookupEntry.set(s, u'e', u't', unicode(i), bytes(i) * 300)
+        s.transact(_tx)
+        s.transact(lambda: s.query(LookupEntry).deleteFromStore())
+        return s
+
+
+    def _freePages(self, store):
+        [(count,)] = store.querySQL('PRAGMA freelist_count')
+        return count
+
+
+    @capture_logging(None)
+    def test_outsideWindow(self, logger):
+        """
+        No maintenance is done outside of a maintenance window.
+        """
+        store = self._store()
+        clock = Clock()
+        clock.advance(12 * 3600)
+        service = MaintenanceService(
+            store=store, windows=[(60, 120)], clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(10):
+            clock.advance(service.interval)
+        self.assertEqual(
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP), [])
+        self.assertNotEqual(self._freePages(store), 0)
+
+
+    @capture_logging(None)
+    def test_insideWindow(self, logger):
+        """
+        Inside a maintenance window, statistics are recalculated, tables are
+        analyzed, the database is optimized, and free pages are vacuumed, one
+        step at a time.
+        """
+        store = self._store()
+        clock = Clock()
+        clock.advance(3600)
+        service = MaintenanceService(
+            store=store, windows=[(60, 120)], vacuumPages=10, clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        steps = LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)
+        self.assertEqual(len(steps), 1)
+        for _ in xrange(100):
+            clock.advance(service.interval)
+        self.assertEqual(self._freePages(store), 0)
+
+        steps = [
+            a.start_message['step'] for a in
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)]
+        self.assertEqual(
+            steps[:8],
+            [u'storage_stats', u'search_stats'] + [u'prefix_stats'] * 3 +
+            [u'compact_changes'] * 2 + [u'analyze'])
+        self.assertIn(u'optimize', steps)
+        self.assertEqual(steps[-1], u'incremental_vacuum')
+        self.assertTrue(len(steps) < 100)
+
+
+    @capture_logging(None)
+    def test_prefixStatistics(self, logger):
+        """
+        Prefix search statistics are recalculated one prefix length of one
+        index per step.
+        """
+        self.patch(SearchPrefixStatistic, 'minimum', 1)
+        store = Store()
+        for indexType in [u'i', u'j']:
+            for i in xrange(3):
+                SearchEntry.insert(
+                    store, SearchClasses.PREFIX, u'e', indexType,
+                    u'result{}'.format(i), u'type', u'value')
+        clock = Clock()
+        clock.advance(3600)
+        service = MaintenanceService(
+            store=store, windows=[(60, 120)], clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(20):
+            clock.advance(service.interval)
+        steps = [
+            a.start_message['step'] for a in
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)]
+        self.assertEqual(steps.count(u'prefix_stats'), 9)
+        self.assertEqual(
+            [SearchPrefixStatistic.estimate(store, u'e', indexType, u'val')
+             for indexType in [u'i', u'j']],
+            [3, 3])
+
+
+    @capture_logging(None)
+    def test_notIncremental(self, logger):
+        """
+        If the database is not in incremental vacuum mode, it is converted
+        with a single full vacuum step, after which free pages are vacuumed
+        incrementally.
+        """
+        store = Store()
+        [(autoVacuum,)] = store.querySQL('PRAGMA auto_vacuum')
+        self.assertEqual(autoVacuum, 0)
+        clock = Clock()
+        clock.advance(3600)
+        service = MaintenanceService(
+            store=store, windows=[(60, 120)], clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(20):
+            clock.advance(service.interval)
+        steps = [
+            a.start_message['step'] for a in
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)]
+        self.assertEqual(steps[-2:], [u'optimize', u'vacuum'])
+        self.assertEqual(steps.count(u'vacuum'), 1)
+        [(autoVacuum,)] = store.querySQL('PRAGMA auto_vacuum')
+        self.assertEqual(autoVacuum, 2)
+
+
+    @capture_logging(None)
+    def test_recompress(self, logger):
+        """
+        If there are any compression policies, existing entries are re-encoded
+        one batch at a time.
+        """
+        store = Store()
+        for i in xrange(250):
+            LookupEntry.set(store, u'e', u't', unicode(i), bytes(i) * 1000)
+        clock = Clock()
+        clock.advance(3600)
+        service = MaintenanceService(
+            store=store,
+            windows=[(60, 120)],
+            compression={u't': Compression(threshold=100)},
+            clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(10):
+            clock.advance(service.interval)
+        steps = [
+            a.start_message['step'] for a in
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)]
+        self.assertEqual(
+            steps[:5], [u'recompress'] * 4 + [u'storage_stats'])
+        self.assertEqual(
+            set(store.query(LookupValue).getColumn('encoding')),
+            {Encodings.DEFLATE.value})
+
+
+
+    @capture_logging(None)
+    def test_compactChanges(self, logger):
+        """
+        The change log is compacted, a batch of changes per step.
+        """
+        store = Store()
+        for i in xrange(10):
+            LookupEntry.set(store, u'e', u't', unicode(i), b'a')
+            LookupEntry.set(store, u'e', u't', unicode(i), b'b')
+        clock = Clock()
+        clock.advance(3600)
+        service = MaintenanceService(
+            store=store, windows=[(60, 120)], clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(10):
+            clock.advance(service.interval)
+        steps = [
+            a.start_message['step'] for a in
+            LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)]
+        self.assertEqual(
+            steps[5:8], [u'compact_changes'] * 2 + [u'analyze'])
+        self.assertEqual(
+            [change.key for change in Change.since(store, 0)],
+            [unicode(i) for i in xrange(10)])
+
+
+    @capture_logging(None)
+    def test_failedStep(self, logger):
+        """
+        A step that fails is logged and skipped, along with the rest of its
+        batched operation, and maintenance carries on.
+        """
+        store = Store()
+        for i in xrange(250):
+            LookupEntry.set(store, u'e', u't', unicode(i), bytes(i) * 1000)
+        clock = Clock()
+        clock.advance(3600)
+
+        def _fail(*a, **kw):
+            raise ZeroDivisionError()
+        self.patch(LookupValue, 'recompress', _fail)
+        self.patch(LookupValue, 'storageStats', _fail)
+        service = MaintenanceService(
+            store=store,
+            windows=[(60, 120)],
+            compression={u't': Compression(threshold=100)},
+            clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        for _ in xrange(10):
+            clock.advance(service.interval)
+        self.assertTrue(service._call.running)
+        actions = LoggedAction.of_type(logger.messages, LOG_MAINTENANCE_STEP)
+        self.assertEqual(
+            [(a.start_message['step'], a.succeeded) for a in actions[:3]],
+            [(u'recompress', False), (u'storage_stats', False),
+             (u'search_stats', True)])
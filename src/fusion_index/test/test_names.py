@@ -0,0 +1,59 @@
+"""
+Tests for L{fusion_index.names}.
+"""
+from axiom.store import Store
+from testtools import TestCase
+from testtools.matchers import Equals, Is
+
+from fusion_index.names import IndexName
+
+
+
+class IndexNameTests(TestCase):
+    """
+    Tests for L{IndexName}.
+    """
+    def test_intern(self):
+        """
+        Interning a name stores it once, ignoring ASCII case, keeping the
+        spelling it was first interned with.
+        """
+        s = Store()
+        self.assertThat(IndexName.find(s, u'prod'), Is(None))
+        nameID = IndexName.intern(s, u'Prod')
+        self.assertThat(IndexName.intern(s, u'pROD'), Equals(nameID))
+        self.assertThat(IndexName.find(s, u'prod'), Equals(nameID))
+        self.assertThat(IndexName.lookup(s, nameID), Equals(u'Prod'))
+        self.assertThat(IndexName.find(s, u'PR\xd6D'), Is(None))
+        self.assertThat(s.query(IndexName).count(), Equals(1))
+
+
+    def test_map(self):
+        """
+        Names are resolved from memory once they have been committed.
+        """
+        s = Store()
+        nameID = s.transact(IndexName.intern, s, u'prod')
+
+        def _query(*a, **kw):
+            self.fail('Name resolved from the store')
+        self.patch(s, 'findFirst', _query)
+        self.patch(s, 'getItemByID', _query)
+        self.assertThat(IndexName.find(s, u'PROD'), Equals(nameID))
+        self.assertThat(IndexName.lookup(s, nameID), Equals(u'prod'))
+
+
+    def test_revert(self):
+        """
+        Names interned by a transaction that is reverted are forgotten.
+        """
+        s = Store()
+
+        def _intern():
+            IndexName.intern(s, u'prod')
+            self.assertThat(IndexName.find(s, u'prod'), Equals(
+                s.findUnique(IndexName).storeID))
+            raise ValueError()
+        self.assertRaises(ValueError, s.transact, _intern)
+        self.assertThat(IndexName.find(s, u'prod'), Is(None))
+        self.assertThat(IndexName._map(s), Equals(({}, {})))
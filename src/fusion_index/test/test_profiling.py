@@ -0,0 +1,87 @@
+"""
+Tests for L{fusion_index.profiling}.
+"""
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.profiling import Profiler, collapsedStacks
+
+
+
+class _Stats(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+
+
+class ProfilerTests(SynchronousTestCase):
+    """
+    Tests for L{Profiler}.
+    """
+    def test_inactive(self):
+        """
+        Resources are not wrapped unless profiling is active.
+        """
+        profiler = Profiler(clock=Clock())
+        resource = object()
+        self.assertFalse(profiler.active)
+        self.assertIdentical(profiler.wrap(u'lookup', resource), resource)
+        self.assertEqual(profiler.routes(), {})
+        self.assertIdentical(profiler.stats(), None)
+        self.assertRaises(ValueError, profiler.start)
+
+
+    def test_requestLimit(self):
+        """
+        Only the given number of requests are profiled.
+        """
+        profiler = Profiler(clock=Clock())
+        profiler.start(requests=2)
+        resource = object()
+        self.assertNotIdentical(profiler.wrap(u'lookup', resource), resource)
+        self.assertNotIdentical(profiler.wrap(u'search', resource), resource)
+        self.assertIdentical(profiler.wrap(u'lookup', resource), resource)
+        self.assertFalse(profiler.active)
+
+
+    def test_timeLimit(self):
+        """
+        Requests are only profiled for the given time.
+        """
+        clock = Clock()
+        profiler = Profiler(clock=clock)
+        profiler.start(seconds=5)
+        clock.advance(4)
+        self.assertTrue(profiler.active)
+        clock.advance(1)
+        self.assertFalse(profiler.active)
+
+
+
+class CollapsedStacksTests(SynchronousTestCase):
+    """
+    Tests for L{collapsedStacks}.
+    """
+    def test_collapsedStacks(self):
+        """
+        The time spent in each function is divided between the stacks leading
+        to it, in proportion to the time spent in it for each caller.
+        """
+        main = ('m.py', 1, 'main')
+        a = ('m.py', 2, 'a')
+        b = ('m.py', 3, 'b')
+        c = ('~', 0, '<len>')
+        stats = _Stats({
+            main: (1, 1, 0.1, 1.0, {}),
+            a: (1, 1, 0.2, 0.5, {main: (1, 1, 0.2, 0.5)}),
+            b: (2, 2, 0.1, 0.4, {main: (1, 1, 0.05, 0.2),
+                                 a: (1, 1, 0.05, 0.2)}),
+            c: (2, 2, 0.3, 0.3, {b: (2, 2, 0.3, 0.3)})})
+        self.assertEqual(
+            collapsedStacks(stats).splitlines(),
+            ['m.py:1:main 100000',
+             'm.py:1:main;m.py:2:a 200000',
+             'm.py:1:main;m.py:2:a;m.py:3:b 50000',
+             'm.py:1:main;m.py:2:a;m.py:3:b;<len> 150000',
+             'm.py:1:main;m.py:3:b 50000',
+             'm.py:1:main;m.py:3:b;<len> 150000'])
@@ -0,0 +1,251 @@
+"""
+Tests for L{fusion_index.replication}.
+"""
+from StringIO import StringIO
+
+from axiom.store import Store
+from eliot.testing import capture_logging
+from epsilon.extime import Time
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.client import FileBodyProducer
+
+from fusion_index.changes import Change, ChangeFeed
+from fusion_index.lookup import LookupEntry
+from fusion_index.replication import (
+    Follower, ReplicaTooFarBehind, ReplicationState)
+from fusion_index.resource import IndexRouter
+from fusion_index.search import SearchClasses, SearchEntry
+from fusion_index.test.util import ResourceTraversalAgent
+
+
+
+class FollowerTests(SynchronousTestCase):
+    """
+    Tests for L{Follower}.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.primary = Store()
+        changeFeed = ChangeFeed(store=self.primary, clock=self.clock)
+        changeFeed.install()
+        self.agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=self.primary, changeFeed=changeFeed).router.resource())
+
+
+    def _follower(self, store=None, blobThreshold=None):
+        follower = Follower(
+            store=store or Store(),
+            agent=self.agent,
+            primary=b'http://primary/',
+            blobThreshold=blobThreshold,
+            batchSize=2,
+            wait=10,
+            clock=self.clock)
+        follower.startService()
+        self.addCleanup(follower.stopService)
+        return follower
+
+
+    def _put(self, path, value):
+        self.successResultOf(
+            self.agent.request(
+                b'PUT', b'http://primary' + path,
+                bodyProducer=FileBodyProducer(StringIO(value))))
+
+
+    def _entries(self, store):
+        """
+        The contents of the indexes in a store.
+        """
+        return (
+            sorted((e.environment, e.indexType, e.key,
+                    LookupEntry.get(store, e.environment, e.indexType, e.key))
+                   for e in store.query(LookupEntry)),
+            sorted((e.searchClass, e.environment, e.indexType, e.result,
+                    e.searchType, e.searchValue)
+                   for e in store.query(SearchEntry)))
+
+
+    def _advance(self, times=10):
+        for _ in xrange(times):
+            self.clock.advance(0)
+
+
+    def test_follow(self):
+        """
+        The replica copies a snapshot of the primary's indexes, and then
+        applies the primary's changes as they are committed.
+        """
+        for key in [b'a', b'b', b'c']:
+            self._put(b'/lookup/e/t/' + key, b'value ' + key)
+        self._put(b'/search/exact/e/i/entries/r1/type', b'one')
+        self._put(b'/search/prefix/e/i/entries/r2/type', b'two')
+        follower = self._follower()
+        self.assertFalse(follower.ready)
+        self._advance()
+        self.assertTrue(follower.ready)
+        self.assertEqual(
+            self._entries(follower.store), self._entries(self.primary))
+
+        self._put(b'/lookup/e/t/a', b'new value')
+        self.successResultOf(
+            self.agent.request(
+                b'DELETE', b'http://primary/search/exact/e/i/entries/r1/type'))
+        self._advance()
+        self.assertEqual(
+            self._entries(follower.store), self._entries(self.primary))
+        state = follower.store.findUnique(ReplicationState)
+        self.assertEqual(state.sequence, Change.latest(self.primary))
+
+
+    def test_resume(self):
+        """
+        A replica that is restarted carries on from the last change it
+        applied.
+        """
+        self._put(b'/lookup/e/t/a', b'value')
+        store = Store()
+        follower = self._follower(store)
+        self._advance()
+        follower.stopService()
+        self._put(b'/lookup/e/t/b', b'value')
+        self.primary.transact(
+            SearchEntry.insert, self.primary, SearchClasses.EXACT, u'e', u'i',
+            u'r', u'type', u'value')
+        self.primary.transact(
+            LookupEntry.set, self.primary, u'e', u't', u'a', b'changed')
+        self.primary.transact(Change.compact, self.primary)
+        follower = self._follower(store)
+        self._advance()
+        self.assertTrue(follower.ready)
+        self.assertEqual(self._entries(store), self._entries(self.primary))
+
+
+    def test_expiry(self):
+        """
+        Expiry times are copied to the replica, and entries reaped by the
+        primary are removed from the replica.
+        """
+        expires = Time.fromPOSIXTimestamp(2000000000)
+        self.primary.transact(
+            LookupEntry.set, self.primary, u'e', u't', u'a', b'value',
+            expires=expires)
+        follower = self._follower()
+        self._advance()
+        self.assertEqual(
+            LookupEntry.find(follower.store, u'e', u't', u'a').expires,
+            expires)
+        self.primary.transact(
+            LookupEntry.set, self.primary, u'e', u't', u'b', b'value',
+            expires=expires)
+        self._advance()
+        self.assertEqual(
+            LookupEntry.find(follower.store, u'e', u't', u'b').expires,
+            expires)
+        self.primary.transact(LookupEntry.reap, self.primary, expires)
+        self._advance()
+        self.assertEqual(follower.store.query(LookupEntry).count(), 0)
+
+
+    def test_blobs(self):
+        """
+        Values the primary stores in files are fetched from the primary, in
+        the snapshot and in changes, and stored in files by the replica.
+        """
+        self.primary = Store(filesdir=self.mktemp())
+        changeFeed = ChangeFeed(store=self.primary, clock=self.clock)
+        changeFeed.install()
+        self.agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=self.primary, changeFeed=changeFeed, blobThreshold=100,
+                ).router.resource())
+        self._put(b'/lookup/e/t/a', b'a' * 100)
+        self._put(b'/lookup/e/t/b%20c', b'b' * 100)
+        follower = self._follower(
+            Store(filesdir=self.mktemp()), blobThreshold=100)
+        self._advance()
+        self._put(b'/lookup/e/t/a', b'A' * 100)
+        self._advance()
+        self.assertEqual(
+            self._entries(follower.store),
+            ([(u'e', u't', u'a', b'A' * 100),
+              (u'e', u't', u'b c', b'b' * 100)],
+             []))
+        self.assertEqual(
+            [e.content.blob is not None
+             for e in follower.store.query(LookupEntry)],
+            [True, True])
+
+
+    def test_blobThreshold(self):
+        """
+        Values at least C{blobThreshold} bytes long are stored in files by the
+        replica, even if the primary stores them in the database.
+        """
+        self._put(b'/lookup/e/t/a', b'a' * 100)
+        self._put(b'/lookup/e/t/b', b'b' * 99)
+        follower = self._follower(
+            Store(filesdir=self.mktemp()), blobThreshold=100)
+        self._advance()
+        self.assertEqual(
+            sorted((e.key, e.content.blob is not None)
+                   for e in follower.store.query(LookupEntry)),
+            [(u'a', True), (u'b', False)])
+        self.assertEqual(
+            LookupEntry.get(follower.store, u'e', u't', u'a'), b'a' * 100)
+
+
+    def test_deletions(self):
+        """
+        Deletions are recorded in the replica's own change log, so that other
+        replicas can follow it.
+        """
+        self._put(b'/lookup/e/t/a', b'value')
+        follower = self._follower()
+        self._advance()
+        self.primary.transact(
+            LookupEntry.deletePrefix, self.primary, u'e', u't', u'')
+        self._advance()
+        self.assertEqual(follower.store.query(LookupEntry).count(), 0)
+        self.assertEqual(
+            [(change.kind, change.key)
+             for change in Change.since(follower.store, 0, 10)],
+            [(u'lookup-set', u'a')] * 2)
+
+
+    @capture_logging(None)
+    def test_tooFarBehind(self, logger):
+        """
+        If changes the replica needs have been removed from the primary's
+        change log, it stops following the primary.
+        """
+        store = Store()
+        follower = self._follower(store)
+        self._advance()
+        follower.stopService()
+        for key in [b'a', b'b', b'c']:
+            self._put(b'/lookup/e/t/' + key, b'value')
+        self.primary.transact(Change.retain, self.primary, 1)
+        follower = self._follower(store)
+        self._advance()
+        self.assertTrue(follower.failed)
+        self.assertFalse(follower.ready)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        logger.flush_tracebacks(ReplicaTooFarBehind)
+
+
+    @capture_logging(None)
+    def test_retry(self, logger):
+        """
+        Failed requests are retried after an interval.
+        """
+        follower = Follower(
+            store=Store(), agent=self.agent, primary=b'http://primary/nowhere',
+            retryInterval=5, clock=self.clock)
+        follower.startService()
+        self.addCleanup(follower.stopService)
+        [call] = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), 5)
+        self.assertEqual(len(logger.flush_tracebacks(ValueError)), 1)
@@ -1,35 +1,68 @@
 import json
+import marshal
+import zlib
 from StringIO import StringIO
 
 from axiom.store import Store
 from eliot.testing import LoggedAction, assertContainsFields, capture_logging
+from epsilon.extime import Time
+from prometheus_client import REGISTRY
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.web import http
 from twisted.web.client import FileBodyProducer, readBody
-
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+from txspinneret.resource import SpinneretResource
+
+from fusion_index.bloom import LookupFilters
+from fusion_index.changes import Change, ChangeFeed
+from fusion_index.coalesce import QueryCoalescer
 from fusion_index.logging import (
-    LOG_LOOKUP_GET, LOG_LOOKUP_PUT, LOG_SEARCH_DELETE, LOG_SEARCH_GET,
-    LOG_SEARCH_PUT)
-from fusion_index.resource import IndexRouter
-from fusion_index.search import SearchClasses
+    LOG_CHANGES_GET, LOG_LOOKUP_DELETE_PREFIX, LOG_LOOKUP_GET,
+    LOG_LOOKUP_GET_MANY, LOG_LOOKUP_LIST, LOG_LOOKUP_PUT, LOG_SEARCH_COUNT,
+    LOG_SEARCH_DELETE, LOG_SEARCH_GET, LOG_SEARCH_MANY, LOG_SEARCH_PUT)
+from fusion_index.lookup import Compression, LookupEntry
+from fusion_index.profiling import Profiler
+from fusion_index.replication import Follower, ReplicationState
+from fusion_index.resource import (
+    ChangesResource, IndexRouter, SnapshotResource)
+from fusion_index.search import SearchClasses, SearchPrefixStatistic
+from fusion_index.stats import IndexStatistics
 from fusion_index.test.util import ResourceTraversalAgent
+from fusion_index.warmup import HotKeys, WarmupService
 
 
 
-def GET(self, agent, path):
+def GET(self, agent, path, headers=None):
     """
     Simulate a GET request.
     """
-    return self.successResultOf(agent.request(b'GET', path))
+    return self.successResultOf(agent.request(b'GET', path, headers))
 
 
-def PUT(self, agent, path, data):
+def PUT(self, agent, path, data, headers=None):
     """
     Simulate a PUT request.
     """
     return self.successResultOf(
         agent.request(
-            b'PUT', path, bodyProducer=FileBodyProducer(StringIO(data))))
+            b'PUT', path, headers,
+            bodyProducer=FileBodyProducer(StringIO(data))))
+
+
+def POST(self, agent, path, data):
+    """
+    Simulate a POST request.
+    """
+    return self.successResultOf(
+        agent.request(
+            b'POST', path, bodyProducer=FileBodyProducer(StringIO(data))))
 
 
 def DELETE(self, agent, path):
@@ -197,6 +230,346 @@ class LookupAPITests(SynchronousTestCase):
             GET(self, agent, b'/lookup/e2/t2/k1').code, http.NOT_FOUND)
 
 
+    def test_compressed(self):
+        """
+        Values in an index with a compression policy are compressed, and are
+        returned as-is with a C{Content-Encoding} header only if the client
+        accepts that encoding.
+        """
+        agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=Store(),
+                compression={u't': Compression(threshold=10)},
+                ).router.resource())
+        value = b'data' * 100
+        response = PUT(self, agent, b'/lookup/e/t/k', value)
+        self.assertEqual(response.code, http.NO_CONTENT)
+
+        response = GET(self, agent, b'/lookup/e/t/k')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(data(self, response), value)
+        self.assertFalse(response.headers.hasHeader(b'Content-Encoding'))
+        self.assertEqual(
+            response.headers.getRawHeaders(b'Vary'), [b'Accept-Encoding'])
+
+        for accept in [b'deflate', b'gzip, deflate;q=0.5', b'*, DEFLATE']:
+            response = GET(
+                self, agent, b'/lookup/e/t/k',
+                Headers({b'Accept-Encoding': [accept]}))
+            self.assertEqual(response.code, http.OK)
+            self.assertEqual(zlib.decompress(data(self, response)), value)
+            self.assertEqual(
+                response.headers.getRawHeaders(b'Content-Encoding'),
+                [b'deflate'])
+
+        for accept in [b'gzip', b'deflate;q=0', b'deflate; q=0.0, gzip']:
+            response = GET(
+                self, agent, b'/lookup/e/t/k',
+                Headers({b'Accept-Encoding': [accept]}))
+            self.assertEqual(data(self, response), value)
+            self.assertFalse(response.headers.hasHeader(b'Content-Encoding'))
+
+        response = PUT(self, agent, b'/lookup/e/t2/k', value)
+        response = GET(
+            self, agent, b'/lookup/e/t2/k',
+            Headers({b'Accept-Encoding': [b'deflate']}))
+        self.assertEqual(data(self, response), value)
+        self.assertFalse(response.headers.hasHeader(b'Content-Encoding'))
+
+
+    def test_blobs(self):
+        """
+        Values at least C{blobThreshold} bytes long are stored in files, and
+        streamed back to the client.
+        """
+        for blobMmap in [False, True]:
+            store = Store(filesdir=self.mktemp())
+            agent = ResourceTraversalAgent(
+                IndexRouter(
+                    store=store, blobThreshold=100, blobMmap=blobMmap,
+                    ).router.resource())
+            value = b'x' * 100000
+            response = PUT(self, agent, b'/lookup/e/t/k', value)
+            self.assertEqual(response.code, http.NO_CONTENT)
+            response = PUT(self, agent, b'/lookup/e/t/k2', b'x' * 99)
+            self.assertEqual(response.code, http.NO_CONTENT)
+            self.assertEqual(
+                store.filesdir.child('blobs').child('temp').listdir(), [])
+
+            response = GET(self, agent, b'/lookup/e/t/k')
+            self.assertEqual(response.code, http.OK)
+            self.assertEqual(
+                response.headers.getRawHeaders(b'Content-Length'),
+                [b'100000'])
+            self.assertEqual(data(self, response), value)
+
+            response = GET(self, agent, b'/lookup/e/t/k2')
+            self.assertEqual(data(self, response), b'x' * 99)
+
+
+    def test_etag(self):
+        """
+        Values are returned with an entity tag, and not returned again if the
+        client already has them.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        PUT(self, agent, b'/lookup/e/t/k', b'value')
+        response = GET(self, agent, b'/lookup/e/t/k')
+        [etag] = response.headers.getRawHeaders(b'ETag')
+        for header in [etag, b'"other", ' + etag[2:], b'*']:
+            response = GET(
+                self, agent, b'/lookup/e/t/k',
+                Headers({b'If-None-Match': [header]}))
+            self.assertEqual(response.code, http.NOT_MODIFIED)
+            self.assertEqual(data(self, response), b'')
+        PUT(self, agent, b'/lookup/e/t/k', b'changed')
+        response = GET(
+            self, agent, b'/lookup/e/t/k',
+            Headers({b'If-None-Match': [etag]}))
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(data(self, response), b'changed')
+        self.assertNotEqual(response.headers.getRawHeaders(b'ETag'), [etag])
+
+
+    @capture_logging(None)
+    def test_getMany(self, logger):
+        """
+        Several values can be looked up at once, leaving out the values the
+        client already has.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        PUT(self, agent, b'/lookup/e/t/a', b'one')
+        PUT(self, agent, b'/lookup/e/t/b', b'two')
+        etag = GET(
+            self, agent, b'/lookup/e/t/b').headers.getRawHeaders(b'ETag')[0]
+        response = POST(
+            self, agent, b'/lookup/e/t',
+            json.dumps(
+                {u'keys': [u'a', u'b', u'c'], u'etags': {u'b': etag}}))
+        self.assertEqual(response.code, http.OK)
+        entries = json.loads(data(self, response))[u'entries']
+        self.assertEqual(entries[u'a'][u'value'], u'b25l')
+        self.assertEqual(entries[u'b'], {u'etag': etag})
+        self.assertIdentical(entries[u'c'], None)
+        [action] = LoggedAction.of_type(logger.messages, LOG_LOOKUP_GET_MANY)
+        assertContainsFields(
+            self, action.start_message,
+            {u'environment': u'e', u'indexType': u't',
+             u'keys': [u'a', u'b', u'c']})
+        assertContainsFields(self, action.end_message, {u'found': 2})
+
+        for body in [b'', b'{}', b'{"keys": "a"}', b'{"keys": [1]}',
+                     json.dumps({u'keys': [u'k'] * 1001}),
+                     b'{"keys": [], "etags": []}']:
+            response = POST(self, agent, b'/lookup/e/t', body)
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+
+    def test_getManyBlobs(self):
+        """
+        Values stored in files are not included when looking up or listing
+        several values, but can be fetched one at a time.
+        """
+        agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=Store(filesdir=self.mktemp()), blobThreshold=100,
+                ).router.resource())
+        PUT(self, agent, b'/lookup/e/t/a', b'one')
+        PUT(self, agent, b'/lookup/e/t/b', b'x' * 100)
+        etag = GET(
+            self, agent, b'/lookup/e/t/b').headers.getRawHeaders(b'ETag')[0]
+        response = POST(
+            self, agent, b'/lookup/e/t', json.dumps({u'keys': [u'a', u'b']}))
+        entries = json.loads(data(self, response))[u'entries']
+        self.assertEqual(entries[u'a'][u'value'], u'b25l')
+        self.assertEqual(entries[u'b'], {u'etag': etag, u'blob': True})
+        response = GET(self, agent, b'/lookup/e/t?values=true')
+        entries = json.loads(data(self, response))[u'entries']
+        self.assertEqual(entries[u'a'][u'value'], u'b25l')
+        self.assertEqual(entries[u'b'], {u'etag': etag, u'blob': True})
+
+
+    @capture_logging(None)
+    def test_list(self, logger):
+        """
+        The keys in an index can be listed a page at a time, optionally with
+        their values.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        for key in [b'a1', b'a2', b'a3', b'b']:
+            PUT(self, agent, b'/lookup/e/t/' + key, b'one')
+        response = GET(self, agent, b'/lookup/e/t?prefix=a&limit=2')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'keys': [u'a1', u'a2'], u'next': u'a2'})
+        [action] = LoggedAction.of_type(logger.messages, LOG_LOOKUP_LIST)
+        assertContainsFields(
+            self, action.start_message,
+            {u'environment': u'e', u'indexType': u't', u'prefix': u'a',
+             u'after': None, u'limit': 2})
+        assertContainsFields(self, action.end_message, {u'count': 2})
+
+        response = GET(
+            self, agent, b'/lookup/e/t?prefix=a&limit=2&after=a2&values=true')
+        etag = GET(
+            self, agent, b'/lookup/e/t/a3').headers.getRawHeaders(b'ETag')[0]
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'keys': [u'a3'], u'next': None,
+             u'entries': {u'a3': {u'etag': etag, u'value': u'b25l'}}})
+        response = GET(self, agent, b'/lookup/e/t')
+        self.assertEqual(
+            json.loads(data(self, response))[u'keys'],
+            [u'a1', u'a2', u'a3', u'b'])
+
+        for query in [b'limit=0', b'limit=1001', b'limit=x', b'values=yes',
+                      b'prefix=%FF']:
+            response = GET(self, agent, b'/lookup/e/t?' + query)
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+
+    @capture_logging(None)
+    def test_deletePrefix(self, logger):
+        """
+        The entries with keys starting with a prefix can be removed, a batch at
+        a time.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        for key in [b'a1', b'a2', b'a3', b'b']:
+            PUT(self, agent, b'/lookup/e/t/' + key, b'one')
+        for expected in [{u'deleted': 2, u'more': True},
+                         {u'deleted': 1, u'more': False}]:
+            response = DELETE(self, agent, b'/lookup/e/t?prefix=a&limit=2')
+            self.assertEqual(response.code, http.OK)
+            self.assertEqual(json.loads(data(self, response)), expected)
+        action = LoggedAction.of_type(
+            logger.messages, LOG_LOOKUP_DELETE_PREFIX)[0]
+        assertContainsFields(
+            self, action.start_message,
+            {u'environment': u'e', u'indexType': u't', u'prefix': u'a',
+             u'limit': 2})
+        assertContainsFields(self, action.end_message, {u'deleted': 2})
+        self.assertEqual(
+            GET(self, agent, b'/lookup/e/t/a1').code, http.NOT_FOUND)
+        self.assertEqual(GET(self, agent, b'/lookup/e/t/b').code, http.OK)
+
+        for query in [b'', b'?limit=1', b'?prefix=a&limit=1001']:
+            response = DELETE(self, agent, b'/lookup/e/t' + query)
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+
+    def test_ttl(self):
+        """
+        An entry can be set with a TTL, given in the C{X-TTL} header or
+        otherwise by the default for its index type, after which it is treated
+        as missing. The expiry time is included in the change log.
+        """
+        store = Store()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, ttl={u't': 60.0}).router.resource())
+        PUT(self, agent, b'/lookup/e/t/default', b'one')
+        PUT(self, agent, b'/lookup/e/u/none', b'two')
+        PUT(self, agent, b'/lookup/e/u/given', b'three',
+            Headers({b'X-TTL': [b'3600']}))
+        PUT(self, agent, b'/lookup/e/u/expired', b'four',
+            Headers({b'X-TTL': [b'0.001']}))
+        now = Time().asPOSIXTimestamp()
+        expiries = {
+            key: LookupEntry.find(store, u'e', indexType, key).expires
+            for indexType, key in [(u't', u'default'), (u'u', u'none'),
+                                   (u'u', u'given')]}
+        self.assertTrue(
+            now < expiries[u'default'].asPOSIXTimestamp() <= now + 60)
+        self.assertIdentical(expiries[u'none'], None)
+        self.assertTrue(
+            now + 3500 < expiries[u'given'].asPOSIXTimestamp() <= now + 3600)
+        store.findUnique(
+            LookupEntry, LookupEntry.key == u'expired').expires = (
+                Time.fromPOSIXTimestamp(now - 1))
+        self.assertEqual(
+            GET(self, agent, b'/lookup/e/u/expired').code, http.NOT_FOUND)
+        self.assertEqual(
+            GET(self, agent, b'/lookup/e/u/given').code, http.OK)
+
+        for ttl in [b'0', b'-1', b'soon', b'inf', b'nan', b'1e20']:
+            response = PUT(
+                self, agent, b'/lookup/e/u/invalid', b'five',
+                Headers({b'X-TTL': [ttl]}))
+            self.assertEqual(response.code, http.BAD_REQUEST)
+        self.assertIdentical(
+            LookupEntry.find(store, u'e', u'u', u'invalid'), None)
+
+        changes = json.loads(
+            data(self, GET(self, agent, b'/changes')))[u'changes']
+        self.assertEqual(
+            [change[u'expires'] for change in changes],
+            [expiries[u'default'].asPOSIXTimestamp(), None,
+             expiries[u'given'].asPOSIXTimestamp(), None])
+
+
+    def test_filters(self):
+        """
+        Lookups of keys ruled out by the lookup filters are answered without
+        querying the store.
+        """
+        store = Store()
+        filters = LookupFilters(store=store, clock=Clock())
+        filters.startService()
+        self.addCleanup(filters.stopService)
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, filters=filters).router.resource())
+        PUT(self, agent, b'/lookup/e/t/a', b'one')
+        labels = {'environment': u'e', 'indexType': u't'}
+        negatives = REGISTRY.get_sample_value(
+            'lookup_filter_negatives_total', labels) or 0
+
+        def _getContent(*a, **kw):
+            self.fail('Store queried for a key ruled out by the filters')
+        self.patch(LookupEntry, 'getContent', _getContent)
+        self.assertEqual(
+            GET(self, agent, b'/lookup/e/t/b').code, http.NOT_FOUND)
+        response = POST(
+            self, agent, b'/lookup/e/t', json.dumps({u'keys': [u'b', u'c']}))
+        self.assertEqual(
+            json.loads(data(self, response))[u'entries'],
+            {u'b': None, u'c': None})
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_filter_negatives_total', labels),
+            negatives + 3)
+
+
+    def test_coalesce(self):
+        """
+        Identical lookups share their results through the coalescer, until the
+        index is modified.
+        """
+        store = Store()
+        changeFeed = ChangeFeed(store=store)
+        changeFeed.install()
+        coalescer = QueryCoalescer(
+            changeFeed=changeFeed, window=1, clock=Clock())
+        coalescer.install()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, coalescer=coalescer).router.resource())
+        labels = {'route': u'lookup', 'environment': u'e', 'indexType': u't'}
+        coalesced = REGISTRY.get_sample_value(
+            'coalesced_requests_total', labels) or 0
+        PUT(self, agent, b'/lookup/e/t/a', b'one')
+        for _ in xrange(2):
+            self.assertEqual(data(self, GET(self, agent, b'/lookup/e/t/a')),
+                             b'one')
+            self.assertEqual(
+                GET(self, agent, b'/lookup/e/t/b').code, http.NOT_FOUND)
+        PUT(self, agent, b'/lookup/e/t/a', b'two')
+        self.assertEqual(data(self, GET(self, agent, b'/lookup/e/t/a')),
+                         b'two')
+        self.assertEqual(
+            REGISTRY.get_sample_value('coalesced_requests_total', labels),
+            coalesced + 2)
+
+
 
 class SearchAPITests(SynchronousTestCase):
     """
@@ -468,6 +841,298 @@ class SearchAPITests(SynchronousTestCase):
               u'type': u'type2'}])
 
 
+    def test_trigram(self):
+        """
+        The trigram index finds entries with similar values.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        response = PUT(
+            self, agent, b'/search/trigram/e/i/entries/result1/type1',
+            b'John Smith')
+        self.assertEqual(response.code, http.NO_CONTENT)
+        response = GET(
+            self, agent, b'/search/trigram/e/i/results/jon%20smith')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': 'result1',
+              u'type': u'type1'}])
+
+
+    def test_token(self):
+        """
+        The token index finds entries containing all of the searched words.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        response = PUT(
+            self, agent, b'/search/token/e/i/entries/result1/type1',
+            b'Smith, John')
+        self.assertEqual(response.code, http.NO_CONTENT)
+        response = GET(self, agent, b'/search/token/e/i/results/jo*%20smith')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': 'result1',
+              u'type': u'type1'}])
+
+
+    def test_substring(self):
+        """
+        The substring index finds entries containing the search value, but only
+        for index types it has been enabled for.
+        """
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=Store(), substring={u'i'}).router.resource())
+        response = PUT(
+            self, agent, b'/search/substring/e/i/entries/result1/type1',
+            b'12345678')
+        self.assertEqual(response.code, http.NO_CONTENT)
+        response = GET(self, agent, b'/search/substring/e/i/results/4567')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': 'result1',
+              u'type': u'type1'}])
+
+        response = PUT(
+            self, agent, b'/search/substring/e/j/entries/result1/type1',
+            b'12345678')
+        self.assertEqual(response.code, http.NOT_FOUND)
+        response = GET(self, agent, b'/search/substring/e/j/results/4567')
+        self.assertEqual(response.code, http.NOT_FOUND)
+
+
+    @capture_logging(None)
+    def test_count(self, logger):
+        """
+        Matching entries can be counted instead of returned.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        for i in xrange(5):
+            PUT(self, agent,
+                b'/search/prefix/e/i/entries/result{}/type'.format(i),
+                b'value')
+        for query, count in [(b'count=true', 5),
+                             (b'count=1&cap=3', 3),
+                             (b'count=true&cap=10', 5)]:
+            response = GET(
+                self, agent, b'/search/prefix/e/i/results/val?' + query)
+            self.assertEqual(response.code, http.OK)
+            self.assertEqual(
+                response.headers.getRawHeaders('Content-Type'),
+                ['application/json'])
+            self.assertEqual(
+                json.loads(data(self, response)), {u'count': count})
+        response = GET(
+            self, agent, b'/search/prefix/e/i/results/val?count=false')
+        self.assertEqual(len(json.loads(data(self, response))), 5)
+        for query in [b'count=true&cap=x', b'count=true&cap=-1']:
+            response = GET(
+                self, agent, b'/search/prefix/e/i/results/val?' + query)
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+        [action] = LoggedAction.of_type(logger.messages, LOG_SEARCH_COUNT)[1:2]
+        assertContainsFields(
+            self, action.start_message,
+            {'searchClass': SearchClasses.PREFIX,
+             'environment': u'e',
+             'indexType': u'i',
+             'searchValue': u'val',
+             'searchType': None,
+             'cap': 3})
+        assertContainsFields(self, action.end_message, {'count': 3})
+
+
+    def test_prefixLimit(self):
+        """
+        Prefix searches estimated to match more entries than the prefix limit
+        are rejected.
+        """
+        self.patch(SearchPrefixStatistic, 'minimum', 0)
+        store = Store()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, prefixLimit=2).router.resource())
+        for i in xrange(3):
+            PUT(self, agent,
+                b'/search/prefix/e/i/entries/result{}/type'.format(i),
+                b'value')
+        PUT(self, agent, b'/search/prefix/e/j/entries/result/type', b'value')
+        index = store.transact(SearchPrefixStatistic.recalculate, store, 1)
+        while index is not None:
+            index = store.transact(
+                SearchPrefixStatistic.recalculate, store, 1, index)
+
+        response = GET(self, agent, b'/search/prefix/e/i/results/v')
+        self.assertEqual(response.code, http.BAD_REQUEST)
+        self.assertIn(b'too broad', data(self, response))
+        for path in [b'/search/prefix/e/i/results/va',
+                     b'/search/prefix/e/j/results/v']:
+            response = GET(self, agent, path)
+            self.assertEqual(response.code, http.OK)
+
+        targets = [
+            {u'searchClass': u'prefix', u'environment': u'e',
+             u'indexType': u'i'},
+            {u'searchClass': u'prefix', u'environment': u'e',
+             u'indexType': u'j'}]
+        response = POST(
+            self, agent, b'/search',
+            json.dumps({u'searchValue': u'v', u'targets': targets}))
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'searchClass': u'prefix', u'environment': u'e',
+              u'indexType': u'i', u'searchType': None,
+              u'results': [], u'rejected': True},
+             {u'searchClass': u'prefix', u'environment': u'e',
+              u'indexType': u'j', u'searchType': None,
+              u'results': [{u'result': u'result', u'type': u'type'}]}])
+        response = POST(
+            self, agent, b'/search',
+            json.dumps({u'searchValue': u'v', u'targets': targets,
+                        u'merge': True}))
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': u'result', u'type': u'type'}])
+
+
+    def test_coalesce(self):
+        """
+        Searches for values with the same normalization share their results
+        through the coalescer, until the index is modified.
+        """
+        store = Store()
+        changeFeed = ChangeFeed(store=store)
+        changeFeed.install()
+        coalescer = QueryCoalescer(
+            changeFeed=changeFeed, window=1, clock=Clock())
+        coalescer.install()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, coalescer=coalescer).router.resource())
+        labels = {'route': u'search', 'environment': u'e', 'indexType': u'i'}
+        coalesced = REGISTRY.get_sample_value(
+            'coalesced_requests_total', labels) or 0
+        PUT(self, agent, b'/search/exact/e/i/entries/one/type', b'Jo Smith')
+        for path in [b'jo%20smith', b'JO-SMITH']:
+            response = GET(self, agent, b'/search/exact/e/i/results/' + path)
+            self.assertEqual(
+                json.loads(data(self, response)),
+                [{u'result': u'one', u'type': u'type'}])
+        PUT(self, agent, b'/search/exact/e/i/entries/two/type', b'Jo Smith')
+        response = GET(self, agent, b'/search/exact/e/i/results/jo%20smith')
+        self.assertEqual(
+            sorted(r[u'result'] for r in json.loads(data(self, response))),
+            [u'one', u'two'])
+        self.assertEqual(
+            REGISTRY.get_sample_value('coalesced_requests_total', labels),
+            coalesced + 1)
+
+
+    @capture_logging(None)
+    def test_searchMany(self, logger):
+        """
+        Several indexes can be searched for the same value at once, with the
+        results grouped by index or merged.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        for path in [b'/search/exact/e/i/entries/result1/type1',
+                     b'/search/prefix/e/i/entries/result1/type1',
+                     b'/search/prefix/e/i/entries/result2/type2',
+                     b'/search/prefix/e/j/entries/result3/type3']:
+            PUT(self, agent, path, b'value')
+        targets = [
+            {u'searchClass': u'exact', u'environment': u'e',
+             u'indexType': u'i'},
+            {u'searchClass': u'prefix', u'environment': u'e',
+             u'indexType': u'i', u'searchType': u'type1'},
+            {u'searchClass': u'prefix', u'environment': u'e',
+             u'indexType': u'j'},
+            {u'searchClass': u'token', u'environment': u'e',
+             u'indexType': u'i'}]
+        response = POST(
+            self, agent, b'/search',
+            json.dumps({u'searchValue': u'Value', u'targets': targets}))
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            ['application/json'])
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'searchClass': u'exact', u'environment': u'e',
+              u'indexType': u'i', u'searchType': None,
+              u'results': [{u'result': u'result1', u'type': u'type1'}]},
+             {u'searchClass': u'prefix', u'environment': u'e',
+              u'indexType': u'i', u'searchType': u'type1',
+              u'results': [{u'result': u'result1', u'type': u'type1'}]},
+             {u'searchClass': u'prefix', u'environment': u'e',
+              u'indexType': u'j', u'searchType': None,
+              u'results': [{u'result': u'result3', u'type': u'type3'}]},
+             {u'searchClass': u'token', u'environment': u'e',
+              u'indexType': u'i', u'searchType': None,
+              u'results': []}])
+
+        response = POST(
+            self, agent, b'/search',
+            json.dumps({u'searchValue': u'val', u'targets': targets[1:3],
+                        u'merge': True}))
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': u'result1', u'type': u'type1'},
+             {u'result': u'result3', u'type': u'type3'}])
+
+        targets[1:2] = [{u'searchClass': u'prefix', u'environment': u'e',
+                         u'indexType': u'i'}]
+        response = POST(
+            self, agent, b'/search',
+            json.dumps({u'searchValue': u'val', u'targets': targets,
+                        u'merge': True, u'limit': 1}))
+        self.assertEqual(
+            json.loads(data(self, response)),
+            [{u'result': u'result1', u'type': u'type1'},
+             {u'result': u'result3', u'type': u'type3'}])
+
+        [action] = LoggedAction.of_type(logger.messages, LOG_SEARCH_MANY)[:1]
+        assertContainsFields(
+            self, action.start_message,
+            {'searchValue': u'Value',
+             'targets': [[u'exact', u'e', u'i', None],
+                         [u'prefix', u'e', u'i', u'type1'],
+                         [u'prefix', u'e', u'j', None],
+                         [u'token', u'e', u'i', None]]})
+        self.assertTrue(action.succeeded)
+
+
+    def test_searchManyInvalid(self):
+        """
+        Invalid multiple searches result in a Bad Request response.
+        """
+        agent = ResourceTraversalAgent(self._resource())
+        target = {u'searchClass': u'exact', u'environment': u'e',
+                  u'indexType': u'i'}
+        for body in [
+                b'junk',
+                json.dumps([]),
+                json.dumps({u'targets': [target]}),
+                json.dumps({u'searchValue': 1, u'targets': [target]}),
+                json.dumps({u'searchValue': u'v', u'targets': target}),
+                json.dumps({u'searchValue': u'v', u'targets': [[]]}),
+                json.dumps({u'searchValue': u'v', u'targets': [target],
+                            u'limit': u'x'}),
+                json.dumps({u'searchValue': u'v', u'targets': [
+                    dict(target, searchClass=u'junk')]}),
+                json.dumps({u'searchValue': u'v', u'targets': [
+                    dict(target, indexType=1)]}),
+                json.dumps({u'searchValue': u'v', u'targets': [
+                    dict(target, searchClass=u'substring')]}),
+                json.dumps({u'searchValue': u'v', u'targets': [target],
+                            u'limit': -1}),
+                json.dumps({u'searchValue': u'v', u'targets': [target],
+                            u'limit': 1001}),
+                json.dumps({u'searchValue': u'v',
+                            u'targets': [target] * 101})]:
+            response = POST(self, agent, b'/search', body)
+            self.assertEqual(response.code, http.BAD_REQUEST, body)
+
+
     def test_invalidSearchClass(self):
         """
         Paths with an invalid search class result in a Not Found response.
@@ -479,6 +1144,283 @@ class SearchAPITests(SynchronousTestCase):
 
 
 
+class ChangesAPITests(SynchronousTestCase):
+    """
+    Tests for the change log HTTP API.
+    """
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.changeFeed = ChangeFeed(store=self.store, clock=self.clock)
+        self.changeFeed.install()
+        self.agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=self.store, changeFeed=self.changeFeed,
+                ).router.resource())
+
+
+    @capture_logging(None)
+    def test_changes(self, logger):
+        """
+        Changes are returned in order, with the current value of lookup
+        entries, starting after the given sequence number.
+        """
+        PUT(self, self.agent, b'/lookup/e/t/k', b'old')
+        PUT(self, self.agent, b'/search/exact/e/i/entries/r/type', b'value')
+        PUT(self, self.agent, b'/lookup/e/t/k', b'new')
+        DELETE(self, self.agent, b'/search/exact/e/i/entries/r/type')
+        response = GET(self, self.agent, b'/changes?limit=3')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            ['application/json'])
+        result = json.loads(data(self, response))
+        changes = result[u'changes']
+        sequences = [change.pop(u'sequence') for change in changes]
+        self.assertEqual(sequences, sorted(sequences))
+        self.assertEqual(result[u'next'], sequences[-1])
+        self.assertEqual(
+            changes,
+            [{u'kind': u'lookup-set', u'environment': u'e',
+              u'indexType': u't', u'key': u'k', u'value': u'bmV3',
+              u'expires': None},
+             {u'kind': u'search-insert', u'environment': u'e',
+              u'indexType': u'i', u'key': u'r', u'searchClass': u'exact',
+              u'searchType': u'type', u'searchValue': u'value'},
+             {u'kind': u'lookup-set', u'environment': u'e',
+              u'indexType': u't', u'key': u'k', u'value': u'bmV3',
+              u'expires': None}])
+        [action] = LoggedAction.of_type(logger.messages, LOG_CHANGES_GET)
+        assertContainsFields(
+            self, action.start_message, {u'after': 0, u'limit': 3})
+        assertContainsFields(self, action.end_message, {u'count': 3})
+
+        response = GET(
+            self, self.agent,
+            b'/changes?after={:d}'.format(result[u'next']))
+        result = json.loads(data(self, response))
+        [change] = result[u'changes']
+        self.assertEqual(change[u'kind'], u'search-remove')
+        self.assertEqual(result[u'next'], change[u'sequence'])
+        response = GET(
+            self, self.agent,
+            b'/changes?after={:d}'.format(result[u'next']))
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'changes': [], u'next': result[u'next'],
+             u'latest': result[u'next']})
+
+
+    def test_maxBytes(self):
+        """
+        The changes returned stop early once their values add up to
+        C{maxBytes}, but at least one is always returned.
+        """
+        for key, value in [(b'a', b'x' * 6), (b'b', b'y' * 6), (b'c', b'z')]:
+            PUT(self, self.agent, b'/lookup/e/t/' + key, value)
+        root = Resource()
+        root.putChild(b'changes', SpinneretResource(ChangesResource(
+            store=self.store, changeFeed=self.changeFeed, maxBytes=12)))
+        agent = ResourceTraversalAgent(root)
+        result = json.loads(data(self, GET(self, agent, b'/changes')))
+        self.assertEqual(
+            [change[u'key'] for change in result[u'changes']], [u'a', u'b'])
+        result = json.loads(data(self, GET(
+            self, agent, b'/changes?after={:d}'.format(result[u'next']))))
+        self.assertEqual(
+            [change[u'key'] for change in result[u'changes']], [u'c'])
+
+
+    def test_waitDisconnected(self):
+        """
+        If the client goes away while waiting for changes, the request stops
+        waiting.
+        """
+        request = DummyRequest([b''])
+        request.args = {b'wait': [b'10']}
+        d = ChangesResource(
+            store=self.store, changeFeed=self.changeFeed).render_GET(request)
+        self.assertNoResult(d)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(self.successResultOf(d), NOT_DONE_YET)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_invalid(self):
+        """
+        Invalid parameters are rejected.
+        """
+        for query in [b'after=x', b'after=-1', b'limit=0', b'limit=100000',
+                      b'wait=-1']:
+            response = GET(self, self.agent, b'/changes?' + query)
+            self.assertEqual(response.code, http.BAD_REQUEST)
+
+
+    def test_gone(self):
+        """
+        Requests for changes that have been removed by retention are rejected.
+        """
+        for key in [b'a', b'b', b'c']:
+            PUT(self, self.agent, b'/lookup/e/t/' + key, b'value')
+        self.store.transact(Change.retain, self.store, 1)
+        horizon = Change.horizon(self.store)
+        response = GET(self, self.agent, b'/changes')
+        self.assertEqual(response.code, http.GONE)
+        response = GET(
+            self, self.agent, b'/changes?after={:d}'.format(horizon))
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(len(json.loads(data(self, response))[u'changes']), 1)
+
+
+    def test_wait(self):
+        """
+        If there are no changes, the request waits for one to be committed, or
+        for the timeout to expire.
+        """
+        d = self.agent.request(b'GET', b'/changes?wait=10')
+        self.assertNoResult(d)
+        PUT(self, self.agent, b'/lookup/e/t/k', b'value')
+        response = self.successResultOf(d)
+        result = json.loads(data(self, response))
+        self.assertEqual(len(result[u'changes']), 1)
+
+        d = self.agent.request(
+            b'GET', b'/changes?wait=10&after={:d}'.format(result[u'next']))
+        self.clock.advance(10)
+        response = self.successResultOf(d)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'changes': [], u'next': result[u'next'],
+             u'latest': result[u'next']})
+
+
+
+class ReplicationAPITests(SynchronousTestCase):
+    """
+    Tests for the HTTP API of primaries and read-only replicas.
+    """
+    def test_snapshot(self):
+        """
+        The entries in the lookup and search indexes are returned a page at a
+        time, along with the latest change.
+        """
+        store = Store()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store).router.resource())
+        PUT(self, agent, b'/lookup/e/t/a', b'one')
+        PUT(self, agent, b'/lookup/e/t/b', b'two')
+        PUT(self, agent, b'/search/exact/e/i/entries/r/type', b'Value')
+        response = GET(self, agent, b'/snapshot/lookup?limit=1')
+        self.assertEqual(response.code, http.OK)
+        page = json.loads(data(self, response))
+        self.assertEqual(page[u'sequence'], Change.latest(store))
+        self.assertEqual(
+            page[u'entries'],
+            [{u'kind': u'lookup-set', u'environment': u'e',
+              u'indexType': u't', u'key': u'a', u'value': u'b25l',
+              u'expires': None}])
+        response = GET(
+            self, agent,
+            b'/snapshot/lookup?limit=1&after={:d}'.format(page[u'next']))
+        page = json.loads(data(self, response))
+        self.assertEqual(
+            [entry[u'key'] for entry in page[u'entries']], [u'b'])
+        response = GET(
+            self, agent,
+            b'/snapshot/lookup?limit=1&after={:d}'.format(page[u'next']))
+        page = json.loads(data(self, response))
+        self.assertEqual((page[u'entries'], page[u'next']), ([], None))
+
+        response = GET(self, agent, b'/snapshot/search')
+        page = json.loads(data(self, response))
+        self.assertEqual(
+            page[u'entries'],
+            [{u'kind': u'search-insert', u'environment': u'e',
+              u'indexType': u'i', u'key': u'r', u'searchClass': u'exact',
+              u'searchType': u'type', u'searchValue': u'value'}])
+        self.assertIdentical(page[u'next'], None)
+
+        self.assertEqual(
+            GET(self, agent, b'/snapshot/other').code, http.NOT_FOUND)
+        self.assertEqual(
+            GET(self, agent, b'/snapshot/lookup?limit=0').code,
+            http.BAD_REQUEST)
+
+
+    def test_snapshotMaxBytes(self):
+        """
+        A page of the snapshot stops early once the values of its entries add
+        up to C{maxBytes}.
+        """
+        store = Store()
+        for key, value in [(u'a', b'x' * 6), (u'b', b'y' * 6), (u'c', b'z')]:
+            LookupEntry.set(store, u'e', u't', key, value)
+        root = Resource()
+        root.putChild(b'snapshot', SpinneretResource(SnapshotResource(
+            store=store, index=u'lookup', maxBytes=12)))
+        agent = ResourceTraversalAgent(root)
+        page = json.loads(data(self, GET(self, agent, b'/snapshot')))
+        self.assertEqual(
+            [entry[u'key'] for entry in page[u'entries']], [u'a', u'b'])
+        page = json.loads(data(self, GET(
+            self, agent, b'/snapshot?after={:d}'.format(page[u'next']))))
+        self.assertEqual(
+            ([entry[u'key'] for entry in page[u'entries']], page[u'next']),
+            ([u'c'], None))
+
+
+    def test_changesBlobs(self):
+        """
+        Lookup changes and snapshot entries refer to values stored in files,
+        rather than including them.
+        """
+        store = Store(filesdir=self.mktemp())
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, blobThreshold=100).router.resource())
+        PUT(self, agent, b'/lookup/e/t/k', b'x' * 100)
+        expected = {
+            u'kind': u'lookup-set', u'environment': u'e', u'indexType': u't',
+            u'key': u'k', u'blob': True, u'expires': None}
+        [change] = json.loads(data(self, GET(self, agent, b'/changes')))[
+            u'changes']
+        del change[u'sequence']
+        self.assertEqual(change, expected)
+        page = json.loads(data(self, GET(self, agent, b'/snapshot/lookup')))
+        self.assertEqual(page[u'entries'], [expected])
+
+
+    def test_readOnly(self):
+        """
+        A read-only replica rejects changes to its indexes, and is not ready
+        until its follower is.
+        """
+        store = Store()
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        follower = Follower(store=store, agent=None, primary=b'http://p/')
+        agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=store, primary=b'http://p/', follower=follower,
+                ).router.resource())
+        self.assertEqual(
+            PUT(self, agent, b'/lookup/e/t/k', b'other').code, http.FORBIDDEN)
+        self.assertEqual(
+            PUT(self, agent, b'/search/exact/e/i/entries/r/type',
+                b'value').code,
+            http.FORBIDDEN)
+        self.assertEqual(
+            DELETE(self, agent, b'/search/exact/e/i/entries/r/type').code,
+            http.FORBIDDEN)
+        self.assertEqual(
+            DELETE(self, agent, b'/lookup/e/t?prefix=k').code, http.FORBIDDEN)
+        response = GET(self, agent, b'/lookup/e/t/k')
+        self.assertEqual(data(self, response), b'value')
+        self.assertEqual(
+            GET(self, agent, b'/ready').code, http.SERVICE_UNAVAILABLE)
+        store.findOrCreate(ReplicationState).snapshot = None
+        self.assertEqual(GET(self, agent, b'/ready').code, http.OK)
+
+
+
 class MetricsTests(SynchronousTestCase):
     """
     Test that metrics are published.
@@ -492,3 +1434,222 @@ class MetricsTests(SynchronousTestCase):
         response = GET(
             self, agent, b'/metrics')
         self.assertEqual(response.code, http.OK)
+
+
+    def test_stats(self):
+        """
+        Index statistics are published at C{/stats}.
+        """
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=Store()).router.resource())
+        PUT(self, agent, b'/lookup/e/t/k', b'value')
+        response = GET(self, agent, b'/stats')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'),
+            ['application/json'])
+        stats = json.loads(data(self, response))
+        self.assertEqual(
+            stats[u'lookup'],
+            [{u'environment': u'e', u'indexType': u't', u'entries': 1,
+              u'logicalBytes': 5, u'storedBytes': 5}])
+        self.assertEqual(stats[u'search'], [])
+
+
+    def test_statsPending(self):
+        """
+        If the index statistics are computed in the background, C{/stats}
+        responds with 503 until they have been computed.
+        """
+        store = Store()
+        statistics = IndexStatistics(store=store, clock=Clock())
+        statistics.startService()
+        self.addCleanup(statistics.stopService)
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, statistics=statistics).router.resource())
+        response = GET(self, agent, b'/stats')
+        self.assertEqual(response.code, http.SERVICE_UNAVAILABLE)
+        statistics.clock.advance(0)
+        response = GET(self, agent, b'/stats')
+        self.assertEqual(response.code, http.OK)
+
+
+    def test_ready(self):
+        """
+        The service is ready at C{/ready} once the caches are warmed up.
+        """
+        store = Store()
+        warmup = WarmupService(
+            store=store, manifest=[[u'lookup', u'e', u't', u'k']] * 3,
+            batchSize=2, interval=1, clock=Clock())
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store, warmup=warmup).router.resource())
+        warmup.startService()
+        response = GET(self, agent, b'/ready')
+        self.assertEqual(response.code, http.SERVICE_UNAVAILABLE)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'ready': False, u'warmed': 2, u'total': 3})
+        warmup.clock.advance(1)
+        response = GET(self, agent, b'/ready')
+        self.assertEqual(response.code, http.OK)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'ready': True, u'warmed': 3, u'total': 3})
+
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store).router.resource())
+        response = GET(self, agent, b'/ready')
+        self.assertEqual(response.code, http.OK)
+
+
+    def test_readyUpgraded(self):
+        """
+        The service is not ready at C{/ready} until the store has been fully
+        upgraded.
+        """
+        store = Store()
+        upgraded = Deferred()
+        self.patch(store, 'whenFullyUpgraded', lambda: upgraded)
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=store).router.resource())
+        response = GET(self, agent, b'/ready')
+        self.assertEqual(response.code, http.SERVICE_UNAVAILABLE)
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'ready': False, u'warmed': 0, u'total': 0})
+        upgraded.callback(None)
+        response = GET(self, agent, b'/ready')
+        self.assertEqual(response.code, http.OK)
+
+
+    def test_hotKeys(self):
+        """
+        Lookup and search requests are recorded in the hot keys.
+        """
+        hotKeys = HotKeys()
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=Store(), hotKeys=hotKeys).router.resource())
+        PUT(self, agent, b'/lookup/e/t/k', b'value')
+        GET(self, agent, b'/lookup/e/t/k')
+        GET(self, agent, b'/search/prefix/e/i/results/val')
+        GET(self, agent, b'/search/exact/e/i/results/value/type')
+        PUT(self, agent, b'/search/exact/e/i/entries/r/type', b'value')
+        self.assertEqual(
+            sorted(hotKeys.manifest()),
+            [[u'lookup', u'e', u't', u'k'],
+             [u'search', u'exact', u'e', u'i', u'value', u'type'],
+             [u'search', u'prefix', u'e', u'i', u'val', None]])
+
+
+
+class AdminTests(SynchronousTestCase):
+    """
+    Tests for the admin HTTP API.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = ResourceTraversalAgent(
+            IndexRouter(
+                store=Store(),
+                adminToken=b'secret',
+                profiler=Profiler(clock=self.clock)).router.resource())
+
+
+    def _admin(self, method, path):
+        """
+        Make an authorized request to an admin resource.
+        """
+        return self.successResultOf(
+            self.agent.request(
+                method, path,
+                Headers({b'Authorization': [b'Bearer secret']})))
+
+
+    def test_disabled(self):
+        """
+        The admin resources are not found if there is no admin token.
+        """
+        agent = ResourceTraversalAgent(
+            IndexRouter(store=Store()).router.resource())
+        response = GET(self, agent, b'/admin/profile')
+        self.assertEqual(response.code, http.NOT_FOUND)
+
+
+    def test_unauthorized(self):
+        """
+        Requests without the admin token are forbidden.
+        """
+        for headers in [None,
+                        Headers({b'Authorization': [b'Bearer wrong']}),
+                        Headers({b'Authorization': [b'Basic secret']})]:
+            response = GET(self, self.agent, b'/admin/profile', headers)
+            self.assertEqual(response.code, http.FORBIDDEN)
+
+
+    def test_profileRequests(self):
+        """
+        Profiling can be started for a number of requests, and the results
+        for each route retrieved.
+        """
+        response = self._admin(b'POST', b'/admin/profile?requests=3')
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'active': True, u'routes': {}})
+        PUT(self, self.agent, b'/lookup/e/t/k', b'value')
+        PUT(self, self.agent, b'/search/exact/e/i/entries/r/t', b'value')
+        GET(self, self.agent, b'/search/exact/e/i/results/value')
+        GET(self, self.agent, b'/lookup/e/t/k')
+        response = self._admin(b'GET', b'/admin/profile')
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'active': False,
+             u'routes': {u'lookup': 1,
+                         u'search/entries': 1,
+                         u'search/results': 1}})
+
+        response = self._admin(
+            b'GET', b'/admin/profile/dump?route=lookup&format=collapsed')
+        self.assertEqual(response.code, http.OK)
+        self.assertIn(b'render_PUT', data(self, response))
+        response = self._admin(b'GET', b'/admin/profile/dump')
+        self.assertEqual(
+            response.headers.getRawHeaders(b'Content-Type'),
+            [b'application/octet-stream'])
+        stats = marshal.loads(data(self, response))
+        self.assertEqual(
+            {name for (_, _, name) in stats
+             if name.startswith('render_')},
+            {'render_PUT', 'render_GET'})
+        response = self._admin(
+            b'GET', b'/admin/profile/dump?route=search')
+        self.assertEqual(response.code, http.NOT_FOUND)
+
+
+    def test_profileSeconds(self):
+        """
+        Profiling can be started for a period of time, and stopped early.
+        """
+        self._admin(b'POST', b'/admin/profile?seconds=10')
+        GET(self, self.agent, b'/lookup/e/t/k')
+        self.clock.advance(10)
+        GET(self, self.agent, b'/lookup/e/t/k')
+        response = self._admin(b'GET', b'/admin/profile')
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'active': False, u'routes': {u'lookup': 1}})
+
+        self._admin(b'POST', b'/admin/profile?seconds=10')
+        response = self._admin(b'DELETE', b'/admin/profile')
+        self.assertEqual(
+            json.loads(data(self, response)),
+            {u'active': False, u'routes': {}})
+
+
+    def test_profileInvalid(self):
+        """
+        Profiling requires a positive request or time limit.
+        """
+        for query in [b'', b'?requests=0', b'?seconds=-1', b'?requests=x']:
+            response = self._admin(b'POST', b'/admin/profile' + query)
+            self.assertEqual(response.code, http.BAD_REQUEST)
@@ -1,10 +1,18 @@
+from sqlite3 import IntegrityError
+
+from axiom.item import declareLegacyItem
 from axiom.store import Store
+from fixtures import TempDir
 from hypothesis import HealthCheck, assume, given, settings
 from py2casefold import casefold
 from testtools import TestCase
 from testtools.matchers import AllMatch, Annotate, Equals, HasLength
 
-from fusion_index.search import SearchClasses, SearchEntry
+from fusion_index import search
+from fusion_index.names import IndexName
+from fusion_index.search import (
+    SearchClasses, SearchEntry, SearchNGram, SearchPrefixStatistic,
+    SearchSuffix, SearchTokens, SearchTooBroad, trigrams)
 from fusion_index.test.test_lookup import axiom_text
 
 
@@ -208,3 +216,514 @@ class SearchTests(TestCase):
                     s, SearchClasses.EXACT, u'e', u'i', u'yo', limit=20)),
                 HasLength(20))
         s.transact(_tx)
+
+
+    def test_insertTwice(self):
+        """
+        Inserting an entry that already exists replaces its search value.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'yo')
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'hey')
+        self.assertThat(
+            list(s.query(SearchEntry).getColumn('searchValue')),
+            Equals([u'hey']))
+        self.assertThat(
+            list(SearchEntry.search(
+                s, SearchClasses.EXACT, u'e', u'i', u'yo')),
+            Equals([]))
+
+
+    def test_insertTwiceLoaded(self):
+        """
+        Replacing the search value of an entry that has already been loaded
+        updates the loaded item too.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'yo')
+        entry = s.findUnique(SearchEntry)
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'hey')
+        self.assertThat(entry.searchValue, Equals(u'hey'))
+
+
+    def test_insertTwiceWithoutReturning(self):
+        """
+        Versions of SQLite without C{UPDATE ... RETURNING} find the entry to
+        update with a separate query.
+        """
+        s = Store()
+        self.patch(search, '_supportsReturning', lambda store: False)
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'yo')
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'hey')
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'OTHER', u'type', u'yo')
+        self.assertThat(
+            sorted(s.query(SearchEntry).getColumn('searchValue')),
+            Equals([u'hey', u'yo']))
+
+
+    def test_unique(self):
+        """
+        Duplicate entries are rejected by the database.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'yo')
+        self.assertRaises(
+            IntegrityError,
+            SearchEntry,
+            store=s,
+            searchClassID=IndexName.find(s, SearchClasses.EXACT.value),
+            environmentID=IndexName.find(s, u'e'),
+            indexTypeID=IndexName.find(s, u'i'),
+            result=u'RESULT', searchType=u'type', searchValue=u'hey')
+
+
+    def test_upgrade1to2(self):
+        """
+        Upgrading version 1 entries discards any duplicates.
+        """
+        s = Store()
+        Old = declareLegacyItem(SearchEntry.typeName, 1, {})
+        old = [
+            Old(store=s, searchClass=u'exact', environment=u'e',
+                indexType=u'i', result=u'RESULT', searchType=u'type',
+                searchValue=value)
+            for value in [u'yo', u'hey']]
+        entries = [s.getItemByID(o.storeID) for o in old]
+        self.assertThat(entries[0], Equals(entries[1]))
+        self.assertThat(
+            list(s.query(SearchEntry).getColumn('searchValue')),
+            Equals([u'yo']))
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'sup')
+        self.assertThat(
+            list(s.query(SearchEntry).getColumn('searchValue')),
+            Equals([u'sup']))
+
+
+    def test_upgrade2to3(self):
+        """
+        Upgrading version 2 entries replaces their search class, environment
+        and index type with interned names.
+        """
+        s = Store()
+        Old = declareLegacyItem(SearchEntry.typeName, 2, {})
+        old = Old(
+            store=s, searchClass=u'prefix', environment=u'e', indexType=u'i',
+            result=u'RESULT', searchType=u'type', searchValue=u'yo')
+        entry = s.getItemByID(old.storeID)
+        self.assertThat(
+            (entry.searchClass, entry.environment, entry.indexType),
+            Equals((u'prefix', u'e', u'i')))
+        self.assertThat(
+            list(SearchEntry.search(
+                s, SearchClasses.PREFIX, u'e', u'i', u'y')),
+            Equals([{u'result': u'RESULT', u'type': u'type'}]))
+
+
+    def test_upgradeSuperseded(self):
+        """
+        Upgrading an entry for a search that has been inserted since the store
+        was opened deletes the old entry instead.
+        """
+        s = Store()
+        old = [
+            declareLegacyItem(SearchEntry.typeName, version, {})(
+                store=s, searchClass=u'exact', environment=u'e',
+                indexType=u'i', result=u'RESULT', searchType=u'type',
+                searchValue=u'yo')
+            for version in [1, 2]]
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'RESULT', u'type', u'sup')
+        entries = [s.getItemByID(o.storeID) for o in old]
+        self.assertThat(entries[0], Equals(entries[1]))
+        self.assertThat(
+            list(s.query(SearchEntry).getColumn('searchValue')),
+            Equals([u'sup']))
+
+
+    def test_migrate(self):
+        """
+        Opening a store with entries from every earlier version upgrades them
+        all, merging them with any entries inserted before they were upgraded.
+        """
+        path = self.useFixture(TempDir()).join(u'index.axiom')
+        s = Store(path)
+        for version, result in [(1, u'R1'), (2, u'R2'), (2, u'R3')]:
+            declareLegacyItem(SearchEntry.typeName, version, {})(
+                store=s, searchClass=u'exact', environment=u'e',
+                indexType=u'i', result=result, searchType=u'type',
+                searchValue=u'yo')
+        s.close()
+
+        s = Store(path)
+        self.assertThat(s.whenFullyUpgraded().called, Equals(False))
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'R3', u'type', u'sup')
+        for _ in s._upgradeManager.upgradeEverything():
+            pass
+        self.assertThat(
+            sorted(s.query(SearchEntry).getColumn('result')),
+            Equals([u'R1', u'R2', u'R3']))
+        self.assertThat(
+            list(SearchEntry.search(
+                s, SearchClasses.EXACT, u'e', u'i', u'yo')),
+            Equals([{u'result': u'R1', u'type': u'type'},
+                    {u'result': u'R2', u'type': u'type'}]))
+
+
+    def test_trigrams(self):
+        """
+        Values are split into trigrams, padded at the start.
+        """
+        self.assertThat(
+            trigrams(u'abcd'),
+            Equals({u'  a', u' ab', u'abc', u'bcd'}))
+        self.assertThat(trigrams(u'a'), Equals({u'  a'}))
+
+
+    def test_trigramSearches(self):
+        """
+        Trigram searches find entries with similar values, ranked by
+        similarity.
+        """
+        s = Store()
+
+        def _tx():
+            for result, value in [(u'1', u'Jonathan Smith'),
+                                  (u'2', u'John Smith'),
+                                  (u'3', u'Jane Smythe'),
+                                  (u'4', u'Bob Jones')]:
+                SearchEntry.insert(
+                    s, SearchClasses.TRIGRAM, u'e', u'i', result, u'type',
+                    value)
+
+            def _search(value, **kw):
+                return [
+                    r[u'result'] for r in SearchEntry.search(
+                        s, SearchClasses.TRIGRAM, u'e', u'i', value, **kw)]
+            self.assertThat(_search(u'jon smith'), Equals([u'2', u'1']))
+            self.assertThat(_search(u'john smith'), Equals([u'2', u'1']))
+            self.assertThat(_search(u'jane smith'), Equals([u'3', u'2', u'1']))
+            self.assertThat(_search(u'jon', limit=1), Equals([u'1']))
+            self.assertThat(_search(u'jon smith', searchType=u'x'), Equals([]))
+            self.assertThat(_search(u'xyz'), Equals([]))
+            self.assertThat(
+                SearchEntry.search(
+                    s, SearchClasses.TRIGRAM, u'e', u'i2', u'jon smith'),
+                Equals([]))
+
+            SearchEntry.insert(
+                s, SearchClasses.TRIGRAM, u'e', u'i', u'1', u'type', u'Bob')
+            self.assertThat(_search(u'jon smith'), Equals([u'2']))
+            SearchEntry.remove(
+                s, SearchClasses.TRIGRAM, u'e', u'i', u'2', u'type')
+            self.assertThat(_search(u'jon smith'), Equals([]))
+            self.assertThat(
+                s.query(SearchNGram).count(),
+                Equals(sum(
+                    len(trigrams(value))
+                    for value in [u'bob', u'janesmythe', u'bobjones'])))
+        s.transact(_tx)
+
+
+    @settings(suppress_health_check=[HealthCheck.filter_too_much])
+    @given(axiom_text(), axiom_text(), axiom_text(), axiom_text(),
+           axiom_text(), axiom_text())
+    def test_substringSearches(self, environment, indexType, prefix,
+                               searchValue, suffix, result):
+        """
+        Test inserting, searching, and removing for the substring search
+        class.
+        """
+        assume(SearchEntry._normalize(searchValue) != u'')
+        # Normalization may combine characters across the boundaries.
+        assume(
+            SearchEntry._normalize(searchValue) in
+            SearchEntry._normalize(prefix + searchValue + suffix))
+        s = Store()
+
+        def _tx():
+            SearchEntry.insert(
+                s, SearchClasses.SUBSTRING, environment, indexType, result,
+                u'type', prefix + searchValue + suffix)
+            self.assertThat(
+                list(SearchEntry.search(
+                    s, SearchClasses.SUBSTRING, environment, indexType,
+                    searchValue)),
+                Equals([{u'result': result,
+                         u'type': u'type'}]))
+
+            SearchEntry.remove(
+                s, SearchClasses.SUBSTRING, environment, indexType, result,
+                u'type')
+            self.assertThat(
+                list(SearchEntry.search(
+                    s, SearchClasses.SUBSTRING, environment, indexType,
+                    searchValue)),
+                Equals([]))
+            self.assertThat(s.query(SearchSuffix).count(), Equals(0))
+        s.transact(_tx)
+
+
+    def test_longSubstrings(self):
+        """
+        Substrings longer than the indexed suffixes are still matched exactly.
+        """
+        s = Store()
+        value = u''.join(unichr(ord(u'a') + i % 26) for i in xrange(100))
+        SearchEntry.insert(
+            s, SearchClasses.SUBSTRING, u'e', u'i', u'RESULT', u'type', value)
+        self.assertThat(
+            s.query(SearchSuffix).count(), Equals(len(set(
+                value[i:i + SearchSuffix.length]
+                for i in xrange(len(value))))))
+        self.assertThat(
+            SearchEntry.search(
+                s, SearchClasses.SUBSTRING, u'e', u'i', value[10:90]),
+            Equals([{u'result': u'RESULT',
+                     u'type': u'type'}]))
+        self.assertThat(
+            SearchEntry.search(
+                s, SearchClasses.SUBSTRING, u'e', u'i',
+                value[10:50] + u'x' + value[51:90]),
+            Equals([]))
+        self.assertThat(
+            SearchEntry.search(
+                s, SearchClasses.SUBSTRING, u'e', u'i',
+                value[10:50] + u'_' + value[51:90]),
+            Equals([]))
+
+
+    def test_substringAmplification(self):
+        """
+        The storage amplification of each substring index is the ratio of the
+        size of its postings to the size of its search values.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.SUBSTRING, u'e', u'i', u'1', u'type', u'abcd')
+        SearchEntry.insert(
+            s, SearchClasses.SUBSTRING, u'e', u'i', u'2', u'type', u'ab')
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'3', u'type', u'abcdefgh')
+        self.assertThat(
+            SearchSuffix.storageStats(s),
+            Equals({(u'e', u'i'): (10 + 3) / 6.0}))
+
+
+    def test_normalizeTokens(self):
+        """
+        Token search values are normalized word by word, keeping a C{*} at the
+        end of a word.
+        """
+        self.assertThat(
+            SearchEntry._normalizeTokens(u'  Smith, JOHN  Q* a*b \u00df.'),
+            Equals(u'smith john q* a* b ss'))
+
+
+    def test_tokenSearches(self):
+        """
+        Token searches find entries containing all of the words searched for,
+        or words starting with them, ranked by relevance.
+        """
+        s = Store()
+
+        def _tx():
+            for result, value in [(u'1', u'John Smith'),
+                                  (u'2', u'Smith, Jane'),
+                                  (u'3', u'John Smithers'),
+                                  (u'4', u'John John Smith')]:
+                SearchEntry.insert(
+                    s, SearchClasses.TOKEN, u'e', u'i', result, u'type',
+                    value)
+            SearchEntry.insert(
+                s, SearchClasses.TOKEN, u'e', u'i2', u'5', u'type',
+                u'John Smith')
+            SearchEntry.insert(
+                s, SearchClasses.EXACT, u'e', u'i', u'6', u'type',
+                u'John Smith')
+
+            def _search(value, **kw):
+                return [
+                    r[u'result'] for r in SearchEntry.search(
+                        s, SearchClasses.TOKEN, u'e', u'i', value, **kw)]
+            self.assertThat(_search(u'smith john'), Equals([u'4', u'1']))
+            self.assertThat(_search(u'smith'), HasLength(3))
+            self.assertThat(_search(u'jane'), Equals([u'2']))
+            self.assertThat(
+                sorted(_search(u'jo* smi*')), Equals([u'1', u'3', u'4']))
+            self.assertThat(_search(u'john', limit=1), Equals([u'4']))
+            self.assertThat(_search(u'john', searchType=u'x'), Equals([]))
+            self.assertThat(_search(u'johnsmith'), Equals([]))
+
+            SearchEntry.insert(
+                s, SearchClasses.TOKEN, u'e', u'i', u'4', u'type', u'Bob')
+            self.assertThat(_search(u'smith john'), Equals([u'1']))
+            SearchEntry.remove(
+                s, SearchClasses.TOKEN, u'e', u'i', u'1', u'type')
+            self.assertThat(_search(u'smith john'), Equals([]))
+            self.assertThat(
+                s.querySQL(
+                    'SELECT COUNT(*) FROM {}'.format(SearchTokens.tableName)),
+                Equals([(4,)]))
+        s.transact(_tx)
+
+
+    def test_tokenRollback(self):
+        """
+        The token index is updated in the same transaction as the entries.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.TOKEN, u'e', u'i', u'1', u'type', u'John Smith')
+
+        def _tx():
+            SearchEntry.insert(
+                s, SearchClasses.TOKEN, u'e', u'i', u'1', u'type', u'Jane')
+            raise ZeroDivisionError()
+        self.assertRaises(ZeroDivisionError, s.transact, _tx)
+        self.assertThat(
+            SearchEntry.search(s, SearchClasses.TOKEN, u'e', u'i', u'john'),
+            Equals([{u'result': u'1',
+                     u'type': u'type'}]))
+
+
+    def test_searchMany(self):
+        """
+        Several indexes can be searched for the same value at once.
+        """
+        s = Store()
+        SearchEntry.insert(
+            s, SearchClasses.EXACT, u'e', u'i', u'1', u'type', u'John Smith')
+        SearchEntry.insert(
+            s, SearchClasses.PREFIX, u'e', u'j', u'2', u'type', u'John Smith')
+        SearchEntry.insert(
+            s, SearchClasses.TOKEN, u'e', u'i', u'3', u'type', u'John Smith')
+        self.assertThat(
+            SearchEntry.searchMany(
+                s,
+                [(SearchClasses.EXACT, u'e', u'i', None),
+                 (SearchClasses.PREFIX, u'e', u'j', u'type'),
+                 (SearchClasses.PREFIX, u'e', u'i', None),
+                 (SearchClasses.TOKEN, u'e', u'i', None)],
+                u'john smith'),
+            Equals([[{u'result': u'1', u'type': u'type'}],
+                    [{u'result': u'2', u'type': u'type'}],
+                    [],
+                    [{u'result': u'3', u'type': u'type'}]]))
+
+
+    def test_count(self):
+        """
+        Matching entries can be counted, stopping at a cap, for each search
+        class.
+        """
+        s = Store()
+
+        def _tx():
+            for searchClass in SearchClasses.iterconstants():
+                for i in xrange(10):
+                    SearchEntry.insert(
+                        s, searchClass, u'e', u'i', unicode(i),
+                        u'type{}'.format(i % 2), u'John Smith {}'.format(i))
+                # Trigram searches are fuzzy, so match all the entries.
+                fuzzy = searchClass == SearchClasses.TRIGRAM
+                for searchValue, searchType, cap, expected in [
+                        (u'John Smith 3', None, None, 10 if fuzzy else 1),
+                        (u'John Smith 3', u'type0', None, 5 if fuzzy else 0),
+                        (u'', None, None, 0)]:
+                    self.assertThat(
+                        SearchEntry.count(
+                            s, searchClass, u'e', u'i', searchValue,
+                            searchType, cap),
+                        Equals(expected), searchClass)
+                if searchClass != SearchClasses.EXACT:
+                    searchValue = {SearchClasses.PREFIX: u'john',
+                                   SearchClasses.SUBSTRING: u'smith',
+                                   SearchClasses.TRIGRAM: u'jon smith',
+                                   SearchClasses.TOKEN: u'smith'}[searchClass]
+                    for searchType, cap, expected in [(None, None, 10),
+                                                      (None, 3, 3),
+                                                      (u'type1', None, 5),
+                                                      (u'type1', 20, 5)]:
+                        self.assertThat(
+                            SearchEntry.count(
+                                s, searchClass, u'e', u'i', searchValue,
+                                searchType, cap),
+                            Equals(expected), searchClass)
+                        self.assertThat(
+                            SearchEntry.search(
+                                s, searchClass, u'e', u'i', searchValue,
+                                searchType, limit=cap or 200),
+                            HasLength(expected), searchClass)
+        s.transact(_tx)
+
+
+    def test_prefixStatistics(self):
+        """
+        Prefix searches estimated to match too many entries are rejected, for
+        short prefixes shared by enough entries.
+        """
+        self.patch(SearchPrefixStatistic, 'minimum', 2)
+        s = Store()
+
+        def _recalculate():
+            for length in xrange(1, SearchPrefixStatistic.length + 1):
+                index = SearchPrefixStatistic.recalculate(s, length)
+                while index is not None:
+                    index = SearchPrefixStatistic.recalculate(
+                        s, length, index)
+
+        def _tx():
+            for i in xrange(5):
+                SearchEntry.insert(
+                    s, SearchClasses.PREFIX, u'e', u'i', u'result{}'.format(i),
+                    u'type', u'Smith {}'.format(i))
+            SearchEntry.insert(
+                s, SearchClasses.PREFIX, u'e', u'i', u'result5', u'type',
+                u'Jones')
+            SearchEntry.insert(
+                s, SearchClasses.PREFIX, u'e', u'j', u'result6', u'type',
+                u'Smith')
+            _recalculate()
+            _recalculate()
+            for prefix, expected in [(u's', 5), (u'smi', 5), (u'smit', 0),
+                                     (u'j', 0), (u'x', 0)]:
+                self.assertThat(
+                    SearchPrefixStatistic.estimate(s, u'e', u'i', prefix),
+                    Equals(expected), prefix)
+
+            e = self.assertRaises(
+                SearchTooBroad, SearchEntry.search,
+                s, SearchClasses.PREFIX, u'e', u'i', u'S', maxMatches=4)
+            self.assertThat(e.estimate, Equals(5))
+            for searchClass, searchValue, maxMatches in [
+                    (SearchClasses.PREFIX, u'S', None),
+                    (SearchClasses.PREFIX, u'S', 5),
+                    (SearchClasses.PREFIX, u'Smith', 4),
+                    (SearchClasses.EXACT, u'S', 0)]:
+                SearchEntry.search(
+                    s, searchClass, u'e', u'i', searchValue,
+                    maxMatches=maxMatches)
+            self.assertThat(
+                SearchEntry.searchMany(
+                    s,
+                    [(SearchClasses.PREFIX, u'e', u'i', None),
+                     (SearchClasses.PREFIX, u'e', u'j', None)],
+                    u'S', maxMatches=4),
+                Equals([None, [{u'result': u'result6', u'type': u'type'}]]))
+
+            s.query(SearchEntry).deleteFromStore()
+            _recalculate()
+            self.assertThat(
+                SearchPrefixStatistic.estimate(s, u'e', u'i', u's'),
+                Equals(0))
+        s.transact(_tx)
@@ -2,9 +2,22 @@
 Tests for L{fusion_index.service}.
 """
 from toolz import count
+from twisted.internet.task import Clock
+from twisted.python.usage import UsageError
 from twisted.trial.unittest import TestCase
 
-from fusion_index.service import FusionIndexServiceMaker
+from fusion_index.admission import AdmissionControl
+from fusion_index.bloom import LookupFilters
+from fusion_index.changes import ChangeRetention
+from fusion_index.expiry import ExpiryReaper
+from fusion_index.lookup import Compression, LookupEntry
+from fusion_index import service
+from fusion_index.maintenance import MaintenanceService
+from fusion_index.replication import Follower
+from fusion_index.resource import IndexRouter
+from fusion_index.service import FusionIndexServiceMaker, Options
+from fusion_index.stats import IndexStatistics
+from fusion_index.warmup import ManifestService, WarmupService
 
 
 
@@ -14,12 +27,405 @@ class FusionIndexServiceTests(TestCase):
     """
     def test_startService(self):
         """
-        L{FusionIndexServiceMaker} creates a multiservice with the store and
-        web services hooked up.
+        L{FusionIndexServiceMaker} creates a multiservice with the store,
+        expiry reaper, change retention and web services hooked up.
         """
         maker = FusionIndexServiceMaker()
-        service = maker.makeService({
-            'db': self.mktemp(),
-            'port': 'tcp:0',
-            })
-        self.assertEqual(count(service), 2)
+        options = Options()
+        options.parseOptions(['--db', self.mktemp(), '--port', 'tcp:0'])
+        service = maker.makeService(options)
+        self.assertEqual(count(service), 4)
+
+
+    def test_maintenanceWindow(self):
+        """
+        If any maintenance windows are configured, a L{MaintenanceService} is
+        also created.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--maintenance-window', '01:00-03:30',
+            '--maintenance-window', '23:00-00:30'])
+        service = maker.makeService(options)
+        [maintenance] = [
+            s for s in service if isinstance(s, MaintenanceService)]
+        self.assertEqual(maintenance.windows, [(60, 210), (1380, 30)])
+
+
+    def test_incrementalVacuum(self):
+        """
+        A new database is created in incremental vacuum mode, so free pages
+        are vacuumed during maintenance windows.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--maintenance-window', '01:00-03:30'])
+        service = maker.makeService(options)
+        [maintenance] = [
+            s for s in service if isinstance(s, MaintenanceService)]
+        store = maintenance.store
+        [(autoVacuum,)] = store.querySQL('PRAGMA auto_vacuum')
+        self.assertEqual(autoVacuum, 2)
+
+        def _tx():
+            for i in xrange(500):
+                LookupEntry.set(store, u'e', u't', unicode(i), bytes(i) * 300)
+        store.transact(_tx)
+        store.transact(lambda: store.query(LookupEntry).deleteFromStore())
+        [(freePages,)] = store.querySQL('PRAGMA freelist_count')
+        self.assertNotEqual(freePages, 0)
+        maintenance.clock = Clock()
+        maintenance.clock.advance(3600)
+        maintenance.startService()
+        self.addCleanup(maintenance.stopService)
+        for _ in xrange(100):
+            maintenance.clock.advance(maintenance.interval)
+        [(freePages,)] = store.querySQL('PRAGMA freelist_count')
+        self.assertEqual(freePages, 0)
+
+
+    def test_compression(self):
+        """
+        Compression policies are passed to the maintenance service.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--maintenance-window', '01:00-03:30',
+            '--compress', 'foo', '--compress', 'bar:100'])
+        service = maker.makeService(options)
+        [maintenance] = [
+            s for s in service if isinstance(s, MaintenanceService)]
+        self.assertEqual(
+            maintenance.compression,
+            {u'foo': Compression(threshold=1024),
+             u'bar': Compression(threshold=100)})
+
+
+    def test_blobs(self):
+        """
+        Values of at least 1MiB are stored in files by default.
+        """
+        options = Options()
+        options.parseOptions(['--db', self.mktemp()])
+        self.assertEqual(options['blob-threshold'], 1024 * 1024)
+        self.assertFalse(options['blob-mmap'])
+        options.parseOptions(
+            ['--db', self.mktemp(), '--blob-threshold', '100', '--blob-mmap'])
+        self.assertEqual(options['blob-threshold'], 100)
+        self.assertTrue(options['blob-mmap'])
+
+
+    def test_ttl(self):
+        """
+        Default TTLs for lookup index types are passed to the router, and
+        expired entries are reaped.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--ttl', 'session:3600', '--ttl', 'token:0.5'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        services = maker.makeService(options)
+        self.assertEqual(routers[0].ttl, {u'session': 3600.0, u'token': 0.5})
+        [reaper] = [s for s in services if isinstance(s, ExpiryReaper)]
+        self.assertIdentical(reaper.store, routers[0].store)
+        for spec in ['session', 'session:', 'session:-1', 'session:never',
+                     'session:1e20']:
+            self.assertRaises(
+                UsageError, Options().parseOptions, ['--ttl', spec])
+
+
+    def test_substring(self):
+        """
+        Substring search is only enabled for the given index types.
+        """
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--substring', 'foo', '--substring', 'bar'])
+        self.assertEqual(options['substring'], {u'foo', u'bar'})
+
+
+    def test_prefixLimit(self):
+        """
+        The prefix search limit is disabled by default, and requires a
+        maintenance window, since that is when the prefix statistics are
+        calculated.
+        """
+        options = Options()
+        options.parseOptions(['--db', self.mktemp()])
+        self.assertEqual(options['prefix-limit'], None)
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--prefix-limit', '1000',
+             '--maintenance-window', '01:00-03:30'])
+        self.assertEqual(options['prefix-limit'], 1000)
+        self.assertRaises(
+            UsageError, Options().parseOptions,
+            ['--db', self.mktemp(), '--prefix-limit', '1000'])
+
+
+    def test_slowQueries(self):
+        """
+        The slow query log is disabled by default.
+        """
+        options = Options()
+        options.parseOptions(['--db', self.mktemp()])
+        self.assertEqual(options['slow-query-threshold'], None)
+        self.assertFalse(options['slow-query-redact'])
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--slow-query-threshold', '0.5',
+             '--slow-query-redact'])
+        self.assertEqual(options['slow-query-threshold'], 0.5)
+        self.assertTrue(options['slow-query-redact'])
+
+
+    def test_adminToken(self):
+        """
+        The admin token is read from a file.
+        """
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(b'secret\n')
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--port', 'tcp:0',
+             '--admin-token-file', path])
+        FusionIndexServiceMaker().makeService(options)
+        [router] = routers
+        self.assertEqual(router.adminToken, b'secret')
+
+
+    def test_emptyAdminToken(self):
+        """
+        An empty admin token is rejected, since it would match an empty
+        C{Authorization} header.
+        """
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(b' \n')
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--port', 'tcp:0',
+             '--admin-token-file', path])
+        self.assertRaises(
+            UsageError, FusionIndexServiceMaker().makeService, options)
+
+
+    def test_serverTiming(self):
+        """
+        The C{Server-Timing} header is disabled by default.
+        """
+        maker = FusionIndexServiceMaker()
+        for args, expected in [([], False), (['--server-timing'], True)]:
+            options = Options()
+            options.parseOptions(
+                ['--db', self.mktemp(), '--port', 'tcp:0'] + args)
+            web = list(maker.makeService(options))[-1]
+            self.assertEqual(web.factory.serverTiming, expected)
+
+
+    def test_admissionControl(self):
+        """
+        Admission control is enabled if the number of reads or writes in
+        flight is limited.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions(['--db', self.mktemp(), '--port', 'tcp:0'])
+        web = list(maker.makeService(options))[-1]
+        self.assertNotIsInstance(web.factory.resource, AdmissionControl)
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0', '--max-writes', '4',
+            '--max-queued', '10', '--max-queue-time', '0.5'])
+        web = list(maker.makeService(options))[-1]
+        admission = web.factory.resource
+        self.assertEqual(
+            (admission.maxReads, admission.maxWrites, admission.maxQueued,
+             admission.maxQueueTime),
+            (None, 4, 10, 0.5))
+
+
+    def test_statsMaxAge(self):
+        """
+        Index statistics are computed on demand by default, or by an
+        L{IndexStatistics} service in the background, as often as
+        C{--stats-max-age} gives.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions(['--db', self.mktemp(), '--port', 'tcp:0'])
+        self.assertEqual(options['stats-max-age'], None)
+        self.assertEqual(
+            [s for s in maker.makeService(options)
+             if isinstance(s, IndexStatistics)],
+            [])
+        options = Options()
+        options.parseOptions(
+            ['--db', self.mktemp(), '--port', 'tcp:0',
+             '--stats-max-age', '5'])
+        [statistics] = [
+            s for s in maker.makeService(options)
+            if isinstance(s, IndexStatistics)]
+        self.assertEqual(statistics.maxAge, 5.0)
+
+
+    def test_hotKeys(self):
+        """
+        If hot keys are tracked, the manifest saved when the service stops is
+        replayed when it starts again.
+        """
+        db = self.mktemp()
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions(
+            ['--db', db, '--port', 'tcp:0', '--hot-keys', '10'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        services = maker.makeService(options)
+        [manifest] = [s for s in services if isinstance(s, ManifestService)]
+        routers[0].hotKeys.lookup(u'e', u't', u'k')
+        manifest.stopService()
+
+        services = maker.makeService(options)
+        [warmup] = [s for s in services if isinstance(s, WarmupService)]
+        self.assertEqual(warmup.manifest, [[u'lookup', u'e', u't', u'k']])
+        self.assertIdentical(routers[1].warmup, warmup)
+
+
+    def test_changeFeed(self):
+        """
+        Requests for the change log can wait for changes, and the change log
+        is trimmed to the change retention limit in the background, whether
+        or not there are maintenance windows.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--change-retention', '1000'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        services = maker.makeService(options)
+        [retention] = [
+            s for s in services if isinstance(s, ChangeRetention)]
+        self.assertEqual(retention.count, 1000)
+        self.assertIdentical(routers[0].changeFeed.store, routers[0].store)
+
+
+    def test_changeRetention(self):
+        """
+        A million changes are kept in the change log by default, and the
+        retention limit must be positive.
+        """
+        options = Options()
+        options.parseOptions(['--db', self.mktemp()])
+        self.assertEqual(options['change-retention'], 1000000)
+        self.assertRaises(
+            UsageError, Options().parseOptions,
+            ['--db', self.mktemp(), '--change-retention', '0'])
+
+
+    def test_follow(self):
+        """
+        If a primary to follow is given, the service is a read-only replica
+        of it.
+        """
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions([
+            '--db', self.mktemp(), '--port', 'tcp:0',
+            '--follow', 'http://primary:8080/'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        services = maker.makeService(options)
+        [follower] = [s for s in services if isinstance(s, Follower)]
+        self.assertEqual(follower.primary, 'http://primary:8080/')
+        self.assertEqual(follower.blobThreshold, 1024 * 1024)
+        self.assertIdentical(follower.store, routers[0].store)
+        self.assertEqual(routers[0].primary, 'http://primary:8080/')
+        self.assertIdentical(routers[0].follower, follower)
+
+
+    def test_lookupFilters(self):
+        """
+        If a false positive rate is given, lookups are checked against Bloom
+        filters of the lookup keys, saved alongside the database.
+        """
+        db = self.mktemp()
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions(['--db', db, '--port', 'tcp:0'])
+        self.assertEqual(options['lookup-filter-error-rate'], None)
+        options.parseOptions([
+            '--db', db, '--port', 'tcp:0',
+            '--lookup-filter-error-rate', '0.001',
+            '--lookup-filter-interval', '60'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        services = maker.makeService(options)
+        [filters] = [s for s in services if isinstance(s, LookupFilters)]
+        self.assertEqual(filters.errorRate, 0.001)
+        self.assertEqual(filters.interval, 60.0)
+        self.assertEqual(
+            filters.path, routers[0].store.dbdir.child('lookup-filters'))
+        self.assertIdentical(routers[0].filters, filters)
+
+
+    def test_coalesce(self):
+        """
+        If a window is given, identical lookups and searches within it share
+        their results.
+        """
+        db = self.mktemp()
+        maker = FusionIndexServiceMaker()
+        options = Options()
+        options.parseOptions(['--db', db, '--port', 'tcp:0'])
+        self.assertEqual(options['coalesce-window'], None)
+        options.parseOptions([
+            '--db', db, '--port', 'tcp:0', '--coalesce-window', '0.1'])
+        routers = []
+
+        def _router(**kw):
+            routers.append(IndexRouter(**kw))
+            return routers[-1]
+        self.patch(service, 'IndexRouter', _router)
+        maker.makeService(options)
+        [router] = routers
+        self.assertEqual(router.coalescer.window, 0.1)
+        self.assertIdentical(router.coalescer.changeFeed, router.changeFeed)
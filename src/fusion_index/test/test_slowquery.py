@@ -0,0 +1,135 @@
+"""
+Tests for L{fusion_index.slowquery}.
+"""
+from axiom.store import Store
+from eliot.testing import LoggedMessage, capture_logging
+from prometheus_client import REGISTRY
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from fusion_index.logging import LOG_SLOW_QUERY
+from fusion_index.lookup import LookupEntry
+from fusion_index.search import SearchClasses, SearchEntry
+from fusion_index.slowquery import SlowQueryLog, tableName
+from fusion_index.timing import Timings, requestTimings, setIndex
+
+
+
+class SlowQueryLogTests(SynchronousTestCase):
+    """
+    Tests for L{SlowQueryLog}.
+    """
+    def _messages(self, logger, fragment):
+        """
+        Get the slow query messages for statements containing a fragment.
+        """
+        return [
+            m.message for m in LoggedMessage.of_type(
+                logger.messages, LOG_SLOW_QUERY)
+            if fragment in m.message['sql']]
+
+
+    @capture_logging(None)
+    def test_belowThreshold(self, logger):
+        """
+        Statements faster than the threshold are not logged.
+        """
+        store = Store()
+        SlowQueryLog(threshold=1.0, clock=Clock()).install(store)
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        LookupEntry.get(store, u'e', u't', u'k')
+        self.assertEqual(
+            LoggedMessage.of_type(logger.messages, LOG_SLOW_QUERY), [])
+
+
+    @capture_logging(None)
+    def test_slowQuery(self, logger):
+        """
+        Statements at least as slow as the threshold are logged with their
+        parameters, query plan, and number of rows.
+        """
+        store = Store()
+        SlowQueryLog(threshold=0.0, clock=Clock()).install(store)
+        for i in xrange(3):
+            SearchEntry.insert(
+                store, SearchClasses.PREFIX, u'e', u'i', unicode(i), u'type',
+                u'value')
+        SearchEntry.search(store, SearchClasses.PREFIX, u'e', u'i', u'val')
+        [message] = self._messages(logger, 'searchValue] >= ?')
+        self.assertEqual(message['rows'], 3)
+        self.assertEqual(message['duration'], 0.0)
+        self.assertIn(u'val', message['args'])
+        [detail] = message['plan']
+        self.assertTrue(detail.startswith(u'SEARCH '), detail)
+        [message] = self._messages(logger, 'last_insert_rowid')[:1]
+        self.assertEqual(message['plan'], [u'SCAN CONSTANT ROW'])
+
+
+    @capture_logging(None)
+    def test_redact(self, logger):
+        """
+        Parameters are left out of the log if redaction is enabled.
+        """
+        store = Store()
+        SlowQueryLog(threshold=0.0, redact=True, clock=Clock()).install(store)
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        LookupEntry.get(store, u'e', u't', u'k')
+        messages = LoggedMessage.of_type(logger.messages, LOG_SLOW_QUERY)
+        self.assertNotEqual(messages, [])
+        for message in messages:
+            self.assertEqual(
+                set(message.message['args']) - {None}, set())
+
+
+    def test_index(self):
+        """
+        Slow statements are counted per table, plan, and the index of the
+        request being handled, if any.
+        """
+        store = Store()
+        SlowQueryLog(threshold=0.0, clock=Clock()).install(store)
+        LookupEntry.set(store, u'e', u't', u'k', b'value')
+        labels = {'table': u'fusion_index_lookup_lookupentry',
+                  'plan': u'search', 'environment': u'slow',
+                  'indexType': u't'}
+        before = REGISTRY.get_sample_value('slow_query_count', labels) or 0
+        request = DummyRequest([])
+        request.timings = Timings(Clock())
+        with requestTimings(request):
+            setIndex(u'slow', u't')
+            LookupEntry.find(store, u'slow', u't', u'k')
+        self.assertEqual(
+            REGISTRY.get_sample_value('slow_query_count', labels),
+            before + 1)
+
+
+    def test_planCache(self):
+        """
+        Query plans are captured once per distinct statement.
+        """
+        store = Store()
+        log = SlowQueryLog(threshold=0.0, maxPlans=2, clock=Clock())
+        log.install(store)
+        for _ in xrange(3):
+            store.querySQL('SELECT 1')
+        self.assertEqual(log._plans, {'SELECT 1': [u'SCAN CONSTANT ROW']})
+        store.querySQL('SELECT 2')
+        store.querySQL('SELECT 3')
+        self.assertEqual(log._plans, {'SELECT 3': [u'SCAN CONSTANT ROW']})
+
+
+    def test_tableName(self):
+        """
+        The table name is taken from the statement, without Axiom's type
+        prefix and version suffix.
+        """
+        for sql, table in [
+                ('SELECT x FROM main.item_foo_bar_v2 WHERE y = ?',
+                 u'foo_bar'),
+                ('INSERT INTO main.item_foo_v1 (oid) VALUES (?)', u'foo'),
+                ('UPDATE item_foo_v10 SET x = ?', u'foo'),
+                ('DELETE FROM fusion_index_search_tokens',
+                 u'fusion_index_search_tokens'),
+                ('PRAGMA optimize', u'')]:
+            self.assertEqual(tableName(sql), table)
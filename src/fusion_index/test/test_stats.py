@@ -0,0 +1,146 @@
+"""
+Tests for L{fusion_index.stats}.
+"""
+from axiom.store import Store
+from prometheus_client import REGISTRY
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.lookup import LookupEntry
+from fusion_index.search import SearchClasses, SearchEntry
+from fusion_index.stats import IndexStatistics
+
+
+
+class IndexStatisticsTests(SynchronousTestCase):
+    """
+    Tests for L{IndexStatistics}.
+    """
+    def _store(self):
+        store = Store(self.mktemp())
+        for i in xrange(3):
+            LookupEntry.set(store, u'e', u'a', unicode(i), b'value')
+        LookupEntry.set(store, u'e', u'b', u'k', b'other value')
+        for i in xrange(2):
+            SearchEntry.insert(
+                store, SearchClasses.EXACT, u'e', u'i', unicode(i), u'type',
+                u'value')
+        SearchEntry.insert(
+            store, SearchClasses.PREFIX, u'e', u'i', u'r', u'type', u'value')
+        return store
+
+
+    def test_statistics(self):
+        """
+        The number of entries in each index, the size of the lookup values, and
+        the size of the database are computed and published.
+        """
+        store = self._store()
+        stats = IndexStatistics(store=store, clock=Clock()).get()
+        self.assertEqual(
+            sorted(stats[u'lookup'], key=lambda s: s[u'indexType']),
+            [{u'environment': u'e', u'indexType': u'a', u'entries': 3,
+              u'logicalBytes': 15, u'storedBytes': 5},
+             {u'environment': u'e', u'indexType': u'b', u'entries': 1,
+              u'logicalBytes': 11, u'storedBytes': 11}])
+        self.assertEqual(
+            sorted(stats[u'search'], key=lambda s: s[u'searchClass']),
+            [{u'searchClass': u'exact', u'environment': u'e',
+              u'indexType': u'i', u'entries': 2},
+             {u'searchClass': u'prefix', u'environment': u'e',
+              u'indexType': u'i', u'entries': 1}])
+        database = stats[u'database']
+        self.assertEqual(
+            database[u'size'],
+            store.dbdir.child('db.sqlite').getsize())
+        self.assertEqual(database[u'walSize'], 0)
+        self.assertEqual(database[u'freePages'], 0)
+        [(cacheSize,)] = store.querySQL('PRAGMA cache_size')
+        self.assertEqual(
+            database[u'cacheSize'],
+            -cacheSize * 1024 if cacheSize < 0
+            else cacheSize * database[u'pageSize'])
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_entries', {'environment': u'e', 'indexType': u'a'}),
+            3)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'search_entries',
+                {'searchClass': u'exact', 'environment': u'e',
+                 'indexType': u'i'}),
+            2)
+
+
+    def test_cached(self):
+        """
+        The statistics are only recomputed once they are too old.
+        """
+        store = self._store()
+        clock = Clock()
+        statistics = IndexStatistics(store=store, maxAge=10, clock=clock)
+        stats = statistics.get()
+        LookupEntry.set(store, u'e', u'c', u'k', b'value')
+        clock.advance(9)
+        self.assertIdentical(statistics.get(), stats)
+        clock.advance(1)
+        stats = statistics.get()
+        self.assertEqual(stats[u'computed'], 10)
+        self.assertEqual(len(stats[u'lookup']), 3)
+
+
+    def test_background(self):
+        """
+        While the service is running, the statistics are computed in the
+        background, a batch of items per transaction, and computed again once
+        they are too old; the last ones computed are served in between.
+        """
+        store = self._store()
+        clock = Clock()
+        statistics = IndexStatistics(
+            store=store, maxAge=10, batchSize=2, clock=clock)
+        transactions = []
+        self.patch(
+            store, 'transact',
+            lambda f, *a: transactions.append(f) or f(*a))
+        statistics.startService()
+        self.addCleanup(statistics.stopService)
+        self.assertIdentical(statistics.get(), None)
+        clock.advance(0)
+        self.assertEqual(len(transactions), 8)
+        stats = statistics.get()
+        self.assertEqual(stats[u'computed'], 0)
+        self.assertEqual(
+            sorted(s[u'entries'] for s in stats[u'lookup']), [1, 3])
+        LookupEntry.set(store, u'e', u'c', u'k', b'value')
+        clock.advance(9)
+        self.assertIdentical(statistics.get(), stats)
+        clock.advance(1)
+        stats = statistics.get()
+        self.assertEqual(stats[u'computed'], 10)
+        self.assertEqual(len(stats[u'lookup']), 3)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_entries', {'environment': u'e', 'indexType': u'c'}),
+            1)
+
+
+    def test_removed(self):
+        """
+        The metrics of indexes that no longer have any entries are removed.
+        """
+        store = self._store()
+        clock = Clock()
+        statistics = IndexStatistics(store=store, maxAge=10, clock=clock)
+        statistics.get()
+        LookupEntry.deletePrefix(store, u'e', u'b', u'')
+        clock.advance(10)
+        statistics.get()
+        self.assertIdentical(
+            REGISTRY.get_sample_value(
+                'lookup_entries', {'environment': u'e', 'indexType': u'b'}),
+            None)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'lookup_entries', {'environment': u'e', 'indexType': u'a'}),
+            3)
@@ -0,0 +1,141 @@
+"""
+Tests for L{fusion_index.timing}.
+"""
+from axiom.store import Store
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.resource import Resource
+from twisted.web.test.requesthelper import DummyChannel
+
+from fusion_index.timing import (
+    TimingRequest, TimingSite, Timings, requestTimings, setRoute, stage,
+    timeStore, timedRoute)
+
+
+
+class _SlowResource(Resource):
+    isLeaf = True
+
+    def __init__(self, clock, store):
+        Resource.__init__(self)
+        self.clock = clock
+        self.store = store
+
+
+    def render_GET(self, request):
+        setRoute(u'slow')
+        self.clock.advance(1)
+        self.store.transact(self.store.querySQL, 'SELECT 1')
+        with stage(u'serialize'):
+            self.clock.advance(2)
+        return b'result'
+
+
+
+class TimingsTests(SynchronousTestCase):
+    """
+    Tests for L{Timings}.
+    """
+    def test_nested(self):
+        """
+        Time spent in a nested stage is only counted towards that stage.
+        """
+        clock = Clock()
+        timings = Timings(clock)
+        with timings.stage(u'render'):
+            clock.advance(1)
+            with timings.stage(u'transact'):
+                clock.advance(2)
+                with timings.stage(u'query'):
+                    clock.advance(3)
+            with timings.stage(u'query'):
+                clock.advance(4)
+        self.assertEqual(timings.stages, [u'render', u'transact', u'query'])
+        self.assertEqual(
+            [timings.duration(name) for name in timings.stages], [1, 2, 7])
+        self.assertEqual(
+            timings.serverTiming(),
+            b'render;dur=1000.000, transact;dur=2000.000, query;dur=7000.000')
+
+
+    def test_timedRoute(self):
+        """
+        Route handlers run while rendering are timed as routing.
+        """
+        clock = Clock()
+        request = TimingRequest(DummyChannel())
+        request.timings = timings = Timings(clock)
+
+        @timedRoute
+        def handler(request, params):
+            clock.advance(2)
+            return params
+
+        with requestTimings(request), stage(u'render'):
+            clock.advance(1)
+            self.assertEqual(handler(request, {}), {})
+        self.assertEqual(timings.stages, [u'render', u'route'])
+        self.assertEqual(
+            [timings.duration(name) for name in timings.stages], [1, 2])
+
+
+    def test_noRequest(self):
+        """
+        Stages outside of a request are not timed.
+        """
+        with stage(u'serialize'):
+            setRoute(u'lookup')
+
+
+
+class TimingSiteTests(SynchronousTestCase):
+    """
+    Tests for L{TimingSite}.
+    """
+    def _request(self, serverTiming):
+        """
+        Process a request to a slow resource.
+        """
+        clock = Clock()
+        store = Store()
+        timeStore(store)
+        channel = DummyChannel()
+        channel.site = TimingSite(
+            _SlowResource(clock, store), serverTiming=serverTiming,
+            clock=clock)
+        request = TimingRequest(channel)
+        request.gotLength(0)
+        clock.advance(0.5)
+        request.requestReceived(b'GET', b'/', b'HTTP/1.1')
+        return request, channel.transport.written.getvalue()
+
+
+    def test_stages(self):
+        """
+        Each stage of handling the request is timed.
+        """
+        request, _ = self._request(False)
+        timings = request.timings
+        self.assertEqual(timings.route, u'slow')
+        self.assertEqual(
+            timings.stages,
+            [u'queue', u'route', u'render', u'transact', u'query',
+             u'serialize', u'write'])
+        self.assertEqual(
+            [timings.duration(name) for name in timings.stages],
+            [0.5, 0, 1, 0, 0, 2, 0])
+
+
+    def test_serverTiming(self):
+        """
+        If enabled, the durations of the stages before the response is written
+        are sent in a C{Server-Timing} header.
+        """
+        _, written = self._request(False)
+        self.assertNotIn(b'Server-Timing', written)
+        _, written = self._request(True)
+        self.assertIn(
+            b'Server-Timing: queue;dur=500.000, route;dur=0.000, '
+            b'render;dur=1000.000, transact;dur=0.000, query;dur=0.000, '
+            b'serialize;dur=2000.000\r\n',
+            written)
@@ -0,0 +1,134 @@
+"""
+Tests for L{fusion_index.warmup}.
+"""
+import json
+
+from axiom.store import Store
+from eliot.testing import capture_logging
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from fusion_index.lookup import LookupEntry
+from fusion_index.search import SearchClasses, SearchEntry
+from fusion_index.warmup import (
+    HotKeys, ManifestService, WarmupService, loadManifest)
+
+
+
+class HotKeysTests(SynchronousTestCase):
+    """
+    Tests for L{HotKeys}.
+    """
+    def test_manifest(self):
+        """
+        The manifest lists the most frequent requests first.
+        """
+        hotKeys = HotKeys(size=2)
+        self.assertEqual(hotKeys.manifest(), [])
+        hotKeys.lookup(u'e', u't', u'a')
+        for _ in xrange(3):
+            hotKeys.search(SearchClasses.PREFIX, u'e', u'i', u'val', None)
+        hotKeys.lookup(u'e', u't', u'b')
+        hotKeys.lookup(u'e', u't', u'b')
+        self.assertEqual(
+            hotKeys.manifest(),
+            [[u'search', u'prefix', u'e', u'i', u'val', None],
+             [u'lookup', u'e', u't', u'b']])
+
+
+    def test_pruning(self):
+        """
+        Once twice as many requests as needed are being counted, only the most
+        frequent are kept.
+        """
+        hotKeys = HotKeys(size=2)
+        for key in [u'a', u'a', u'b', u'c', u'c', u'c', u'd', u'e']:
+            hotKeys.lookup(u'e', u't', key)
+        self.assertEqual(len(hotKeys._counts), 3)
+        self.assertEqual(
+            hotKeys.manifest(),
+            [[u'lookup', u'e', u't', u'c'], [u'lookup', u'e', u't', u'a']])
+
+
+
+class ManifestTests(SynchronousTestCase):
+    """
+    Tests for L{ManifestService} and L{loadManifest}.
+    """
+    def test_save(self):
+        """
+        The manifest is saved periodically and when the service stops.
+        """
+        path = FilePath(self.mktemp())
+        clock = Clock()
+        hotKeys = HotKeys()
+        service = ManifestService(
+            hotKeys=hotKeys, path=path, interval=10, clock=clock)
+        service.startService()
+        clock.advance(10)
+        self.assertFalse(path.exists())
+        hotKeys.lookup(u'e', u't', u'a')
+        clock.advance(10)
+        self.assertEqual(loadManifest(path), [[u'lookup', u'e', u't', u'a']])
+        hotKeys.lookup(u'e', u't', u'b')
+        service.stopService()
+        self.assertEqual(len(loadManifest(path)), 2)
+
+
+    @capture_logging(None)
+    def test_loadInvalid(self, logger):
+        """
+        A missing or invalid manifest is treated as empty.
+        """
+        path = FilePath(self.mktemp())
+        self.assertEqual(loadManifest(path), [])
+        for content in [b'{', b'{}']:
+            path.setContent(content)
+            self.assertEqual(loadManifest(path), [])
+        self.assertEqual(len(logger.flush_tracebacks(ValueError)), 2)
+
+
+
+class WarmupServiceTests(SynchronousTestCase):
+    """
+    Tests for L{WarmupService}.
+    """
+    def test_empty(self):
+        """
+        With an empty manifest, the service is ready at once.
+        """
+        service = WarmupService(store=Store(), manifest=[], clock=Clock())
+        service.startService()
+        self.assertTrue(service.ready)
+
+
+    @capture_logging(None)
+    def test_replay(self, logger):
+        """
+        The requests in the manifest are replayed a batch at a time; missing
+        keys are ignored, and other errors are logged.
+        """
+        store = Store()
+        LookupEntry.set(store, u'e', u't', u'a', b'value')
+        SearchEntry.insert(
+            store, SearchClasses.PREFIX, u'e', u'i', u'r', u'type', u'value')
+        manifest = json.loads(json.dumps(
+            [[u'lookup', u'e', u't', u'a'],
+             [u'lookup', u'e', u't', u'missing'],
+             [u'search', u'prefix', u'e', u'i', u'val', None],
+             [u'search', u'invalid', u'e', u'i', u'val', None],
+             [u'unknown']]))
+        clock = Clock()
+        service = WarmupService(
+            store=store, manifest=manifest, batchSize=2, interval=1,
+            clock=clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEqual((service.ready, service.warmed), (False, 2))
+        clock.advance(1)
+        self.assertEqual((service.ready, service.warmed), (False, 4))
+        clock.advance(1)
+        self.assertEqual((service.ready, service.warmed), (True, 5))
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(len(logger.flush_tracebacks(ValueError)), 1)
@@ -79,9 +79,10 @@ class MemoryRequest(object):
         self._client = client
         self.prepath = []
         location = http.urlparse(self.uri)
-        self.postpath = location.path[1:].split(b'/')
+        self.postpath = map(http.unquote, location.path[1:].split(b'/'))
         self._finishDeferreds = []
         self.written = []
+        self.producer = None
         self.finished = 0
         self.args = parse_qs(location.query, True)
         self.content = content
@@ -131,6 +132,17 @@ class MemoryRequest(object):
         self.written.append(data)
 
 
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if not streaming:
+            while self.producer is not None:
+                producer.resumeProducing()
+
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
     def render(self, resource):
         """
         Render the given resource as a response to this request.
@@ -0,0 +1,331 @@
+"""
+Per-stage timing of request handling.
+
+Each request handled by a L{TimingSite} is timed in stages: waiting for the
+request to be received and processed (C{queue}), locating the resource
+(C{route}, including the handlers of nested routes, which txspinneret only
+runs while the enclosing resource is rendered), rendering (C{render}), running
+transactions (C{transact}) and the SQL statements within them (C{query}), JSON
+encoding (C{serialize}), logging (C{log}), and writing the response
+(C{write}). Stages nest, and the time spent
+in a nested stage is only counted towards that stage, so the stages add up to
+the total time taken by the request.
+
+The durations are published as histograms per route and stage, and
+optionally sent to the client in a C{Server-Timing} header. The index a
+request is for, if any, is recorded alongside the route, so that other
+per-request measurements can be attributed to it.
+"""
+from contextlib import contextmanager
+from functools import wraps
+
+from twisted.internet import reactor
+from twisted.web.server import Request, Site
+
+from fusion_index.metrics import METRIC_REQUEST_STAGE_LATENCY
+
+
+
+_current = [None]
+
+
+
+class Timings(object):
+    """
+    The durations of the stages of handling a request.
+
+    @ivar route: The route template of the request, if known.
+
+    @ivar index: The C{(environment, indexType)} of the index the request is
+        for, or C{None}.
+
+    @ivar stages: The names of the stages, in the order they were first
+        entered.
+    """
+    route = u'other'
+    index = None
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._stack = []
+        self.stages = []
+        self._durations = {}
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the request.
+
+        @type name: L{unicode}
+        @param name: The stage name.
+        """
+        self.add(name, 0.0)
+        frame = [name, self._clock.seconds(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = self._clock.seconds() - frame[1]
+            self.add(name, elapsed - frame[2])
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+
+    def add(self, name, duration):
+        """
+        Add time to a stage.
+        """
+        if name not in self._durations:
+            self.stages.append(name)
+            self._durations[name] = 0.0
+        self._durations[name] += duration
+
+
+    def duration(self, name):
+        """
+        The time spent in a stage so far, in seconds, including the time spent
+        in it by stages that have not finished yet.
+        """
+        duration = self._durations.get(name, 0.0)
+        now = self._clock.seconds()
+        inner = 0.0
+        for frameName, start, nested in reversed(self._stack):
+            elapsed = now - start
+            if frameName == name:
+                duration += elapsed - nested - inner
+            inner = elapsed
+        return duration
+
+
+    def serverTiming(self):
+        """
+        Format the stages so far as a C{Server-Timing} header value.
+
+        @rtype: L{bytes}
+        """
+        return b', '.join(
+            b'{};dur={:.3f}'.format(
+                name.encode('ascii'), self.duration(name) * 1000)
+            for name in self.stages)
+
+
+    def observe(self):
+        """
+        Publish the stage durations.
+        """
+        for name in self.stages:
+            METRIC_REQUEST_STAGE_LATENCY.labels(self.route, name).observe(
+                self._durations[name])
+
+
+
+def stage(name):
+    """
+    Time a stage of the request currently being processed, if any.
+
+    @type name: L{unicode}
+    @param name: The stage name.
+    """
+    timings = _current[0]
+    if timings is None:
+        return _noStage()
+    return timings.stage(name)
+
+
+
+@contextmanager
+def _noStage():
+    yield
+
+
+
+class timedContext(object):
+    """
+    Time entering and exiting a context manager as a stage of the request
+    currently being processed, if any.
+
+    @type name: L{unicode}
+    @param name: The stage name.
+
+    @param context: The context manager.
+    """
+    def __init__(self, name, context):
+        self._name = name
+        self._context = context
+
+
+    def __enter__(self):
+        with stage(self._name):
+            return self._context.__enter__()
+
+
+    def __exit__(self, *excInfo):
+        with stage(self._name):
+            return self._context.__exit__(*excInfo)
+
+
+
+def timedRoute(handler):
+    """
+    Time a route handler as part of the C{route} stage of the request
+    currently being processed, if any.
+
+    txspinneret resolves the routes of nested routers while rendering, so
+    without this the time spent in their handlers is counted as rendering.
+    """
+    @wraps(handler)
+    def _handler(*a, **kw):
+        with stage(u'route'):
+            return handler(*a, **kw)
+    return _handler
+
+
+
+@contextmanager
+def requestTimings(request):
+    """
+    Time the stages of handling a request within the context, if it is a
+    L{TimingRequest}.
+    """
+    previous, _current[0] = _current[0], getattr(request, 'timings', None)
+    try:
+        yield
+    finally:
+        _current[0] = previous
+
+
+
+def setRoute(route):
+    """
+    Record the route template of the request currently being processed, if
+    any.
+
+    @type route: L{unicode}
+    """
+    timings = _current[0]
+    if timings is not None:
+        timings.route = route
+
+
+
+def setIndex(environment, indexType):
+    """
+    Record the index the request currently being processed is for, if any.
+
+    @type environment: L{unicode}
+
+    @type indexType: L{unicode}
+    """
+    timings = _current[0]
+    if timings is not None:
+        timings.index = environment, indexType
+
+
+
+def currentIndex():
+    """
+    Get the index the request currently being processed is for.
+
+    @rtype: L{tuple} of two L{unicode}s
+    @return: The environment and index type, or empty strings if there is no
+        request being processed, or it is not for a particular index.
+    """
+    timings = _current[0]
+    if timings is None or timings.index is None:
+        return u'', u''
+    return timings.index
+
+
+
+def timed(name, f):
+    """
+    Wrap a callable so that calls to it are timed as a stage.
+    """
+    def _timed(*a, **kw):
+        with stage(name):
+            return f(*a, **kw)
+    return _timed
+
+
+
+def timeStore(store):
+    """
+    Time the transactions and SQL statements run against a store.
+
+    @type store: L{axiom.store.Store}
+    """
+    store.transact = timed(u'transact', store.transact)
+    store._queryandfetch = timed(u'query', store._queryandfetch)
+
+
+
+class TimingRequest(Request):
+    """
+    A request that times the stages of its handling.
+
+    @ivar received: When the request started being received, in seconds
+        since the epoch.
+
+    @ivar timings: The L{Timings} of the request.
+    """
+    def __init__(self, channel, *a, **kw):
+        Request.__init__(self, channel, *a, **kw)
+        self._clock = getattr(channel.site, 'clock', reactor)
+        self.received = self._clock.seconds()
+        self._serverTiming = getattr(channel.site, 'serverTiming', False)
+        self.timings = Timings(self._clock)
+
+
+    def process(self):
+        self.timings.add(u'queue', self._clock.seconds() - self.received)
+        with requestTimings(self):
+            Request.process(self)
+
+
+    def render(self, resrc):
+        with self.timings.stage(u'render'):
+            Request.render(self, resrc)
+
+
+    def write(self, data):
+        if not self.startedWriting and self._serverTiming:
+            self.setHeader(b'Server-Timing', self.timings.serverTiming())
+        with self.timings.stage(u'write'):
+            Request.write(self, data)
+
+
+    def finish(self):
+        with self.timings.stage(u'write'):
+            Request.finish(self)
+        self.timings.observe()
+
+
+
+class TimingSite(Site):
+    """
+    A site that times the stages of handling each request.
+
+    @ivar serverTiming: Whether to send the stage durations to the client in a
+        C{Server-Timing} header. The durations are those when the response
+        starts being written, so the C{write} stage is not included.
+    """
+    requestFactory = TimingRequest
+
+    def __init__(self, resource, serverTiming=False, clock=reactor, *a, **kw):
+        Site.__init__(self, resource, *a, **kw)
+        self.serverTiming = serverTiming
+        self.clock = clock
+
+
+    def getResourceFor(self, request):
+        with stage(u'route'):
+            return Site.getResourceFor(self, request)
+
+
+
+__all__ = [
+    'TimingSite', 'TimingRequest', 'Timings', 'requestTimings', 'stage',
+    'timedContext', 'timedRoute', 'setRoute', 'setIndex', 'currentIndex',
+    'timeStore']
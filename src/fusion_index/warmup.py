@@ -0,0 +1,224 @@
+"""
+Warming up caches after a restart.
+
+While the service runs, the most frequently requested lookup keys and searches
+are tracked by L{HotKeys}, and periodically saved to a manifest by
+L{ManifestService}. When the service starts again, L{WarmupService} replays
+the requests in the manifest, a batch at a time, to bring the hottest parts of
+the database back into the page cache.
+"""
+import json
+
+from characteristic import Attribute, attributes
+from eliot import write_traceback
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from fusion_index.lookup import LookupEntry
+from fusion_index.metrics import METRIC_WARMUP_PROGRESS
+from fusion_index.search import SearchClasses, SearchEntry
+
+
+
+@attributes([Attribute('size', default_value=1000)])
+class HotKeys(object):
+    """
+    Track approximately the C{size} most frequently requested lookup keys and
+    searches.
+
+    Up to twice as many requests as needed are counted; once that many are
+    being counted, only the most frequent half are kept.
+    """
+    _counts = None
+
+    def _record(self, request):
+        if self._counts is None:
+            self._counts = {}
+        count = self._counts.get(request)
+        if count is not None:
+            self._counts[request] = count + 1
+            return
+        if len(self._counts) >= self.size * 2:
+            self._counts = dict(self._top())
+        self._counts[request] = 1
+
+
+    def _top(self):
+        """
+        The most frequent requests, with their counts, most frequent first.
+        """
+        return sorted(
+            (self._counts or {}).items(), key=lambda item: -item[1]
+            )[:self.size]
+
+
+    def lookup(self, environment, indexType, key):
+        """
+        Record a lookup request.
+        """
+        self._record((u'lookup', environment, indexType, key))
+
+
+    def search(self, searchClass, environment, indexType, searchValue,
+               searchType):
+        """
+        Record a search request.
+        """
+        self._record(
+            (u'search', searchClass.value, environment, indexType,
+             searchValue, searchType))
+
+
+    def manifest(self):
+        """
+        Get the manifest of the most frequent requests.
+
+        @rtype: L{list} of L{list}s
+        @return: The requests, most frequent first.
+        """
+        return [list(request) for request, _ in self._top()]
+
+
+
+@attributes(
+    ['hotKeys',
+     'path',
+     Attribute('interval', default_value=300.0),
+     Attribute('clock', default_value=reactor)])
+class ManifestService(Service):
+    """
+    Save the manifest of the most frequent requests to C{path} every
+    C{interval} seconds, and when stopped.
+    """
+    _call = None
+
+    def startService(self):
+        Service.startService(self)
+        self._call = LoopingCall(self.save)
+        self._call.clock = self.clock
+        self._call.start(self.interval, now=False)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.running:
+            self._call.stop()
+        self._call = None
+        self.save()
+
+
+    def save(self):
+        """
+        Save the manifest.
+        """
+        manifest = self.hotKeys.manifest()
+        if manifest:
+            self.path.setContent(json.dumps(manifest))
+
+
+
+def loadManifest(path):
+    """
+    Load a manifest saved by L{ManifestService}.
+
+    @type path: L{twisted.python.filepath.FilePath}
+
+    @rtype: L{list} of L{list}s
+    @return: The requests in the manifest; if there is no valid manifest,
+        none.
+    """
+    if not path.exists():
+        return []
+    try:
+        manifest = json.loads(path.getContent())
+        if not isinstance(manifest, list):
+            raise ValueError('Manifest is not a list')
+        return manifest
+    except ValueError:
+        write_traceback()
+        return []
+
+
+
+@attributes(
+    ['store',
+     'manifest',
+     Attribute('batchSize', default_value=50),
+     Attribute('interval', default_value=0.0),
+     Attribute('clock', default_value=reactor)])
+class WarmupService(Service):
+    """
+    Replay the requests in a manifest, C{batchSize} requests every
+    C{interval} seconds, to warm up the database page cache.
+
+    @ivar warmed: The number of requests replayed so far.
+    """
+    warmed = 0
+    _call = None
+
+    @property
+    def ready(self):
+        """
+        Whether every request has been replayed.
+        """
+        return self.warmed >= len(self.manifest)
+
+
+    def startService(self):
+        Service.startService(self)
+        self._progress()
+        if self.ready:
+            return
+        self._call = LoopingCall(self._tick)
+        self._call.clock = self.clock
+        self._call.start(self.interval, now=True)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._call is not None and self._call.running:
+            self._call.stop()
+        self._call = None
+
+
+    def _tick(self):
+        """
+        Replay the next batch of requests.
+        """
+        batch = self.manifest[self.warmed:self.warmed + self.batchSize]
+        self.store.transact(lambda: [self._replay(r) for r in batch])
+        self.warmed += len(batch)
+        self._progress()
+        if self.ready:
+            self._call.stop()
+
+
+    def _progress(self):
+        METRIC_WARMUP_PROGRESS.set(
+            float(self.warmed) / len(self.manifest) if self.manifest else 1.0)
+
+
+    def _replay(self, request):
+        """
+        Replay a single request, ignoring any errors.
+        """
+        try:
+            if request[0] == u'lookup':
+                _, environment, indexType, key = request
+                LookupEntry.getContent(self.store, environment, indexType, key)
+            elif request[0] == u'search':
+                (_, searchClass, environment, indexType, searchValue,
+                 searchType) = request
+                SearchEntry.search(
+                    self.store, SearchClasses.lookupByValue(searchClass),
+                    environment, indexType, searchValue, searchType)
+        except KeyError:
+            pass
+        except Exception:
+            write_traceback()
+
+
+
+__all__ = [
+    'HotKeys', 'ManifestService', 'WarmupService', 'loadManifest']